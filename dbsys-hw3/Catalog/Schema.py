@@ -1,4 +1,4 @@
-import json, re
+import json, re, struct
 from collections import namedtuple, OrderedDict
 from struct import Struct
 
@@ -24,6 +24,70 @@ class Types:
       'text'    : ('s', True, chr(0), lambda x: x)
     }
 
+  # Order-preserving binary key encodings, whose packed representations
+  # compare bytewise (i.e., with memcmp) in the same order as their values.
+  # These are used for index keys, and define for each type a big-endian
+  # struct pack letter, and conversions to and from the encoded value.
+  # Signed integers are offset to flip their sign bit, while floating point
+  # values flip their sign bit if positive, and all bits if negative.
+  keyTypes = {
+      # name, pack_letter, encode, decode
+      'byte'    : ('B', lambda x: x, lambda x: x),
+      'short'   : ('H', lambda x: x + (1 << 15), lambda x: x - (1 << 15)),
+      'int'     : ('I', lambda x: x + (1 << 31), lambda x: x - (1 << 31)),
+      'float'   : ('I', lambda x: Types.encodeFloatKey(x, 'f', 'I'), lambda x: Types.decodeFloatKey(x, 'f', 'I')),
+      'double'  : ('Q', lambda x: Types.encodeFloatKey(x, 'd', 'Q'), lambda x: Types.decodeFloatKey(x, 'd', 'Q')),
+      'char'    : ('s', lambda x: x, lambda x: x),
+      'text'    : ('s', lambda x: x, lambda x: x)
+    }
+
+  @classmethod
+  def encodeFloatKey(cls, value, floatFormat, intFormat):
+    bits    = struct.unpack('>' + intFormat, struct.pack('>' + floatFormat, value))[0]
+    signBit = 1 << (8 * struct.calcsize(intFormat) - 1)
+    return bits ^ (2 * signBit - 1) if bits & signBit else bits | signBit
+
+  @classmethod
+  def decodeFloatKey(cls, bits, floatFormat, intFormat):
+    signBit = 1 << (8 * struct.calcsize(intFormat) - 1)
+    bits    = bits & ~signBit if bits & signBit else bits ^ (2 * signBit - 1)
+    return struct.unpack('>' + floatFormat, struct.pack('>' + intFormat, bits))[0]
+
+  @classmethod
+  def formatKeyType(cls, typeDesc):
+    """
+    Converts a type description string into a big-endian C-struct format
+    for its order-preserving key encoding.
+
+    >>> Types.formatKeyType('int')
+    'I'
+
+    >>> Types.formatKeyType('char(100)')
+    '100s'
+
+    Order-preserving key encodings compare bytewise in value order.
+
+    >>> keyFormat = Struct('>' + Types.formatKeyType('int'))
+    >>> encode = Types.keyTypes['int'][1]
+    >>> values = [-100, -1, 0, 1, 256, 70000]
+    >>> sorted(values, key=lambda x: keyFormat.pack(encode(x))) == values
+    True
+
+    >>> keyFormat = Struct('>' + Types.formatKeyType('double'))
+    >>> (encode, decode) = Types.keyTypes['double'][1:]
+    >>> values = [-1e10, -2.5, -0.5, 0.0, 0.25, 3.0, 1e10]
+    >>> sorted(values, key=lambda x: keyFormat.pack(encode(x))) == values
+    True
+    >>> [decode(encode(x)) for x in values] == values
+    True
+    """
+    format = Types.formatType(typeDesc)
+    if format:
+      typeStr = Types.parseType(typeDesc)["typeStr"]
+      letter  = Types.keyTypes[typeStr][0]
+      format  = format[:-1] + letter
+    return format
+
   @classmethod
   def parseType(cls, typeDesc):
     typeMatcher = re.compile("(?P<typeStr>\w+)(\((?P<size>\d+)\))?(?P<rest>.*)")
@@ -197,8 +261,38 @@ class DBSchema:
   >>> projectedSchema.unpack(schema.projectBinary(schema.pack(e1), projectedSchema))
   employeeId(id=1)
 
+  Index keys use an order-preserving binary representation.
+  >>> schema.packKey(e1)
+  b'\\x80\\x00\\x00\\x011990-01-01\\x80\\x01\\x86\\xa0'
+  >>> schema.unpackKey(schema.packKey(e1)) == e1
+  True
+  >>> projectedSchema.unpackKey(schema.projectKey(schema.pack(e1), projectedSchema))
+  employeeId(id=1)
+
   >>> schema.match(DBSchema('employee2', [('id', 'int'), ('dob', 'char(10)'), ('salary', 'int')]))
   True
+
+  # Test direct concatenation of packed tuples, with and without alignment padding.
+  >>> schema.fieldOffsets()
+  [0, 4, 16]
+  >>> lhsSchema = DBSchema('lhs', [('a', 'int'), ('b', 'char(3)')])
+  >>> rhsSchema = DBSchema('rhs', [('c', 'int'), ('d', 'byte')])
+  >>> joinSchema = DBSchema('lhsrhs', lhsSchema.schema() + rhsSchema.schema())
+  >>> concat = joinSchema.binaryConcatenator([lhsSchema, rhsSchema])
+  >>> lhsTuple = lhsSchema.pack(lhsSchema.instantiate(1, 'abc'))
+  >>> rhsTuple = rhsSchema.pack(rhsSchema.instantiate(2, 3))
+  >>> joinSchema.unpack(concat(lhsTuple, rhsTuple))
+  lhsrhs(a=1, b='abc', c=2, d=3)
+  >>> concat(lhsTuple, rhsTuple) == joinSchema.pack(joinSchema.instantiate(1, 'abc', 2, 3))
+  True
+
+  >>> concat = DBSchema('rhslhs', rhsSchema.schema() + lhsSchema.schema()).binaryConcatenator([rhsSchema, lhsSchema])
+  >>> concat(rhsTuple, lhsTuple)
+  b'\\x02\\x00\\x00\\x00\\x03\\x00\\x00\\x00\\x01\\x00\\x00\\x00abc'
+
+  >>> concat = DBSchema('lhslhs', lhsSchema.schema() + projectedSchema.schema()).binaryConcatenator([lhsSchema, projectedSchema])
+  >>> concat(lhsTuple, b'\\x07\\x00\\x00\\x00')
+  b'\\x01\\x00\\x00\\x00abc\\x00\\x07\\x00\\x00\\x00'
   """
 
   def __init__(self, name, fieldsAndTypes):
@@ -209,6 +303,12 @@ class DBSchema:
       self.clazz   = namedtuple(self.name, self.fields)
       self.binrepr = Struct(''.join([Types.formatType(x) for x in self.types]))
       self.size    = self.binrepr.size
+
+      # Order-preserving key representation, see Types.keyTypes.
+      keyTypes     = [Types.keyTypes[Types.parseType(x)["typeStr"]] for x in self.types]
+      self.keyrepr = Struct('>' + ''.join([Types.formatKeyType(x) for x in self.types]))
+      self.keyEncoders = [x[1] for x in keyTypes]
+      self.keyDecoders = [x[2] for x in keyTypes]
     else:
       raise ValueError("Invalid attributes when constructing a schema")
 
@@ -264,11 +364,78 @@ class DBSchema:
         raise ValueError("Invalid field in projection: "+f)
     return schema.instantiate(*fields)
 
+  # Returns the byte offset of each field in the packed representation,
+  # accounting for the struct module's native alignment padding.
+  def fieldOffsets(self):
+    formats = [Types.formatType(t) for t in self.types]
+    return [struct.calcsize(''.join(formats[:i+1])) - struct.calcsize(formats[i]) \
+              for i in range(len(formats))]
+
+  # Returns a function that builds a packed instance of this schema directly
+  # from packed instances of the given schemas, whose fields must appear in this
+  # schema in order (e.g., a join's output schema for its input schemas).
+  #
+  # This precomputes a splice plan of byte ranges to copy from each input, and
+  # any alignment padding to insert between ranges. When no padding differs from
+  # the inputs' layout, the function simply concatenates its inputs.
+  def binaryConcatenator(self, schemas):
+    if [f for s in schemas for f in s.schema()] != self.schema():
+      raise ValueError("Invalid binary concatenation, mismatched schemas")
+
+    dstOffsets = iter(self.fieldOffsets())
+    segments   = []
+    dstEnd     = 0
+
+    for (schemaIdx, schema) in enumerate(schemas):
+      for (srcOffset, fieldType) in zip(schema.fieldOffsets(), schema.types):
+        fieldSize = struct.calcsize(Types.formatType(fieldType))
+        padding   = next(dstOffsets) - dstEnd
+
+        # Extend the last segment for contiguous fields in both input and output.
+        if segments and padding == 0 and segments[-1][0] == schemaIdx and segments[-1][2] == srcOffset:
+          segments[-1][2] += fieldSize
+        else:
+          segments.append([schemaIdx, srcOffset, srcOffset + fieldSize, b'\x00' * padding])
+
+        dstEnd += padding + fieldSize
+
+    if len(segments) == len(schemas) \
+        and all(seg[1] == 0 and seg[2] == schemas[seg[0]].size and not seg[3] for seg in segments):
+      return lambda *buffers: b''.join(buffers)
+
+    def concatenate(*buffers):
+      pieces = []
+      for (schemaIdx, start, end, padding) in segments:
+        if padding:
+          pieces.append(padding)
+        pieces.append(buffers[schemaIdx][start:end])
+      return b''.join(pieces)
+
+    return concatenate
+
   # Project a packed tuple to a binary representation of the given schema.
   # TODO: make this more efficient by direct field access and copying.
   def projectBinary(self, binaryInstance, schema):
     return schema.pack(self.project(self.unpack(binaryInstance), schema))
 
+  # Project a packed tuple to an order-preserving key representation of the given schema.
+  # Index keys use this representation, so that index order matches value order.
+  def projectKey(self, binaryInstance, schema):
+    return schema.packKey(self.project(self.unpack(binaryInstance), schema))
+
+  # Return an order-preserving binary key representation of the instance
+  def packKey(self, instance):
+    if self.keyrepr:
+      values = [self.keyEncoders[i](Types.formatValue(instance[i], self.types[i]))
+                  for i in range(len(instance))]
+      return self.keyrepr.pack(*values)
+
+  def unpackKey(self, buffer):
+    if self.clazz and self.keyrepr:
+      values = [Types.formatValue(self.keyDecoders[i](v), self.types[i], False)
+                  for i, v in enumerate(self.keyrepr.unpack(buffer))]
+      return self.clazz._make(values)
+
   # Return a binary representation of the instance
   def pack(self, instance):
     if self.binrepr:
@@ -0,0 +1,586 @@
+import bisect, collections, json, math, os.path, random
+
+class ColumnStatistics:
+  """
+  Statistics on the values of a single column of a relation.
+
+  Column statistics hold the number of values, the number of distinct values (NDV),
+  the minimum and maximum values, a list of the most common values (MCVs) with their
+  frequencies, and an equi-depth histogram over all other values. Each histogram
+  bucket holds the same number of values, and is given by its lower and upper bound,
+  such that the histogram is a sorted list of numBuckets+1 bounds.
+
+  Our storage engine does not support nulls, thus all counts are null-free.
+
+  >>> stats = ColumnStatistics.build([i % 10 for i in range(90)] + [3] * 10 + list(range(100, 200)))
+  >>> (stats.numValues, stats.numDistinct, stats.minValue, stats.maxValue)
+  (200, 110, 0, 199)
+  >>> stats.mostCommon[0]
+  (3, 19)
+
+  >>> (stats.equalitySelectivity(3), stats.equalitySelectivity(150), stats.equalitySelectivity(500))
+  (0.095, 0.005, 0.0)
+  >>> round(stats.rangeSelectivity(100, 150), 2), round(stats.rangeSelectivity(None, 5), 2)
+  (0.25, 0.32)
+
+  >>> ColumnStatistics.unpack(json.loads(json.dumps(stats.pack()))) == stats
+  True
+  """
+
+  # The default number of histogram buckets and most common values per column.
+  numBuckets    = 20
+  numMostCommon = 10
+
+  def __init__(self, **kwargs):
+    self.numValues   = kwargs.get("numValues", 0)
+    self.numDistinct = kwargs.get("numDistinct", 0)
+    self.minValue    = kwargs.get("minValue", None)
+    self.maxValue    = kwargs.get("maxValue", None)
+    self.mostCommon  = [tuple(x) for x in kwargs.get("mostCommon", [])]   # list of (value, count), by decreasing count
+    self.histogram   = list(kwargs.get("histogram", []))                  # sorted bucket bounds
+
+  def __eq__(self, other):
+    return isinstance(other, ColumnStatistics) and self.pack() == other.pack()
+
+  # Builds column statistics from a list of values. When the values are a sample of
+  # a larger relation of 'numTuples' values, counts are scaled to the relation size,
+  # and the NDV is extrapolated with the Duj1 estimator of Haas et al.
+  @classmethod
+  def build(cls, values, numTuples=None, numBuckets=None, numMostCommon=None):
+    numBuckets    = numBuckets or ColumnStatistics.numBuckets
+    numMostCommon = numMostCommon or ColumnStatistics.numMostCommon
+    if not values:
+      return cls()
+
+    n         = len(values)
+    numTuples = max(numTuples or n, n)
+    scale     = numTuples / n
+    counts    = collections.Counter(values)
+
+    # Most common values are those occurring more than once, and more often than average.
+    average    = n / len(counts)
+    mostCommon = [(v, c) for (v, c) in counts.most_common(numMostCommon) if c > 1 and c > average]
+    mcvSet     = set(v for (v, _) in mostCommon)
+
+    rest      = sorted(v for v in values if v not in mcvSet)
+    histogram = []
+    if rest:
+      step      = (len(rest) - 1) / min(numBuckets, len(rest))
+      histogram = [rest[round(i * step)] for i in range(min(numBuckets, len(rest)) + 1)]
+
+    if numTuples > n:
+      singletons  = sum(1 for c in counts.values() if c == 1)
+      numDistinct = n * len(counts) / (n - singletons + singletons * n / numTuples)
+    else:
+      numDistinct = len(counts)
+
+    return cls(numValues=numTuples, numDistinct=max(1, min(numTuples, round(numDistinct))),
+               minValue=min(counts), maxValue=max(counts), histogram=histogram,
+               mostCommon=[(v, round(c * scale)) for (v, c) in mostCommon])
+
+
+  # Selectivity estimation.
+
+  # Returns the fraction of values that are not most common values.
+  def histogramFraction(self):
+    mcvCount = sum(c for (_, c) in self.mostCommon)
+    return max(0.0, 1.0 - mcvCount / self.numValues) if self.numValues else 0.0
+
+  # Returns the estimated fraction of values equal to the given value.
+  def equalitySelectivity(self, value):
+    if not self.numValues:
+      return 0.0
+
+    for (v, c) in self.mostCommon:
+      if v == value:
+        return c / self.numValues
+
+    try:
+      if value < self.minValue or value > self.maxValue:
+        return 0.0
+    except TypeError:
+      pass
+
+    return self.histogramFraction() / max(1, self.numDistinct - len(self.mostCommon))
+
+  # Returns the estimated fraction of values in the given range, where either bound
+  # may be None for open-ended ranges. Histogram buckets partially overlapping the
+  # range are interpolated linearly for numeric values, and count as half a bucket otherwise.
+  def rangeSelectivity(self, low=None, high=None, lowInclusive=True, highInclusive=True):
+    if not self.numValues:
+      return 0.0
+
+    def inRange(v):
+      return (low is None or v > low or (lowInclusive and v == low)) \
+               and (high is None or v < high or (highInclusive and v == high))
+
+    try:
+      mcvCount = sum(c for (v, c) in self.mostCommon if inRange(v))
+      return min(1.0, mcvCount / self.numValues + self.histogramFraction() * self.bucketFraction(low, high))
+    except TypeError:
+      return 1.0 / 3
+
+  # Returns the fraction of histogram values between the given bounds.
+  def bucketFraction(self, low, high):
+    bounds     = self.histogram
+    numBuckets = len(bounds) - 1
+    if numBuckets < 1:
+      return 1.0 if bounds and (low is None or bounds[0] >= low) and (high is None or bounds[0] <= high) else 0.0
+
+    def position(value):
+      if value is None:
+        return None
+      i = bisect.bisect_left(bounds, value)
+      if i == 0:
+        return 0.0
+      if i > numBuckets:
+        return float(numBuckets)
+      (lo, hi) = (bounds[i-1], bounds[i])
+      if isinstance(value, (int, float)) and hi != lo:
+        return i - 1 + (value - lo) / (hi - lo)
+      return i - 0.5
+
+    start = position(low)
+    end   = position(high)
+    start = 0.0 if start is None else start
+    end   = float(numBuckets) if end is None else end
+    return max(0.0, end - start) / numBuckets
+
+  # Returns the estimated selectivity of an equality between this column and another.
+  def joinSelectivity(self, other):
+    return 1.0 / max(1, self.numDistinct, other.numDistinct)
+
+
+  # Column statistics serialization, as a JSON-compatible dictionary.
+  def pack(self):
+    return { "numValues": self.numValues, "numDistinct": self.numDistinct,
+             "minValue": self.minValue, "maxValue": self.maxValue,
+             "mostCommon": [list(x) for x in self.mostCommon], "histogram": list(self.histogram) }
+
+  @classmethod
+  def unpack(cls, packed):
+    return cls(**packed)
+
+
+class RelationStatistics:
+  """
+  Statistics on a relation, with its row and page counts at the time of analysis,
+  and statistics on each analyzed column.
+
+  The relation tracks the number of tuples modified since its analysis. Its
+  statistics are considered stale once this exceeds a fraction of its row count.
+  """
+
+  # The fraction of modified tuples after which statistics are stale.
+  staleFraction = 0.1
+
+  def __init__(self, **kwargs):
+    self.numTuples     = kwargs.get("numTuples", 0)
+    self.numPages      = kwargs.get("numPages", 0)
+    self.columns       = kwargs.get("columns", {})   # field name -> ColumnStatistics
+    self.modifications = kwargs.get("modifications", 0)
+
+  def column(self, field):
+    return self.columns.get(field, None)
+
+  def isStale(self):
+    return self.modifications > RelationStatistics.staleFraction * max(1, self.numTuples)
+
+  def pack(self):
+    return { "numTuples": self.numTuples, "numPages": self.numPages, "modifications": self.modifications,
+             "columns": { f: c.pack() for (f, c) in self.columns.items() } }
+
+  @classmethod
+  def unpack(cls, packed):
+    columns = { f: ColumnStatistics.unpack(c) for (f, c) in packed["columns"].items() }
+    return cls(numTuples=packed["numTuples"], numPages=packed["numPages"], \
+               modifications=packed["modifications"], columns=columns)
+
+
+class RelationSynopsis:
+  """
+  A sample synopsis of a relation, i.e., a uniform random sample of its tuples stored
+  as a separate relation (see Statistics.synopsisRelation), used to estimate query
+  plans by sampling without accessing base relations.
+
+  The synopsis records the number of sampled tuples, and the relation's row count
+  when sampled. Like relation statistics, it tracks the number of tuples modified
+  since sampling, and is stale once these or the relation's size change by a fraction
+  of its row count.
+  """
+
+  def __init__(self, **kwargs):
+    self.numTuples      = kwargs.get("numTuples", 0)
+    self.relationTuples = kwargs.get("relationTuples", 0)
+    self.modifications  = kwargs.get("modifications", 0)
+
+  def isStale(self, relationTuples):
+    changes = max(self.modifications, abs(relationTuples - self.relationTuples))
+    return changes > RelationStatistics.staleFraction * max(1, self.relationTuples)
+
+  def pack(self):
+    return { "numTuples": self.numTuples, "relationTuples": self.relationTuples, "modifications": self.modifications }
+
+  @classmethod
+  def unpack(cls, packed):
+    return cls(**packed)
+
+
+class Statistics:
+  """
+  A statistics catalog, maintaining relation and column statistics for the optimizer.
+
+  Statistics are built by analyzing relations (see Database.analyze), which scans
+  a relation's pages and builds statistics over a uniform reservoir sample of at
+  most sampleSize tuples. Statistics can be refreshed incrementally, for specific
+  relations and columns, or for all relations whose statistics are stale due to
+  modifications since their last analysis.
+
+  The catalog also maintains a sample synopsis per relation, rebuilt when analyzing
+  the relation, or on demand for plans over unanalyzed relations. The optimizer
+  estimates these plans by sampling synopses rather than base relations.
+
+  The catalog is checkpointed to its own file in the data directory, alongside
+  the database catalog.
+
+  >>> import Database, shutil
+  >>> db = Database.Database(dataDir='stats-test')
+  >>> db.createRelation('employee', [('id', 'int'), ('dept', 'char(4)'), ('age', 'int')])
+  >>> schema = db.relationSchema('employee')
+  >>> _ = db.insertTuples('employee', [schema.pack(schema.instantiate(i, 'd' + str(i % 5), 20 + i % 40)) for i in range(1000)])
+
+  >>> db.analyze('employee')
+  >>> stats = db.statistics.relation('employee')
+  >>> (stats.numTuples, stats.column('id').numDistinct, stats.column('dept').numDistinct, stats.column('age').maxValue)
+  (1000, 1000, 5, 59)
+
+  # Statistics become stale after modifying over 10% of a relation, and are refreshed by analyze.
+  >>> _ = db.insertTuples('employee', [schema.pack(schema.instantiate(i, 'd9', 99)) for i in range(1000, 1200)])
+  >>> db.statistics.staleRelations()
+  ['employee']
+  >>> db.analyze()
+  >>> (db.statistics.relation('employee').numTuples, db.statistics.staleRelations())
+  (1200, [])
+
+  # Analysis also samples a synopsis of the relation.
+  >>> synopsis = db.statistics.synopsis('employee')
+  >>> (synopsis.numTuples, synopsis.relationTuples)
+  (500, 1200)
+  >>> synopsisRelation = Statistics.synopsisRelation('employee')
+  >>> len([tup for (_, page) in db.storageEngine().pages(synopsisRelation) for tup in page])
+  500
+
+  # Statistics are restored with the database.
+  >>> db.close()
+  >>> db2 = Database.Database(dataDir='stats-test')
+  >>> db2.statistics.relation('employee').column('age').maxValue
+  99
+  >>> db2.statistics.synopsis('employee').numTuples
+  500
+
+  # Removing a relation removes its statistics and synopsis.
+  >>> db2.removeRelation('employee')
+  >>> (db2.statistics.relation('employee'), db2.statistics.synopsis('employee'), db2.storageEngine().hasRelation(synopsisRelation))
+  (None, None, False)
+  >>> db2.close()
+  >>> shutil.rmtree('stats-test')
+  """
+
+  checkpointEncoding = "latin1"
+  checkpointFile     = "db.stats"
+
+  # The maximum number of tuples sampled when analyzing a relation.
+  sampleSize = 30000
+
+  # The maximum number of tuples in a relation's sample synopsis.
+  synopsisSize = 500
+
+  def __init__(self, **kwargs):
+    self.dataDir   = kwargs.get("dataDir", None)
+    self.relations = kwargs.get("relations", {})   # relation name -> RelationStatistics
+    self.synopses  = kwargs.get("synopses", {})    # relation name -> RelationSynopsis
+
+    if self.dataDir and "relations" not in kwargs \
+        and os.path.exists(os.path.join(self.dataDir, Statistics.checkpointFile)):
+      self.restore()
+
+  def relation(self, relId):
+    return self.relations.get(relId, None)
+
+  def column(self, relId, field):
+    stats = self.relation(relId)
+    return stats.column(field) if stats else None
+
+  # Returns whether all the given relations have been analyzed.
+  def hasStatistics(self, relIds):
+    return all(relId in self.relations for relId in relIds)
+
+  def staleRelations(self):
+    return sorted(relId for (relId, stats) in self.relations.items() if stats.isStale())
+
+  # Records the number of tuples inserted, deleted or updated in an analyzed or sampled relation.
+  def recordModifications(self, relId, count=1):
+    for summary in [self.relation(relId), self.synopsis(relId)]:
+      if summary:
+        summary.modifications += count
+
+  # Removes a relation's statistics, and its synopsis from the given storage engine.
+  def remove(self, relId, storage=None):
+    removed = self.relations.pop(relId, None)
+    if self.synopses.pop(relId, None):
+      removed = True
+      if storage and storage.hasRelation(Statistics.synopsisRelation(relId)):
+        storage.removeRelation(Statistics.synopsisRelation(relId))
+
+    if removed:
+      self.checkpoint()
+
+
+  # Analysis.
+
+  # Analyzes a relation, given its schema and the storage engine holding its pages.
+  # When given a list of fields, only their statistics are refreshed, retaining
+  # those of any other fields.
+  def analyze(self, relId, schema, storage, fields=None):
+    fields         = fields or schema.fields
+    positions      = [schema.fields.index(f) for f in fields]
+    (_, numPages, numTuples) = storage.relationStats(relId)
+
+    (sample, seen) = self.sampleRelation(relId, storage, Statistics.sampleSize)
+    rows = []
+    for tupleData in sample:
+      values = schema.unpack(tupleData)
+      rows.append([values[i] for i in positions])
+
+    previous = self.relation(relId)
+    columns  = dict(previous.columns) if previous and fields != schema.fields else {}
+    for (i, field) in enumerate(fields):
+      columns[field] = ColumnStatistics.build([row[i] for row in rows], seen)
+
+    self.relations[relId] = RelationStatistics(numTuples=seen, numPages=numPages, columns=columns)
+    self.buildSynopsis(relId, schema, storage, random.sample(sample, min(len(sample), Statistics.synopsisSize)), seen)
+
+  # Returns a uniform reservoir sample of at most the given number of packed tuples
+  # from a relation, and the number of tuples in the relation.
+  def sampleRelation(self, relId, storage, sampleSize):
+    sample = []
+    seen   = 0
+    for (_, page) in storage.pages(relId):
+      for tupleData in page:
+        seen += 1
+        if len(sample) < sampleSize:
+          sample.append(bytes(tupleData))
+        else:
+          i = random.randrange(seen)
+          if i < sampleSize:
+            sample[i] = bytes(tupleData)
+    return (sample, seen)
+
+
+  # Sample synopses.
+
+  # Returns the name of the relation holding a relation's synopsis.
+  @staticmethod
+  def synopsisRelation(relId):
+    return "synopsis_" + relId
+
+  def synopsis(self, relId):
+    return self.synopses.get(relId, None)
+
+  # Returns whether a storage relation holds a synopsis.
+  def isSynopsisRelation(self, relId):
+    return any(Statistics.synopsisRelation(r) == relId for r in self.synopses)
+
+  # Stores a synopsis for a relation, given a uniform sample of its packed tuples and its
+  # row count. Without a sample, this samples the relation from the storage engine.
+  def buildSynopsis(self, relId, schema, storage, sample=None, numTuples=None):
+    if sample is None:
+      (sample, numTuples) = self.sampleRelation(relId, storage, Statistics.synopsisSize)
+
+    synopsisRelId = Statistics.synopsisRelation(relId)
+    if storage.hasRelation(synopsisRelId):
+      storage.removeRelation(synopsisRelId)
+    storage.createRelation(synopsisRelId, schema)
+    if sample:
+      storage.insertTuples(synopsisRelId, sample)
+
+    self.synopses[relId] = RelationSynopsis(numTuples=len(sample), relationTuples=numTuples)
+    self.checkpoint()
+
+
+  # Statistics catalog persistence.
+  # Character values are stored as latin1 strings, and restored as bytes.
+  def checkpoint(self):
+    if self.dataDir:
+      path = os.path.join(self.dataDir, Statistics.checkpointFile)
+      with open(path, 'w', encoding=Statistics.checkpointEncoding) as f:
+        f.write(self.pack())
+
+  def restore(self):
+    path = os.path.join(self.dataDir, Statistics.checkpointFile)
+    with open(path, 'r', encoding=Statistics.checkpointEncoding) as f:
+      restored = Statistics.unpack(f.read())
+      self.relations = restored.relations
+      self.synopses  = restored.synopses
+
+  def pack(self):
+    return json.dumps({ "relations": { relId: stats.pack() for (relId, stats) in self.relations.items() },
+                        "synopses":  { relId: synopsis.pack() for (relId, synopsis) in self.synopses.items() } },
+                      cls=StatisticsEncoder)
+
+  # Catalogs checkpointed without synopses map relation names to their statistics.
+  @classmethod
+  def unpack(cls, buffer):
+    packed = json.loads(buffer, object_hook=StatisticsEncoder.decode)
+    if set(packed.keys()) != {"relations", "synopses"}:
+      packed = { "relations": packed, "synopses": {} }
+
+    return cls(relations={ relId: RelationStatistics.unpack(s) for (relId, s) in packed["relations"].items() },
+               synopses={ relId: RelationSynopsis.unpack(s) for (relId, s) in packed["synopses"].items() })
+
+
+class CardinalityObservation:
+  """
+  An observed output cardinality of an executed sub-plan, alongside the optimizer's
+  estimate, and the sizes of the sub-plan's relations when executed.
+  """
+
+  def __init__(self, **kwargs):
+    self.description   = kwargs.get("description", "")
+    self.estimated     = kwargs.get("estimated", 0)
+    self.actual        = kwargs.get("actual", 0)
+    self.relationSizes = dict(kwargs.get("relationSizes", {}))
+    self.count         = kwargs.get("count", 1)
+
+  # Returns the ratio between the larger and smaller of the estimated and actual
+  # cardinalities, treating empty results as a single tuple.
+  def qError(self):
+    return CardinalityObservation.ratio(self.estimated, self.actual)
+
+  @staticmethod
+  def ratio(estimated, actual):
+    (estimated, actual) = (max(1, estimated), max(1, actual))
+    return max(estimated / actual, actual / estimated)
+
+  # Returns the observed cardinality, scaled by the growth of each relation since execution.
+  def correctedCardinality(self, relationSizes):
+    scale = 1.0
+    for (relId, size) in self.relationSizes.items():
+      scale *= relationSizes.get(relId, size) / max(1, size)
+    return self.actual * scale
+
+
+class CardinalityFeedback:
+  """
+  A store of cardinality feedback, recording the estimated and actual cardinalities
+  of executed sub-plans, keyed by the optimizer's feedback signatures (see
+  Optimizer.feedbackSignature). The optimizer uses these observations in place of
+  its estimates for matching sub-plans of later queries.
+
+  Observations whose actual cardinality differs from what the store would have
+  predicted by more than a factor of 'tolerance' change the feedback version of
+  their relations, invalidating cached plan costs and prepared plans over them.
+
+  Feedback signatures may refer to Python functions, thus the store is kept in memory only.
+
+  >>> feedback = CardinalityFeedback()
+  >>> feedback.record(('query', ('employee',), ('age < 30',)), 'employee where age < 30', {'employee': 1000}, 100, 800)
+  >>> (feedback.cardinality(('query', ('employee',), ('age < 30',)), {'employee': 2000}), feedback.version('employee'))
+  (1600.0, 1)
+
+  # Accurate repeated observations keep the feedback version.
+  >>> feedback.record(('query', ('employee',), ('age < 30',)), 'employee where age < 30', {'employee': 1000}, 100, 790)
+  >>> feedback.record(('query', ('employee',), ('age > 90',)), 'employee where age > 90', {'employee': 1000}, 20, 25)
+  >>> feedback.version('employee')
+  1
+  >>> print(feedback.report())
+  q-error=7.90 estimated=100 actual=790 runs=2: employee where age < 30
+  q-error=1.25 estimated=20 actual=25 runs=1: employee where age > 90
+
+  >>> feedback.remove('employee')
+  >>> (feedback.isEmpty(), feedback.version('employee'))
+  (True, 2)
+  """
+
+  # The ratio between a predicted and an actual cardinality, beyond which an observation
+  # changes the optimizer's estimates.
+  tolerance = 2.0
+
+  def __init__(self):
+    self.observations = {}   # feedback signature -> CardinalityObservation
+    self.versions     = {}   # relation name -> feedback version
+
+  def isEmpty(self):
+    return not self.observations
+
+  # Returns the feedback version of a relation.
+  def version(self, relId):
+    return self.versions.get(relId, 0)
+
+  def updateVersion(self, relIds):
+    for relId in set(relIds):
+      self.versions[relId] = self.version(relId) + 1
+
+  # Records the estimated and actual cardinalities of an executed sub-plan, given the
+  # sizes of its relations.
+  def record(self, key, description, relationSizes, estimated, actual):
+    previous  = self.observations.get(key, None)
+    predicted = previous.correctedCardinality(relationSizes) if previous else estimated
+
+    self.observations[key] = CardinalityObservation(description=description, estimated=estimated, actual=actual, \
+                                                    relationSizes=relationSizes, count=previous.count + 1 if previous else 1)
+
+    if CardinalityObservation.ratio(predicted, actual) > CardinalityFeedback.tolerance:
+      self.updateVersion(relationSizes.keys())
+
+  def hasObservation(self, key):
+    return key in self.observations
+
+  # Returns the cardinality of a sub-plan with the given signature, as observed and
+  # scaled to the given current sizes of its relations, or None if never observed.
+  def cardinality(self, key, relationSizes):
+    observation = self.observations.get(key, None)
+    return observation.correctedCardinality(relationSizes) if observation else None
+
+  # Removes all observations over a relation.
+  def remove(self, relId):
+    removed = [key for (key, obs) in self.observations.items() if relId in obs.relationSizes]
+    for key in removed:
+      del self.observations[key]
+    if removed:
+      self.updateVersion([relId])
+
+  # Returns the observations with the largest q-errors, worst first.
+  def misestimates(self, limit=10):
+    return sorted(self.observations.values(), key=lambda obs: obs.qError(), reverse=True)[:limit]
+
+  # Returns a report of the worst misestimates, one per line.
+  def report(self, limit=10):
+    return '\n'.join("q-error={:.2f} estimated={:.0f} actual={} runs={}: {}".format( \
+                        obs.qError(), obs.estimated, obs.actual, obs.count, obs.description) \
+                      for obs in self.misestimates(limit))
+
+
+class StatisticsEncoder(json.JSONEncoder):
+  """
+  Custom JSON encoder for statistics, encoding byte strings (i.e., character values).
+
+  >>> json.loads(json.dumps([b'abc', 1], cls=StatisticsEncoder), object_hook=StatisticsEncoder.decode)
+  [b'abc', 1]
+  """
+  def default(self, obj):
+    if isinstance(obj, bytes):
+      return { "__bytes__": obj.decode(Statistics.checkpointEncoding) }
+    else:
+      return super().default(obj)
+
+  @staticmethod
+  def decode(obj):
+    if "__bytes__" in obj:
+      return obj["__bytes__"].encode(Statistics.checkpointEncoding)
+    return obj
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,10 +1,16 @@
 import json, io, os, os.path
 
 from Catalog.Schema        import DBSchema, DBSchemaEncoder, DBSchemaDecoder
-from Query.Plan            import PlanBuilder
+from Catalog.Statistics    import CardinalityFeedback, Statistics
+from Query.Plan            import PlanBuilder, PreparedPlan
 from Query.Optimizer       import Optimizer
 from Query.Optimizer       import BushyOptimizer
 from Query.Optimizer       import GreedyOptimizer
+from Query.Optimizer       import HeuristicOptimizer
+from Query.Optimizer       import IKKBZOptimizer
+from Query.Optimizer       import IterativeImprovementOptimizer
+from Query.Optimizer       import SimulatedAnnealingOptimizer
+from Query.Optimizer       import GeneticOptimizer
 from Storage.StorageEngine import StorageEngine
 
 class Database:
@@ -12,15 +18,40 @@ class Database:
   A top-level database engine class.
 
   For now, this primarily maintains a simple catalog,
-  mapping relation names to schema objects.
+  mapping relation names to schema objects, and a statistics
+  catalog built by analyzing relations for the query optimizer.
 
   Also, it provies the ability to construct query
   plan objects, as well as wrapping the storage layer methods.
+
+  Queries joining many relations may be optimized with a heuristic
+  or randomized join ordering strategy with a bounded planning time,
+  given by the 'largeJoinStrategy', 'largeJoinThreshold' and
+  'optimizationBudget' keyword arguments.
+
+  Repeated queries may be prepared (see Database.prepare), reusing a cached
+  optimized plan for queries that only differ in the literals of their predicates.
+
+  Executed queries record the actual cardinalities of their sub-plans as feedback,
+  which the optimizer uses in place of its estimates for the same sub-plans in later
+  queries (see Database.recordFeedback and Database.feedbackReport).
   """
 
   checkpointEncoding = "latin1"
   checkpointFile     = "db.catalog"
 
+  # Join ordering strategies for queries over many relations, where exhaustive
+  # enumeration is too expensive (see Database.setLargeJoinStrategy).
+  largeJoinStrategies = {
+    "greedy"                : GreedyOptimizer,
+    "ikkbz"                 : IKKBZOptimizer,
+    "iterative-improvement" : IterativeImprovementOptimizer,
+    "simulated-annealing"   : SimulatedAnnealingOptimizer,
+    "genetic"               : GeneticOptimizer
+  }
+
+  defaultLargeJoinThreshold = 10
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -28,12 +59,21 @@ class Database:
 
     else:
       storageArgs = {k:v for (k,v) in kwargs.items() \
-                      if k in ["pageSize", "poolSize", "dataDir", "indexDir"]}
+                      if k in ["pageSize", "poolSize", "dataDir", "indexDir", "indexManagerClass"]}
 
       self.relationMap     = kwargs.get("relations", {})
+      self.versionMap      = {}
       self.defaultPageSize = kwargs.get("pageSize", io.DEFAULT_BUFFER_SIZE)
       self.storage         = kwargs.get("storage", StorageEngine(**storageArgs))
+      self.statistics      = kwargs.get("statistics", Statistics(dataDir=self.storage.fileMgr.dataDir))
+      self.feedback        = CardinalityFeedback()
       self.optimizer       = Optimizer(self)
+      self.preparedPlans   = {}
+      self.preparedHits    = 0
+
+      self.setLargeJoinStrategy(kwargs.get("largeJoinStrategy", None), \
+                                kwargs.get("largeJoinThreshold", Database.defaultLargeJoinThreshold), \
+                                kwargs.get("optimizationBudget", HeuristicOptimizer.defaultTimeBudget))
 
       checkpointFound = os.path.exists(os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile))
       restoring       = "restore" in kwargs
@@ -43,11 +83,21 @@ class Database:
 
   def fromOther(self, other):
     self.relationMap     = other.relationMap
+    self.versionMap      = other.versionMap
     self.defaultPageSize = other.defaultPageSize
     self.storage         = other.storage
+    self.statistics      = other.statistics
+    self.feedback        = other.feedback
     self.optimizer       = other.optimizer
+    self.preparedPlans   = other.preparedPlans
+    self.preparedHits    = other.preparedHits
+
+    self.largeJoinStrategy  = other.largeJoinStrategy
+    self.largeJoinThreshold = other.largeJoinThreshold
+    self.largeJoinOptimizer = other.largeJoinOptimizer
 
   def close(self):
+    self.statistics.checkpoint()
     if self.storage:
       self.storage.close()
 
@@ -61,9 +111,28 @@ class Database:
   def fileManager(self):
     return self.storage.fileMgr if self.storage else None
 
-  def queryOptimizer(self):
+  # Returns the optimizer for the given query plan. Queries joining more than the
+  # large join threshold's number of relations use the large join strategy, if any.
+  def queryOptimizer(self, queryPlan=None):
+    if queryPlan and self.largeJoinOptimizer and len(queryPlan.relations()) > self.largeJoinThreshold:
+      return self.largeJoinOptimizer
     return self.optimizer
 
+  # Sets the join ordering strategy for large queries, or disables it given None.
+  # Heuristic and randomized strategies are bounded by the given time budget, in seconds.
+  def setLargeJoinStrategy(self, strategy, threshold=None, timeBudget=None):
+    if strategy is not None and strategy not in Database.largeJoinStrategies:
+      raise ValueError("Unknown join ordering strategy: " + str(strategy))
+
+    optimizerClass          = Database.largeJoinStrategies.get(strategy, None)
+    self.largeJoinStrategy  = strategy
+    self.largeJoinThreshold = threshold if threshold is not None else Database.defaultLargeJoinThreshold
+
+    if optimizerClass and issubclass(optimizerClass, HeuristicOptimizer):
+      self.largeJoinOptimizer = optimizerClass(self, timeBudget=timeBudget)
+    else:
+      self.largeJoinOptimizer = optimizerClass(self) if optimizerClass else None
+
   # User API
 
   # Catalog methods
@@ -77,6 +146,19 @@ class Database:
     if relationName in self.relationMap:
       return self.relationMap[relationName]
 
+  # Returns a version counter for the given relation, which changes whenever the
+  # relation's contents or statistics change (e.g., to invalidate cached plan costs).
+  def relationVersion(self, relationName):
+    return self.versionMap.get(relationName, 0)
+
+  def updateVersion(self, relationName):
+    self.versionMap[relationName] = self.relationVersion(relationName) + 1
+
+  # Records changes to the given number of tuples in a relation.
+  def recordModifications(self, relationName, count=1):
+    self.updateVersion(relationName)
+    self.statistics.recordModifications(relationName, count)
+
   # DDL statements
   def createRelation(self, relationName, relationFields):
     if relationName not in self.relationMap:
@@ -91,6 +173,9 @@ class Database:
     if relationName in self.relationMap:
       del self.relationMap[relationName]
       self.storage.removeRelation(relationName)
+      self.statistics.remove(relationName, self.storage)
+      self.feedback.remove(relationName)
+      self.recordModifications(relationName)
       self.checkpoint()
     else:
       raise ValueError("No relation '" + relationName + "' found in database")
@@ -100,15 +185,82 @@ class Database:
   # Returns a tuple id for the newly inserted data.
   def insertTuple(self, relationName, tupleData):
     if relationName in self.relationMap:
+      self.recordModifications(relationName)
       return self.storage.insertTuple(relationName, tupleData)
     else:
       raise ValueError("Unknown relation '" + relationName + "' while inserting a tuple")
 
+  # Returns a list of tuple ids for the newly inserted data.
+  # Index maintenance for the inserted tuples is batched and applied in key order.
+  def insertTuples(self, relationName, tuplesData):
+    if relationName in self.relationMap:
+      tupleIds = self.storage.insertTuples(relationName, tuplesData)
+      self.recordModifications(relationName, len(tupleIds))
+      return tupleIds
+    else:
+      raise ValueError("Unknown relation '" + relationName + "' while inserting tuples")
+
   def deleteTuple(self, tupleId):
-    self.storage.deleteTuple(tupleId)
+    relationName = self.tupleRelation(tupleId)
+    if relationName is not None:
+      self.recordModifications(relationName)
+      self.storage.deleteTuple(relationName, tupleId)
+    else:
+      raise ValueError("Unknown relation for tuple id while deleting a tuple")
 
   def updateTuple(self, tupleId, tupleData):
-    self.storage.updateTuple(tupleId, tupleData)
+    relationName = self.tupleRelation(tupleId)
+    if relationName is not None:
+      self.recordModifications(relationName)
+      self.storage.updateTuple(relationName, tupleId, tupleData)
+    else:
+      raise ValueError("Unknown relation for tuple id while updating a tuple")
+
+  # Returns the name of the relation containing the given tuple id.
+  def tupleRelation(self, tupleId):
+    fileId = tupleId.pageId.fileId if tupleId else None
+    for (relationName, relFileId) in self.fileManager().relationFiles.items():
+      if relFileId == fileId:
+        return relationName
+
+  # Statistics
+
+  # Analyzes the given relation, building statistics on all of its fields, or
+  # only the given fields. Without a relation name, this analyzes all relations
+  # whose statistics are missing or stale.
+  def analyze(self, relationName=None, fields=None):
+    if relationName is None:
+      stale = self.statistics.staleRelations()
+      for name in self.relationMap:
+        if self.statistics.relation(name) is None or name in stale:
+          self.statistics.analyze(name, self.relationMap[name], self.storage)
+          self.updateVersion(name)
+
+    elif relationName in self.relationMap:
+      schema = self.relationMap[relationName]
+      if fields and any(f not in schema.fields for f in fields):
+        raise ValueError("Unknown fields " + str(fields) + " while analyzing relation '" + relationName + "'")
+      self.statistics.analyze(relationName, schema, self.storage, fields)
+      self.updateVersion(relationName)
+
+    else:
+      raise ValueError("Unknown relation '" + relationName + "' while analyzing")
+
+  # Builds sample synopses for the given relations where missing or stale (see Statistics.synopsis).
+  def refreshSynopses(self, relationNames):
+    for name in set(relationNames):
+      synopsis = self.statistics.synopsis(name)
+      if synopsis is None or synopsis.isStale(self.storage.relationStats(name)[2]):
+        self.statistics.buildSynopsis(name, self.relationMap[name], self.storage)
+
+  # Records the actual cardinalities of an executed query plan's operators
+  # as cardinality feedback for the optimizer (see Optimizer.recordFeedback).
+  def recordFeedback(self, queryPlan):
+    self.optimizer.recordFeedback(queryPlan)
+
+  # Returns a report of the sub-plans with the worst cardinality estimates among executed queries.
+  def feedbackReport(self, limit=10):
+    return self.feedback.report(limit)
 
   # Queries
 
@@ -122,7 +274,35 @@ class Database:
 
   # Returns an optimized version of the given query plan.
   def optimizeQuery(self, queryPlan):
-    return optimizer.optimizeQuery(queryPlan)
+    return self.queryOptimizer(queryPlan).optimizeQuery(queryPlan)
+
+  # Returns a prepared query for a plan template, replacing the literal constants in its
+  # predicates by named parameters bound to their values (see Plan.parameterize).
+  # We parameterize a copy of the template, which is left unchanged.
+  #
+  # Optimized plans are cached by the template's parameterized shape, and reused by
+  # templates differing only in their literals. Cached plans are invalidated when the
+  # catalog entries, statistics, indexes or cardinality feedback of their relations change.
+  def prepare(self, planTemplate):
+    planTemplate = planTemplate.copy()
+    parameters   = planTemplate.parameterize()
+    shape        = self.optimizer.planSignature(planTemplate.root)
+    dependencies = self.planDependencies(planTemplate.relations())
+
+    entry = self.preparedPlans.get(shape, None)
+    if entry and entry[0] == dependencies:
+      self.preparedHits += 1
+    else:
+      entry = (dependencies, self.optimizeQuery(planTemplate))
+      self.preparedPlans[shape] = entry
+
+    return PreparedPlan(entry[1], parameters)
+
+  # Returns the catalog entries, statistics, index ids and feedback versions of the given relations.
+  def planDependencies(self, relationNames):
+    return tuple((name, self.relationSchema(name), self.statistics.relation(name), \
+                  tuple(indexId for (_, _, indexId) in self.storage.indexes(name)), self.feedback.version(name)) \
+                    for name in sorted(set(relationNames)))
 
   # Save the database internals to the data directory.
   def checkpoint(self):
@@ -130,6 +310,7 @@ class Database:
       dbcPath = os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile)
       with open(dbcPath, 'w', encoding=Database.checkpointEncoding) as f:
         f.write(self.pack())
+      self.statistics.checkpoint()
 
   # Load relations and schema from an existing data directory.
   def restore(self):
@@ -147,7 +328,8 @@ class Database:
   @classmethod
   def unpack(cls, buffer, storageEngine):
     (relationMap, pageSize) = json.loads(buffer, cls=DBSchemaDecoder)
-    return cls(relations=relationMap, pageSize=pageSize, storage=storageEngine, restore=True)
+    statistics = Statistics(dataDir=storageEngine.fileMgr.dataDir)
+    return cls(relations=relationMap, pageSize=pageSize, storage=storageEngine, statistics=statistics, restore=True)
 
 if __name__ == "__main__":
     import doctest
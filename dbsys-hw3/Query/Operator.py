@@ -1,3 +1,58 @@
+import copy, functools, math, sys, time
+
+from Storage.File import StorageFile
+from Utils.ExpressionInfo import ExpressionInfo
+from Utils.SelectivityEstimator import SelectivityEstimator
+
+class OperatorProfile:
+  """
+  Runtime statistics for an operator, collected during an analyzed plan execution.
+
+  Statistics are accumulated over the operator's iterator calls, and are thus
+  inclusive of any work done by the operator's children. The operator computes
+  its exclusive statistics by subtracting those of its children.
+  """
+
+  counters = ["wallTime", "cpuTime", "pagesRead", "bufferHits", "bufferMisses", "pagesWritten"]
+
+  def __init__(self, bufferPool):
+    self.bufferPool = bufferPool
+    self.tuplesOut  = 0
+    self.inclusive  = dict.fromkeys(OperatorProfile.counters, 0)
+
+  # Returns the current values of all counters, in the order of OperatorProfile.counters.
+  def snapshot(self):
+    return [time.perf_counter(), time.process_time(), \
+            StorageFile.pagesRead, self.bufferPool.numHits, self.bufferPool.numMisses, \
+            StorageFile.pagesWritten]
+
+  # Adds the counter increments since the given snapshot.
+  def accumulate(self, start):
+    for (name, startValue, endValue) in zip(OperatorProfile.counters, start, self.snapshot()):
+      self.inclusive[name] += endValue - startValue
+
+  # Wraps an operator's iterator method to profile its calls.
+  # Profiled '__next__' calls also count the tuples in each output page.
+  @staticmethod
+  def profiled(method, countOutput):
+    @functools.wraps(method)
+    def profiledMethod(operator):
+      if not operator.profiling:
+        return method(operator)
+
+      profile = operator.profile
+      start   = profile.snapshot()
+      try:
+        result = method(operator)
+        if countOutput:
+          profile.tuplesOut += result[1].header.numTuples()
+        return result
+      finally:
+        profile.accumulate(start)
+
+    return profiledMethod
+
+
 class Operator:
   """
   An abstract base class for all operator implementations.
@@ -7,6 +62,45 @@ class Operator:
 
   opCount = 0
 
+  # Runtime profiling state, see useProfiling.
+  profile   = None
+  profiling = False
+
+  # The statistics catalog used for cardinality estimation, see prepare.
+  # Without statistics, or once sampled, operators use sampled estimates instead.
+  statistics   = None
+  sampleTested = False
+
+  # The cached statistics-based cardinality estimate, reset when preparing the operator.
+  cardinalityEstimate = None
+
+  # An observed cardinality overriding our estimates, see Optimizer.applyFeedback.
+  cardinalityFeedback = None
+
+  # Query parameter values bound to the operator's expressions, see bindParameters.
+  parameters       = {}
+  parameterGlobals = None
+
+  # Instruments the iterator methods of every operator implementation for profiling.
+  # Iterators also restart the actual cardinality, which thus counts the output of the
+  # latest iteration (e.g., of a nested loops join's repeatedly scanned RHS).
+  def __init_subclass__(cls, **kwargs):
+    super().__init_subclass__(**kwargs)
+    if "__iter__" in cls.__dict__:
+      setattr(cls, "__iter__", Operator.restarted(cls.__dict__["__iter__"]))
+    for method in ["__iter__", "__next__"]:
+      if method in cls.__dict__:
+        setattr(cls, method, OperatorProfile.profiled(cls.__dict__[method], method == "__next__"))
+
+  @staticmethod
+  def restarted(method):
+    @functools.wraps(method)
+    def restartedMethod(operator):
+      operator.actualCardinality = 0
+      return method(operator)
+
+    return restartedMethod
+
   def __init__(self, **kwargs):
     self.opId = Operator.opCount
     Operator.opCount += 1
@@ -19,11 +113,28 @@ class Operator:
   def initializeStatistics(self):
     self.estimatedCardinality = 0
     self.actualCardinality    = 0
+    self.numEvaluations       = 0
 
   # Returns this operator's identifier.
   def id(self):
     return self.opId
 
+  # Returns a copy of the plan rooted at this operator, with new operator identifiers.
+  # Rewriting the copy's operators in place (e.g., by the query optimizer) leaves
+  # this plan unchanged.
+  def copy(self):
+    operator = copy.copy(self)
+    operator.opId = Operator.opCount
+    Operator.opCount += 1
+    operator.initializeStatistics()
+
+    for attr in ["subPlan", "lhsPlan", "rhsPlan"]:
+      child = getattr(self, attr, None)
+      if child is not None:
+        setattr(operator, attr, child.copy())
+
+    return operator
+
   # Returns the output schema of this operator
   def schema(self):
     raise NotImplementedError
@@ -42,7 +153,10 @@ class Operator:
 
   # Prepares the operator for execution.
   def prepare(self, database):
-    self.storage = database.storageEngine()
+    self.storage    = database.storageEngine()
+    self.statistics = database.statistics
+    self.cardinalityEstimate = None
+    self.cardinalityFeedback = None
 
   # Create a temporary output relation, removing any existing relation.
   def initializeOutput(self):
@@ -94,6 +208,26 @@ class Operator:
     else:
       self.actualCardinality += 1
 
+  # Used during parallel processing to append a packed output page produced by
+  # a worker process (see Query.Parallel) to this operator's output relation.
+  def emitOutputPage(self, pageBuffer):
+    if self.tempFile is None:
+      self.initializeOutput()
+
+    pageId = self.tempFile.pageId(self.tempFile.numPages())
+    page   = self.tempFile.pageClass().unpack(pageId, bytearray(pageBuffer))
+    page.setDirty(False)
+    self.tempFile.writePage(page)
+    self.tempFile.flush()
+
+    numTuples = page.header.numTuples()
+    self.tempFile.header.numTuples += numTuples
+
+    if self.sampled:
+      self.estimatedCardinality += numTuples
+    else:
+      self.actualCardinality += numTuples
+
   # Returns whether this operator has an output page ready for its iterator.
   # This method can raise a StopIteration exception to end this operator's processing.
   def isOutputPageReady(self):
@@ -131,6 +265,21 @@ class Operator:
       schemaLocals[k] = v
     return schemaLocals
 
+  # Evaluates a query operator expression in the given environment, and the
+  # global environment of the operator implementation's module.
+  # We count evaluations for runtime profiling.
+  def evaluate(self, expr, env):
+    self.numEvaluations += 1
+    return eval(expr, self.parameterGlobals or sys.modules[type(self).__module__].__dict__, env)
+
+  # Binds values for the query parameters used in the operator's expressions (see
+  # Plan.parameterize). Parameters are evaluated as global variables alongside
+  # the operator implementation's module, and also used for cardinality estimates.
+  def bindParameters(self, parameters):
+    self.cardinalityEstimate = None
+    self.parameters       = parameters
+    self.parameterGlobals = dict(sys.modules[type(self).__module__].__dict__, **parameters)
+
   # Plan and statistics information
 
   # Returns a single line description of the operator.
@@ -142,17 +291,95 @@ class Operator:
   def useSampling(self, sampled, sampleFactor):
     self.sampled = sampled
     self.sampleFactor = sampleFactor
+    self.sampleTested = self.sampleTested or sampled
     for childOp in self.inputs():
       childOp.useSampling(sampled, sampleFactor)
 
+  # Instructs this operator and all of our children to collect runtime profiles
+  # during execution. Enabling profiling resets any previously collected profile.
+  def useProfiling(self, profiling):
+    if profiling:
+      self.profile = OperatorProfile(self.storage.bufferPool)
+      self.numEvaluations = 0
+    self.profiling = profiling
+    for childOp in self.inputs():
+      childOp.useProfiling(profiling)
+
+  # Returns this operator's profiled statistics, excluding those of its children.
+  def exclusiveProfile(self):
+    stats = dict(self.profile.inclusive)
+    for childOp in self.inputs():
+      if childOp.profile:
+        for name in OperatorProfile.counters:
+          stats[name] -= childOp.profile.inclusive[name]
+    return stats
+
+  # Returns a single line description of the operator's runtime profile.
+  # Times are shown as inclusive/exclusive of our children, while I/O counters are exclusive.
+  def explainProfile(self):
+    if self.profile is None:
+      return "(not profiled)"
+
+    inclusive = self.profile.inclusive
+    exclusive = self.exclusiveProfile()
+    tuplesIn  = sum(map(lambda x: x.profile.tuplesOut if x.profile else 0, self.inputs()))
+
+    return "(rows={},estRows={:.0f},tuplesIn={},".format(self.profile.tuplesOut, self.cardinality(True), tuplesIn) \
+            + "wall={:.2f}/{:.2f}ms,".format(1000 * inclusive["wallTime"], 1000 * exclusive["wallTime"]) \
+            + "cpu={:.2f}/{:.2f}ms,".format(1000 * inclusive["cpuTime"], 1000 * exclusive["cpuTime"]) \
+            + "pagesRead={pagesRead},hits={bufferHits},misses={bufferMisses},pagesWritten={pagesWritten},".format(**exclusive) \
+            + "evals={})".format(self.numEvaluations)
+
   # Returns the number of tuples this operator produces, either
   # as an estimate or a profiled actual cardinality.
+  # Estimates are based on cardinality feedback from earlier executions if available,
+  # on sampling if the operator has been sampled, and on the statistics catalog otherwise.
   def cardinality(self, estimated):
     if estimated:
-      return self.estimatedCardinality * self.sampleFactor
+      if self.cardinalityFeedback is not None:
+        return self.cardinalityFeedback
+      if self.sampleTested or self.statistics is None:
+        return self.estimatedCardinality * self.sampleScale()
+      if self.cardinalityEstimate is None:
+        self.cardinalityEstimate = self.estimateCardinality()
+      return self.cardinalityEstimate
     else:
       return self.actualCardinality
 
+  # Returns the factor scaling up the number of tuples produced while sampling to
+  # an estimate over the full inputs. Inputs are sampled independently, thus
+  # we multiply their factors, while base relations use the plan's sample factor.
+  def sampleScale(self):
+    return math.prod(x.sampleScale() for x in self.inputs()) if self.inputs() else self.sampleFactor
+
+  # Returns the estimated number of tuples this operator produces, from the
+  # statistics catalog. By default, operators produce all of their inputs.
+  def estimateCardinality(self):
+    return sum(map(lambda x: x.cardinality(True), self.inputs()))
+
+  # Returns a dictionary mapping this operator's output fields to the base
+  # relation columns they originate from, as (relation id, field) pairs.
+  # Fields computed by the operator, e.g., aggregates, have no source column.
+  def attributeSources(self):
+    return {}
+
+  # Returns a dictionary of column statistics for this operator's output fields, where available.
+  def columnStatistics(self):
+    columns = {}
+    if self.statistics is not None:
+      for (attr, (relId, field)) in self.attributeSources().items():
+        column = self.statistics.column(relId, field)
+        if column is not None:
+          columns[attr] = column
+    return columns
+
+  # Returns the estimated selectivity of a predicate over the given column statistics.
+  # Query parameters are estimated with their bound values.
+  def predicateSelectivity(self, expr, columns):
+    if expr and self.parameters:
+      expr = ExpressionInfo(expr).bindParameters(self.parameters)
+    return SelectivityEstimator(columns).estimate(expr)
+
   # Returns this operator's selectivity, either as an estimate or
   # a profiled actual selectivity.
   def selectivity(self, estimated):
@@ -0,0 +1,158 @@
+import functools, operator, random
+from Query.Operator import Operator
+from Storage.Index.BitmapIndex import Bitmap
+
+class BitmapHeapScan(Operator):
+  """
+  A bitmap heap scan operator, retrieving a relation's tuples through one or more indexes.
+
+  The scan collects the tuple ids matched by each of its index scans, and combines
+  them by intersection ('and') or union ('or'), as given by the 'combine' argument.
+  It then fetches the matching tuples in page order, visiting each heap page once
+  regardless of the order of the index entries (see StorageEngine.fetchTuples).
+
+  When any index scan is over a bitmap index, matches are combined as bitmaps of
+  tuple positions, including negated scans (i.e., NOT predicates), converting the
+  matches of any other index scans into bitmaps.
+
+  The index scans act as access paths of this operator rather than as child
+  operators, that is, they are never iterated directly.
+  """
+
+  combiners       = { "and": set.intersection, "or": set.union }
+  bitmapCombiners = { "and": operator.and_, "or": operator.or_ }
+
+  def __init__(self, relId, schema, indexScans, **kwargs):
+    if relId and schema and indexScans:
+      super().__init__(**kwargs)
+      self.relId      = relId
+      self.relSchema  = schema
+      self.indexScans = indexScans
+      self.combine    = kwargs.get("combine", "and")
+    else:
+      raise ValueError("Invalid relation name, schema or indexes for a bitmap heap scan")
+
+    if self.combine not in BitmapHeapScan.combiners:
+      raise ValueError("Invalid combination of index scans in a bitmap heap scan")
+
+    if any(map(lambda x: x.relId != self.relId, self.indexScans)):
+      raise ValueError("Invalid index scans on another relation for a bitmap heap scan")
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.relSchema
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return None
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "BitmapHeapScan"
+
+  # Returns child operators if present
+  def inputs(self):
+    return []
+
+  # Copies this operator along with its index scans.
+  def copy(self):
+    operator = super().copy()
+    operator.indexScans = [indexScan.copy() for indexScan in self.indexScans]
+    return operator
+
+  # Prepares this operator and its index scans for execution.
+  def prepare(self, database):
+    super().prepare(database)
+    for indexScan in self.indexScans:
+      indexScan.prepare(database)
+
+  # Binds query parameters to this operator and its index scans, whose keys may use them.
+  def bindParameters(self, parameters):
+    super().bindParameters(parameters)
+    for indexScan in self.indexScans:
+      indexScan.bindParameters(parameters)
+
+  # Returns the tuple ids matched by the combination of all index scans.
+  def tupleIds(self):
+    bitmaps = [indexScan.bitmap() for indexScan in self.indexScans]
+    layout  = next((b for b in bitmaps if b is not None), None)
+
+    if layout is not None:
+      bitmaps = [b if b is not None else Bitmap(layout.fileId, layout.slotsPerPage, indexScan.tupleIds()) \
+                  for (b, indexScan) in zip(bitmaps, self.indexScans)]
+      return functools.reduce(BitmapHeapScan.bitmapCombiners[self.combine], bitmaps).tupleIds()
+
+    idSets = [set(indexScan.tupleIds()) for indexScan in self.indexScans]
+    return functools.reduce(BitmapHeapScan.combiners[self.combine], idSets)
+
+
+  # Volcano-style iterator abstraction
+  def __iter__(self):
+    for indexScan in self.indexScans:
+      if self.storage.getIndex(indexScan.indexId) is None:
+        raise ValueError("Missing index in storage manager: %s" % indexScan.indexId)
+
+    self.initializeOutput()
+    self.inputIterator = self.storage.fetchTuples(self.tupleIds())
+    self.inputFinished = False
+    return self
+
+  # Bitmap heap scans are pipelined over the fetched heap pages.
+  def __next__(self):
+    while not(self.inputFinished or self.isOutputPageReady()):
+      try:
+        (_, tupleData) = next(self.inputIterator)
+        self.processTuple(tupleData)
+      except StopIteration:
+        self.inputFinished = True
+
+    # Flush the page before handing it out, since it is no longer tracked as an output
+    # page, and the temporary file would otherwise keep offering it for new tuples.
+    (pageId, page) = self.outputPage()
+    self.storage.bufferPool.flushPage(pageId)
+    return (pageId, page)
+
+  # Emits a fetched tuple. When sampling, we retain each tuple with probability 1/sampleFactor.
+  def processTuple(self, tupleData):
+    if self.sampled and random.random() * self.sampleFactor > 1.0:
+      return
+
+    self.emitOutputTuple(tupleData)
+
+  # Bitmap heap scans do not process input pages.
+  def processInputPage(self, pageId, page):
+    raise ValueError("Page-at-a-time processing not supported for bitmap heap scans")
+
+
+  # Plan and statistics information
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    indexes = "; ".join(map(lambda x: str(x.indexId) + ":" + x.explainKeys(), self.indexScans))
+    return super().explain() + "(" + self.relId + ",combine=" + self.combine + ",indexes=[" + indexes + "])"
+
+  # A bitmap heap scan's cost is a sequential page access per retrieved tuple,
+  # which is an upper bound on the number of heap pages visited, in addition to
+  # reading the index entries matched by each of its index scans.
+  def localCost(self, estimated):
+    return self.cardinality(estimated) * self.tupleCost + sum(x.lookupCost() for x in self.indexScans)
+
+  # Bitmap heap scan fields originate from the scanned relation.
+  def attributeSources(self):
+    return { f: (self.relId, f) for f in self.relSchema.fields }
+
+  # Estimates the scan's output size assuming independent index scans, such that
+  # intersections multiply their selectivities, and unions add them excluding overlaps.
+  def estimateCardinality(self):
+    _, _, numTuples = self.storage.relationStats(self.relId)
+    selectivities   = [indexScan.keySelectivity() for indexScan in self.indexScans]
+    if self.combine == "and":
+      selectivity = functools.reduce(operator.mul, selectivities)
+    else:
+      selectivity = 1.0 - functools.reduce(operator.mul, [1.0 - s for s in selectivities])
+    return numTuples * selectivity
+
+  # Returns the fraction of the relation retrieved by the scan.
+  def selectivity(self, estimated):
+    _, _, numTuples = self.storage.relationStats(self.relId)
+    return self.cardinality(estimated) / numTuples if numTuples else 1.0
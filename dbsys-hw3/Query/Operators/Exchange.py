@@ -0,0 +1,135 @@
+import math
+
+import Query.Parallel as Parallel
+
+from Query.Operator import Operator
+from Query.Operators.TableScan import TableScan
+from Query.Operators.Select    import Select
+from Query.Operators.Project   import Project
+from Storage.File              import StorageFile
+
+class Exchange(Operator):
+  """
+  A parallel exchange operator implementation.
+
+  This partitions a scan-select-project pipeline into page ranges over the
+  scanned relation's file, and runs the pipeline over each range in a worker
+  process. Workers open the relation file read-only, and return packed output
+  pages that we gather into our output relation in page range order.
+
+  The sub-plan must be a chain of selections and projections over a table scan.
+  Exchange parameters are the number of worker processes, and optionally the
+  number of page ranges (defaulting to one range per worker).
+  """
+  def __init__(self, subPlan, **kwargs):
+    super().__init__(**kwargs)
+    self.subPlan       = subPlan
+    self.numWorkers    = kwargs.get("numWorkers", Parallel.defaultWorkers())
+    self.numPartitions = kwargs.get("numPartitions", self.numWorkers)
+    self.initializePipeline()
+
+  # Collects the pipeline's operators, ordered from the table scan upwards.
+  def initializePipeline(self):
+    self.pipeline = []
+    operator = self.subPlan
+    while isinstance(operator, (Select, Project)):
+      self.pipeline.insert(0, operator)
+      operator = operator.subPlan
+
+    if isinstance(operator, TableScan):
+      self.scan = operator
+    else:
+      raise ValueError("Invalid exchange input, expected a select-project pipeline over a table scan")
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.subPlan.schema()
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return [self.subPlan.schema()]
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "Exchange"
+
+  # Returns child operators if present
+  def inputs(self):
+    return [self.subPlan]
+
+  # Iterator abstraction for exchange operator.
+  def __iter__(self):
+    self.initializeOutput()
+    self.outputIterator = self.processAllPages()
+    return self
+
+  def __next__(self):
+    return next(self.outputIterator)
+
+  # Page-at-a-time operator processing
+  def processInputPage(self, pageId, page):
+    for inputTuple in page:
+      self.emitOutputTuple(inputTuple)
+
+  # Set-at-a-time operator processing
+  def processAllPages(self):
+    # Sampling passes through the sub-plan serially, since sampled scans
+    # do not cover contiguous page ranges.
+    if self.sampled or self.numWorkers <= 1:
+      for (pageId, page) in self.subPlan:
+        self.processInputPage(pageId, page)
+
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
+
+    else:
+      # Ensure the relation file is up-to-date for our workers' read-only access.
+      (_, _, numPages) = Parallel.flushRelation(self.storage, self.scan.relationId())
+
+      partitions = self.partitions(numPages)
+      for pageBuffers in Parallel.runTasks(self, "processPartition", partitions, self.numWorkers):
+        for pageBuffer in pageBuffers:
+          self.emitOutputPage(pageBuffer)
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Splits the scanned relation's pages into contiguous ranges.
+  def partitions(self, numPages):
+    rangeSize = max(1, math.ceil(numPages / max(1, self.numPartitions)))
+    return [(start, min(start + rangeSize, numPages)) for start in range(0, numPages, rangeSize)]
+
+  # Worker processing of a single page range, returning packed output pages.
+  def processPartition(self, start, end):
+    (fileId, relFile) = self.storage.fileMgr.relationFile(self.scan.relationId())
+    pageIterator = StorageFile.readOnlyPages(fileId, relFile.path, (start, end))
+
+    outputTuples = (self.processPipeline(tup) for (_, page) in pageIterator for tup in page)
+    return Parallel.packPages(filter(lambda x: x is not None, outputTuples), \
+                              self.schema(), self.storage.fileMgr.defaultPageSize)
+
+  # Applies the pipeline's operators to an input tuple, returning None
+  # if the tuple is filtered out.
+  def processPipeline(self, inputTuple):
+    for operator in self.pipeline:
+      inputTuple = operator.processTuple(inputTuple)
+      if inputTuple is None:
+        break
+    return inputTuple
+
+
+  # Plan and statistics information
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    return super().explain() + "(numWorkers=" + str(self.numWorkers) + ")"
+
+  # Exchanges retain the column sources of their pipeline.
+  def attributeSources(self):
+    return self.subPlan.attributeSources()
+
+  # The sub-pipeline's cost is shared across our workers, while gathering
+  # its output remains serial.
+  def cost(self, estimated):
+    return self.subPlan.cost(estimated) / max(1, self.numWorkers) + self.localCost(estimated)
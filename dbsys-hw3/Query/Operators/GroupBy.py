@@ -1,5 +1,10 @@
+import math
+
+import Query.Parallel as Parallel
+
 from Catalog.Schema import DBSchema
 from Query.Operator import Operator
+from Storage.File   import StorageFile
 
 class GroupBy(Operator):
   def __init__(self, subPlan, **kwargs):
@@ -16,6 +21,11 @@ class GroupBy(Operator):
     self.aggExprs    = kwargs.get("aggExprs", None)
     self.groupHashFn = kwargs.get("groupHashFn", None)
 
+    # Parallel aggregation parameters: the number of worker processes, and
+    # each worker's memory budget in pages of partition data per pass.
+    self.numWorkers  = kwargs.get("numWorkers", 1)
+    self.workerPages = kwargs.get("workerPages", None)
+
     self.validateGroupBy()
     self.initializeSchema()
 
@@ -106,39 +116,28 @@ class GroupBy(Operator):
       for tup in page:
         groupVal = self.ensureTuple(self.groupExpr(self.subSchema.unpack(tup)))
         groupId = self.groupHashFn(groupVal)
+        self.numEvaluations += 2
         self.emitPartitionTuple(groupId, tup)
 
+    # Aggregate partitions in worker processes, one task per partition.
+    if self.numWorkers > 1 and not self.sampled:
+      tasks = [(Parallel.flushRelation(self.storage, partRelId),) \
+                for partRelId in self.partitionFiles.values()]
+
+      for pageBuffers in Parallel.runTasks(self, "aggregatePartition", tasks, self.numWorkers):
+        for pageBuffer in pageBuffers:
+          self.emitOutputPage(pageBuffer)
+
     # We assume that the partitions fit in main memory.
-    for partRelId in self.partitionFiles.values():
-      partFile = self.storage.fileMgr.relationFile(partRelId)[1]
-
-      # Use an in-memory Python dict to accumulate the aggregates.
-      aggregates = {}
-      for (pageId, page) in partFile.pages():
-        for tup in page:
-          # Evaluate group-by value.
-          namedTup = self.subSchema.unpack(tup)
-          groupVal = self.ensureTuple(self.groupExpr(namedTup))
-
-          # Look up the aggregate for the group.
-          if groupVal not in aggregates:
-            aggregates[groupVal] = self.initialExprs()
-
-          # Increment the aggregate.
-          aggregates[groupVal] = \
-            list(map( \
-              lambda x: x[0](x[1], namedTup), \
-              zip(self.incrExprs(), aggregates[groupVal])))
-
-      # Finalize the aggregate value for each group.
-      for (groupVal, aggVals) in aggregates.items():
-        finalVals = list(map(lambda x: x[0](x[1]), zip(self.finalizeExprs(), aggVals)))
-        outputTuple = self.outputSchema.instantiate(*(list(groupVal) + finalVals))
-        self.emitOutputTuple(self.outputSchema.pack(outputTuple))
-
-      # No need to track anything but the last output page when in batch mode.
-      if self.outputPages:
-        self.outputPages = [self.outputPages[-1]]
+    else:
+      for partRelId in self.partitionFiles.values():
+        partFile = self.storage.fileMgr.relationFile(partRelId)[1]
+        for outputTuple in self.aggregatePages(partFile.pages()):
+          self.emitOutputTuple(outputTuple)
+
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
 
     # Clean up partitions.
     self.removePartitionFiles()
@@ -146,6 +145,54 @@ class GroupBy(Operator):
     # Return an iterator for the output file.
     return self.storage.pages(self.relationId())
 
+  # Aggregates the tuples in the given pages, returning a generator of packed output tuples.
+  # When a partition is processed in multiple passes, only those groups whose hash value
+  # matches the pass id are aggregated.
+  def aggregatePages(self, pages, numPasses=1, passId=0):
+    # Use an in-memory Python dict to accumulate the aggregates.
+    aggregates = {}
+    for (pageId, page) in pages:
+      for tup in page:
+        # Evaluate group-by value.
+        namedTup = self.subSchema.unpack(tup)
+        groupVal = self.ensureTuple(self.groupExpr(namedTup))
+
+        if numPasses > 1 and hash(groupVal) % numPasses != passId:
+          continue
+
+        # Look up the aggregate for the group.
+        if groupVal not in aggregates:
+          aggregates[groupVal] = self.initialExprs()
+
+        # Increment the aggregate.
+        aggregates[groupVal] = \
+          list(map( \
+            lambda x: x[0](x[1], namedTup), \
+            zip(self.incrExprs(), aggregates[groupVal])))
+        self.numEvaluations += 1 + len(self.aggExprs)
+
+    # Finalize the aggregate value for each group.
+    for (groupVal, aggVals) in aggregates.items():
+      finalVals = list(map(lambda x: x[0](x[1]), zip(self.finalizeExprs(), aggVals)))
+      outputTuple = self.outputSchema.instantiate(*(list(groupVal) + finalVals))
+      yield self.outputSchema.pack(outputTuple)
+
+  # Worker processing of a partition, given its (file id, path, number of pages).
+  # Partitions larger than the worker's memory budget are aggregated in several
+  # passes over the partition file. Returns packed output pages.
+  def aggregatePartition(self, partFile):
+    (fileId, path, numPages) = partFile
+
+    budget    = self.workerPages if self.workerPages \
+                  else max(1, self.storage.bufferPool.numPages() // self.numWorkers)
+    numPasses = max(1, math.ceil(numPages / budget))
+
+    outputTuples = (outputTuple for passId in range(numPasses) \
+                      for outputTuple in self.aggregatePages( \
+                        StorageFile.readOnlyPages(fileId, path), numPasses, passId))
+
+    return Parallel.packPages(outputTuples, self.outputSchema, self.storage.fileMgr.defaultPageSize)
+
   # Bucket construction helpers.
   def partitionRelationId(self, partitionId):
     return self.operatorType() + str(self.id()) + "_" \
@@ -176,3 +223,18 @@ class GroupBy(Operator):
   def explain(self):
     return super().explain() + "(groupSchema=" + self.groupSchema.toString() \
                              + ", aggSchema=" + self.aggSchema.toString() + ")"
+
+  # Grouping fields named after an input field retain its column source.
+  def attributeSources(self):
+    inputSources = self.subPlan.attributeSources()
+    return { f: inputSources[f] for f in self.groupSchema.fields if f in inputSources }
+
+  # Estimates the number of groups as the product of the grouping fields' distinct
+  # value counts, bounded by the input size. Without statistics on all grouping
+  # fields, we assume every input tuple forms its own group.
+  def estimateCardinality(self):
+    numInputs = self.subPlan.cardinality(True)
+    columns   = self.subPlan.columnStatistics()
+    if all(f in columns for f in self.groupSchema.fields):
+      return min(numInputs, math.prod(columns[f].numDistinct for f in self.groupSchema.fields))
+    return numInputs
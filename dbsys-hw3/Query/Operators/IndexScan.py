@@ -0,0 +1,276 @@
+import random, struct
+from Catalog.Schema import DBSchema
+from Query.Operator import Operator
+from Utils.ExpressionInfo import QueryParameter
+from Utils.SelectivityEstimator import SelectivityEstimator
+
+class IndexScan(Operator):
+  """
+  An index scan operator, retrieving a relation's tuples through one of its indexes.
+
+  Index scans support three access modes, based on their keyword arguments:
+  - a point lookup, given a 'key' tuple of values for all index key fields.
+  - a range scan, given an optional 'lowKey' and 'highKey' tuple of key values,
+    with 'lowInclusive' and 'highInclusive' flags (defaulting to inclusive bounds).
+  - a full scan of the relation in index key order, when no keys are given.
+
+  Since our indexes are unclustered, the scan fetches each matching tuple from
+  its page, and emits it into the operator's output relation. Tuples are fetched
+  in index key order, see BitmapHeapScan for fetching index matches in page order.
+  Hash indexes only support point lookups, and full scans in no particular order.
+
+  Scans over bitmap indexes may be negated with a 'negate' keyword argument,
+  matching all indexed tuples not matched by the scan's key or key range.
+
+  Given an 'includeSchema' keyword argument matching the included columns of a
+  covering index, the scan is index-only: it never accesses the heap file, and
+  emits the key and included columns of each index entry, in that order.
+
+  Key values may be query parameters (see Utils.ExpressionInfo.QueryParameter), which
+  are bound when executing the scan. If a bound key cannot be used as an index key
+  (e.g., due to its type), the scan falls back to retrieving all index entries, thus
+  the caller must also evaluate the scan's predicate on parameterized scans' outputs.
+  """
+
+  def __init__(self, relId, schema, indexId, keySchema, **kwargs):
+    if relId and schema and indexId is not None and keySchema:
+      super().__init__(**kwargs)
+      self.relId         = relId
+      self.relSchema     = schema
+      self.indexId       = indexId
+      self.keySchema     = keySchema
+      self.key           = kwargs.get("key", None)
+      self.lowKey        = kwargs.get("lowKey", None)
+      self.highKey       = kwargs.get("highKey", None)
+      self.lowInclusive  = kwargs.get("lowInclusive", True)
+      self.highInclusive = kwargs.get("highInclusive", True)
+      self.includeSchema = kwargs.get("includeSchema", None)
+      self.negate        = kwargs.get("negate", False)
+    else:
+      raise ValueError("Invalid relation name, schema or index for an index scan")
+
+    if self.key is not None and not(self.lowKey is None and self.highKey is None):
+      raise ValueError("Invalid index scan, with both a lookup key and a key range")
+
+    if self.negate and self.isCovering():
+      raise ValueError("Invalid index scan, with a negated covering index")
+
+    if self.isCovering():
+      self.outputSchema = DBSchema(self.relationId(), self.keySchema.schema() + self.includeSchema.schema())
+
+  # Returns whether this is an index-only scan over a covering index.
+  def isCovering(self):
+    return self.includeSchema is not None
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.outputSchema if self.isCovering() else self.relSchema
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return None
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "IndexScan"
+
+  # Returns child operators if present
+  def inputs(self):
+    return []
+
+  # Returns the packed, order-preserving index key for the given key values.
+  def packKey(self, values):
+    values = self.keyValues(values)
+    return self.keySchema.packKey(self.keySchema.instantiate(*values)) if values is not None else None
+
+  # Returns the given key values with any query parameters bound to their values.
+  def keyValues(self, values):
+    return QueryParameter.bindValues(values, self.parameters)
+
+  # Returns whether the scan's keys are exact index keys once their query parameters are
+  # bound, that is, they can be packed without any loss of precision, truncation or overflow.
+  def hasIndexKeys(self):
+    for values in [self.key, self.lowKey, self.highKey]:
+      if values is not None and any(isinstance(v, QueryParameter) for v in values):
+        try:
+          values = self.keyValues(values)
+          if tuple(self.keySchema.unpackKey(self.packKey(values))) != values:
+            return False
+        except (struct.error, TypeError, ValueError, OverflowError):
+          return False
+    return True
+
+  # Returns an iterator over the (key, tuple id, included values) triples of all
+  # covering index entries matching the scan. Point lookups use a single-key range.
+  def coveringEntries(self):
+    if not self.hasIndexKeys():
+      return self.storage.lookupCovering(self.relId, self.indexId, None, None)
+    elif self.key is not None:
+      key = self.packKey(self.key)
+      return self.storage.lookupCovering(self.relId, self.indexId, key, key)
+    else:
+      return self.storage.lookupCovering(self.relId, self.indexId, \
+                self.packKey(self.lowKey), self.packKey(self.highKey), \
+                self.lowInclusive, self.highInclusive)
+
+  # Returns an output tuple for a covering index entry, from its key and included values.
+  def coveringTuple(self, key, included):
+    values = tuple(self.keySchema.unpackKey(key)) + tuple(self.includeSchema.unpack(included))
+    return self.outputSchema.pack(self.outputSchema.instantiate(*values))
+
+  # Returns the bitmap of tuples matching the scan, or None if the index is not a bitmap index.
+  def bitmap(self):
+    (lowKey, highKey) = (self.key, self.key) if self.key is not None else (self.lowKey, self.highKey)
+    if not self.hasIndexKeys():
+      (lowKey, highKey) = (None, None)
+    return self.storage.lookupBitmap(self.relId, self.indexId, self.packKey(lowKey), self.packKey(highKey), \
+                                     self.lowInclusive, self.highInclusive, self.negate)
+
+  # Returns an iterator over the tuple ids of all index entries matching the scan.
+  def tupleIds(self):
+    if self.negate:
+      bitmap = self.bitmap()
+      if bitmap is None:
+        raise ValueError("Invalid negated index scan over a non-bitmap index")
+      return bitmap.tupleIds()
+
+    elif not self.hasIndexKeys():
+      entries = self.storage.scanByIndex(self.relId, self.indexId)
+
+    elif self.key is not None:
+      return self.storage.lookupByIndex(self.relId, self.indexId, self.packKey(self.key))
+
+    elif self.lowKey is not None or self.highKey is not None:
+      entries = self.storage.lookupRange(self.relId, self.indexId, \
+                  self.packKey(self.lowKey), self.packKey(self.highKey), \
+                  self.lowInclusive, self.highInclusive)
+
+    else:
+      entries = self.storage.scanByIndex(self.relId, self.indexId)
+
+    return (tupleId for (_, tupleId) in entries)
+
+
+  # Volcano-style iterator abstraction
+  def __iter__(self):
+    if self.storage.getIndex(self.indexId) is None:
+      raise ValueError("Missing index in storage manager: %s" % self.indexId)
+
+    self.initializeOutput()
+    self.inputIterator = self.coveringEntries() if self.isCovering() else self.tupleIds()
+    self.inputFinished = False
+    return self
+
+  # Index scans are always pipelined.
+  def __next__(self):
+    while not(self.inputFinished or self.isOutputPageReady()):
+      try:
+        if self.isCovering():
+          (key, _, included) = next(self.inputIterator)
+          self.processCoveringEntry(key, included)
+        else:
+          tupleId = next(self.inputIterator)
+          self.processTupleId(tupleId)
+      except StopIteration:
+        self.inputFinished = True
+
+    # Flush the page before handing it out, since it is no longer tracked as an output
+    # page, and the temporary file would otherwise keep offering it for new tuples.
+    (pageId, page) = self.outputPage()
+    self.storage.bufferPool.flushPage(pageId)
+    return (pageId, page)
+
+  # Fetches the tuple for an index entry, and emits it as an output tuple.
+  # When sampling, we retain each index entry with probability 1/sampleFactor.
+  def processTupleId(self, tupleId):
+    if self.sampled and random.random() * self.sampleFactor > 1.0:
+      return
+
+    # Copy the tuple, since emitting it may evict its page from the buffer pool.
+    page = self.storage.bufferPool.getPage(tupleId.pageId)
+    self.emitOutputTuple(bytes(page.getTuple(tupleId)))
+
+  # Emits an output tuple directly from a covering index entry, without a heap access.
+  def processCoveringEntry(self, key, included):
+    if self.sampled and random.random() * self.sampleFactor > 1.0:
+      return
+
+    self.emitOutputTuple(self.coveringTuple(key, included))
+
+  # Index scans do not process input pages.
+  def processInputPage(self, pageId, page):
+    raise ValueError("Page-at-a-time processing not supported for index scans")
+
+
+  # Plan and statistics information
+
+  # Returns a description of the scan's key or key range.
+  def explainKeys(self):
+    if self.key is not None:
+      keys = "key=" + str(self.key)
+
+    elif self.lowKey is not None or self.highKey is not None:
+      low  = ("[" if self.lowInclusive else "(") + str(self.lowKey) if self.lowKey is not None else "(-inf"
+      high = str(self.highKey) + ("]" if self.highInclusive else ")") if self.highKey is not None else "inf)"
+      keys = "range=" + low + ", " + high
+
+    else:
+      keys = "scan"
+
+    return "not " + keys if self.negate else keys
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    include = ",include=" + self.includeSchema.toString() if self.isCovering() else ""
+    return super().explain() + "(" + self.relId + ",index=" + str(self.indexId) \
+            + ",keySchema=" + self.keySchema.toString() + include + "," + self.explainKeys() + ")"
+
+  # An index scan's cost is a random I/O per retrieved tuple. Covering scans only
+  # read index entries, which we cost relative to the size of a full tuple.
+  def localCost(self, estimated):
+    cost = self.cardinality(estimated) * self.tupleCost
+    return cost * self.schema().size / self.relSchema.size if self.isCovering() else cost
+
+  # Returns the cost of reading the index entries matched by the scan, relative to the
+  # size of a full tuple. Bitmap index lookups read a bitmap with a bit per tuple.
+  def lookupCost(self):
+    _, _, numTuples = self.storage.relationStats(self.relId)
+    if self.storage.indexKind(self.indexId) == "bitmap":
+      return numTuples / 8 * self.tupleCost / self.relSchema.size
+    return numTuples * self.keySelectivity() * self.tupleCost * self.keySchema.size / self.relSchema.size
+
+  # Index scan fields originate from the scanned relation.
+  def attributeSources(self):
+    return { f: (self.relId, f) for f in self.schema().fields }
+
+  # Returns the estimated fraction of the relation matched by the scan's keys, from
+  # the statistics on the key fields. Range scans only use the first key field.
+  def keySelectivity(self):
+    columns = { f: self.statistics.column(self.relId, f) for f in self.keySchema.fields }
+
+    if self.key is not None:
+      selectivity = 1.0
+      for (field, value) in zip(self.keySchema.fields, self.keyValues(self.key)):
+        column = columns[field]
+        selectivity *= column.equalitySelectivity(value) if column else SelectivityEstimator.defaultSelectivity["=="]
+
+    elif self.lowKey is not None or self.highKey is not None:
+      column = columns[self.keySchema.fields[0]]
+      low    = self.keyValues(self.lowKey)[0] if self.lowKey is not None else None
+      high   = self.keyValues(self.highKey)[0] if self.highKey is not None else None
+      selectivity = column.rangeSelectivity(low, high, self.lowInclusive, self.highInclusive) \
+                      if column else SelectivityEstimator.defaultSelectivity["other"]
+
+    else:
+      selectivity = 1.0
+
+    return 1.0 - selectivity if self.negate else selectivity
+
+  def estimateCardinality(self):
+    _, _, numTuples = self.storage.relationStats(self.relId)
+    return numTuples * self.keySelectivity()
+
+  # Returns the fraction of the relation retrieved by the scan.
+  def selectivity(self, estimated):
+    _, _, numTuples = self.storage.relationStats(self.relId)
+    return self.cardinality(estimated) / numTuples if numTuples else 1.0
@@ -1,7 +1,13 @@
-import itertools
+import math
+
+import Query.Parallel as Parallel
 
 from Catalog.Schema import DBSchema
 from Query.Operator import Operator
+from Query.Operators.IndexScan import IndexScan
+from Query.Operators.TableScan import TableScan
+from Storage.File   import StorageFile
+from Utils.ExpressionInfo import ExpressionInfo
 
 class Join(Operator):
   def __init__(self, lhsPlan, rhsPlan, **kwargs):
@@ -22,8 +28,21 @@ class Join(Operator):
     self.lhsHashFn      = kwargs.get("lhsHashFn", None)
     self.rhsHashFn      = kwargs.get("rhsHashFn", None)
 
+    # Parallel hash join parameters: the number of worker processes, and
+    # each worker's memory budget in pages for building hash tables.
+    self.numWorkers     = kwargs.get("numWorkers", 1)
+    self.workerPages    = kwargs.get("workerPages", None)
+
+    # Nested loops joins materialize a non-base-table RHS input once into a spool,
+    # keeping it in memory for up to the given number of pages.
+    self.spoolPages     = kwargs.get("spoolPages", None)
+
+    # The output schema is built on first use, since query optimization
+    # creates many candidate joins that are never executed.
+    self.joinSchema     = None
+    self.joinSources    = None
+
     self.validateJoin()
-    self.initializeSchema()
     self.initializeMethod(**kwargs)
 
   def localCost(self, estimated):
@@ -40,15 +59,33 @@ class Join(Operator):
       return (numTuplesLeft * self.tupleCost * numTuplesRight * self.tupleCost) + (numTuplesLeft * self.tupleCost)
       #return (numTuplesLeft * numPagesRight) + numPagesLeft
     elif self.joinMethod == "block-nested-loops":
-      return (numTuplesLeft * self.tupleCost) + (((numTuplesLeft * self.tupleCost)// (self.storage.bufferPool.numPages() - 2)) * (numTuplesRight * self.tupleCost))
+      # The RHS is read once per block of LHS pages filling the buffer pool.
+      numBlocks = math.ceil(tupleSizeLeft * numTuplesLeft / pageSize / (self.storage.bufferPool.numPages() - 2))
+      return (numTuplesLeft * self.tupleCost) + (numBlocks * (numTuplesRight * self.tupleCost))
       #return numPagesLeft + ((numPagesLeft // (self.storage.bufferPool.numPages() - 2)) * numPagesRight)
     elif self.joinMethod == "indexed":
-      raise NotImplementedError
+      # An index lookup per LHS tuple, and a random I/O per match as with index scans.
+      matchCost = self.cardinality(estimated) * self.tupleCost
+      if self.isCoveringRhs():
+        matchCost = matchCost * self.rhsPlan.schema().size / self.rhsPlan.relSchema.size
+      return 2 * (numTuplesLeft * self.tupleCost) + matchCost
     elif self.joinMethod == "hash":
       return 3 * ((numTuplesLeft * self.tupleCost) + (numTuplesRight * self.tupleCost))
     else:
       return None
   
+  # Indexed joins access their RHS relation through the index, rather than by executing the RHS plan.
+  def cost(self, estimated):
+    if self.joinMethod == "indexed":
+      return self.localCost(estimated) + self.lhsPlan.cost(estimated)
+    return super().cost(estimated)
+
+  # Indexed joins look up every sampled LHS tuple in the full RHS relation.
+  def sampleScale(self):
+    if self.joinMethod == "indexed":
+      return self.lhsPlan.sampleScale()
+    return super().sampleScale()
+
   # Checks the join parameters.
   def validateJoin(self):
     # Valid join methods: "nested-loops", "block-nested-loops", "indexed", "hash"
@@ -88,6 +125,9 @@ class Join(Operator):
     fields = self.lhsSchema.schema() + self.rhsSchema.schema()
     self.joinSchema = DBSchema(schema, fields)
 
+    # Output tuples are built directly from the packed input tuples.
+    self.joinTuple  = self.joinSchema.binaryConcatenator([self.lhsSchema, self.rhsSchema])
+
   # Initializes any additional operator parameters based on the join method.
   def initializeMethod(self, **kwargs):
     if self.joinMethod == "indexed":
@@ -97,6 +137,8 @@ class Join(Operator):
 
   # Returns the output schema of this operator
   def schema(self):
+    if self.joinSchema is None:
+      self.initializeSchema()
     return self.joinSchema
 
   # Returns any input schemas for the operator if present
@@ -152,28 +194,43 @@ class Join(Operator):
   # Nested loops implementation
   #
   def nestedLoops(self):
-    for (lPageId, lhsPage) in self.lhsPlan:
-      for lTuple in lhsPage:
-        # Load the lhs once per inner loop.
-        joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+    rhsInput = self.rewindableRhs()
+
+    try:
+      for (lPageId, lhsPage) in self.lhsPlan:
+        for lTuple in lhsPage:
+          # Load the lhs once per inner loop.
+          joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
 
-        for (rPageId, rhsPage) in self.rhsPlan:
-          for rTuple in rhsPage:
-            # Load the RHS tuple fields.
-            joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+          for (rPageId, rhsPage) in rhsInput:
+            for rTuple in rhsPage:
+              # Load the RHS tuple fields.
+              joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
 
-            # Evaluate the join predicate, and output if we have a match.
-            if eval(self.joinExpr, globals(), joinExprEnv):
-              outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-              self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+              # Evaluate the join predicate, and output if we have a match.
+              if self.evaluate(self.joinExpr, joinExprEnv):
+                self.emitOutputTuple(self.joinTuple(lTuple, rTuple))
 
-        # No need to track anything but the last output page when in batch mode.
-        if self.outputPages:
-          self.outputPages = [self.outputPages[-1]]
+          # No need to track anything but the last output page when in batch mode.
+          if self.outputPages:
+            self.outputPages = [self.outputPages[-1]]
+    finally:
+      rhsInput.close()
 
     # Return an iterator to the output relation
     return self.storage.pages(self.relationId())
 
+  # Returns a rewindable RHS input for nested loops joins. Base tables are rescanned
+  # directly, while other RHS plans are evaluated once into a spool.
+  def rewindableRhs(self):
+    if isinstance(self.rhsPlan, TableScan):
+      return RewindablePlan(self.rhsPlan)
+
+    maxPages = self.spoolPages if self.spoolPages is not None \
+                 else max(1, self.storage.bufferPool.numPages() // 8)
+
+    return Spool(self.rhsPlan, self.storage, self.relationId() + "_spool", maxPages)
+
 
   ##################################
   #
@@ -181,6 +238,12 @@ class Join(Operator):
   #
   # This attempts to use all the free pages in the buffer pool
   # for its block of the outer relation.
+  #
+  # For each block, we load the outer tuples once, and build an in-memory hash table
+  # over the block using any equality conjuncts between LHS and RHS attributes in
+  # the join expression. We then scan the inner relation once per block, probing
+  # the hash table with each inner tuple and evaluating only the residual predicate.
+  # Without any equality conjuncts, the hash table holds the block in a single bucket.
 
   # Accesses a block of pages from an iterator.
   # This method pins pages in the buffer pool during its access.
@@ -200,77 +263,113 @@ class Join(Operator):
     return pageBlock
 
   def blockNestedLoops(self):
-    # Access the outer relation's block, pinning pages in the buffer pool.
-    bufPool    = self.storage.bufferPool
-    lhsIter    = iter(self.lhsPlan)
-    lPageBlock = self.accessPageBlock(bufPool, lhsIter)
-
-    while lPageBlock:
-      for (lPageId, lhsPage) in lPageBlock:
-        for lTuple in lhsPage:
-          # Load the lhs once per inner loop.
-          joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+    # Materialize the inner relation prior to pinning any outer relation pages.
+    rhsInput = self.rewindableRhs()
 
-          for (rPageId, rhsPage) in self.rhsPlan:
-            for rTuple in rhsPage:
-              # Load the RHS tuple fields.
-              joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
-
-              # Evaluate the join predicate, and output if we have a match.
-              if eval(self.joinExpr, globals(), joinExprEnv):
-                outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-                self.emitOutputTuple(self.joinSchema.pack(outputTuple))
-
-          # No need to track anything but the last output page when in batch mode.
-          if self.outputPages:
-            self.outputPages = [self.outputPages[-1]]
+    try:
+      # Access the outer relation's block, pinning pages in the buffer pool.
+      bufPool    = self.storage.bufferPool
+      lhsIter    = iter(self.lhsPlan)
+      lPageBlock = self.accessPageBlock(bufPool, lhsIter)
 
-        # Unpin the page after joining with the RHS relation.
-        # Thus future accesses can evict the page while reading the next block.
-        bufPool.unpinPage(lPageId)
+      (lhsKeyExprs, rhsKeyExprs, residualExpr) = self.blockJoinExprs()
 
-      # Move to the next page block after processing it.
-      lPageBlock = self.accessPageBlock(bufPool, lhsIter)
+      while lPageBlock:
+        try:
+          # Load the block's LHS tuples once, hashing them on their equi-join keys.
+          blockTable = {}
+          for (lPageId, lhsPage) in lPageBlock:
+            for lTuple in lhsPage:
+              lhsEnv   = self.loadSchema(self.lhsSchema, lTuple)
+              blockKey = tuple(self.evaluate(keyExpr, lhsEnv) for keyExpr in lhsKeyExprs)
+              blockTable.setdefault(blockKey, []).append((lTuple, lhsEnv))
+
+          for (rPageId, rhsPage) in rhsInput:
+            for rTuple in rhsPage:
+              # Load the RHS tuple fields once per block, and probe the block.
+              rhsEnv   = self.loadSchema(self.rhsSchema, rTuple)
+              probeKey = tuple(self.evaluate(keyExpr, rhsEnv) for keyExpr in rhsKeyExprs)
+
+              for (lTuple, lhsEnv) in blockTable.get(probeKey, []):
+                # Evaluate the residual join predicate, and output if we have a match.
+                if residualExpr is not None:
+                  joinExprEnv = dict(lhsEnv)
+                  joinExprEnv.update(rhsEnv)
+                  if not self.evaluate(residualExpr, joinExprEnv):
+                    continue
+
+                self.emitOutputTuple(self.joinTuple(lTuple, rTuple))
+
+            # No need to track anything but the last output page when in batch mode.
+            if self.outputPages:
+              self.outputPages = [self.outputPages[-1]]
+        finally:
+          # Unpin the block's pages after joining with the RHS relation.
+          # Thus future accesses can evict the pages while reading the next block.
+          for (lPageId, _) in lPageBlock:
+            bufPool.unpinPage(lPageId)
+
+        # Move to the next page block after processing it.
+        lPageBlock = self.accessPageBlock(bufPool, lhsIter)
+    finally:
+      rhsInput.close()
 
     # Return an iterator to the output relation
     return self.storage.pages(self.relationId())
 
+  # Splits the join expression into compiled LHS and RHS equi-join key expressions,
+  # and a compiled residual predicate (or None if there is no residual predicate).
+  def blockJoinExprs(self):
+    (equalities, residuals) = ExpressionInfo(self.joinExpr) \
+                                .equiJoinComponents(set(self.lhsSchema.fields), set(self.rhsSchema.fields))
+
+    compileExpr  = lambda expr: compile(expr, "<join>", "eval")
+    lhsKeyExprs  = [compileExpr(lhsExpr) for (lhsExpr, _) in equalities]
+    rhsKeyExprs  = [compileExpr(rhsExpr) for (_, rhsExpr) in equalities]
+    residualExpr = compileExpr(ExpressionInfo.conjunction(residuals)) if residuals else None
+    return (lhsKeyExprs, rhsKeyExprs, residualExpr)
+
 
   ##################################
   #
   # Indexed nested loops implementation
   #
-  # TODO: test
+  # For each LHS page, we collect the tuple ids of the RHS index matches of all tuples
+  # in the page, and fetch the matches in RHS page order (i.e., a bitmap heap fetch),
+  # visiting each RHS page once per LHS page rather than once per match.
   def indexedNestedLoops(self):
     if self.storage.getIndex(self.indexId) is None:
       raise ValueError("Missing index in storage manager: %s" % self.indexId)
     if self.indexId:
-      bufPool = self.storage.bufferPool
       for (lPageId, lhsPage) in self.lhsPlan:
+        # Match LHS tuples against RHS tuple ids using the index.
+        # LHS tuples are copied since fetching RHS pages may evict the LHS page.
+        lhsMatches = {}
+        rhsTuples  = {}
         for lTuple in lhsPage:
-          # Load the lhs once per inner loop.
-          joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
-
-          # Match against RHS tuples using the index.
-          joinKey = self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema)
-          matches = self.storage.fileMgr.lookupByIndex(self.rhsPlan.relationId(), self.indexId, joinKey)
-
-          for rhsTupId in matches:
-            rhsPage = bufPool.getPage(rhsTupId.pageId)
-            rTuple  = rhsPage.getTuple(rhsTupId)
-
-            # Load the RHS tuple fields.
-            joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
-
+          lTuple  = bytes(lTuple)
+          joinKey = self.lhsSchema.projectKey(lTuple, self.lhsKeySchema)
+          for (rhsTupId, rTuple) in self.indexMatches(joinKey):
+            lhsMatches.setdefault(rhsTupId, []).append(lTuple)
+            if rTuple is not None:
+              rhsTuples[rhsTupId] = rTuple
+
+        # Covering index matches already hold the RHS tuple, while others are fetched in page order.
+        rhsInput = rhsTuples.items() if self.isCoveringRhs() else self.storage.fetchTuples(lhsMatches.keys())
+        for (rhsTupId, rTuple) in rhsInput:
+          for lTuple in lhsMatches[rhsTupId]:
             # Evaluate any remaining join predicate, and output if we have a match.
-            fullMatch = eval(self.joinExpr, globals(), joinExprEnv) if self.joinExpr else True
-            if fullMatch:
-              outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-              self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+            if self.joinExpr:
+              joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+              joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+              if not self.evaluate(self.joinExpr, joinExprEnv):
+                continue
 
-          # No need to track anything but the last output page when in batch mode.
-          if self.outputPages:
-            self.outputPages = [self.outputPages[-1]]
+            self.emitOutputTuple(self.joinTuple(lTuple, rTuple))
+
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
 
       # Return an iterator to the output relation
       return self.storage.pages(self.relationId())
@@ -279,6 +378,23 @@ class Join(Operator):
       raise ValueError("No index found while using an indexed nested loops join")
 
 
+  # Returns whether the RHS is an index-only scan over the join's index, in which case
+  # RHS tuples are built from the index entries without accessing the heap file.
+  def isCoveringRhs(self):
+    return isinstance(self.rhsPlan, IndexScan) and self.rhsPlan.isCovering() \
+            and self.rhsPlan.indexId == self.indexId
+
+  # Returns (tuple id, RHS tuple) pairs for index matches of the join key, where the
+  # RHS tuple is None unless it can be built from a covering index entry.
+  def indexMatches(self, joinKey):
+    if self.isCoveringRhs():
+      entries = self.storage.lookupCovering(self.rhsPlan.relId, self.indexId, joinKey, joinKey)
+      return ((tupleId, self.rhsPlan.coveringTuple(key, included)) for (key, tupleId, included) in entries)
+    else:
+      tupleIds = self.storage.lookupByIndex(self.rhsPlan.relationId(), self.indexId, joinKey)
+      return ((tupleId, None) for tupleId in tupleIds)
+
+
   ##################################
   #
   # Hash join implementation.
@@ -286,37 +402,36 @@ class Join(Operator):
   def hashJoin(self):
     # Partition the LHS and RHS inputs, creating a temporary file for each partition.
     # We assume one-level of partitioning is sufficient and skip recurring.
+    # Input tuples are copied since writing partition pages may evict the input page.
     for (lPageId, lPage) in self.lhsPlan:
-      for lTuple in lPage:
+      for lTuple in [bytes(t) for t in lPage]:
         lPartEnv = self.loadSchema(self.lhsSchema, lTuple)
-        lPartKey = eval(self.lhsHashFn, globals(), lPartEnv)
+        lPartKey = self.evaluate(self.lhsHashFn, lPartEnv)
         self.emitPartitionTuple(lPartKey, lTuple, left=True)
 
     for (rPageId, rPage) in self.rhsPlan:
-      for rTuple in rPage:
+      for rTuple in [bytes(t) for t in rPage]:
         rPartEnv = self.loadSchema(self.rhsSchema, rTuple)
-        rPartKey = eval(self.rhsHashFn, globals(), rPartEnv)
+        rPartKey = self.evaluate(self.rhsHashFn, rPartEnv)
         self.emitPartitionTuple(rPartKey, rTuple, left=False)
 
     # Iterate over partition pairs and output matches
     # evaluating the join expression as necessary.
-    for ((lPageId, lPage), (rPageId, rPage)) in self.partitionPairs():
-      for lTuple in lPage:
-        joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
-        for rTuple in rPage:
-          joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
-          output = \
-            ( self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema) \
-                == self.rhsSchema.projectBinary(rTuple, self.rhsKeySchema) ) \
-            and ( eval(self.joinExpr, globals(), joinExprEnv) if self.joinExpr else True )
+    if self.numWorkers > 1 and not self.sampled:
+      self.parallelPartitionJoin()
 
-          if output:
-            outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-            self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+    else:
+      # Partition files are read outside the buffer pool, in blocks within its size,
+      # since partitions may not fit in the pool (see partitionPairMatches).
+      for (lPartRelId, rPartRelId) in self.partitionMatches():
+        lhsFile = Parallel.flushRelation(self.storage, lPartRelId)
+        rhsFile = Parallel.flushRelation(self.storage, rPartRelId)
+        for outputTuple in self.partitionPairMatches(lhsFile, rhsFile):
+          self.emitOutputTuple(outputTuple)
 
-      # No need to track anything but the last output page when in batch mode.
-      if self.outputPages:
-        self.outputPages = [self.outputPages[-1]]
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
 
     # Clean up partitions.
     self.removePartitionFiles()
@@ -336,19 +451,64 @@ class Join(Operator):
     # Create a partition file as needed.
     if not self.storage.hasRelation(partRelId):
       self.storage.createRelation(partRelId, partSchema)
-      self.partitionFiles[int(left)][partitionId] = partRelId
+      self.partitionFiles[0 if left else 1][partitionId] = partRelId
 
     partFile = self.storage.fileMgr.relationFile(partRelId)[1]
     if partFile:
       partFile.insertTuple(partitionTuple)
 
-  # Return pairs of pages from matching partitions.
-  def partitionPairs(self):
+  # Return pairs of relation ids for matching partitions.
+  def partitionMatches(self):
     lKeys = self.partitionFiles[0].keys()
     rKeys = self.partitionFiles[1].keys()
-    matches = [(self.partitionFiles[0][partId], self.partitionFiles[1][partId]) \
-                for partId in lKeys if partId in rKeys]
-    return PartitionIterator(matches, self.storage)
+    return [(self.partitionFiles[0][partId], self.partitionFiles[1][partId]) \
+              for partId in lKeys if partId in rKeys]
+
+  # Joins matching partitions in worker processes, one task per partition pair,
+  # and gathers the workers' output pages into our output relation.
+  def parallelPartitionJoin(self):
+    tasks = [(Parallel.flushRelation(self.storage, lPartRelId), \
+              Parallel.flushRelation(self.storage, rPartRelId)) \
+                for (lPartRelId, rPartRelId) in self.partitionMatches()]
+
+    for pageBuffers in Parallel.runTasks(self, "joinPartitionPair", tasks, self.numWorkers):
+      for pageBuffer in pageBuffers:
+        self.emitOutputPage(pageBuffer)
+
+  # Worker processing of a partition pair, given the (file id, path, number of pages)
+  # of both partition files. Returns packed output pages.
+  def joinPartitionPair(self, lhsFile, rhsFile):
+    outputTuples = self.partitionPairMatches(lhsFile, rhsFile)
+    return Parallel.packPages(outputTuples, self.joinSchema, self.storage.fileMgr.defaultPageSize)
+
+  # Generates the join output for a partition pair by building a hash table over
+  # blocks of the LHS partition within the worker's memory budget, and probing
+  # each block with the RHS partition.
+  def partitionPairMatches(self, lhsFile, rhsFile):
+    (lFileId, lPath, lNumPages) = lhsFile
+    (rFileId, rPath, _)         = rhsFile
+
+    blockSize = self.workerPages if self.workerPages \
+                  else max(1, self.storage.bufferPool.numPages() // self.numWorkers)
+
+    for blockStart in range(0, lNumPages, blockSize):
+      blockTable = {}
+      for (_, lPage) in StorageFile.readOnlyPages(lFileId, lPath, (blockStart, blockStart + blockSize)):
+        for lTuple in lPage:
+          lKey = self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema)
+          blockTable.setdefault(lKey, []).append(lTuple)
+
+      for (_, rPage) in StorageFile.readOnlyPages(rFileId, rPath):
+        for rTuple in rPage:
+          lMatches = blockTable.get(self.rhsSchema.projectBinary(rTuple, self.rhsKeySchema), [])
+          for lTuple in lMatches:
+            if self.joinExpr:
+              joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+              joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+              if not self.evaluate(self.joinExpr, joinExprEnv):
+                continue
+
+            yield self.joinTuple(lTuple, rTuple)
 
   # Delete all existing partition files.
   def removePartitionFiles(self):
@@ -385,35 +545,105 @@ class Join(Operator):
 
     return super().explain() + exprs
 
-# An iterator class for looping over pairs of pages from partition files.
-class PartitionIterator:
-  def __init__(self, partFiles, storageEngine):
-    self.partFiles = partFiles
-    self.storage   = storageEngine
-    self.fileIter  = iter(self.partFiles)
-    self.nextFilePair()
+  # Join output fields originate from the input fields at the same position.
+  def attributeSources(self):
+    if self.joinSources is None:
+      self.joinSources = {}
+      for (schema, plan) in [(self.lhsSchema, self.lhsPlan), (self.rhsSchema, self.rhsPlan)]:
+        inputSources = plan.attributeSources()
+        for (field, inputField) in zip(schema.fields, plan.schema().fields):
+          if inputField in inputSources:
+            self.joinSources[field] = inputSources[inputField]
+    return self.joinSources
+
+  # Returns the key schema of the index used by an indexed join.
+  def indexKeySchema(self):
+    indexes = self.storage.indexes(self.rhsPlan.relationId())
+    return next((keySchema for (keySchema, _, indexId) in indexes if indexId == self.indexId), None)
+
+  # Returns the equalities between the join keys of a hash or indexed join, which
+  # are evaluated in addition to the join expression.
+  def keyExprs(self):
+    keyPairs = []
+    if self.joinMethod == "hash":
+      keyPairs = zip(self.lhsKeySchema.fields, self.rhsKeySchema.fields)
+    elif self.joinMethod == "indexed":
+      indexKeySchema = self.indexKeySchema()
+      keyPairs = zip(self.lhsKeySchema.fields, indexKeySchema.fields) if indexKeySchema else []
+
+    return [lhsAttr + " == " + rhsAttr for (lhsAttr, rhsAttr) in keyPairs]
+
+  # Estimates the join's output size from the selectivity of its join keys and expression.
+  def estimateCardinality(self):
+    columns     = self.columnStatistics()
+    selectivity = self.predicateSelectivity(self.joinExpr, columns)
+
+    for keyExpr in self.keyExprs():
+      selectivity *= self.predicateSelectivity(keyExpr, columns)
+
+    return self.lhsPlan.cardinality(True) * self.rhsPlan.cardinality(True) * selectivity
+
+# A rewindable join input that rescans a base table on every iteration.
+class RewindablePlan:
+  def __init__(self, plan):
+    self.plan = plan
 
   def __iter__(self):
-    return self
+    return iter(self.plan)
+
+  def close(self):
+    pass
+
+# A rewindable join input, materializing its plan's output exactly once.
+#
+# The spool keeps the plan's output tuples in memory while they fit within the
+# given number of pages, and otherwise spills them to a temporary relation.
+# Iterating over the spool yields (page id, page) pairs, where in-memory pages
+# are lists of tuples.
+class Spool:
+  def __init__(self, plan, storageEngine, relId, maxPages):
+    self.storage  = storageEngine
+    self.relId    = relId
+    self.maxPages = maxPages
+    self.pages    = []
+    self.spilled  = False
+    self.materialize(plan)
+
+  def materialize(self, plan):
+    for (pageId, page) in plan:
+      if not self.spilled and len(self.pages) >= self.maxPages:
+        self.spill(plan.schema())
+
+      # Copy the page's tuples, since spool insertions may evict the page's buffer pool frame.
+      tuples = [bytes(tupleData) for tupleData in page]
+      if self.spilled:
+        for tupleData in tuples:
+          self.spoolFile.insertTuple(tupleData)
+      else:
+        self.pages.append(tuples)
+
+  # Moves the in-memory pages to the spool's temporary relation.
+  def spill(self, schema):
+    if self.storage.hasRelation(self.relId):
+      self.storage.removeRelation(self.relId)
+
+    self.storage.createRelation(self.relId, schema)
+    self.spoolFile = self.storage.fileMgr.relationFile(self.relId)[1]
+    for page in self.pages:
+      for tupleData in page:
+        self.spoolFile.insertTuple(tupleData)
+
+    self.pages   = []
+    self.spilled = True
 
-  def nextFilePair(self):
-    try:
-      (lPartRelId, rPartRelId) = next(self.fileIter)
-      self.lFile = self.storage.fileMgr.relationFile(lPartRelId)[1]
-      self.rFile = self.storage.fileMgr.relationFile(rPartRelId)[1]
-    except StopIteration:
-      self.fileIter     = None
-      self.pagePairIter = None
+  def __iter__(self):
+    if self.spilled:
+      return self.storage.pages(self.relId)
     else:
-      self.pagePairIter = itertools.product(self.lFile.pages(), self.rFile.pages())
-
-  def __next__(self):
-    if self.fileIter is not None:
-      while self.pagePairIter is not None:
-        try:
-          return next(self.pagePairIter)
-        except StopIteration:
-          self.nextFilePair()
+      return iter(enumerate(self.pages))
 
-    if self.fileIter is None:
-      raise StopIteration
+  # Removes any temporary relation used by the spool.
+  def close(self):
+    if self.spilled and self.storage.hasRelation(self.relId):
+      self.storage.removeRelation(self.relId)
+    self.pages = []
@@ -70,15 +70,18 @@ class Project(Operator):
 
     if set(locals().keys()).isdisjoint(set(inputSchema.fields)):
       for inputTuple in page:
-        # Execute the projection expressions.
-        projectExprEnv = self.loadSchema(inputSchema, inputTuple)
-        vals = {k : eval(v[0], globals(), projectExprEnv) for (k,v) in self.projectExprs.items()}
-        outputTuple = outputSchema.pack([vals[i] for i in outputSchema.fields])
-        self.emitOutputTuple(outputTuple)
+        self.emitOutputTuple(self.processTuple(inputTuple))
 
     else:
       raise ValueError("Overlapping variables detected with operator schema")
 
+  # Tuple-at-a-time processing, returning the packed projection of the input tuple.
+  def processTuple(self, inputTuple):
+    # Execute the projection expressions.
+    projectExprEnv = self.loadSchema(self.subPlan.schema(), inputTuple)
+    vals = {k : self.evaluate(v[0], projectExprEnv) for (k,v) in self.projectExprs.items()}
+    return self.outputSchema.pack([vals[i] for i in self.outputSchema.fields])
+
   # Set-at-a-time operator processing
   def processAllPages(self):
     if self.inputIterator is None:
@@ -107,3 +110,8 @@ class Project(Operator):
   # Returns a single line description of the operator.
   def explain(self):
     return super().explain() + "(projections=" + str(self.projectExprs) + ")"
+
+  # Projections of a single input field retain its column source.
+  def attributeSources(self):
+    inputSources = self.subPlan.attributeSources()
+    return { k: inputSources[v[0].strip()] for (k, v) in self.projectExprs.items() if v[0].strip() in inputSources }
@@ -57,15 +57,20 @@ class Select(Operator):
     schema = self.subPlan.schema()
     if set(locals().keys()).isdisjoint(set(schema.fields)):
       for inputTuple in page:
-        # Load tuple fields into the select expression context
-        selectExprEnv = self.loadSchema(schema, inputTuple)
-
-        # Execute the predicate.
-        if eval(self.selectExpr, globals(), selectExprEnv):
+        if self.processTuple(inputTuple) is not None:
           self.emitOutputTuple(inputTuple)
     else:
       raise ValueError("Overlapping variables detected with operator schema")
 
+  # Tuple-at-a-time processing, returning the input tuple if it satisfies
+  # the predicate, and None otherwise.
+  def processTuple(self, inputTuple):
+    # Load tuple fields into the select expression context
+    selectExprEnv = self.loadSchema(self.subPlan.schema(), inputTuple)
+
+    # Execute the predicate.
+    return inputTuple if self.evaluate(self.selectExpr, selectExprEnv) else None
+
   # Set-at-a-time operator processing
   def processAllPages(self):
     if self.inputIterator is None:
@@ -94,3 +99,17 @@ class Select(Operator):
   # Returns a single line description of the operator.
   def explain(self):
     return super().explain() + "(predicate='" + str(self.selectExpr) + "')"
+
+  # Selections retain the column sources of their input.
+  def attributeSources(self):
+    return self.subPlan.attributeSources()
+
+  # Estimates the selection's output size from its predicate's selectivity over its input.
+  def estimateCardinality(self):
+    return self.subPlan.cardinality(True) * self.selectivity(True)
+
+  # Without a sample, the estimated selectivity is that of the predicate over the input's column statistics.
+  def selectivity(self, estimated):
+    if estimated and not self.sampleTested and self.statistics is not None:
+      return self.predicateSelectivity(self.selectExpr, self.subPlan.columnStatistics())
+    return super().selectivity(estimated)
@@ -1,4 +1,5 @@
-import random
+import math, random
+from Catalog.Statistics import Statistics
 from Query.Operator import Operator
 
 class TableScan(Operator):
@@ -8,6 +9,7 @@ class TableScan(Operator):
       super().__init__(**kwargs)
       self.relId      = relId
       self.relSchema  = schema
+      self.scanSynopsis = False
     else:
       raise ValueError("Invalid relation name or schema for a table scan")
 
@@ -33,21 +35,28 @@ class TableScan(Operator):
     return []
 
   # Volcano-style iterator abstraction
+  #
+  # When sampling, we scan the relation's synopsis if it has one (see
+  # Statistics.synopsis), and sample the relation's pages otherwise.
   def __iter__(self):
-    self.pageIterator = self.storage.pages(self.relId)
+    if self.sampled:
+      self.scanSynopsis = self.synopsis() is not None
+    scannedRelId = Statistics.synopsisRelation(self.relId) if self.sampled and self.scanSynopsis else self.relId
+
+    self.pageIterator = self.storage.pages(scannedRelId)
     self.nextPageId, self.nextPage = None, None
     self.pageSize, self.numPages, _ = self.storage.relationStats(self.relId)
 
     p = max(1, self.cardinality(False) / (self.pageSize * self.sampleFactor))
     self.sampleSize = p if self.sampled else 0
-    self.prevPageIndex, self.pagesToSample = (0, p)
+    self.pagesToSample = sorted(random.sample(range(self.numPages), min(self.numPages, math.ceil(p))))
     return self
 
   # Table scans are always pipelined.
   # While this implementation is more verbose than necessary, it conveys
   # the page-oriented processing style of all operators.
   def __next__(self):
-    if self.sampled:
+    if self.sampled and not self.scanSynopsis:
       return self.sampledOutput()
     else:
       return self.nextOutput()
@@ -65,19 +74,12 @@ class TableScan(Operator):
   # Our sampling algorithm returns whole pages, thus the number of
   # sampled elements is ceil(numSamples/pagesize) * pagesize
   #
-  # TODO: this uses the page iterator, which still pulls in all
-  # pages to the buffer pool. We should directly skip over unused pages.
+  # We pick the sampled pages up front, and only read these pages.
   def sampledOutput(self):
-    if self.pagesToSample > 0:
-      pageId, page = None, None
-      while pageId is None and page is None:
-        pr = self.pagesToSample / (1 + self.numPages - self.prevPageIndex)
-        pageId, page = self.nextOutput()
-        self.prevPageIndex = pageId.pageIndex
-        if pr >= random.random():
-          pageId, page = None, None
-      self.pagesToSample -= 1
-      return (pageId, page)
+    if self.pagesToSample:
+      relFile = self.storage.fileMgr.relationFile(self.relId)[1]
+      pageId  = relFile.pageId(self.pagesToSample.pop(0))
+      return (pageId, self.storage.bufferPool.getPage(pageId))
     else:
       raise StopIteration
 
@@ -110,11 +112,25 @@ class TableScan(Operator):
     _, _, r = self.storage.relationStats(self.relId)
     return r
 
+  # Returns the relation's synopsis from the statistics catalog, if any.
+  def synopsis(self):
+    return self.statistics.synopsis(self.relId) if self.statistics else None
+
+  # Synopsis scans represent the relation by the synopsis' tuples.
+  def sampleScale(self):
+    if self.scanSynopsis:
+      return self.cardinality(True) / max(1, self.synopsis().numTuples)
+    return self.sampleFactor
+
   # Returns the table's cost as the product of the table cardinality,
   # and the per-tuple cost.
   def cost(self, estimated):
     return self.cardinality(estimated) * self.tupleCost
 
+  # Table scan fields originate from the scanned relation.
+  def attributeSources(self):
+    return { f: (self.relId, f) for f in self.relSchema.fields }
+
   # A table scan returns a constant selectivity.
   def selectivity(self, estimated):
     return 1.0
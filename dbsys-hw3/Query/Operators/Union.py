@@ -93,3 +93,9 @@ class Union(Operator):
 
     # Return an iterator to the output relation
     return self.storage.pages(self.relationId())
+
+  # Our inputs may be sampled at different rates, thus we scale our sampled output
+  # by the ratio of our inputs' estimated and sampled cardinalities.
+  def sampleScale(self):
+    sampled = sum(x.cardinality(True) / x.sampleScale() for x in self.inputs())
+    return sum(x.cardinality(True) for x in self.inputs()) / sampled if sampled else self.sampleFactor
@@ -1,13 +1,25 @@
+import dis
+import heapq
 import itertools
+import math
+import random
+import struct
 import time
 
+from collections import OrderedDict
+
+from Catalog.Schema import DBSchema
 from Query.Plan import Plan
 from Query.Operators.Join import Join
 from Query.Operators.TableScan import TableScan 
+from Query.Operators.IndexScan import IndexScan
+from Query.Operators.BitmapHeapScan import BitmapHeapScan
+from Query.Operators.Exchange import Exchange
 from Query.Operators.Project import Project
 from Query.Operators.Select import Select
 from Query.Operators.GroupBy import GroupBy
-from Utils.ExpressionInfo import ExpressionInfo
+from Query.Operators.Union import Union
+from Utils.ExpressionInfo import ExpressionInfo, QueryParameter
 
 class Optimizer:
   """
@@ -89,6 +101,15 @@ class Optimizer:
   >>> result = db.optimizer.pickJoinOrder(query4)
   >>> print(result.explain())
 
+  # Plans over unanalyzed relations are estimated by sampling the relations' synopses,
+  # which are built on demand and kept across optimizations.
+  >>> synopsis = db.statistics.synopsis('employee')
+  >>> synopsis.numTuples == min(db.statistics.synopsisSize, db.storage.relationStats('employee')[2])
+  True
+  >>> _ = db.optimizer.pickJoinOrder(query4)
+  >>> db.statistics.synopsis('employee') is synopsis
+  True
+
   # Pushdown Optimization
   >>> query5 = db.query().fromTable('employee').union(db.query().fromTable('employee')).join( \
         db.query().fromTable('department'), \
@@ -97,101 +118,607 @@ class Optimizer:
         .select({'id': ('id', 'int'), 'eid':('eid','int')}).finalize()
 
 
-  # Pushdown Optimization
- # >>> query6 = db.query().fromTable('employee').union(db.query().fromTable('employee')).join( \
- #       db.query().fromTable('department'), \
- #       method='block-nested-loops', expr='id == eid')\
- #       .where('eid > 0 and id > 0 and (eid == 5 or id == 6)').finalize()
- # >>> print(db.optimizer.pickJoinOrder(query6).explain())
-
+  # Selection conjuncts are pushed through unions, with conjuncts spanning both join inputs
+  # joining the join predicate, and narrowing projections over the join inputs.
+  >>> print(db.optimizer.pushdownOperators(query5).explain()) # doctest: +ELLIPSIS
+  Project[...](projections={'id': ('id', 'int'), 'eid': ('eid', 'int')})
+    BNLJoin[...](expr='id == eid and (eid == 5 or id == 6)')
+      Project[...](projections={'eid': ('eid', 'int')})
+        Select[...](predicate='eid > 0')
+          TableScan[...](department)
+      UnionAll[...]
+        Project[...](projections={'id': ('id', 'int')})
+          Select[...](predicate='id > 0')
+            TableScan[...](employee)
+        Project[...](projections={'id': ('id', 'int')})
+          Select[...](predicate='id > 0')
+            TableScan[...](employee)
+
+  # Plan cost memoization. Greedy ordering re-costs the unchosen pairs of each step, and
+  # a repeated query reuses all costs, until one of its relations changes.
+  >>> import shutil
+  >>> memoDb = Database.Database(dataDir='optimizer-memo-test')
+  >>> for r in ['M1', 'M2', 'M3', 'M4']:
+  ...   memoDb.createRelation(r, [(r.lower() + 'a', 'int'), (r.lower() + 'b', 'int')])
+  ...   memoSchema = memoDb.relationSchema(r)
+  ...   _ = memoDb.insertTuples(r, [memoSchema.pack(memoSchema.instantiate(i, i % 10)) for i in range(100)])
+  >>> memoDb.analyze()
+  >>> memoQuery = memoDb.query().fromTable('M1').join(memoDb.query().fromTable('M2'), method='block-nested-loops', expr='m1a == m2a') \
+                    .join(memoDb.query().fromTable('M3'), method='block-nested-loops', expr='m2b == m3a') \
+                    .join(memoDb.query().fromTable('M4'), method='block-nested-loops', expr='m3b == m4b').finalize()
+
+  >>> greedy = GreedyOptimizer(memoDb)
+  >>> _ = greedy.pickJoinOrder(memoQuery)
+  >>> (greedy.reportPlanCount, greedy.planCacheHits)
+  (36, 6)
+
+  >>> _ = greedy.pickJoinOrder(memoQuery)
+  >>> (greedy.reportPlanCount, greedy.planCacheHits)
+  (36, 42)
+
+  >>> _ = memoDb.insertTuple('M4', memoSchema.pack(memoSchema.instantiate(100, 0)))
+  >>> _ = greedy.pickJoinOrder(memoQuery)
+  >>> (greedy.reportPlanCount, greedy.planCacheHits)
+  (36, 54)
+
+  # Rewrites modify operators in place, thus reset the signatures cached by operator id.
+  >>> memoPlan  = memoDb.query().fromTable('M1').join(memoDb.query().fromTable('M2'), \
+                    method='block-nested-loops', expr='m1a == m2a and m2b < 5').finalize()
+  >>> signature = greedy.planSignature(memoPlan.root)
+  >>> greedy.planSignature(greedy.pushdownOperators(memoPlan).root) == signature
+  False
+
+  >>> memoDb.close()
+  >>> shutil.rmtree('optimizer-memo-test')
+
+  # Cardinality feedback. Correlated predicates are underestimated until executed, after
+  # which the optimizer estimates the same sub-plans by their observed cardinalities.
+  >>> feedbackDb = Database.Database(dataDir='optimizer-feedback-test')
+  >>> for r in ['F1', 'F2']:
+  ...   feedbackDb.createRelation(r, [(r.lower() + 'a', 'int'), (r.lower() + 'b', 'int')])
+  ...   feedbackSchema = feedbackDb.relationSchema(r)
+  ...   _ = feedbackDb.insertTuples(r, [feedbackSchema.pack(feedbackSchema.instantiate(i % 100, i % 100)) for i in range(1000)])
+  >>> feedbackDb.analyze()
+  >>> def feedbackQuery():
+  ...   return feedbackDb.query().fromTable('F1').where('f1a < 10 and f1b < 10').join( \
+                 feedbackDb.query().fromTable('F2'), method='block-nested-loops', expr='f1a == f2a').finalize()
+  >>> def feedbackEstimates():
+  ...   plan = feedbackQuery()
+  ...   feedbackDb.optimizer.estimatePlan(plan)
+  ...   return [round(op.cardinality(True)) for (_, op) in plan.flatten() if not isinstance(op, TableScan)]
+
+  >>> feedbackEstimates()
+  [100, 10]
+  >>> len([tup for page in feedbackDb.processQuery(feedbackDb.optimizeQuery(feedbackQuery())) for tup in page[1]])
+  1000
+  >>> feedbackEstimates()
+  [1000, 100]
+  >>> print(feedbackDb.feedbackReport())
+  q-error=10.00 estimated=100 actual=1000 runs=1: F1, F2 where f1a < 10 and f1a == f2a and f1b < 10
+  q-error=10.00 estimated=10 actual=100 runs=1: F1 where f1a < 10 and f1b < 10
+
+  >>> feedbackDb.close()
+  >>> shutil.rmtree('optimizer-feedback-test')
+
+  # Join method selection. Equi-joins are also candidates for hash joins keyed on their
+  # equalities, and for indexed joins when the inner relation has an index on its join
+  # attributes, with any other conjuncts evaluated as a residual predicate.
+  >>> from Catalog.Schema import DBSchema
+  >>> def createJoinRelations(methodDb):
+  ...   for (r, n) in [('JS', 20), ('JB', 5000), ('JC', 10000)]:
+  ...     methodDb.createRelation(r, [(r.lower() + 'a', 'int'), (r.lower() + 'b', 'int')])
+  ...     methodSchema = methodDb.relationSchema(r)
+  ...     _ = methodDb.insertTuples(r, [methodSchema.pack(methodSchema.instantiate(i, i % 100)) for i in range(n)])
+  ...   _ = methodDb.storageEngine().createIndex('JB', methodDb.relationSchema('JB'), DBSchema('jbKey', [('jba', 'int')]), True)
+  ...   methodDb.analyze()
+  >>> def joinMethods(plan):
+  ...   return [op.joinMethod for (_, op) in plan.flatten() if isinstance(op, Join)]
+
+  >>> methodDb = Database.Database(dataDir='optimizer-method-test')
+  >>> createJoinRelations(methodDb)
+  >>> methodOpt = Optimizer(methodDb)
+  >>> def scanPlan(r):
+  ...   return Plan(root=TableScan(r, methodDb.relationSchema(r))).prepare(methodDb)
+
+  >>> candidates = methodOpt.joinCandidates(scanPlan('JS'), scanPlan('JB'), 'jsa == jba and jsb <= jbb')
+  >>> [(c.joinMethod, len([tup for page in Plan(root=c).prepare(methodDb) for tup in page[1]])) for c in candidates]
+  [('block-nested-loops', 20), ('nested-loops', 20), ('hash', 20), ('indexed', 20)]
+  >>> (candidates[2].lhsHashFn, candidates[2].rhsHashFn, candidates[2].joinExpr, candidates[3].joinExpr)
+  ('hash(jsa) % 1', 'hash(jba) % 1', 'jsb <= jbb', 'jsb <= jbb')
+
+  # Residual disjunctions keep their precedence within the residual conjunction.
+  >>> candidates = methodOpt.joinCandidates(scanPlan('JS'), scanPlan('JB'), 'jsa == jba and jsb <= jbb and (jsb == 1 or jbb == 2)')
+  >>> [(c.joinMethod, len([tup for page in Plan(root=c).prepare(methodDb) for tup in page[1]])) for c in candidates]
+  [('block-nested-loops', 2), ('nested-loops', 2), ('hash', 2), ('indexed', 2)]
+  >>> (candidates[2].joinExpr, candidates[3].joinExpr)
+  ('jsb <= jbb and (jsb == 1 or jbb == 2)', 'jsb <= jbb and (jsb == 1 or jbb == 2)')
+
+  # A small outer input probes the inner relation's index.
+  >>> methodQuery = methodDb.query().fromTable('JS').join(methodDb.query().fromTable('JB'), \
+                      method='block-nested-loops', expr='jsa == jba').finalize()
+  >>> joinMethods(methodOpt.pickJoinOrder(methodQuery))
+  ['indexed']
+
+  # Join predicate conjuncts over a single input are applied below the join.
+  >>> def pushdownQuery():
+  ...   return methodDb.query().fromTable('JS').join(methodDb.query().fromTable('JB'), \
+                 method='block-nested-loops', expr='jsa == jba and jsb < 5').select({'jbb': ('jbb', 'int')}).finalize()
+  >>> pushdownPlan = methodOpt.optimizeQuery(pushdownQuery())
+  >>> print(pushdownPlan.explain()) # doctest: +ELLIPSIS
+  Project[...](projections={'jbb': ('jbb', 'int')})
+    IndexJoin[...](indexKeySchema=lhsKey[(jsa,int)])
+      TableScan[...](JB)
+      Project[...](projections={'jsa': ('jsa', 'int')})
+        Select[...](predicate='jsb < 5')
+          TableScan[...](JS)
+  >>> sorted(bytes(tup) for page in methodDb.processQuery(pushdownPlan) for tup in page[1]) \
+        == sorted(bytes(tup) for page in methodDb.processQuery(pushdownQuery()) for tup in page[1])
+  True
+
+  # The optimizer rewrites a copy of the given plan, leaving the plan itself unchanged.
+  >>> originalPlan    = pushdownQuery()
+  >>> originalExplain = originalPlan.explain()
+  >>> _ = methodOpt.optimizeQuery(originalPlan)
+  >>> originalPlan.explain() == originalExplain
+  True
+  >>> methodDb.close()
+
+  # Large inputs for the buffer pool use a hash join, rather than many block nested loops passes.
+  >>> smallDb = Database.Database(dataDir='optimizer-method-test-small', pageSize=4096, poolSize=4 * 4096)
+  >>> createJoinRelations(smallDb)
+  >>> smallQuery = smallDb.query().fromTable('JB').join(smallDb.query().fromTable('JC'), \
+                     method='block-nested-loops', expr='jbb == jcb').finalize()
+  >>> smallPlan = Optimizer(smallDb).pickJoinOrder(smallQuery)
+  >>> joinMethods(smallPlan)
+  ['hash']
+  >>> len([tup for page in smallDb.processQuery(smallPlan) for tup in page[1]])
+  500000
+  >>> smallDb.close()
+
+  >>> shutil.rmtree('optimizer-method-test')
+  >>> shutil.rmtree('optimizer-method-test-small')
   """
 
+  # The maximum number of partitions of hash joins chosen by the optimizer.
+  maxHashPartitions = 32
+
+  # The maximum number of entries in the plan cost memo, evicted in LRU order.
+  maxPlanCosts = 4096
+
   def __init__(self, db):
     self.db = db
 
+    # A memo of estimated plan costs and cardinalities, keyed by plan signature.
+    # Entries record the versions of the plan's relations (see Database.relationVersion),
+    # and remain valid across queries until any of these relations change.
+    # Plan signatures are cached by operator id until operators are rewritten (see resetSignatures).
+    self.planCosts     = OrderedDict()
+    self.signatures    = {}
+    self.planCacheHits = 0
+
+    # Key schemas of candidate hash and indexed joins.
+    self.keySchemas    = {}
+
+    # Values of the query parameters in the plan being optimized (see Plan.parameterize).
+    self.parameters    = {}
+
+    # Cardinality feedback signatures, keyed by operator id and parameter values,
+    # and reset along with plan signatures.
+    self.feedbackSignatures = {}
+
   # Caches the cost of a plan computed during query optimization.
   def addPlanCost(self, plan, cost):
-    raise NotImplementedError
+    (key, entry) = (self.planKey(plan), (self.relationVersions(plan), cost, plan.root.cardinality(True)))
+    self.planCosts[key] = entry
+    self.planCosts.move_to_end(key)
+    while len(self.planCosts) > Optimizer.maxPlanCosts:
+      self.planCosts.popitem(last=False)
 
   # Checks if we have already computed the cost of this plan.
+  # Returns a (cost, cardinality) pair if so, and None otherwise.
   def getPlanCost(self, plan):
-    raise NotImplementedError
+    key   = self.planKey(plan)
+    entry = self.planCosts.get(key, None)
+    if entry and entry[0] == self.relationVersions(plan):
+      self.planCacheHits += 1
+      self.planCosts.move_to_end(key)
+      return entry[1:]
+    return None
+
+  # Plan costs are memoized by plan signature and the values of any query parameters.
+  def planKey(self, plan):
+    return (self.planSignature(plan.root), tuple(sorted(self.parameters.items())))
+
+  # Returns the estimated cost of a candidate plan, using the memo where possible.
+  def planCost(self, plan):
+    cached = self.getPlanCost(plan)
+    if cached:
+      return cached[0]
+
+    self.estimatePlan(plan)
+    cost = plan.cost(True)
+    self.addPlanCost(plan, cost)
+    return cost
+
+  # Returns the current version of each relation in a plan, including its size in the
+  # storage engine to detect changes made directly through the storage layer, and its
+  # cardinality feedback version to pick up any corrected estimates.
+  def relationVersions(self, plan):
+    return tuple((r, self.db.relationVersion(r), self.db.storage.relationStats(r)[2], self.db.feedback.version(r)) \
+                  for r in sorted(set(plan.relations())))
+
+  # Returns a canonical signature for the plan rooted at an operator, built from its
+  # relations, predicates (as sorted conjuncts) and join methods. Equivalent plans
+  # with reordered conjuncts share a signature.
+  def planSignature(self, operator):
+    if operator.id() not in self.signatures:
+      self.signatures[operator.id()] = self.operatorSignature(operator)
+    return self.signatures[operator.id()]
+
+  # Clears the plan and feedback signatures cached by operator id. Plan enumeration builds
+  # new operators over existing sub-plans, while rewrites such as pushdownOperators and
+  # useIndexScans modify operators in place, thus we reset the caches after each rewrite and query.
+  def resetSignatures(self):
+    self.signatures = {}
+    self.feedbackSignatures = {}
+
+  def operatorSignature(self, operator):
+    def conjuncts(expr):
+      return tuple(sorted(ExpressionInfo(expr).decomposeCNF())) if expr and expr.strip() != "True" else ()
+
+    def fields(schema):
+      return tuple(schema.fields) if schema else None
+
+    def values(key):
+      return tuple(key) if key is not None else None
+
+    inputs = tuple(self.planSignature(op) for op in operator.inputs())
+
+    if isinstance(operator, TableScan):
+      return ("scan", operator.relId)
+
+    elif isinstance(operator, IndexScan):
+      return ("index", operator.relId, operator.indexId, \
+              values(operator.key), values(operator.lowKey), values(operator.highKey), \
+              operator.lowInclusive, operator.highInclusive, operator.negate, fields(operator.includeSchema))
+
+    elif isinstance(operator, BitmapHeapScan):
+      return ("bitmap", operator.relId, operator.combine) + tuple(map(self.planSignature, operator.indexScans))
+
+    elif isinstance(operator, Select):
+      return ("select", conjuncts(operator.selectExpr)) + inputs
+
+    elif isinstance(operator, Join):
+      return ("join", operator.joinMethod, conjuncts(operator.joinExpr), \
+              fields(operator.lhsKeySchema), fields(operator.rhsKeySchema), \
+              operator.lhsHashFn, operator.rhsHashFn, getattr(operator, "indexId", None)) + inputs
+
+    elif isinstance(operator, Project):
+      return ("project", tuple(sorted((k, v[0]) for (k, v) in operator.projectExprs.items()))) + inputs
+
+    elif isinstance(operator, Union):
+      return ("union",) + inputs
+
+    # Group-by functions are equivalent if they share their code, default arguments
+    # and closure values, i.e., if built by the same code from the same values.
+    elif isinstance(operator, GroupBy):
+      def function(fn):
+        closure = tuple(cell.cell_contents for cell in fn.__closure__ or ())
+        return (fn.__code__, fn.__defaults__, closure)
+
+      try:
+        signature = ("groupby", tuple(operator.groupSchema.schema()), tuple(operator.aggSchema.schema()), \
+                     function(operator.groupExpr), function(operator.groupHashFn), \
+                     tuple((initial, function(incr), function(final)) for (initial, incr, final) in operator.aggExprs))
+        hash(signature)
+        return signature + inputs
+      except (AttributeError, TypeError, ValueError):
+        pass
+
+    # Other operators (e.g., group-bys with callable objects) are only equivalent to themselves.
+    return (operator.operatorType(), operator.id()) + inputs
+
+  # Prepares a candidate plan for cost estimation. Plans over analyzed relations
+  # are estimated from the statistics catalog (see Database.analyze), while plans
+  # over any unanalyzed relation are estimated by sampling, scanning the sample
+  # synopses of their relations rather than the relations themselves.
+  # Sub-plans executed by earlier queries use their observed cardinalities instead.
+  def estimatePlan(self, plan):
+    plan.parameters = self.parameters
+    plan.prepare(self.db)
+    if not self.db.statistics.hasStatistics(plan.relations()):
+      self.db.refreshSynopses(plan.relations())
+      plan.sample(100)
+    self.applyFeedback(plan)
+
+  # Cardinality feedback.
+  #
+  # Executed plans record the actual cardinalities of their operators in the database's
+  # feedback store (see Statistics.CardinalityFeedback). Sub-plans of scans, selections,
+  # projections and joins produce the same tuples regardless of their join order, join
+  # methods and access paths, thus we key these by their relations and their sorted
+  # predicate conjuncts, including any join keys, with bound query parameters. Other
+  # sub-plans are keyed by their plan signature (see planSignature).
+  def feedbackSignature(self, operator):
+    key = (operator.id(), tuple(sorted(operator.parameters.items())))
+    if key not in self.feedbackSignatures:
+      self.feedbackSignatures[key] = self.operatorFeedbackSignature(operator)
+    return self.feedbackSignatures[key]
+
+  def operatorFeedbackSignature(self, operator):
+    # Equalities between attributes are symmetric.
+    def normalize(conjunct):
+      sides = conjunct.split(" == ")
+      return " == ".join(sorted(sides)) if len(sides) == 2 and all(x.isidentifier() for x in sides) else conjunct
+
+    def conjuncts(expr):
+      if expr is None or expr.strip() == "True":
+        return []
+      if operator.parameters:
+        expr = ExpressionInfo(expr).bindParameters(operator.parameters)
+      return [normalize(c) for c in ExpressionInfo(expr).decomposeCNF()]
+
+    inputs = [self.feedbackSignature(op) for op in operator.inputs()]
+    if any(key[0] != "query" for key in inputs):
+      return ("plan", self.planSignature(operator))
+
+    # Index access paths built by the optimizer record the conjuncts they answer (see selectIndexScan).
+    sourceConjuncts = getattr(operator, "sourceConjuncts", None)
+    relations = []
+
+    if isinstance(operator, TableScan):
+      (relations, predicates) = ([operator.relId], [])
+    elif isinstance(operator, (IndexScan, BitmapHeapScan)) and sourceConjuncts is not None:
+      (relations, predicates) = ([operator.relId], [p for c in sourceConjuncts for p in conjuncts(c)])
+    elif isinstance(operator, Select):
+      predicates = conjuncts(operator.selectExpr)
+    elif isinstance(operator, Join):
+      predicates = conjuncts(operator.joinExpr) + [normalize(c) for c in operator.keyExprs()]
+    elif isinstance(operator, Project):
+      predicates = []
+    else:
+      return ("plan", self.planSignature(operator))
+
+    relations  = relations + [r for key in inputs for r in key[1]]
+    predicates = predicates + [p for key in inputs for p in key[2]]
+    return ("query", tuple(sorted(relations)), tuple(sorted(set(predicates))))
+
+  # Returns the current sizes of the relations accessed by an operator.
+  def relationSizes(self, operator):
+    return { r: self.db.storage.relationStats(r)[2] for r in Plan(root=operator).relations() }
+
+  # Overrides the estimates of a prepared plan's operators with their observed cardinalities,
+  # scaled to the current sizes of their relations.
+  def applyFeedback(self, plan):
+    if self.db.feedback.isEmpty():
+      return
+
+    for (_, operator) in plan.flatten():
+      key = self.feedbackSignature(operator)
+      if self.db.feedback.hasObservation(key):
+        operator.cardinalityFeedback = self.db.feedback.cardinality(key, self.relationSizes(operator))
+
+  # Records the estimated and actual cardinalities of an executed plan's operators. We skip
+  # table scans, whose cardinalities are exact, the RHS of indexed joins, which are accessed
+  # through their index, and the pipelines of parallel exchanges, which run in worker processes.
+  def recordFeedback(self, plan):
+    operators = [plan.root]
+    while operators:
+      operator = operators.pop()
+      if isinstance(operator, Join) and operator.joinMethod == "indexed":
+        operators.append(operator.lhsPlan)
+      elif not (isinstance(operator, Exchange) and operator.numWorkers > 1):
+        operators.extend(operator.inputs())
+
+      if not isinstance(operator, TableScan):
+        key = self.feedbackSignature(operator)
+        self.db.feedback.record(key, self.feedbackDescription(operator, key), self.relationSizes(operator), \
+                                operator.cardinality(True), operator.cardinality(False))
+
+  def feedbackDescription(self, operator, key):
+    if key[0] == "query":
+      return ", ".join(key[1]) + (" where " + " and ".join(key[2]) if key[2] else "")
+    return operator.operatorType() + " over " + ", ".join(sorted(self.relationSizes(operator)))
+
+  # Operator pushdown.
+  #
+  # Returns an equivalent plan with selections and projections pushed down towards
+  # the base relations. Selection predicates are split into their conjuncts, and each
+  # conjunct is placed above the lowest operator whose output covers its attributes.
+  # This includes any join predicate conjuncts over a single join input, while
+  # conjuncts spanning both inputs of a join are added to its join predicate.
+  #
+  # Conjuncts are pushed through projections whose output attributes are plain input
+  # attributes, renaming them as necessary, and into both inputs of a union. Group-bys
+  # compute their outputs with Python functions, thus we keep conjuncts above them.
+  #
+  # Joins, unions and group-bys then only read the attributes required by their
+  # ancestors, through narrowing projections over their inputs. Exchange pipelines,
+  # and the RHS relations of indexed joins, are left as is.
+  def pushdownOperators(self, plan):
+    root = self.pushdownSelections(plan.root, [])
+    root = self.pushdownProjections(root, None)
+    self.resetSignatures()
+
+    newPlan = Plan(root=root)
+    newPlan.prepare(self.db)
+    return newPlan
+
+  # Returns an operator with the given conjuncts pushed down into it, removing the
+  # operator's own selections and placing their conjuncts in the same way.
+  def pushdownSelections(self, operator, conjuncts):
+    if isinstance(operator, Select):
+      conjuncts = conjuncts + ExpressionInfo(operator.selectExpr).decomposeCNF()
+      return self.pushdownSelections(operator.subPlan, conjuncts)
+
+    remaining = []
+    if isinstance(operator, Project):
+      (pushed, remaining) = self.projectConjuncts(operator, conjuncts)
+      operator.subPlan = self.pushdownSelections(operator.subPlan, pushed)
+
+    elif isinstance(operator, Join):
+      remaining = self.joinConjuncts(operator, conjuncts)
+
+    elif isinstance(operator, Union):
+      operator.lhsPlan = self.pushdownSelections(operator.lhsPlan, conjuncts)
+      operator.rhsPlan = self.pushdownSelections(operator.rhsPlan, conjuncts)
+
+    elif isinstance(operator, GroupBy):
+      operator.subPlan = self.pushdownSelections(operator.subPlan, [])
+      remaining = conjuncts
+
+    else:
+      remaining = conjuncts
+
+    remaining = [c for c in dict.fromkeys(remaining) if c.strip() != "True"]
+    return Select(operator, ExpressionInfo.conjunction(remaining)) if remaining else operator
+
+  # Splits conjuncts over a projection's output into those over plain input attributes,
+  # renamed to the projection's input attributes, and those over computed attributes.
+  def projectConjuncts(self, project, conjuncts):
+    inputFields = project.subPlan.schema().fields
+    names = { f: expr.strip() for (f, (expr, _)) in project.projectExprs.items() if expr.strip() in inputFields }
+
+    pushed    = []
+    remaining = []
+    for c in conjuncts:
+      exprInfo = ExpressionInfo(c)
+      if exprInfo.getAttributes() <= set(names):
+        pushed.append(exprInfo.renameAttributes(names))
+      else:
+        remaining.append(c)
+
+    return (pushed, remaining)
+
+  # Pushes the given conjuncts and the join predicate's conjuncts into the inputs of a join
+  # that cover their attributes. Conjuncts spanning both inputs form the new join predicate,
+  # and we return the conjuncts over attributes the join does not produce.
+  #
+  # Inputs with a renamed schema are not pushed into, nor is the RHS of an indexed join,
+  # whose predicate is then evaluated as a residual over the index matches.
+  def joinConjuncts(self, join, conjuncts):
+    lhsFields = set(join.lhsSchema.fields)
+    rhsFields = set(join.rhsSchema.fields)
+    lhsPushed = join.lhsSchema.fields == join.lhsPlan.schema().fields
+    rhsPushed = join.rhsSchema.fields == join.rhsPlan.schema().fields and join.joinMethod != "indexed"
+
+    joinConjuncts = ExpressionInfo(join.joinExpr).decomposeCNF() if join.joinExpr else []
+    (lhsConjuncts, rhsConjuncts, spanning, remaining) = ([], [], [], [])
+
+    for c in joinConjuncts + conjuncts:
+      attrs = ExpressionInfo(c).getAttributes()
+      if lhsPushed and attrs <= lhsFields:
+        lhsConjuncts.append(c)
+      elif rhsPushed and attrs <= rhsFields:
+        rhsConjuncts.append(c)
+      elif attrs <= lhsFields | rhsFields:
+        spanning.append(c)
+      else:
+        remaining.append(c)
+
+    join.lhsPlan = self.pushdownSelections(join.lhsPlan, lhsConjuncts)
+    join.rhsPlan = self.pushdownSelections(join.rhsPlan, rhsConjuncts)
+
+    # Nested loops joins require a join predicate, unlike hash and indexed joins.
+    spanning = [c for c in dict.fromkeys(spanning) if c.strip() != "True"]
+    if spanning:
+      join.joinExpr = ExpressionInfo.conjunction(spanning)
+    else:
+      join.joinExpr = "True" if join.joinMethod in ["nested-loops", "block-nested-loops"] else None
+
+    return remaining
+
+  # Returns an operator producing at least the required attributes (or all of its
+  # attributes given None), with its inputs narrowed to the attributes it reads.
+  def pushdownProjections(self, operator, required):
+    if isinstance(operator, Project):
+      exprs = [expr for (expr, _) in operator.projectExprs.values()]
+      operator.subPlan = self.pushdownProjections(operator.subPlan, self.expressionAttributes(exprs))
+
+    elif isinstance(operator, Select):
+      if required is not None:
+        required = required | ExpressionInfo(operator.selectExpr).getAttributes()
+      operator.subPlan = self.pushdownProjections(operator.subPlan, required)
+
+    elif isinstance(operator, Join):
+      self.narrowJoin(operator, required)
+
+    elif isinstance(operator, Union):
+      operator.lhsPlan = self.narrowInput(operator.lhsPlan, required)
+      operator.rhsPlan = self.narrowInput(operator.rhsPlan, required)
+      operator.validateSchema()
+
+    elif isinstance(operator, GroupBy):
+      operator.subPlan   = self.narrowInput(operator.subPlan, self.groupByAttributes(operator))
+      operator.subSchema = operator.subPlan.schema()
+
+    return operator
+
+  # Narrows the inputs of a join to the attributes required by its ancestors, and those
+  # used by its join predicate, keys and hash functions.
+  def narrowJoin(self, join, required):
+    if required is not None:
+      exprs = [e for e in [join.joinExpr, join.lhsHashFn, join.rhsHashFn] if e]
+      keys  = [f for keySchema in [join.lhsKeySchema, join.rhsKeySchema] if keySchema for f in keySchema.fields]
+      required = required | self.expressionAttributes(exprs) | set(keys)
+
+    if join.lhsSchema.fields == join.lhsPlan.schema().fields:
+      join.lhsPlan   = self.narrowInput(join.lhsPlan, required)
+      join.lhsSchema = join.lhsPlan.schema()
+
+    if join.rhsSchema.fields == join.rhsPlan.schema().fields and join.joinMethod != "indexed":
+      join.rhsPlan   = self.narrowInput(join.rhsPlan, required)
+      join.rhsSchema = join.rhsPlan.schema()
+
+    join.joinSources = None
+    join.initializeSchema()
+
+  # Returns an operator producing the required attributes of the given input operator,
+  # adding a projection if the input produces any other attributes.
+  def narrowInput(self, operator, required):
+    operator = self.pushdownProjections(operator, required)
+    schema   = operator.schema()
+    if required is None or set(schema.fields) <= required:
+      return operator
+
+    # Projections must have at least one output attribute.
+    fields = [(f, t) for (f, t) in schema.schema() if f in required] or schema.schema()[:1]
+    if isinstance(operator, Project):
+      exprs = { f: operator.projectExprs[f] for (f, _) in fields }
+      return Project(operator.subPlan, exprs)
+    return Project(operator, { f: (f, t) for (f, t) in fields })
+
+  # Returns the names referenced by a list of expressions.
+  def expressionAttributes(self, exprs):
+    return set().union(*[ExpressionInfo(e).getAttributes() for e in exprs])
+
+  # Returns the input attributes read by a group-by's grouping and aggregate functions,
+  # or None if any function uses its input tuple other than by reading its attributes
+  # (e.g., indexing it by position), in which case the group-by requires all attributes.
+  def groupByAttributes(self, groupBy):
+    inputFields = groupBy.subSchema.fields
+    functions   = [(groupBy.groupExpr, 0)] + [(incrExpr, 1) for (_, incrExpr, _) in groupBy.aggExprs]
+
+    attributes = set()
+    for (fn, argIndex) in functions:
+      code = getattr(fn, "__code__", None)
+      if code is None or code.co_argcount <= argIndex or code.co_varnames[argIndex] in code.co_cellvars:
+        return None
+
+      tupleArg     = code.co_varnames[argIndex]
+      instructions = list(dis.get_instructions(fn))
+      for (instr, nextInstr) in zip(instructions, instructions[1:] + [None]):
+        loaded = instr.argval if isinstance(instr.argval, tuple) else (instr.argval,)
+        if instr.opname.startswith(("LOAD_FAST", "STORE_FAST", "DELETE_FAST")) and tupleArg in loaded:
+          readsAttribute = instr.opname.startswith("LOAD_FAST") and loaded.index(tupleArg) == len(loaded) - 1 \
+                             and nextInstr is not None and nextInstr.opname == "LOAD_ATTR" \
+                             and nextInstr.argval in inputFields
+          if not readsAttribute:
+            return None
+          attributes.add(nextInstr.argval)
+
+    return attributes
 
-#  def removeUnaryPlan(self, plan):
-#    fieldDict = {}
-#    selectList = []
-#    q = []
-#    q.append((plan.root,None, ""))
-#
-#    while len(q) > 0:
-#      (currNode, pNode, sub) = q.pop()
-#      if currNode.operatorType() == "Select":
-#        selectList.append(currNode)
-#        q.append((currNode.subPlan, currNode, "only"))
-#        if sub == "only":
-#          pNode.subPlan = currNode.subPlan
-#        elif sub == "left":
-#          pNode.lhsPlan = currNode.subPlan
-#        elif sub == "right":
-#          pNode.rhsPlan = currNode.subPlan
-#        else:
-#          plan.root = currNode.subPlan
-#      elif currNode.operatorType() == "Project":
-#        #TODO add implementation
-#        continue
-#      elif currNode.operatorType() == "TableScan":
-#        for f in currNode.schema().fields:
-#          fieldDict[f] = (pNode,sub)
-#        continue
-#      elif currNode.operatorType() == "GroupBy" or currNode.operatorType() == "Sort":
-#        q.append((currNode.subPlan, currNode, "only"))
-#      else: #join and union
-#        q.append((currNode.lhsPlan, currNode, "left"))
-#        q.append((currNode.rhsPlan, currNode, "right"))
-#    
-#    return (plan,selectList,fieldDict)
-
-  def decompSelects(self,selectList):
-    decompList = []
-
-    for s in selectList:
-      exprList = ExpressionInfo(s.selectExpr).decomposeCNF()
-      for e in exprList:
-        select = Select(None,e)
-        decompList.append(select)
-      return decompList
-  # Given a plan, return an optimized plan with both selection and
-  # projection operations pushed down to their nearest defining relation
-  # This does not need to cascade operators, but should determine a
-  # suitable ordering for selection predicates based on the cost model below.
-#  def pushdownOperators(self, plan):
-#    (removedPlan,selectList,fieldDict) = self.removeUnaryPlan(plan)
-#    decompList = self.decompSelects(selectList)
-#    
-#    for s in decompList:
-#      attrList = ExpressionInfo(s.selectExpr).getAttributes()
-#
-#      if len(attrList) == 1: #TODO should really be number of sources, not num attributes
-#        (pNode, sub) = fieldDict[attrList.pop()]
-#        if sub == "only":
-#          s.subPlan = pNode.subPlan
-#          pNode.subPlan = s
-#        elif sub == "left":
-#          s.subPlan = pNode.lhsPlan
-#          pNode.lhsPlan = s
-#        elif sub == "right":
-#          s.subPlan = pNode.rhsPlan
-#          pNode.rhsPlan = s
-#        else:
-#          s.subPlan = removedPlan.root
-#          removedPlan.root = s
-#      else:
-#        #TODO handle selects with multiple attributes (and dealing with projects)
-#        s.subPlan = removedPlan.root
-#        removedPlan.root = s
-#      
-#    return removedPlan
-    
   def obtainFieldDict(self, plan):
     q = []
     q.append(plan.root)
@@ -210,6 +737,7 @@ class Optimizer:
     
     return attrDict    
 
+  # Names other than relation attributes (e.g., query parameters) are ignored.
   def getExprDicts(self, plan, fieldDict):
     q = []
     q.append(plan.root)
@@ -225,7 +753,7 @@ class Optimizer:
         for selectExpr in selectExprList:
           attrList = ExpressionInfo(selectExpr).getAttributes()
           sourceList = [] 
-          for attr in attrList:
+          for attr in attrList & fieldDict.keys():
             source = fieldDict[attr]
             if source not in sourceList:
               sourceList.append(source)
@@ -235,20 +763,22 @@ class Optimizer:
             selectTablesDict[sourceTuple] = []
           selectTablesDict[sourceTuple].append(selectExpr)
       
-      elif "Join" in currNode.operatorType():
+      elif "Join" in currNode.operatorType() and currNode.joinExpr:
         joinExprList = ExpressionInfo(currNode.joinExpr).decomposeCNF()
         for joinExpr in joinExprList:
           attrList = ExpressionInfo(joinExpr).getAttributes()
           sourceList = [] 
-          for attr in attrList:
+          for attr in attrList & fieldDict.keys():
             source = fieldDict[attr]
             if source not in sourceList:
               sourceList.append(source)
 
+          # Join conjuncts over a single relation are applied as selections on it.
           sourceTuple = tuple(sorted(sourceList))
-          if sourceTuple not in joinTablesDict:
-            joinTablesDict[sourceTuple] = []
-          joinTablesDict[sourceTuple].append(joinExpr)
+          exprDict = selectTablesDict if len(sourceTuple) == 1 else joinTablesDict
+          if sourceTuple not in exprDict:
+            exprDict[sourceTuple] = []
+          exprDict[sourceTuple].append(joinExpr)
         
       if len(currNode.inputs()) > 1:
         q.append(currNode.lhsPlan)
@@ -262,6 +792,10 @@ class Optimizer:
   # Returns an optimized query plan with joins ordered via a System-R style
   # dyanmic programming algorithm. The plan cost should be compared with the
   # use of the cost model below.
+  #
+  # We only consider connected subsets of relations in the query's join graph,
+  # extending each with a relation that shares a predicate with it, thus avoiding
+  # cross products unless the join graph is disconnected.
   def pickJoinOrder(self, plan):
     relations = plan.relations()
     fieldDict = self.obtainFieldDict(plan)
@@ -270,70 +804,151 @@ class Optimizer:
     # then in system R we will build opt(A,B) Join C using join exprs involving A,C and B,C
     # and on top of it the select exprs that involve 2 tables A,C or B,C
 
-    isGroupBy = True if plan.root.operatorType() == "GroupBy" else False
-    outputSchema = plan.schema() 
-    optDict = {}
+    graph = self.joinGraph(relations, joinTablesDict, selectTablesDict)
+    optDict = self.singleRelationPlans(relations, selectTablesDict)
+    self.reportPlanCount = 0
 
-    for npass in range(1, len(relations) + 1):
-      if npass == 1:
-        for r in relations:
-          table = TableScan(r,self.db.relationSchema(r))
-          if (r,) in selectTablesDict: 
-            selectExprs = selectTablesDict[(r,)]
-            selectString = self.combineSelects(selectExprs)
-            select = Select(table,selectString)
-            optDict[(r,)] = Plan(root=select)
-          else:
-            optDict[(r,)] = Plan(root=table)
+    for subset in sorted(self.connectedSubgraphs(graph, relations), key=len):
+      if len(subset) > 1:
+        bestJoin = None
+        for rel in sorted(subset):
+          rest = sorted(subset - {rel})
+          if tuple(rest) in optDict and graph[rel] & set(rest):
+            (join, cost) = self.pickJoinMethod(optDict[tuple(rest)], optDict[(rel,)], \
+                                               rest, [rel], joinTablesDict, selectTablesDict)
+            if bestJoin == None or cost < bestCost:
+              (bestJoin, bestCost) = (join, cost)
+
+        if bestJoin:
+          bestJoin.prepare(self.db)
+          optDict[tuple(sorted(subset))] = bestJoin
+
+    return self.completePlan(plan, optDict[tuple(sorted(relations))])
+
+  # Returns initial plans for each relation, applying its selection predicates.
+  def singleRelationPlans(self, relations, selectTablesDict):
+    optDict = {}
+    for r in relations:
+      table = TableScan(r,self.db.relationSchema(r))
+      if (r,) in selectTablesDict: 
+        selectExprs = selectTablesDict[(r,)]
+        selectString = self.combineSelects(selectExprs)
+        select = Select(table,selectString)
+        optDict[(r,)] = Plan(root=select)
       else:
-        combinations = itertools.combinations(relations,npass)
-        for c in combinations:
-          clist = sorted(c)
-          bestJoin = None
-          for rel in clist:
-            temp = list(clist)
-            temp.remove(rel)
-            leftOps = optDict[tuple(temp)].root
-            rightOps = optDict[(rel,)].root
-
-            selectExpr = self.createExpression(temp, [rel], selectTablesDict)
-            joinExpr = self.createExpression(temp, [rel], joinTablesDict)
-            
-            joinBnljOp = Join(leftOps, rightOps, expr=joinExpr, method="block-nested-loops" )
-            fullBnljOp = Select(joinBnljOp, selectExpr)
-
-            if selectExpr == "True":
-              joinBnlj = Plan(root=joinBnljOp)
-            else:
-              joinBnlj = Plan(root=fullBnljOp)
-            
-            joinBnlj.prepare(self.db)
-            joinBnlj.sample(100)
-            
-            joinNljOp = Join(leftOps, rightOps, expr=joinExpr, method="nested-loops" )
-            fullNljOp = Select(joinNljOp, selectExpr)
-
-            if selectExpr == "True":
-              joinNlj = Plan(root=joinNljOp)
-            else:
-              joinNlj = Plan(root=fullNljOp)
-            
-            joinNlj.prepare(self.db)
-            joinNlj.sample(100)
-
-            if joinBnlj.cost(True) < joinNlj.cost(True):
-              if bestJoin == None or joinBnlj.cost(True) < bestJoin.cost(True):
-                bestJoin = joinBnlj
-            else:
-              if bestJoin == None or joinNlj.cost(True) < bestJoin.cost(True):
-                bestJoin = joinNlj
-    
-            self.clearSampleFiles()
-
-          optDict[tuple(clist)] = bestJoin
-          
-    # after System R algorithm
-    newPlan = optDict[tuple(sorted(relations))]
+        optDict[(r,)] = Plan(root=table)
+      optDict[(r,)].prepare(self.db)
+    return optDict
+
+  # Returns the cheapest join of the given plans, over the relation lists lList and
+  # rList respectively, as a pair of the join plan and its cost. The join applies
+  # all join predicates between the two sides, and any selection predicates spanning
+  # them are applied immediately above the join.
+  def pickJoinMethod(self, lhsPlan, rhsPlan, lList, rList, joinTablesDict, selectTablesDict):
+    selectExpr = self.createExpression(lList, rList, selectTablesDict)
+    joinExpr   = self.createExpression(lList, rList, joinTablesDict)
+
+    bestJoin = None
+    for joinOp in self.joinCandidates(lhsPlan, rhsPlan, joinExpr):
+      join   = Plan(root=joinOp if selectExpr == "True" else Select(joinOp, selectExpr))
+      cost   = self.planCost(join)
+      self.reportPlanCount += 1
+
+      if bestJoin == None or cost < bestCost:
+        (bestJoin, bestCost) = (join, cost)
+
+    self.clearSampleFiles()
+    return (bestJoin, bestCost)
+
+  # Join method selection.
+  #
+  # Returns the candidate join operators for joining two plans with a join expression.
+  # Nested loops joins apply to any join expression. Equi-joins also use a hash join
+  # keyed on their equalities between attributes, and an indexed join if the RHS is
+  # a base relation with an index matching the RHS attributes of these equalities.
+  # Any remaining conjuncts are evaluated by the hash or indexed join as a residual.
+  def joinCandidates(self, lhsPlan, rhsPlan, joinExpr):
+    candidates = [Join(lhsPlan.root, rhsPlan.root, expr=joinExpr, method=method) \
+                    for method in ["block-nested-loops", "nested-loops"]]
+
+    (keys, residuals) = self.equiJoinKeys(lhsPlan.schema(), rhsPlan.schema(), joinExpr)
+    if keys:
+      candidates.append(self.hashJoin(lhsPlan, rhsPlan, keys, residuals))
+      indexJoin = self.indexedJoin(lhsPlan, rhsPlan, keys, residuals)
+      if indexJoin:
+        candidates.append(indexJoin)
+
+    return candidates
+
+  # Splits a join expression into (lhs attribute, rhs attribute) pairs of equalities
+  # between attributes of the same type, and a list of residual conjuncts.
+  def equiJoinKeys(self, lhsSchema, rhsSchema, joinExpr):
+    if joinExpr is None or joinExpr.strip() == "True":
+      return ([], [])
+
+    lhsTypes = dict(zip(lhsSchema.fields, lhsSchema.types))
+    rhsTypes = dict(zip(rhsSchema.fields, rhsSchema.types))
+    (equalities, residuals) = ExpressionInfo(joinExpr).equiJoinComponents(set(lhsSchema.fields), set(rhsSchema.fields))
+
+    keys = []
+    for (lhsExpr, rhsExpr) in equalities:
+      if lhsExpr in lhsTypes and rhsExpr in rhsTypes and lhsTypes[lhsExpr] == rhsTypes[rhsExpr]:
+        keys.append((lhsExpr, rhsExpr))
+      else:
+        residuals.append(lhsExpr + " == " + rhsExpr)
+
+    return (keys, residuals)
+
+  # Returns a key schema over the given fields of a schema, reusing key schemas across candidate joins.
+  def keySchema(self, name, schema, fields):
+    fieldsAndTypes = tuple((f, schema.types[schema.fields.index(f)]) for f in fields)
+    if (name, fieldsAndTypes) not in self.keySchemas:
+      self.keySchemas[(name, fieldsAndTypes)] = DBSchema(name, list(fieldsAndTypes))
+    return self.keySchemas[(name, fieldsAndTypes)]
+
+  # Returns a hash join on the given key pairs. Both hash functions partition tuples by
+  # the hash of their key values, using enough partitions for the smaller input to
+  # have about a page per partition, up to a limit on the number of partition files.
+  def hashJoin(self, lhsPlan, rhsPlan, keys, residuals):
+    (lhsFields, rhsFields) = (list(k) for k in zip(*keys))
+
+    pageSize   = self.db.storage.bufferPool.pageSize
+    inputPages = min(plan.root.cardinality(True) * plan.schema().size / pageSize for plan in [lhsPlan, rhsPlan])
+    partitions = max(1, min(Optimizer.maxHashPartitions, math.ceil(inputPages)))
+
+    def hashFn(fields):
+      key = fields[0] if len(fields) == 1 else "(" + ", ".join(fields) + ")"
+      return "hash(" + key + ") % " + str(partitions)
+
+    return Join(lhsPlan.root, rhsPlan.root, method="hash", expr=ExpressionInfo.conjunction(residuals) or None, \
+                lhsKeySchema=self.keySchema("lhsKey", lhsPlan.schema(), lhsFields), lhsHashFn=hashFn(lhsFields), \
+                rhsKeySchema=self.keySchema("rhsKey", rhsPlan.schema(), rhsFields), rhsHashFn=hashFn(rhsFields))
+
+  # Returns an indexed join on the given key pairs, or None if the RHS is not a base
+  # relation with an index matching either all RHS key attributes, or any single one.
+  # A selection over the RHS relation is evaluated as part of the join's residual.
+  def indexedJoin(self, lhsPlan, rhsPlan, keys, residuals):
+    (scan, rhsExprs) = (rhsPlan.root, [])
+    if isinstance(scan, Select) and isinstance(scan.subPlan, TableScan):
+      (scan, rhsExprs) = (scan.subPlan, [rhsPlan.root.selectExpr])
+    if not isinstance(scan, TableScan):
+      return None
+
+    storage = self.db.storageEngine()
+    for indexKeys in [keys] + ([[k] for k in keys] if len(keys) > 1 else []):
+      indexId = storage.matchIndex(scan.relId, self.keySchema("indexKey", scan.schema(), [r for (_, r) in indexKeys]))
+      if indexId is not None:
+        remaining = [l + " == " + r for (l, r) in keys if (l, r) not in indexKeys]
+        joinExpr  = ExpressionInfo.conjunction(remaining + residuals + rhsExprs) or None
+        return Join(lhsPlan.root, scan, method="indexed", expr=joinExpr, indexId=indexId, \
+                    lhsKeySchema=self.keySchema("lhsKey", lhsPlan.schema(), [l for (l, _) in indexKeys]))
+
+    return None
+
+  # Adds any group-by and projection of the original plan above an optimized join plan.
+  def completePlan(self, plan, newPlan):
+    isGroupBy = True if plan.root.operatorType() == "GroupBy" else False
+    outputSchema = plan.schema() 
 
     if isGroupBy:
       newGroupBy = GroupBy(newPlan.root, groupSchema=plan.root.groupSchema, \
@@ -356,57 +971,357 @@ class Optimizer:
   
     return newPlan
 
+  # Join graph enumeration.
+  #
+  # Returns the join graph of a query, as a dictionary mapping each relation to the
+  # set of relations sharing a join or selection predicate with it. If the graph is
+  # disconnected, we add cross product edges between all relations of distinct
+  # components, such that cross products are only considered between components.
+  def joinGraph(self, relations, joinTablesDict, selectTablesDict):
+    graph = {r: set() for r in relations}
+    for exprDict in [joinTablesDict, selectTablesDict]:
+      for rels in exprDict:
+        for (r1, r2) in itertools.combinations(rels, 2):
+          graph[r1].add(r2)
+          graph[r2].add(r1)
+
+    components = self.connectedComponents(graph)
+    for (c1, c2) in itertools.combinations(components, 2):
+      for (r1, r2) in itertools.product(c1, c2):
+        graph[r1].add(r2)
+        graph[r2].add(r1)
+
+    return graph
+
+  def connectedComponents(self, graph):
+    components = []
+    visited = set()
+    for r in graph:
+      if r not in visited:
+        component = {r}
+        frontier  = [r]
+        while frontier:
+          for n in graph[frontier.pop()] - component:
+            component.add(n)
+            frontier.append(n)
+        visited |= component
+        components.append(component)
+    return components
+
+  # Returns the relations adjacent to a set of relations in the join graph.
+  def neighborhood(self, graph, subset):
+    return set().union(*(graph[r] for r in subset)) - subset
+
+  # Returns all connected subgraphs of the join graph, as frozensets of relations, where
+  # relations are numbered by their position in the given order. Each subgraph is
+  # enumerated exactly once, by expanding from its lowest-numbered relation (DPccp's
+  # EnumerateCsg, see Moerkotte and Neumann, VLDB 2006).
+  def connectedSubgraphs(self, graph, order):
+    for i in reversed(range(len(order))):
+      subset = frozenset([order[i]])
+      yield subset
+      yield from self.expandSubgraph(graph, subset, frozenset(order[:i+1]))
+
+  # Yields all connected supersets of a subgraph, extended only with relations outside the exclusion set.
+  def expandSubgraph(self, graph, subset, excluded):
+    neighbors  = self.neighborhood(graph, subset) - excluded
+    extensions = [frozenset(c) for k in range(1, len(neighbors) + 1) for c in itertools.combinations(sorted(neighbors), k)]
+    for extension in extensions:
+      yield subset | extension
+    for extension in extensions:
+      yield from self.expandSubgraph(graph, subset | extension, excluded | neighbors)
+
+  # Returns all connected subgraphs that are disjoint from, and adjacent to, the given
+  # connected subgraph (DPccp's EnumerateCmp). With connectedSubgraphs, this yields
+  # every pair of connected subgraphs whose union is connected exactly once.
+  def complementSubgraphs(self, graph, subset, order):
+    index     = {r: i for (i, r) in enumerate(order)}
+    excluded  = frozenset(order[:min(index[r] for r in subset) + 1]) | subset
+    neighbors = self.neighborhood(graph, subset) - excluded
+    for v in sorted(neighbors, key=index.get, reverse=True):
+      yield frozenset([v])
+      yield from self.expandSubgraph(graph, frozenset([v]), \
+                   excluded | frozenset(n for n in neighbors if index[n] <= index[v]))
+
+  # Returns all (connected subgraph, connected complement) pairs of the join graph.
+  def connectedPairs(self, graph, order):
+    return [(s1, s2) for s1 in self.connectedSubgraphs(graph, order) for s2 in self.complementSubgraphs(graph, s1, order)]
+
+  # Returns the conjunction of all predicates in exprDict spanning both relation lists,
+  # that is, over relations from lList and rList, and no others.
   def createExpression(self, lList, rList, exprDict):
-   
-    lcombos = []
-    lTemp = []
-    rcombos = []
-    rTemp = []
-    for i in range(1, len(lList) + 1):
-      lTemp.extend(itertools.combinations(lList,i))
-    lcombos = [list(elem) for elem in lTemp]
-    for i in range(1, len(rList) + 1):
-      rTemp.extend(list(itertools.combinations(rList,i)))
-    rcombos = [list(elem) for elem in rTemp]
-    plist = list(itertools.product(lcombos,rcombos))
-   
-    masterlist = []
-
-    for elem in plist:
-      item1 = elem[0]
-      item2 = elem[1]
-      item1.extend(item2)
-      masterlist.append(sorted(item1))
-      
-    exprString = ""
-   
-    for listc in masterlist:
-      c = tuple(listc)
-      if c in exprDict:
-        for s in exprDict[c]:
-          exprString += s + " and "
-    
-    if(exprString == ""):
-      return "True"
-    exprString = exprString[:len(exprString) - 5]
-    
-    return exprString
+    lSet = set(lList)
+    rSet = set(rList)
+
+    exprs = []
+    for (rels, relExprs) in sorted(exprDict.items()):
+      if lSet.intersection(rels) and rSet.intersection(rels) and set(rels) <= lSet | rSet:
+        exprs.extend(relExprs)
+
+    return ExpressionInfo.conjunction(exprs) if exprs else "True"
 
   def combineSelects(self,selectExprs):
-    selectString = ""
-    for s in selectExprs:
-      selectString += s
-      selectString += " and "
+    return ExpressionInfo.conjunction(selectExprs)
+
+  # Index selection.
+  #
+  # Returns a query plan where selections over table scans use index scans if any
+  # conjuncts of the selection predicate match an index on the relation. The matched
+  # conjuncts are answered by the index, while the remaining conjuncts are evaluated
+  # by a residual selection over the index scan.
+  #
+  # Below a projection, we track the attributes required by the projection and any
+  # intermediate selections. Scans whose required attributes are all covered by
+  # a covering index (i.e., by its key and included columns) use an index-only scan,
+  # as do the RHS inputs of indexed joins over a covering index.
+  def useIndexScans(self, plan):
+    newPlan = Plan(root=self.indexScanRewrite(plan.root))
+    self.resetSignatures()
+    newPlan.prepare(self.db)
+    return newPlan
 
-    selectString = selectString[:len(selectString) - 5]
-    return selectString
+  def indexScanRewrite(self, operator, required=None):
+    if isinstance(operator, Select) and isinstance(operator.subPlan, TableScan):
+      return self.selectIndexScan(operator, required)
+
+    if isinstance(operator, TableScan) and required is not None:
+      return self.coveringIndexScan(operator, required) or operator
+
+    # Exchange pipelines must end in a table scan.
+    if isinstance(operator, Exchange):
+      return operator
+
+    # The RHS of an indexed join is accessed through the join's own index.
+    children = ["subPlan", "lhsPlan", "rhsPlan"]
+    if isinstance(operator, Join) and operator.joinMethod == "indexed":
+      children.remove("rhsPlan")
+      if required is not None:
+        self.coveringIndexJoin(operator, required)
+
+    # Projections and selections read their input schema when processing tuples, and
+    # thus support index-only inputs. Other operators require all input attributes.
+    if isinstance(operator, Project):
+      required = set().union(*[ExpressionInfo(e).getAttributes() for (e, _) in operator.projectExprs.values()])
+    elif isinstance(operator, Select) and required is not None:
+      required = required | ExpressionInfo(operator.selectExpr).getAttributes()
+    else:
+      required = None
+
+    for attr in children:
+      child = getattr(operator, attr, None)
+      if child is not None:
+        setattr(operator, attr, self.indexScanRewrite(child, required))
+
+    return operator
+
+  # Returns the covering indexes of a relation whose key and included columns contain
+  # all the given attributes, as (key schema, primary, index id, include schema) tuples.
+  def coveringIndexes(self, relId, attributes):
+    storage = self.db.storageEngine()
+    indexes = []
+    for (keySchema, primary, indexId) in storage.indexes(relId):
+      includeSchema = storage.indexIncludes(indexId)
+      if includeSchema is not None and attributes <= set(keySchema.fields + includeSchema.fields):
+        indexes.append((keySchema, primary, indexId, includeSchema))
+    return indexes
+
+  # Returns a full index-only scan replacing a table scan, or None if no index covers
+  # the required attributes.
+  def coveringIndexScan(self, scan, required):
+    indexes = self.coveringIndexes(scan.relId, required & set(scan.schema().fields))
+    if indexes:
+      (keySchema, _, indexId, includeSchema) = indexes[0]
+      indexScan = IndexScan(scan.relId, scan.schema(), indexId, keySchema, includeSchema=includeSchema)
+      indexScan.sourceConjuncts = []
+      return indexScan
+
+  # Replaces the RHS table scan of an indexed join with an index-only scan, if the join's
+  # index covers the required RHS attributes. Joins renaming their RHS are left as is.
+  def coveringIndexJoin(self, join, required):
+    rhs = join.rhsPlan
+    if not isinstance(rhs, TableScan) or join.rhsSchema.fields != rhs.schema().fields:
+      return
+
+    if join.joinExpr:
+      required = required | ExpressionInfo(join.joinExpr).getAttributes()
+
+    covering = self.coveringIndexes(rhs.relId, required & set(rhs.schema().fields))
+    for (keySchema, _, indexId, includeSchema) in covering:
+      if indexId == join.indexId:
+        join.rhsPlan   = IndexScan(rhs.relId, rhs.schema(), indexId, keySchema, includeSchema=includeSchema)
+        join.rhsPlan.sourceConjuncts = []
+        join.rhsSchema = join.rhsPlan.schema()
+        join.joinSources = None
+        join.initializeSchema()
+
+  # Returns the cheapest index access path and residual selection for a selection over
+  # a table scan, or the selection itself if no index matches the predicate.
+  #
+  # A primary key lookup yields a single tuple, and uses an index scan. Otherwise, when
+  # the required attributes are known and covered by an index, we use an index-only scan
+  # over the best matching covering index. We fall back to a full index-only scan if
+  # no index matches the predicate. Otherwise, we use a bitmap heap scan, considering
+  # indexes in order of their estimated selectivity, and intersecting the matches of
+  # any index answering disjoint conjuncts of the predicate if it lowers the estimated
+  # cost of the access path. We keep the table scan if no index lowers its cost.
+  # Bitmap indexes also answer inequalities as negated lookups, which are only used
+  # when intersected with other index matches, while hash indexes only answer equalities.
+  #
+  # Comparisons with query parameters use index keys bound when executing the index scan,
+  # for any of their values. These comparisons are also evaluated by the residual selection,
+  # since index scans whose bound keys are not index keys retrieve all index entries.
+  def selectIndexScan(self, select, required=None):
+    scan        = select.subPlan
+    conjuncts   = ExpressionInfo(select.selectExpr).decomposeCNF()
+    comparisons = [ExpressionInfo(c).sargableComparison(set(scan.schema().fields), self.parameters) for c in conjuncts]
+    rechecked   = set(i for (i, c) in enumerate(comparisons) if c and isinstance(c[2], QueryParameter))
+    storage     = self.db.storageEngine()
+
+    candidates = []
+    for (keySchema, primary, indexId) in storage.indexes(scan.relId):
+      match = self.matchIndexKey(keySchema, primary, comparisons, storage.indexKind(indexId))
+      if match:
+        candidates.append(match + (keySchema, indexId))
+
+    if all(scanArgs.get("negate", False) for (_, scanArgs, _, _, _) in candidates):
+      candidates = []
+
+    candidates.sort(key=lambda x: x[0])
+    primaryLookup = bool(candidates) and candidates[0][0] == 0
+
+    covering = []
+    if required is not None and not primaryLookup:
+      attributes = (required | ExpressionInfo(select.selectExpr).getAttributes()) & set(scan.schema().fields)
+      for (keySchema, primary, indexId, includeSchema) in self.coveringIndexes(scan.relId, attributes):
+        match = self.matchIndexKey(keySchema, primary, comparisons, storage.indexKind(indexId))
+        if match or not candidates:
+          covering.append((match or (6, {}, set())) + (keySchema, indexId, includeSchema))
+      covering.sort(key=lambda x: x[0])
+
+    if covering:
+      (_, scanArgs, matched, keySchema, indexId, includeSchema) = covering[0]
+      indexScan = IndexScan(scan.relId, scan.schema(), indexId, keySchema, includeSchema=includeSchema, **scanArgs)
+
+    elif not candidates:
+      return select
+
+    elif primaryLookup:
+      (_, scanArgs, matched, keySchema, indexId) = candidates[0]
+      indexScan = IndexScan(scan.relId, scan.schema(), indexId, keySchema, **scanArgs)
+
+    else:
+      indexScans = []
+      for (_, scanArgs, indexMatched, keySchema, indexId) in candidates:
+        indexScan = IndexScan(scan.relId, scan.schema(), indexId, keySchema, **scanArgs)
+        indexScan.prepare(self.db)
+        indexScan.bindParameters(self.parameters)
+        indexScans.append((indexScan.keySelectivity(), indexScan, indexMatched))
+      indexScans.sort(key=lambda x: x[0])
+
+      (chosen, matched, bestCost) = ([], set(), self.accessPathCost(select))
+      for (_, indexScan, indexMatched) in indexScans:
+        if not matched.isdisjoint(indexMatched) or (indexScan.negate and not chosen):
+          continue
+
+        accessPath = BitmapHeapScan(scan.relId, scan.schema(), chosen + [indexScan], combine="and")
+        cost = self.accessPathCost(self.residualSelect(accessPath, conjuncts, (matched | indexMatched) - rechecked))
+        if cost < bestCost:
+          (chosen, matched, bestCost) = (chosen + [indexScan], matched | indexMatched, cost)
+
+      if not chosen:
+        return select
+
+      indexScan = BitmapHeapScan(scan.relId, scan.schema(), chosen, combine="and")
+
+    indexScan.sourceConjuncts = [c for (i, c) in enumerate(conjuncts) if i in matched]
+    return self.residualSelect(indexScan, conjuncts, matched - rechecked)
+
+  # Returns an access path with a selection of the conjuncts it does not answer, if any.
+  def residualSelect(self, accessPath, conjuncts, answered):
+    residuals = [c for (i, c) in enumerate(conjuncts) if i not in answered]
+
+    if not residuals:
+      return accessPath
+    elif len(residuals) == 1:
+      return Select(accessPath, residuals[0])
+    else:
+      return Select(accessPath, ExpressionInfo.conjunction(residuals))
+
+  # Returns the estimated cost of a candidate access path from the statistics catalog.
+  def accessPathCost(self, accessPath):
+    return Plan(root=accessPath, parameters=self.parameters).prepare(self.db).cost(True)
+
+  # Matches sargable comparisons against an index key, returning a triple of the access
+  # rank (lower is better), the index scan arguments, and the positions of the matched
+  # comparisons, or None if the index cannot be used.
+  #
+  # Equality comparisons on all key fields yield a point lookup, ranked ahead of range
+  # scans on single-field keys. Primary indexes are preferred over secondary indexes,
+  # and bounded ranges over half-open ranges. Hash indexes (i.e., of the "hash" kind)
+  # only support point lookups. Inequalities on bitmap indexes yield negated point
+  # lookups, ranked last.
+  def matchIndexKey(self, keySchema, primary, comparisons, kind="btree"):
+    def find(field, ops):
+      return next((i for (i, c) in enumerate(comparisons) if c and c[0] == field and c[1] in ops), None)
+
+    equalities = [find(f, ['==']) for f in keySchema.fields]
+    if None not in equalities:
+      key = tuple(comparisons[i][2] for i in equalities)
+      if self.isIndexKey(keySchema, key):
+        return (0 if primary else 1, {"key": key}, set(equalities))
+
+    if kind != "hash" and len(keySchema.fields) == 1:
+      low  = find(keySchema.fields[0], ['>', '>='])
+      high = find(keySchema.fields[0], ['<', '<='])
+      low  = low  if low  is not None and self.isIndexKey(keySchema, (comparisons[low][2],))  else None
+      high = high if high is not None and self.isIndexKey(keySchema, (comparisons[high][2],)) else None
+
+      if low is not None or high is not None:
+        scanArgs = {}
+        if low is not None:
+          scanArgs.update(lowKey=(comparisons[low][2],), lowInclusive=comparisons[low][1] == '>=')
+        if high is not None:
+          scanArgs.update(highKey=(comparisons[high][2],), highInclusive=comparisons[high][1] == '<=')
+
+        matched = set(i for i in [low, high] if i is not None)
+        return ((2 if len(matched) == 2 else 4) + (0 if primary else 1), scanArgs, matched)
+
+    if kind == "bitmap" and len(keySchema.fields) == 1:
+      other = find(keySchema.fields[0], ['!='])
+      other = other if other is not None and not isinstance(comparisons[other][2], QueryParameter) else None
+      if other is not None and self.isIndexKey(keySchema, (comparisons[other][2],)):
+        return (6, {"key": (comparisons[other][2],), "negate": True}, set([other]))
+
+    return None
+
+  # Returns whether the given values can be packed as an index key without any loss
+  # of precision, truncation or overflow, and thus be used for an index lookup.
+  # Query parameters are checked with their values in the plan being optimized.
+  def isIndexKey(self, keySchema, values):
+    try:
+      values = QueryParameter.bindValues(values, self.parameters)
+      packed = keySchema.packKey(keySchema.instantiate(*values))
+      return tuple(keySchema.unpackKey(packed)) == tuple(values)
+    except (struct.error, TypeError, ValueError, OverflowError):
+      return False
 
   # Optimize the given query plan, returning the resulting improved plan.
-  # This should perform operation pushdown, followed by join order selection.
+  # This performs operation pushdown, followed by join order selection,
+  # and finally index selection. Join ordering rebuilds the plan's joins
+  # from its predicates, thus we push down projections over the new joins again.
+  #
+  # Query parameters are estimated with their values in the given plan, and the
+  # optimized plan binds these values. Since rewrites modify operators in place,
+  # we optimize a copy of the given plan, which is left unchanged.
   def optimizeQuery(self, plan):
-    #pushedDown_plan = self.pushdownOperators(plan)
+    self.resetSignatures()
+    plan = plan.copy()
+    self.parameters = plan.parameters
+    pushedDown_plan = self.pushdownOperators(plan)
     #start = time.time()
-    joinPicked_plan = self.pickJoinOrder(plan)
+    joinPicked_plan = self.useIndexScans(self.pushdownOperators(self.pickJoinOrder(pushedDown_plan)))
+    if plan.parameters:
+      joinPicked_plan.bindParameters(plan.parameters)
     #end = time.time()
 
     #bushyOutput = open("bushy12Tests.txt", "a")
@@ -418,7 +1333,8 @@ class Optimizer:
 
 
   def clearSampleFiles(self):
-    temp_rels = filter(lambda rel: rel not in self.db.relations(), self.db.storage.relations())
+    temp_rels = filter(lambda rel: rel not in self.db.relations() and not self.db.statistics.isSynopsisRelation(rel), \
+                       self.db.storage.relations())
     for rel in list(temp_rels):
       self.db.storage.removeRelation(rel) 
 
@@ -430,233 +1346,492 @@ if __name__ == "__main__":
 
 
 class BushyOptimizer(Optimizer):
+  """
+  A bushy join order optimizer, using the DPccp dynamic programming algorithm.
+
+  This enumerates every pair of connected subgraphs of the query's join graph
+  whose union is connected, and joins their best plans in both orders. Thus,
+  we never consider joins without a predicate between their inputs, unless
+  the join graph itself is disconnected.
+
+  >>> import Database, shutil
+  >>> db = Database.Database(dataDir='bushy-test')
+  >>> bushy = BushyOptimizer(db)
+
+  # Chains of n relations have (n^3 - n)/6 connected pairs, and stars have (n-1) * 2^(n-2).
+  >>> chain = bushy.joinGraph(['A', 'B', 'C', 'D'], {('A', 'B'): ['a == b'], ('B', 'C'): ['b == c'], ('C', 'D'): ['c == d']}, {})
+  >>> star  = bushy.joinGraph(['A', 'B', 'C', 'D'], {('A', 'B'): ['a == b'], ('A', 'C'): ['a == c'], ('A', 'D'): ['a == d']}, {})
+  >>> len(bushy.connectedPairs(chain, ['A', 'B', 'C', 'D'])), len(bushy.connectedPairs(star, ['A', 'B', 'C', 'D']))
+  (10, 12)
+
+  # Disconnected components are joined by cross products.
+  >>> sorted(bushy.joinGraph(['A', 'B', 'C'], {('A', 'B'): ['a == b']}, {})['C'])
+  ['A', 'B']
+
+  >>> for r in ['R1', 'R2', 'R3', 'R4']:
+  ...   db.createRelation(r, [(r.lower() + 'a', 'int'), (r.lower() + 'b', 'int')])
+  ...   schema = db.relationSchema(r)
+  ...   _ = db.insertTuples(r, [schema.pack(schema.instantiate(i, i % 10)) for i in range(100)])
+  >>> db.analyze()
+  >>> query = db.query().fromTable('R1').join(db.query().fromTable('R2'), method='block-nested-loops', expr='r1a == r2a') \
+                .join(db.query().fromTable('R3'), method='block-nested-loops', expr='r2b == r3a') \
+                .join(db.query().fromTable('R4'), method='block-nested-loops', expr='r3b == r4b').finalize()
+  >>> result = bushy.pickJoinOrder(query)
+  >>> sorted(result.relations()), bushy.reportPlanCount
+  (['R1', 'R2', 'R3', 'R4'], 64)
+
+  >>> any(op.joinExpr == 'True' for (_, op) in result.flatten() if isinstance(op, Join))
+  False
+
+  >>> db.close()
+  >>> shutil.rmtree('bushy-test')
+  """
  
   def __init__(self, db):
     super().__init__(db)
 
   def pickJoinOrder(self, plan):
-    
     relations = plan.relations()
     fieldDict = self.obtainFieldDict(plan)
-    
+    (joinTablesDict, selectTablesDict) = self.getExprDicts(plan, fieldDict)
 
+    graph = self.joinGraph(relations, joinTablesDict, selectTablesDict)
+    optDict = self.singleRelationPlans(relations, selectTablesDict)
+    self.reportPlanCount = len(relations)
+
+    # Pairs are joined in increasing size of their union, such that the best
+    # plans of both sides are always known.
+    pairs = sorted(self.connectedPairs(graph, relations), key=lambda p: len(p[0]) + len(p[1]))
+    bestCosts = {}
+    for (s1, s2) in pairs:
+      key = tuple(sorted(s1 | s2))
+      for (lList, rList) in [(sorted(s1), sorted(s2)), (sorted(s2), sorted(s1))]:
+        (join, cost) = self.pickJoinMethod(optDict[tuple(lList)], optDict[tuple(rList)], \
+                                           lList, rList, joinTablesDict, selectTablesDict)
+        if key not in optDict or cost < bestCosts[key]:
+          join.prepare(self.db)
+          optDict[key] = join
+          bestCosts[key] = cost
+
+    return self.completePlan(plan, optDict[tuple(sorted(relations))])
+
+class GreedyOptimizer(Optimizer):
+  """
+  A greedy join order optimizer, repeatedly joining the pair of plans with the
+  cheapest join, among pairs connected in the query's join graph.
+  """
+
+  def __init__(self, db):
+    super().__init__(db)
+
+  def pickJoinOrder(self, plan):
+    relations = plan.relations()
+    fieldDict = self.obtainFieldDict(plan)
     (joinTablesDict, selectTablesDict) = self.getExprDicts(plan, fieldDict)
-    # makes dicts that maps a list of relations to exprs involving that list
-    # then in system R we will build opt(A,B) Join C using join exprs involving A,C and B,C
-    # and on top of it the select exprs that involve 2 tables A,C or B,C
 
-    isGroupBy = True if plan.root.operatorType() == "GroupBy" else False
-    outputSchema = plan.schema() 
-    optDict = {}
+    graph = self.joinGraph(relations, joinTablesDict, selectTablesDict)
+    worklist = list(self.singleRelationPlans(relations, selectTablesDict).values())
     self.reportPlanCount = 0
 
-    for npass in range(1, len(relations) + 1):
-      if npass == 1:
-        for r in relations:
-          table = TableScan(r,self.db.relationSchema(r))
-          if (r,) in selectTablesDict: 
-            selectExprs = selectTablesDict[(r,)]
-            selectString = self.combineSelects(selectExprs)
-            select = Select(table,selectString)
-            optDict[(r,)] = Plan(root=select)
-          else:
-            optDict[(r,)] = Plan(root=table)
-          self.reportPlanCount += 1
-      else:
-        combinations = itertools.combinations(relations,npass)
-        for c in combinations:
-          fullList = sorted(c)
-          clist = self.getCombos(fullList)
-          bestJoin = None
-          for subcombo in clist:
-            complement = self.getComplement(fullList, subcombo)
-            
-            leftOps = optDict[tuple(complement)].root
-            rightOps = optDict[tuple(subcombo)].root
-
-            selectExpr = self.createExpression(complement, subcombo, selectTablesDict)
-            joinExpr = self.createExpression(complement, subcombo, joinTablesDict)
-            
-            joinBnljOp = Join(leftOps, rightOps, expr=joinExpr, method="block-nested-loops" )
-            fullBnljOp = Select(joinBnljOp, selectExpr)
-
-            if selectExpr == "True":
-              joinBnlj = Plan(root=joinBnljOp)
-            else:
-              joinBnlj = Plan(root=fullBnljOp)
-            
-            joinBnlj.prepare(self.db)
-            joinBnlj.sample(100)
-            
-            joinNljOp = Join(leftOps, rightOps, expr=joinExpr, method="nested-loops" )
-            fullNljOp = Select(joinNljOp, selectExpr)
-
-            if selectExpr == "True":
-              joinNlj = Plan(root=joinNljOp)
-            else:
-              joinNlj = Plan(root=fullNljOp)
-            
-            joinNlj.prepare(self.db)
-            joinNlj.sample(100)
-
-            if joinBnlj.cost(True) < joinNlj.cost(True):
-              if bestJoin == None or joinBnlj.cost(True) < bestJoin.cost(True):
-                bestJoin = joinBnlj
-            else:
-              if bestJoin == None or joinNlj.cost(True) < bestJoin.cost(True):
-                bestJoin = joinNlj
-
-            self.reportPlanCount += 2
-            self.clearSampleFiles()
-
-          optDict[tuple(fullList)] = bestJoin
-          
-    # after System R algorithm
-    newPlan = optDict[tuple(sorted(relations))]
+    while(len(worklist) > 1):
+      bestJoin = None
+      sourcePair = None
 
-    if isGroupBy:
-      newGroupBy = GroupBy(newPlan.root, groupSchema=plan.root.groupSchema, \
-        aggSchema=plan.root.aggSchema, groupExpr=plan.root.groupExpr, \
-        aggExprs=plan.root.aggExprs, \
-        groupHashFn=plan.root.groupHashFn)
-      newGroupBy.prepare(self.db)
-      newPlan = Plan(root=newGroupBy)
+      for pair in itertools.combinations(worklist,2):
+        (lList, rList) = (pair[0].relations(), pair[1].relations())
+        if not self.neighborhood(graph, set(lList)) & set(rList):
+          continue
 
-    if set(outputSchema.schema()) != set(newPlan.schema().schema()):
-      projectDict = {}
+        for (lhs, rhs, lhsRels, rhsRels) in [(pair[0], pair[1], lList, rList), (pair[1], pair[0], rList, lList)]:
+          (join, cost) = self.pickJoinMethod(lhs, rhs, lhsRels, rhsRels, joinTablesDict, selectTablesDict)
+          if bestJoin == None or cost < bestCost:
+            (bestJoin, bestCost) = (join, cost)
+            sourcePair = pair
 
-      for f, t in outputSchema.schema():
-        projectDict[f] = (f, t) 
-      
-      currRoot = newPlan.root
-      project = Project(currRoot, projectDict)
-      project.prepare(self.db)
-      newPlan = Plan(root=project)
-  
-    return newPlan
-   
-  def getComplement(self,fullList,xList):
-    newList = fullList[:]
-    
-    for x in xList:
-      newList.remove(x)
-    return newList
-  
-  def getCombos(self, cList):
-    combos = []
-    temp = []
-    for i in range(1, len(cList)):
-      temp.extend(itertools.combinations(cList,i))
-    combos = [sorted(list(elem)) for elem in temp]
+      bestJoin.prepare(self.db)
+      worklist.remove(sourcePair[0])
+      worklist.remove(sourcePair[1])
+      worklist.append(bestJoin)
 
-    return combos
+    return self.completePlan(plan, worklist[0])
 
-class GreedyOptimizer(Optimizer):
 
-  def __init__(self, db):
+class HeuristicOptimizer(Optimizer):
+  """
+  A base class for join order optimizers over queries with too many relations
+  for exhaustive enumeration.
+
+  Subclasses search the space of linear join orders, that is, sequences of
+  relations where each relation is adjacent to an earlier one in the query's
+  join graph. The plans of every prefix of a join order are memoized for the
+  current query, such that join orders sharing a prefix share its cost.
+
+  Each search is bounded by the optimizer's time budget, in seconds, and returns
+  the cheapest join order found when the budget runs out. Searches always
+  complete at least one join order, regardless of their budget.
+
+  >>> import Database, shutil
+  >>> db = Database.Database(dataDir='heuristic-test')
+  >>> for i in range(6):
+  ...   db.createRelation('H' + str(i), [('h%da' % i, 'int'), ('h%db' % i, 'int')])
+  ...   schema = db.relationSchema('H' + str(i))
+  ...   _ = db.insertTuples('H' + str(i), [schema.pack(schema.instantiate(j, j % (i + 2))) for j in range(20 * (i + 1))])
+  >>> db.analyze()
+
+  # A chain of joins, with a cycle closed by a predicate between the first and last relations.
+  >>> def chainQuery(cyclic):
+  ...   query = db.query().fromTable('H0')
+  ...   for i in range(1, 6):
+  ...     expr = 'h%db == h%da' % (i - 1, i)
+  ...     expr = expr + ' and h0a == h5b' if cyclic and i == 5 else expr
+  ...     query = query.join(db.query().fromTable('H' + str(i)), method='block-nested-loops', expr=expr)
+  ...   return query.finalize()
+
+  >>> optimizers = [IKKBZOptimizer(db), IterativeImprovementOptimizer(db, seed=1), \
+                    SimulatedAnnealingOptimizer(db, seed=1), GeneticOptimizer(db, seed=1)]
+  >>> best = Optimizer(db).pickJoinOrder(chainQuery(False)).cost(True)
+  >>> for optimizer in optimizers:
+  ...   for cyclic in [False, True]:
+  ...     result = optimizer.pickJoinOrder(chainQuery(cyclic))
+  ...     joins  = [op for (_, op) in result.flatten() if isinstance(op, Join)]
+  ...     assert sorted(result.relations()) == ['H' + str(i) for i in range(6)]
+  ...     assert all(op.joinExpr != 'True' for op in joins)
+  ...   print(type(optimizer).__name__, optimizer.pickJoinOrder(chainQuery(False)).cost(True) <= 2 * best)
+  IKKBZOptimizer True
+  IterativeImprovementOptimizer True
+  SimulatedAnnealingOptimizer True
+  GeneticOptimizer True
+
+  # Without any budget, the searches return their first complete join order.
+  >>> for optimizer in optimizers:
+  ...   optimizer.timeBudget = 0
+  ...   assert sorted(optimizer.pickJoinOrder(chainQuery(True)).relations()) == ['H' + str(i) for i in range(6)]
+
+  # Join orders are restored to connected orders by moving relations after an adjacent one.
+  >>> optimizer = SimulatedAnnealingOptimizer(db, seed=1)
+  >>> optimizer.graph = optimizer.joinGraph(['A', 'B', 'C', 'D'], {('A', 'B'): ['a == b'], ('B', 'C'): ['b == c'], ('C', 'D'): ['c == d']}, {})
+  >>> optimizer.connectedOrder(['A', 'C', 'D', 'B'])
+  ('A', 'B', 'C', 'D')
+  >>> optimizer.connectedOrder(['C', 'A', 'B', 'D'])
+  ('C', 'B', 'A', 'D')
+
+  # Databases use a large join strategy for queries over more relations than its threshold.
+  >>> db.setLargeJoinStrategy('genetic', threshold=5, timeBudget=1.0)
+  >>> type(db.queryOptimizer(chainQuery(False))).__name__, db.queryOptimizer(chainQuery(False)).timeBudget
+  ('GeneticOptimizer', 1.0)
+  >>> sorted(db.optimizeQuery(chainQuery(False)).relations()) == ['H' + str(i) for i in range(6)]
+  True
+  >>> db.setLargeJoinStrategy('genetic', threshold=6)
+  >>> type(db.queryOptimizer(chainQuery(False))).__name__
+  'Optimizer'
+  >>> db.setLargeJoinStrategy('exhaustive')
+  Traceback (most recent call last):
+  ...
+  ValueError: Unknown join ordering strategy: exhaustive
+
+  >>> db.close()
+  >>> shutil.rmtree('heuristic-test')
+  """
+
+  defaultTimeBudget = 5.0
+
+  def __init__(self, db, timeBudget=None, seed=None):
     super().__init__(db)
+    self.timeBudget = timeBudget if timeBudget is not None else HeuristicOptimizer.defaultTimeBudget
+    self.random     = random.Random(seed)
 
   def pickJoinOrder(self, plan):
     relations = plan.relations()
     fieldDict = self.obtainFieldDict(plan)
-    (joinTablesDict, selectTablesDict) = self.getExprDicts(plan, fieldDict)
-    # makes dicts that maps a list of relations to exprs involving that list
-    # then in system R we will build opt(A,B) Join C using join exprs involving A,C and B,C
-    # and on top of it the select exprs that involve 2 tables A,C or B,C
+    (self.joinTablesDict, self.selectTablesDict) = self.getExprDicts(plan, fieldDict)
 
-    isGroupBy = True if plan.root.operatorType() == "GroupBy" else False
-    outputSchema = plan.schema() 
+    self.graph = self.joinGraph(relations, self.joinTablesDict, self.selectTablesDict)
     self.reportPlanCount = 0
+    self.deadline = time.time() + self.timeBudget
 
-    worklist = []
-    for r in relations:
-      table = TableScan(r,self.db.relationSchema(r))
-      table.prepare(self.db)
-      if (r,) in selectTablesDict: 
-        selectExprs = selectTablesDict[(r,)]
-        selectString = self.combineSelects(selectExprs)
-        select = Select(table,selectString)
-        select.prepare(self.db)
-        worklist.append(Plan(root=select))
-      else:
-        worklist.append(Plan(root=table))
-
-    while(len(worklist) > 1):
-      combos = itertools.combinations(worklist,2)
-      bestJoin = None
-      sourcePair = None
+    self.orderPlans = {}
+    for (rels, relPlan) in self.singleRelationPlans(relations, self.selectTablesDict).items():
+      self.orderPlans[rels] = (relPlan, self.planCost(relPlan))
 
-      for pair in combos:
-        op1 = pair[0].root
-        op2 = pair[1].root
+    order = self.searchJoinOrder(relations) if len(relations) > 1 else tuple(relations)
+    return self.completePlan(plan, self.orderPlan(order)[0])
 
-        selectExpr = self.createExpression(pair[0].relations(), pair[1].relations(), selectTablesDict)
-        joinExpr = self.createExpression(pair[0].relations(), pair[1].relations(), joinTablesDict)
-        
-        join1BnljOp = Join(op1, op2, expr=joinExpr, method="block-nested-loops" )
-        join2BnljOp = Join(op2, op1, expr=joinExpr, method="block-nested-loops" )
-
-
-        join1NljOp = Join(op1, op2, expr=joinExpr, method="nested-loops" )
-        join2NljOp = Join(op2, op1, expr=joinExpr, method="nested-loops" )
-
-        if selectExpr == "True":
-          full1BnljOp = join1BnljOp
-          full2BnljOp = join2BnljOp
-          
-          full1NljOp = join1NljOp
-          full2NljOp = join2NljOp
-
-        else:
-          full1BnljOp = Select(join1BnljOp, selectExpr)
-          full2BnljOp = Select(join2BnljOp, selectExpr)
-          
-          full1NljOp = Select(join1NljOp, selectExpr)
-          full2NljOp = Select(join2NljOp, selectExpr)
-        
+  # Returns the cheapest join order found over the given relations.
+  # This is the search strategy, implemented by each heuristic optimizer subclass.
+  def searchJoinOrder(self, relations):
+    raise NotImplementedError
 
-        joinList = [full1BnljOp, full2BnljOp, full1NljOp, full2NljOp]
+  # Returns whether the optimizer's time budget has run out for the current query.
+  def outOfTime(self):
+    return time.time() >= self.deadline
 
-        for j in joinList:
-          joinplan = Plan(root=j)
-          joinplan.prepare(self.db)
-          joinplan.sample(100)
+  # Returns the linear plan joining relations in the given order, and its cost. Each
+  # relation is joined with the plan of its prefix, as either the left or right input.
+  def orderPlan(self, order):
+    order = tuple(order)
+    if order not in self.orderPlans:
+      (prefixPlan, _) = self.orderPlan(order[:-1])
+      (relPlan, _)    = self.orderPlans[order[-1:]]
+      (prefix, rel)   = (list(order[:-1]), [order[-1]])
 
-          if bestJoin == None or joinplan.cost(True) < bestJoin.cost(True):
-            bestJoin = joinplan
-            sourcePair = pair
+      bestJoin = None
+      for (lhsPlan, rhsPlan, lList, rList) in [(prefixPlan, relPlan, prefix, rel), (relPlan, prefixPlan, rel, prefix)]:
+        (join, cost) = self.pickJoinMethod(lhsPlan, rhsPlan, lList, rList, self.joinTablesDict, self.selectTablesDict)
+        if bestJoin == None or cost < bestCost:
+          (bestJoin, bestCost) = (join, cost)
+
+      bestJoin.prepare(self.db)
+      self.orderPlans[order] = (bestJoin, bestCost)
+    return self.orderPlans[order]
+
+  def orderCost(self, order):
+    return self.orderPlan(order)[1]
+
+  # Returns a join order over the given relations where each relation is adjacent to an
+  # earlier one in the join graph, otherwise preserving their relative order.
+  def connectedOrder(self, relations):
+    remaining = list(relations)
+    order     = [remaining.pop(0)]
+    while remaining:
+      joined = set(order)
+      i = next(i for (i, r) in enumerate(remaining) if self.graph[r] & joined)
+      order.append(remaining.pop(i))
+    return tuple(order)
+
+  def randomOrder(self, relations):
+    return self.connectedOrder(self.random.sample(list(relations), len(relations)))
+
+  # Returns a random neighbor of a join order, either swapping two relations or
+  # moving a relation to another position.
+  def neighborOrder(self, order):
+    order  = list(order)
+    (i, j) = self.random.sample(range(len(order)), 2)
+    if self.random.random() < 0.5:
+      (order[i], order[j]) = (order[j], order[i])
+    else:
+      order.insert(j, order.pop(i))
+    return self.connectedOrder(order)
+
+class IKKBZOptimizer(HeuristicOptimizer):
+  """
+  A join order optimizer using the IKKBZ algorithm (Ibaraki and Kameda, 1984;
+  Krishnamurthy, Boral and Zaniolo, 1986).
 
-        self.reportPlanCount += 4
-        self.clearSampleFiles()
+  For acyclic join graphs, IKKBZ finds the optimal left-deep join order without
+  cross products under the C_out cost model (the sum of intermediate result sizes)
+  in polynomial time, for each choice of the first relation. We estimate each
+  relation's cardinality and each join predicate's selectivity once, and pick the
+  cheapest of the per-root orders under our own cost model.
 
+  Cyclic join graphs are reduced to their minimum selectivity spanning tree.
+  """
 
+  def searchJoinOrder(self, relations):
+    (cardinalities, selectivities) = self.joinGraphEstimates(relations)
+    tree = self.spanningTree(relations, selectivities)
+
+    best = None
+    for root in sorted(relations, key=lambda r: (cardinalities[r], r)):
+      order = self.rootedOrder(tree, root, cardinalities, selectivities)
+      cost  = self.orderCost(order)
+      if best is None or cost < bestCost:
+        (best, bestCost) = (order, cost)
+      if self.outOfTime():
+        break
+
+    return best
+
+  # Returns the estimated cardinality of each relation, and the estimated selectivity
+  # of each edge of the join graph, keyed by the edge's pair of relations in both orders.
+  def joinGraphEstimates(self, relations):
+    cardinalities = { r: max(1, self.orderPlans[(r,)][0].root.cardinality(True)) for r in relations }
+    selectivities = {}
+    for (r1, r2) in itertools.combinations(sorted(relations), 2):
+      if r2 in self.graph[r1]:
+        (join, _) = self.orderPlan((r1, r2))
+        selectivity = join.root.cardinality(True) / (cardinalities[r1] * cardinalities[r2])
+        selectivities[(r1, r2)] = selectivities[(r2, r1)] = selectivity
+    return (cardinalities, selectivities)
+
+  # Returns a minimum selectivity spanning tree of the join graph (using Prim's algorithm),
+  # as a dictionary mapping each relation to its adjacent relations in the tree.
+  def spanningTree(self, relations, selectivities):
+    tree   = { r: set() for r in relations }
+    joined = { relations[0] }
+    while len(joined) < len(relations):
+      (_, r1, r2) = min((selectivities[(r1, r2)], r1, r2) for r1 in joined for r2 in self.graph[r1] - joined)
+      tree[r1].add(r2)
+      tree[r2].add(r1)
+      joined.add(r2)
+    return tree
+
+  # Returns the IKKBZ join order for the spanning tree rooted at the given relation.
+  def rootedOrder(self, tree, root, cardinalities, selectivities):
+    chains = [self.normalizedChain(tree, child, root, cardinalities, selectivities) for child in tree[root]]
+    merged = heapq.merge(*chains, key=IKKBZOptimizer.rank)
+    return (root,) + tuple(r for (rels, _, _) in merged for r in rels)
+
+  # Returns the normalized chain for the subtree at a relation, as a list of compound
+  # relations in ascending rank order. Each compound relation is a triple of its
+  # relation sequence, and its T (output size factor) and C (C_out cost) values.
+  def normalizedChain(self, tree, node, parent, cardinalities, selectivities):
+    chains = [self.normalizedChain(tree, child, node, cardinalities, selectivities) for child in tree[node] - {parent}]
+    merged = list(heapq.merge(*chains, key=IKKBZOptimizer.rank))
+
+    size    = selectivities[(parent, node)] * cardinalities[node]
+    current = ((node,), size, size)
+
+    # A relation must precede its subtree, so we combine it with any following
+    # relations of lower rank, since these should otherwise be joined first.
+    while merged and IKKBZOptimizer.rank(merged[0]) < IKKBZOptimizer.rank(current):
+      current = IKKBZOptimizer.combine(current, merged.pop(0))
+
+    return [current] + merged
+
+  @staticmethod
+  def rank(compound):
+    (_, t, c) = compound
+    return (t - 1) / c if c > 0 else float('-inf')
+
+  @staticmethod
+  def combine(lhs, rhs):
+    (lhsRels, lhsT, lhsC) = lhs
+    (rhsRels, rhsT, rhsC) = rhs
+    return (lhsRels + rhsRels, lhsT * rhsT, lhsC + lhsT * rhsC)
+
+class IterativeImprovementOptimizer(HeuristicOptimizer):
+  """
+  A join order optimizer using iterative improvement (Swami and Gupta, 1988).
 
-      worklist.remove(sourcePair[0])
-      worklist.remove(sourcePair[1])
-      worklist.append(bestJoin)
+  Starting from random join orders, we repeatedly move to a random cheaper
+  neighboring order, until reaching a local minimum where a number of moves
+  (proportional to the number of relations) fail to improve the order. We
+  return the cheapest local minimum over a number of random restarts.
+  """
 
-    # after System R algorithm
-    newPlan = worklist[0]
+  def __init__(self, db, timeBudget=None, seed=None, restarts=10):
+    super().__init__(db, timeBudget, seed)
+    self.restarts = restarts
+
+  def searchJoinOrder(self, relations):
+    best = None
+    for _ in range(self.restarts):
+      (order, cost) = self.localMinimum(self.randomOrder(relations))
+      if best is None or cost < bestCost:
+        (best, bestCost) = (order, cost)
+      if self.outOfTime():
+        break
+    return best
+
+  # Returns the local minimum reached from a join order, and its cost.
+  def localMinimum(self, order):
+    cost     = self.orderCost(order)
+    failures = 0
+    while failures < 2 * len(order) and not self.outOfTime():
+      candidate = self.neighborOrder(order)
+      candidateCost = self.orderCost(candidate)
+      if candidateCost < cost:
+        (order, cost, failures) = (candidate, candidateCost, 0)
+      else:
+        failures += 1
+    return (order, cost)
 
-    if isGroupBy:
-      newGroupBy = GroupBy(newPlan.root, groupSchema=plan.root.groupSchema, \
-        aggSchema=plan.root.aggSchema, groupExpr=plan.root.groupExpr, \
-        aggExprs=plan.root.aggExprs, \
-        groupHashFn=plan.root.groupHashFn)
-      newGroupBy.prepare(self.db)
-      newPlan = Plan(root=newGroupBy)
+class SimulatedAnnealingOptimizer(HeuristicOptimizer):
+  """
+  A join order optimizer using simulated annealing (Ioannidis and Wong, 1987).
+
+  This performs a random walk over neighboring join orders, accepting moves to a
+  more expensive order with a probability decreasing with its cost increase and
+  with a temperature that cools after each stage of moves. Following Ioannidis
+  and Kang (1990), the initial temperature is twice the initial order's cost, each
+  stage makes 16 moves per join, and the temperature cools by 5% per stage. The
+  search is frozen after 4 stages without improving the best order, once the
+  temperature is below 1% of the best order's cost.
+  """
 
-    if set(outputSchema.schema()) != set(newPlan.schema().schema()):
-      projectDict = {}
+  initialTemperature = 2.0
+  stageMoves         = 16
+  coolingRate        = 0.95
+  frozenStages       = 4
+  frozenTemperature  = 0.01
+
+  def searchJoinOrder(self, relations):
+    order = self.randomOrder(relations)
+    cost  = self.orderCost(order)
+    (best, bestCost) = (order, cost)
+
+    temperature = SimulatedAnnealingOptimizer.initialTemperature * cost
+    unimproved  = 0
+    while not self.outOfTime():
+      improved = False
+      for _ in range(SimulatedAnnealingOptimizer.stageMoves * (len(relations) - 1)):
+        if self.outOfTime():
+          break
+
+        candidate = self.neighborOrder(order)
+        candidateCost = self.orderCost(candidate)
+        delta = candidateCost - cost
+        if delta <= 0 or (temperature > 0 and self.random.random() < math.exp(-delta / temperature)):
+          (order, cost) = (candidate, candidateCost)
+          if cost < bestCost:
+            (best, bestCost, improved) = (order, cost, True)
+
+      unimproved  = 0 if improved else unimproved + 1
+      temperature = temperature * SimulatedAnnealingOptimizer.coolingRate
+      if unimproved >= SimulatedAnnealingOptimizer.frozenStages \
+          and temperature < SimulatedAnnealingOptimizer.frozenTemperature * bestCost:
+        break
+
+    return best
+
+class GeneticOptimizer(HeuristicOptimizer):
+  """
+  A join order optimizer using a genetic algorithm (Bennett, Ferris and Ioannidis, 1991).
 
-      for f, t in outputSchema.schema():
-        projectDict[f] = (f, t) 
-      
-      currRoot = newPlan.root
-      project = Project(currRoot, projectDict)
-      project.prepare(self.db)
-      newPlan = Plan(root=project)
-  
-    return newPlan
+  This evolves a population of random join orders over a number of generations.
+  Each generation keeps the cheapest orders of the previous one, and breeds the
+  rest from parents chosen by tournament selection, using an order crossover
+  (a slice of one parent, with the remaining relations in the other parent's
+  order) and random mutations to neighboring orders.
+  """
 
+  populationSize = 32
+  eliteSize      = 2
+  tournamentSize = 3
+  mutationRate   = 0.2
+
+  def __init__(self, db, timeBudget=None, seed=None, generations=50):
+    super().__init__(db, timeBudget, seed)
+    self.generations = generations
+
+  def searchJoinOrder(self, relations):
+    population = []
+    while len(population) < GeneticOptimizer.populationSize and not (population and self.outOfTime()):
+      order = self.randomOrder(relations)
+      population.append((self.orderCost(order), order))
+    population.sort()
+
+    for _ in range(self.generations):
+      if self.outOfTime():
+        break
+
+      offspring = population[:GeneticOptimizer.eliteSize]
+      while len(offspring) < GeneticOptimizer.populationSize and not self.outOfTime():
+        child = self.crossover(self.tournament(population), self.tournament(population))
+        if self.random.random() < GeneticOptimizer.mutationRate:
+          child = self.neighborOrder(child)
+        offspring.append((self.orderCost(child), child))
+      population = sorted(offspring)
+
+    return population[0][1]
+
+  # Returns the cheapest of a random sample of join orders from a population.
+  def tournament(self, population):
+    return min(self.random.sample(population, min(GeneticOptimizer.tournamentSize, len(population))))[1]
+
+  def crossover(self, lhs, rhs):
+    (i, j) = sorted(self.random.sample(range(len(lhs) + 1), 2))
+    chosen = lhs[i:j]
+    rest   = [r for r in rhs if r not in chosen]
+    return self.connectedOrder(rest[:i] + list(chosen) + rest[i:])
 
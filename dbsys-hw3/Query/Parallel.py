@@ -0,0 +1,66 @@
+"""
+Process-parallel execution helpers for query operators.
+
+Operators dispatch work to a pool of worker processes with runTasks, naming
+one of their own methods to execute in each worker. Workers are forked from
+the dispatching process, and thus inherit the operator (including any
+unpicklable state such as group-by lambdas) without serialization.
+
+Workers must not use the parent's buffer pool or open file handles. Instead
+they read storage files directly with StorageFile.readOnlyPages, and return
+their results as packed pages built with packPages. The dispatching operator
+then gathers these pages into its output relation with emitOutputPage.
+"""
+
+import concurrent.futures, multiprocessing, os
+
+from Catalog.Identifiers import FileId, PageId
+from Storage.SlottedPage import SlottedPage
+
+# Operators currently dispatching work to a worker pool, by operator id.
+activeOperators = {}
+
+def defaultWorkers():
+  return os.cpu_count() or 1
+
+# Worker entry point, invoking the given method on a registered operator.
+def runTask(opId, method, args):
+  return getattr(activeOperators[opId], method)(*args)
+
+# Flushes a relation's dirty pages and file buffers, so that workers can read
+# the relation file directly. Returns the file's id, path and number of pages.
+def flushRelation(storage, relId):
+  (fileId, relFile) = storage.fileMgr.relationFile(relId)
+  storage.bufferPool.flushDirtyPages(fileId)
+  relFile.flush()
+  return (fileId, relFile.path, relFile.numPages())
+
+# Runs the operator's method once per argument tuple in a pool of worker processes.
+# This returns a generator over the task results, in the order of the argument list.
+def runTasks(operator, method, argsList, numWorkers):
+  activeOperators[operator.id()] = operator
+  try:
+    context = multiprocessing.get_context("fork")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=numWorkers, mp_context=context) as pool:
+      futures = [pool.submit(runTask, operator.id(), method, args) for args in argsList]
+      for future in futures:
+        yield future.result()
+  finally:
+    del activeOperators[operator.id()]
+
+# Packs a sequence of tuples into a list of page buffers, for the given schema and page size.
+# The page identifiers used here are placeholders, since the gathering operator
+# assigns pages to its own output file.
+def packPages(tuples, schema, pageSize, pageClass=SlottedPage):
+  pageBuffers = []
+  page        = None
+  for tup in tuples:
+    if page is None or page.insertTuple(tup) is None:
+      if page is not None:
+        pageBuffers.append(page.pack())
+      page = pageClass(pageId=PageId(FileId(0), len(pageBuffers)), buffer=bytes(pageSize), schema=schema)
+      page.insertTuple(tup)
+
+  if page is not None:
+    pageBuffers.append(page.pack())
+  return pageBuffers
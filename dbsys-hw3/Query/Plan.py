@@ -4,11 +4,15 @@ from collections import deque
 from Catalog.Schema  import DBSchema
 
 from Query.Operators.TableScan import TableScan
+from Query.Operators.IndexScan import IndexScan
+from Query.Operators.BitmapHeapScan import BitmapHeapScan
 from Query.Operators.Select    import Select
 from Query.Operators.Project   import Project
 from Query.Operators.Union     import Union
 from Query.Operators.Join      import Join
 from Query.Operators.GroupBy   import GroupBy
+from Query.Operators.Exchange  import Exchange
+from Utils.ExpressionInfo      import ExpressionInfo
 
 class Plan:
   """
@@ -28,8 +32,15 @@ class Plan:
   Plan instances should use the 'prepare' method prior to
   iteration (as done with Database.processQuery), to initialize
   all operators contained in the plan.
+
+  Once a prepared plan's results have been fully iterated, the plan
+  records the actual cardinalities of its operators as feedback for
+  the database's query optimizer (see Database.recordFeedback).
   """
 
+  # The database the plan was last prepared with, see prepare.
+  database = None
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -38,6 +49,7 @@ class Plan:
     elif "root" in kwargs:
       self.root = kwargs["root"]
       self.sampleCardinality = 0
+      self.parameters = kwargs.get("parameters", {})
 
     else:
       raise ValueError("No root operator specified for query plan")
@@ -50,13 +62,17 @@ class Plan:
   def root(self):
     return self.root
 
+  # Returns a copy of the query plan, with copies of all of its operators (see Operator.copy).
+  def copy(self):
+    return Plan(root=self.root.copy(), parameters=dict(self.parameters))
+
   # Returns the query result schema.
   def schema(self):
     return self.root.schema()
 
   # Returns the relations used by the query.
   def relations(self):
-    return [op.relationId() for (_,op) in self.flatten() if isinstance(op, TableScan)]
+    return [op.relId for (_,op) in self.flatten() if isinstance(op, (TableScan, IndexScan, BitmapHeapScan))]
 
   # Pre-order depth-first flattening of the query tree.
   def flatten(self):
@@ -78,32 +94,84 @@ class Plan:
 
   # Returns a prepared plan, where every operator has filled in
   # internal parameters necessary for processing data.
+  # This also binds the values of any query parameters.
   def prepare(self, database):
     if self.root:
+      self.database = database
       for (_, operator) in self.flatten():
         operator.prepare(database)
+      if self.parameters:
+        self.bindParameters(self.parameters)
       return self
     else:
       raise ValueError("Invalid query plan")
 
+  # Replaces the literal constants in the plan's selection and join predicates by
+  # named query parameters (see ExpressionInfo.parameterize), and returns a
+  # dictionary of the parameters' values.
+  def parameterize(self):
+    parameters = dict(self.parameters)
+    for (_, operator) in self.flatten():
+      if isinstance(operator, Select):
+        operator.selectExpr = ExpressionInfo(operator.selectExpr).parameterize(parameters)
+      elif isinstance(operator, Join) and operator.joinExpr:
+        operator.joinExpr = ExpressionInfo(operator.joinExpr).parameterize(parameters)
+
+    self.parameters = parameters
+    return parameters
+
+  # Binds values for the plan's query parameters to all of its operators.
+  def bindParameters(self, parameters):
+    self.parameters = parameters
+    for (_, operator) in self.flatten():
+      operator.bindParameters(parameters)
+
   # Iterator abstraction for query processing.
   # Thus, we can use: "for page in plan: ..."
+  #
+  # We pass along the pages of the root operator's iterator, recording cardinality
+  # feedback at the end of a complete, non-sampled execution.
   def __iter__(self):
-    return iter(self.root)
+    yield from self.root
+    if self.database is not None and not self.root.sampled:
+      self.database.recordFeedback(self)
 
   # Plan and statistics information.
 
   # Returns a description for the entire query plan, based on the
   # description of each individual operator.
-  def explain(self):
+  #
+  # With the 'analyze' flag, this first runs the (prepared) plan with runtime
+  # profiling, and adds each operator's profile to its description.
+  def explain(self, analyze=False):
     if self.root:
+      if analyze:
+        self.analyze()
+
       planDesc = []
       indent = ' ' * 2
       for (depth, operator) in self.flatten():
-        planDesc.append(indent * depth + operator.explain())
+        opDesc = operator.explain()
+        if analyze:
+          opDesc += " " + operator.explainProfile()
+        planDesc.append(indent * depth + opDesc)
 
       return '\n'.join(planDesc)
 
+  # Runs the plan with runtime profiling enabled for all operators, discarding the query results.
+  # The plan must be prepared prior to analysis.
+  def analyze(self):
+    if not hasattr(self.root, "storage"):
+      raise ValueError("Query plan must be prepared before analysis")
+
+    self.root.useProfiling(True)
+    try:
+      for page in self:
+        pass
+    finally:
+      self.root.useProfiling(False)
+    return self
+
   # Returns the cost of the plan, either as an estimate or as an actual cost
   # based on the boolean 'estimated' parameter.
   #
@@ -121,6 +189,8 @@ class Plan:
   #
   #     scaleFactor = actual dataset size / desired sample dataset size
   #
+  # Scans over relations with a sample synopsis (see Statistics.synopsis) read the
+  # synopsis instead, and scale their output by the synopsis' own sampling rate.
   def sample(self, scaleFactor):
     self.root.useSampling(True, scaleFactor)
     # Process query, update each operator's cost, cardinality, and selectivity estimates.
@@ -130,11 +200,109 @@ class Plan:
 
     # Leave the scale factor unchanged, so that we can correctly use estimated statistics after sampling.
     self.root.useSampling(False, scaleFactor)
-    return self.sampleCardinality * scaleFactor
+    return self.sampleCardinality * self.root.sampleScale()
 
-  def pushdownOperators(self):
-    self.root = self.root.pushdownOperators()
-    return self
+  # Returns an equivalent plan with selections and projections pushed down towards
+  # the base relations, as done by the database's query optimizer.
+  def pushdownOperators(self, database):
+    return database.optimizer.pushdownOperators(self)
+
+class PreparedPlan:
+  """
+  A prepared query, pairing a cached, optimized plan with values for its parameters.
+
+  Prepared plans are created by Database.prepare, and are processed as any other
+  plan, e.g., with Database.processQuery, which binds the parameter values to the
+  cached plan. The 'bind' method returns a prepared plan with other parameter values.
+
+  >>> import Database, shutil
+  >>> db = Database.Database(dataDir='prepared-test')
+  >>> db.createRelation('employee', [('id', 'int'), ('age', 'int')])
+  >>> db.createRelation('department', [('did', 'int'), ('eid', 'int')])
+  >>> empSchema = db.relationSchema('employee')
+  >>> depSchema = db.relationSchema('department')
+  >>> _ = db.insertTuples('employee', [empSchema.pack(empSchema.instantiate(i, 20 + i % 40)) for i in range(200)])
+  >>> _ = db.insertTuples('department', [depSchema.pack(depSchema.instantiate(i % 5, i)) for i in range(200)])
+  >>> db.analyze()
+
+  >>> def ageQuery(low, high):
+  ...   return db.query().fromTable('employee').join(db.query().fromTable('department'), \
+                 method='block-nested-loops', expr='id == eid').where('age >= ' + str(low) + ' and age < ' + str(high) \
+               ).select({'id': ('id', 'int'), 'did': ('did', 'int')}).finalize()
+  >>> def ids(plan):
+  ...   return sorted(plan.schema().unpack(tup).id for page in db.processQuery(plan) for tup in page[1])
+
+  # Literals are replaced by parameters, and queries differing in their literals share an optimized plan.
+  # The query template itself is left unchanged.
+  >>> template = ageQuery(20, 22)
+  >>> prepared = db.prepare(template)
+  >>> prepared.parameters
+  {'_p0': 20, '_p1': 22}
+  >>> template.parameters, template.root.subPlan.selectExpr
+  ({}, 'age >= 20 and age < 22')
+  >>> print(prepared.explain()) # doctest: +ELLIPSIS
+  Project[...](projections={'id': ('id', 'int'), 'did': ('did', 'int')})
+    BNLJoin[...](expr='id == eid')
+      TableScan[...](department)
+      Project[...](projections={'id': ('id', 'int')})
+        Select[...](predicate='age >= _p0 and age < _p1')
+          TableScan[...](employee)
+  >>> ids(prepared) == ids(ageQuery(20, 22))
+  True
+
+  >>> other = db.prepare(ageQuery(50, 60))
+  >>> (other.plan is prepared.plan, db.preparedHits, ids(other) == ids(ageQuery(50, 60)))
+  (True, 1, True)
+  >>> ids(prepared.bind(_p1=21)) == ids(ageQuery(20, 21))
+  True
+
+  # Cached plans are re-optimized once their relations' statistics change.
+  >>> db.analyze('department')
+  >>> db.prepare(ageQuery(20, 22)).plan is prepared.plan
+  False
+
+  # Prepared point lookups use an index scan, whose key is bound to the parameter's value
+  # when executing the scan. The selection retains the predicate, e.g., for non-key values.
+  >>> empKey = DBSchema('employeeKey', [('id', 'int')])
+  >>> empIdx = db.storageEngine().createIndex('employee', empSchema, empKey, True)
+  >>> lookup = db.prepare(db.query().fromTable('employee').where('id == 12').finalize())
+  >>> print(lookup.explain()) # doctest: +ELLIPSIS
+  Select[...](predicate='id == _p0')
+    IndexScan[...](employee,index=...,keySchema=employeeKey[(id,int)],key=(_p0,))
+  >>> def ages(plan):
+  ...   return [empSchema.unpack(tup).age for page in db.processQuery(plan) for tup in page[1]]
+  >>> ages(lookup), ages(lookup.bind(_p0=45)), ages(lookup.bind(_p0=2.5))
+  ([32], [25], [])
+
+  >>> db.close()
+  >>> shutil.rmtree('prepared-test')
+  """
+
+  def __init__(self, plan, parameters):
+    self.plan       = plan
+    self.parameters = parameters
+
+  # Returns a prepared plan for the same query, with the given parameter values.
+  def bind(self, **parameters):
+    unknown = [name for name in parameters if name not in self.parameters]
+    if unknown:
+      raise ValueError("Unknown query parameters " + str(unknown))
+    return PreparedPlan(self.plan, dict(self.parameters, **parameters))
+
+  def schema(self):
+    return self.plan.schema()
+
+  def relations(self):
+    return self.plan.relations()
+
+  def explain(self, analyze=False):
+    self.plan.bindParameters(self.parameters)
+    return self.plan.explain(analyze)
+
+  # Returns the cached plan, prepared with our parameter values.
+  def prepare(self, database):
+    self.plan.parameters = self.parameters
+    return self.plan.prepare(database)
 
 class PlanBuilder:
   """
@@ -181,6 +349,12 @@ class PlanBuilder:
   >>> [query2.schema().unpack(tup).id for page in db.processQuery(query2) for tup in page[1]]
   [0, 1, 2, 3, 4]
 
+  ### EXPLAIN ANALYZE SELECT eid FROM Employee WHERE age < 30
+  >>> print(db.processQuery(query2).explain(analyze=True)) # doctest: +ELLIPSIS
+  Project[...,cost=...](projections={'id': ('id', 'int')}) (rows=5,...,tuplesIn=5,...,evals=5)
+    Select[...,cost=...](predicate='age < 30') (rows=5,...,tuplesIn=20,...,evals=20)
+      TableScan[...,cost=...](employee) (rows=20,...,tuplesIn=0,...)
+
 
   ### SELECT * FROM Employee UNION ALL Employee
   >>> query3 = db.query().fromTable('employee').union(db.query().fromTable('employee')).finalize()
@@ -210,6 +384,15 @@ class PlanBuilder:
   >>> [(tup.id, tup.id2) for tup in q4results] # doctest:+ELLIPSIS
   [(0, 0), (1, 1), (2, 2), ..., (18, 18), (19, 19)]
 
+  # Non-base inner inputs are spooled, spilling to a temporary relation beyond the spool size.
+  >>> query4b = db.query().fromTable('employee').join( \
+        db.query().fromTable('employee').where('age < 30'), \
+        rhsSchema=e2schema, spoolPages=0, \
+        method='block-nested-loops', expr='id == id2').finalize()
+
+  >>> [(tup.id, tup.id2) for tup in [query4b.schema().unpack(tup) for page in db.processQuery(query4b) for tup in page[1]]]
+  [(0, 0), (1, 1), (2, 2), (3, 3), (4, 4)]
+
   ### Hash join test with the same query.
   ### SELECT * FROM Employee E1 JOIN Employee E2 ON E1.id = E2.id
   >>> e2schema   = schema.rename('employee2', {'id':'id2', 'age':'age2'})
@@ -253,17 +436,244 @@ class PlanBuilder:
   >>> sorted([(tup.id, tup.minAge, tup.maxAge) for tup in q6results]) # doctest:+ELLIPSIS
   [(0, 20, 20), (1, 22, 22), ..., (18, 56, 56), (19, 58, 58)]
 
+  ### Parallel scan over 2 worker processes
+  ### SELECT id FROM Employee WHERE age < 30
+  >>> query7 = db.query().fromTable('employee').where("age < 30").select({'id': ('id', 'int')}).exchange(numWorkers=2).finalize()
+
+  >>> print(query7.explain()) # doctest: +ELLIPSIS
+  Exchange[...,cost=...](numWorkers=2)
+    Project[...,cost=...](projections={'id': ('id', 'int')})
+      Select[...,cost=...](predicate='age < 30')
+        TableScan[...,cost=...](employee)
+
+  >>> [query7.schema().unpack(tup).id for page in db.processQuery(query7) for tup in page[1]]
+  [0, 1, 2, 3, 4]
+
+  ### Parallel hash join and group by, processing partitions over 2 worker processes
+  >>> query8 = db.query().fromTable('employee').join( \
+          db.query().fromTable('employee'), \
+          rhsSchema=e2schema, \
+          method='hash', numWorkers=2, \
+          lhsHashFn='hash(id) % 4',  lhsKeySchema=keySchema, \
+          rhsHashFn='hash(id2) % 4', rhsKeySchema=keySchema2, \
+        ).finalize()
+
+  >>> q8results = [query8.schema().unpack(tup) for page in db.processQuery(query8) for tup in page[1]]
+  >>> sorted([(tup.id, tup.id2) for tup in q8results]) == sorted([(tup.id, tup.id2) for tup in q5results])
+  True
+
+  >>> query9 = db.query().fromTable('employee').groupBy( \
+          groupSchema=keySchema, \
+          aggSchema=aggMinMaxSchema, \
+          groupExpr=(lambda e: e.id), \
+          aggExprs=[(sys.maxsize, lambda acc, e: min(acc, e.age), lambda x: x), \
+                    (0, lambda acc, e: max(acc, e.age), lambda x: x)], \
+          groupHashFn=(lambda gbVal: hash(gbVal[0]) % 2), \
+          numWorkers=2 \
+        ).finalize()
+
+  >>> q9results = [query9.schema().unpack(tup) for page in db.processQuery(query9) for tup in page[1]]
+  >>> sorted([(tup.id, tup.minAge, tup.maxAge) for tup in q9results]) # doctest:+ELLIPSIS
+  [(0, 20, 20), (1, 22, 22), ..., (18, 56, 56), (19, 58, 58)]
+
+  ### Index scans over a relation with a primary index on 'did', and a secondary index on 'floor'.
+  >>> db.createRelation('department', [('did', 'int'), ('floor', 'int')])
+  >>> deptSchema = db.relationSchema('department')
+  >>> deptKey    = DBSchema('departmentKey', [('did', 'int')])
+  >>> floorKey   = DBSchema('floorKey', [('floor', 'int')])
+  >>> deptIdx    = db.storageEngine().createIndex('department', deptSchema, deptKey, True)
+  >>> floorIdx   = db.storageEngine().createIndex('department', deptSchema, floorKey, False)
+  >>> for tup in [deptSchema.pack(deptSchema.instantiate(i, i % 5)) for i in range(50)]:
+  ...    _ = db.insertTuple(deptSchema.name, tup)
+  ...
+
+  ### SELECT did FROM Department WHERE did >= 10 AND did < 15
+  >>> query11 = db.query().fromIndex('department', deptIdx, deptKey, \
+          lowKey=(10,), highKey=(15,), highInclusive=False).finalize()
+
+  >>> print(query11.explain()) # doctest: +ELLIPSIS
+  IndexScan[...,cost=...](department,index=...,keySchema=departmentKey[(did,int)],range=[(10,), (15,)))
+
+  >>> [deptSchema.unpack(tup).did for page in db.processQuery(query11) for tup in page[1]]
+  [10, 11, 12, 13, 14]
+
+  ### Index scans spanning several output pages: SELECT sid FROM Shipment WHERE sid < 2500
+  >>> db.createRelation('shipment', [('sid', 'int'), ('region', 'int')])
+  >>> shipSchema = db.relationSchema('shipment')
+  >>> shipKey    = DBSchema('shipmentKey', [('sid', 'int')])
+  >>> shipIdx    = db.storageEngine().createIndex('shipment', shipSchema, shipKey, True)
+  >>> tupleIds   = db.insertTuples('shipment', [shipSchema.pack(shipSchema.instantiate(i, i % 4)) for i in range(3000)])
+  >>> query11b   = db.query().fromIndex('shipment', shipIdx, shipKey, highKey=(2500,), highInclusive=False).finalize()
+  >>> q11bpages  = [page for page in db.processQuery(query11b)]
+  >>> len(q11bpages) > 1
+  True
+
+  >>> q11bresults = [shipSchema.unpack(tup).sid for page in q11bpages for tup in page[1]]
+  >>> len(q11bresults), q11bresults == list(range(2500))
+  (2500, True)
+
+  ### SELECT did FROM Department WHERE did < 3 OR floor == 4, fetching matches in page order
+  >>> query12 = db.query().fromIndexes('department', \
+          [IndexScan('department', deptSchema, deptIdx, deptKey, highKey=(3,), highInclusive=False), \
+           IndexScan('department', deptSchema, floorIdx, floorKey, key=(4,))], combine='or').finalize()
+
+  >>> print(query12.explain()) # doctest: +ELLIPSIS
+  BitmapHeapScan[...,cost=...](department,combine=or,indexes=[...:range=(-inf, (3,)); ...:key=(4,)])
+
+  >>> [deptSchema.unpack(tup).did for page in db.processQuery(query12) for tup in page[1]] # doctest:+ELLIPSIS
+  [0, 1, 2, 4, 9, 14, ..., 44, 49]
+
+  ### Bitmap heap scans spanning several output pages: SELECT sid FROM Shipment WHERE sid >= 500 OR region == 1
+  >>> regionKey  = DBSchema('shipmentRegion', [('region', 'int')])
+  >>> regionIdx  = db.storageEngine().createIndex('shipment', shipSchema, regionKey, False)
+  >>> query12b   = db.query().fromIndexes('shipment', \
+          [IndexScan('shipment', shipSchema, shipIdx, shipKey, lowKey=(500,)), \
+           IndexScan('shipment', shipSchema, regionIdx, regionKey, key=(1,))], combine='or').finalize()
+  >>> q12bpages  = [page for page in db.processQuery(query12b)]
+  >>> len(q12bpages) > 1
+  True
+
+  >>> q12bresults = [shipSchema.unpack(tup).sid for page in q12bpages for tup in page[1]]
+  >>> len(q12bresults), q12bresults == [i for i in range(3000) if i >= 500 or i % 4 == 1]
+  (2625, True)
+
+  ### Index selection by estimated selectivity and cost, intersecting both indexes' matches:
+  ### SELECT did FROM Department WHERE floor == 2 AND did > 40 AND did % 2 == 1
+  >>> db.analyze('department')
+  >>> query13 = db.optimizer.useIndexScans( \
+          db.query().fromTable('department').where('floor == 2 and did > 40 and did % 2 == 1').finalize())
+
+  >>> print(query13.explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='did % 2 == 1')
+    BitmapHeapScan[...,cost=...](department,combine=and,indexes=[...:range=((40,), inf); ...:key=(2,)])
+
+  >>> [deptSchema.unpack(tup).did for page in db.processQuery(query13) for tup in page[1]]
+  [47]
+
+  ### Unselective predicates keep the table scan: SELECT did FROM Department WHERE did >= 2 AND floor <= 4 AND did % 2 == 1
+  >>> query13b = db.optimizer.useIndexScans( \
+          db.query().fromTable('department').where('did >= 2 and floor <= 4 and did % 2 == 1').finalize())
+
+  >>> print(query13b.explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='did >= 2 and floor <= 4 and did % 2 == 1')
+    TableScan[...,cost=...](department)
+
+  >>> len([tup for page in db.processQuery(query13b) for tup in page[1]])
+  24
+
+  >>> query13.relations()
+  ['department']
+
+  ### Index selection on a primary key: SELECT did FROM Department WHERE did == 12
+  >>> query14 = db.optimizer.useIndexScans(db.query().fromTable('department').where('did == 12').finalize())
+
+  >>> print(query14.explain()) # doctest: +ELLIPSIS
+  IndexScan[...,cost=...](department,index=...,keySchema=departmentKey[(did,int)],key=(12,))
+
+  >>> [deptSchema.unpack(tup).floor for page in db.processQuery(query14) for tup in page[1]]
+  [2]
+
+  ### Covering indexes, on 'custkey' including 'orderdate'.
+  >>> db.createRelation('orders', [('oid', 'int'), ('custkey', 'int'), ('orderdate', 'int')])
+  >>> ordersSchema = db.relationSchema('orders')
+  >>> custKey      = DBSchema('ordersCustKey', [('custkey', 'int')])
+  >>> custIdx      = db.storageEngine().createIndex('orders', ordersSchema, custKey, False, \
+                       DBSchema('ordersDate', [('orderdate', 'int')]))
+  >>> tupleIds = db.insertTuples('orders', [ordersSchema.pack(ordersSchema.instantiate(i, i % 10, 100+i)) for i in range(30)])
+
+  ### Index-only scan: SELECT orderdate FROM Orders WHERE custkey == 3
+  >>> query15 = db.optimizer.useIndexScans(db.query().fromTable('orders').where('custkey == 3') \
+                  .select({'orderdate': ('orderdate', 'int')}).finalize())
+
+  >>> print(query15.explain()) # doctest: +ELLIPSIS
+  Project[...,cost=...](...)
+    IndexScan[...,cost=...](orders,index=...,keySchema=ordersCustKey[(custkey,int)],include=ordersDate[(orderdate,int)],key=(3,))
+
+  >>> [query15.schema().unpack(tup).orderdate for page in db.processQuery(query15) for tup in page[1]]
+  [103, 113, 123]
+
+  ### Indexed join with an index-only RHS:
+  ### SELECT did, orderdate FROM Department, Orders WHERE floor == custkey AND did < 2
+  >>> query16 = db.optimizer.useIndexScans(db.query().fromTable('department').where('did < 2').join( \
+                  db.query().fromTable('orders'), method='indexed', indexId=custIdx, lhsKeySchema=floorKey) \
+                  .select({'did': ('did', 'int'), 'orderdate': ('orderdate', 'int')}).finalize())
+
+  >>> query16.root.subPlan.rhsPlan.explain() # doctest: +ELLIPSIS
+  'IndexScan[...](orders,index=...,keySchema=ordersCustKey[(custkey,int)],include=ordersDate[(orderdate,int)],scan)'
+
+  >>> sorted((t.did, t.orderdate) for t in [query16.schema().unpack(tup) for page in db.processQuery(query16) for tup in page[1]])
+  [(0, 100), (0, 110), (0, 120), (1, 101), (1, 111), (1, 121)]
+
+  ### Bitmap indexes on low-cardinality columns, combining matches before any heap access.
+  >>> db.createRelation('lineitem', [('lid', 'int'), ('flag', 'int'), ('mode', 'int')])
+  >>> lineSchema = db.relationSchema('lineitem')
+  >>> tupleIds   = db.insertTuples('lineitem', [lineSchema.pack(lineSchema.instantiate(i, i % 3, i % 7)) for i in range(70)])
+  >>> flagKey    = DBSchema('lineitemFlag', [('flag', 'int')])
+  >>> modeKey    = DBSchema('lineitemMode', [('mode', 'int')])
+  >>> flagIdx    = db.storageEngine().createIndex('lineitem', lineSchema, flagKey, False, kind="bitmap")
+  >>> modeIdx    = db.storageEngine().createIndex('lineitem', lineSchema, modeKey, False, kind="bitmap")
+
+  ### SELECT lid FROM Lineitem WHERE flag == 1 AND mode != 2
+  >>> query17 = db.optimizer.useIndexScans(db.query().fromTable('lineitem').where('flag == 1 and mode != 2').finalize())
+
+  >>> print(query17.explain()) # doctest: +ELLIPSIS
+  BitmapHeapScan[...,cost=...](lineitem,combine=and,indexes=[...:key=(1,); ...:not key=(2,)])
+
+  >>> q17results = [lineSchema.unpack(tup).lid for page in db.processQuery(query17) for tup in page[1]]
+  >>> q17results == [i for i in range(70) if i % 3 == 1 and i % 7 != 2]
+  True
+
+  ### Hash indexes answer equality predicates only: SELECT * FROM Lineitem WHERE lid == 12 / lid > 65
+  >>> lidKey = DBSchema('lineitemKey', [('lid', 'int')])
+  >>> lidIdx = db.storageEngine().createIndex('lineitem', lineSchema, lidKey, True, kind="hash")
+  >>> query18 = db.optimizer.useIndexScans(db.query().fromTable('lineitem').where('lid == 12').finalize())
+  >>> print(query18.explain()) # doctest: +ELLIPSIS
+  IndexScan[...,cost=...](lineitem,index=...,keySchema=lineitemKey[(lid,int)],key=(12,))
+
+  >>> [lineSchema.unpack(tup).mode for page in db.processQuery(query18) for tup in page[1]]
+  [5]
+
+  >>> query19 = db.optimizer.useIndexScans(db.query().fromTable('lineitem').where('lid > 65').finalize())
+  >>> print(query19.explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='lid > 65')
+    TableScan[...,cost=...](lineitem)
+
+  ### Cardinality estimates from the statistics catalog, rather than by sampling.
+  >>> db.analyze('lineitem')
+  >>> query20 = db.query().fromTable('lineitem').where('flag == 1 and lid < 35').finalize().prepare(db)
+  >>> round(query20.root.cardinality(True))
+  12
+
+  >>> query21 = db.query().fromTable('lineitem').join(db.query().fromTable('orders'), \
+                  method='block-nested-loops', expr='mode == custkey').finalize().prepare(db)
+  >>> db.analyze('orders')
+  >>> round(query21.root.cardinality(True)), len([tup for page in db.processQuery(query21) for tup in page[1]])
+  (210, 210)
+
+  >>> query22 = db.query().fromTable('lineitem').where('flag in [0, 2] or not (mode < 5)').finalize().prepare(db)
+  >>> round(query22.root.cardinality(True)), len([tup for page in db.processQuery(query22) for tup in page[1]])
+  (53, 53)
+
   # Populate employees relation with another 10000 tuples
   >>> for tup in [schema.pack(schema.instantiate(i, math.ceil(random.gauss(45, 25)))) for i in range(10000)]:
   ...    _ = db.insertTuple(schema.name, tup)
   ...
 
   ### Sample 1/10th of: SELECT * FROM Employee WHERE age < 30
-  >>> query8 = db.query().fromTable('employee').where("age < 30").finalize()
-  >>> estimatedSize = query8.sample(10)
+  >>> query10 = db.query().fromTable('employee').where("age < 30").finalize()
+  >>> estimatedSize = query10.sample(10)
   >>> estimatedSize > 0
   True
 
+  ### Once analyzed, sampling scans the relation's synopsis rather than its pages.
+  >>> db.analyze('employee')
+  >>> query11 = db.query().fromTable('employee').where("age < 30").finalize()
+  >>> actualSize = len([tup for page in db.processQuery(query11) for tup in page[1]])
+  >>> abs(query11.sample(10) - actualSize) / actualSize < 0.3
+  True
+  >>> query11.root.subPlan.scanSynopsis
+  True
+
   """
 
   def __init__(self, **kwargs):
@@ -289,6 +699,20 @@ class PlanBuilder:
       schema = self.database.relationSchema(relId)
       return PlanBuilder(operator=TableScan(relId, schema), db=self.database)
 
+  # Starts a query with an index scan, given the index id and key schema, and any
+  # point lookup key or key range arguments (see Query.Operators.IndexScan).
+  def fromIndex(self, relId, indexId, keySchema, **kwargs):
+    if self.database:
+      schema = self.database.relationSchema(relId)
+      return PlanBuilder(operator=IndexScan(relId, schema, indexId, keySchema, **kwargs), db=self.database)
+
+  # Starts a query with a bitmap heap scan, combining the matches of the given
+  # index scans by intersection or union (with combine='and' or combine='or').
+  def fromIndexes(self, relId, indexScans, **kwargs):
+    if self.database:
+      schema = self.database.relationSchema(relId)
+      return PlanBuilder(operator=BitmapHeapScan(relId, schema, indexScans, **kwargs), db=self.database)
+
   def where(self, conditionExpr):
     if self.operator:
       return PlanBuilder(operator=Select(self.operator, conditionExpr), db=self.database)
@@ -322,6 +746,13 @@ class PlanBuilder:
     else:
       raise ValueError("Invalid group by operator")
 
+  # Runs the running select-project pipeline over a table scan in parallel.
+  def exchange(self, **kwargs):
+    if self.operator:
+      return PlanBuilder(operator=Exchange(self.operator, **kwargs), db=self.database)
+    else:
+      raise ValueError("Invalid exchange operator")
+
   # Constructs a plan instance from the running plan tree.
   def finalize(self):
     if self.operator:
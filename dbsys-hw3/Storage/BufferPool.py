@@ -42,6 +42,8 @@ class BufferPool:
       self.freeListLen  = len(self.freeList)
 
       self.fileMgr      = None
+      self.numHits      = 0
+      self.numMisses    = 0
 
   def fromOther(self, other):
     self.pageSize    = other.pageSize
@@ -51,6 +53,8 @@ class BufferPool:
     self.freeList    = other.freeList
     self.freeListLen = other.freeListLen
     self.fileMgr     = other.fileMgr
+    self.numHits     = other.numHits
+    self.numMisses   = other.numMisses
 
   def setFileManager(self, fileMgr):
     self.fileMgr = fileMgr
@@ -85,9 +89,11 @@ class BufferPool:
   def getPageWithHit(self, pageId, pinned=False):
     if self.fileMgr:
       if self.hasPage(pageId):
+        self.numHits += 1
         return (self.getCachedPage(pageId, pinned)[1], True)
 
       else:
+        self.numMisses += 1
         # Fetch the page from the file system, adding it to the buffer pool
         if not self.freeList:
           self.evictPage()
@@ -148,6 +154,11 @@ class BufferPool:
         self.freeListLen += 1
         del self.pageMap[pageId]
 
+  # Discards all cached pages of a file without flushing them, e.g., when removing the file.
+  def discardFile(self, fileId):
+    for pageId in [pId for pId in self.pageMap if pId.fileId == fileId]:
+      self.discardPage(pageId)
+
   # Removes a page from the page map, returning it to the free 
   # page list. This method also flushes the page to disk.
   def flushPage(self, pageId):
@@ -182,8 +193,20 @@ class BufferPool:
       else:
         raise ValueError("Could not find a page to evict in the buffer pool")
 
+  # Writes out all dirty pages, optionally restricted to a single file,
+  # while keeping them resident in the buffer pool. This ensures the on-disk
+  # file is up-to-date for readers that bypass the buffer pool.
+  def flushDirtyPages(self, fileId=None):
+    if self.fileMgr:
+      for (pageId, (_, page, _)) in list(self.pageMap.items()):
+        if page.isDirty() and (fileId is None or pageId.fileId == fileId):
+          page.setDirty(False)
+          self.fileMgr.writePage(page)
+    else:
+      raise ValueError("Uninitalized buffer pool, no file manager found")
+
   def clear(self):
-    for (pageId, (offset, page, _)) in self.pageMap.items():
+    for (pageId, (offset, page, _)) in list(self.pageMap.items()):
       if page.isDirty():
         self.flushPage(pageId)
 
@@ -235,6 +235,10 @@ class StorageFile:
 
   defaultPageClass = SlottedPage
 
+  # Process-wide I/O counters, used for runtime profiling.
+  pagesRead    = 0
+  pagesWritten = 0
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -405,6 +409,7 @@ class StorageFile:
       self.file.seek(self.pageOffset(pageId))
       bytesRead = self.file.readinto(bufferForPage)
       if bytesRead == self.pageSize():
+        StorageFile.pagesRead += 1
         page = self.pageClass().unpack(pageId, bufferForPage)
         # Refresh the free page list based on the on-disk header contents.
         if page.header.hasFreeTuple() and pageId not in self.freePages:
@@ -419,6 +424,7 @@ class StorageFile:
     if isinstance(page, self.pageClass()):
       self.file.seek(self.pageOffset(page.pageId))
       self.file.write(page.pack())
+      StorageFile.pagesWritten += 1
       # Refresh the free page list based on the in-memory header contents.
       # This is needed if the page has been directly modified while resident in the buffer pool.
       if not page.header.hasFreeTuple():
@@ -460,18 +466,18 @@ class StorageFile:
     self.header.deleteTuple()
     pId       = tupleId.pageId
     page      = self.bufferPool.getPage(pId)
-    tupleData = page.getTuple(tupleId)
+    tupleData = bytes(page.getTuple(tupleId))
     page.deleteTuple(tupleId)
     if page.header.hasFreeTuple() and pId not in self.freePages:
       self.freePages.add(pId)
     return tupleData
 
   # Updates the tuple by id
-  # Returns the updated tuple for further operations (e.g., index maintenance)
+  # Returns a copy of the old tuple for further operations (e.g., index maintenance)
   def updateTuple(self, tupleId, tupleData):
     pId     = tupleId.pageId
     page    = self.bufferPool.getPage(pId)
-    oldData = page.getTuple(tupleId)
+    oldData = bytes(page.getTuple(tupleId))
     page.putTuple(tupleId, tupleData)
     return oldData
 
@@ -497,6 +503,15 @@ class StorageFile:
   def tuples(self, pinned=False):
     return self.FileTupleIterator(self)
 
+  # Read-only page iterator over the file at the given path, for a half-open
+  # range of page indexes (defaulting to all pages).
+  # This opens its own file handle and bypasses the buffer pool, for use by
+  # worker processes that cannot share our buffer pool. The caller must ensure
+  # any dirty pages for the file have been flushed prior to iteration.
+  @classmethod
+  def readOnlyPages(cls, fileId, filePath, pageRange=None):
+    return cls.FileReadOnlyPageIterator(fileId, filePath, pageRange)
+
 
   def pack(self):
     if self.fileId and self.path:
@@ -576,6 +591,33 @@ class StorageFile:
       else:
         raise StopIteration
 
+  class FileReadOnlyPageIterator:
+    def __init__(self, fileId, filePath, pageRange=None):
+      self.fileId = fileId
+      self.file   = io.BufferedReader(io.FileIO(filePath, "r"))
+      self.header = FileHeader.fromFile(self.file)
+      self.buffer = bytearray(self.header.pageSize)
+
+      numPages = math.floor((os.path.getsize(filePath) - self.header.size) / self.header.pageSize)
+      (start, end) = pageRange if pageRange else (0, numPages)
+      self.currentPageIdx = start
+      self.endPageIdx     = min(end, numPages)
+
+    def __iter__(self):
+      return self
+
+    def __next__(self):
+      if self.currentPageIdx < self.endPageIdx:
+        pId = PageId(self.fileId, self.currentPageIdx)
+        self.file.seek(self.header.size + self.header.pageSize * self.currentPageIdx)
+        if self.file.readinto(self.buffer) != self.header.pageSize:
+          raise ValueError("Read a partial page")
+        self.currentPageIdx += 1
+        return (pId, self.header.pageClass.unpack(pId, self.buffer))
+      else:
+        self.file.close()
+        raise StopIteration
+
   class FileTupleIterator:
     def __init__(self, storageFile, pinned=False):
       self.storageFile     = storageFile
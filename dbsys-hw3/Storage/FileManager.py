@@ -1,9 +1,9 @@
 import json, io, os, os.path, pickle
 
 from Catalog.Schema             import DBSchema
-from Catalog.Identifiers        import FileId
-from Storage.File               import StorageFile
-from Storage.Index.IndexManager import IndexManager
+from Catalog.Identifiers             import FileId
+from Storage.File                    import StorageFile
+from Storage.Index.BTreeIndexManager import BTreeIndexManager
 
 class FileManager:
   """
@@ -13,6 +13,12 @@ class FileManager:
   relation name to a file identifier, and the second mapping a file
   identifier to the storage file object.
 
+  The file manager also hosts the storage files for B+-tree indexes, which are
+  present in the file map (but not the relation files), such that index pages
+  are cached in the buffer pool. The index manager implementation is given by
+  the 'indexManagerClass' argument, defaulting to the native B+-tree indexes,
+  with the BerkeleyDB IndexManager available as an alternative.
+
   >>> import Storage.BufferPool
   >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
   >>> bp = Storage.BufferPool.BufferPool()
@@ -39,10 +45,26 @@ class FileManager:
   >>> bp.setFileManager(fm)
   >>> list(fm.relations())
   ['employee']
+
+  # Tuples with duplicate primary keys are rejected without adding heap data,
+  # including within bulk insertions.
+  >>> keySchema = DBSchema('employeeKey', [('id', 'int')])
+  >>> indexId = fm.createIndex(schema.name, schema, keySchema, True)
+  >>> tupleIds = fm.insertTuples(schema.name, [schema.pack(schema.instantiate(i, 20)) for i in range(3)])
+  >>> fm.insertTuples(schema.name, [schema.pack(schema.instantiate(i, 30)) for i in [3, 4, 3]])
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique index
+
+  >>> sorted(schema.unpack(t).id for t in fm.tuples(schema.name))
+  [0, 1, 2, 3, 4]
+  >>> [keySchema.unpackKey(k).id for (k, _) in fm.indexManager.scanByKey(schema.name)]
+  [0, 1, 2, 3, 4]
   """
 
   defaultDataDir     = "data/"
   defaultFileClass   = StorageFile
+  defaultIndexClass  = BTreeIndexManager
 
   checkpointEncoding = "latin1"
   checkpointFile     = "db.fm"
@@ -72,7 +94,7 @@ class FileManager:
         self.fileCounter   = kwargs.get("fileCounter", 0)
         self.relationFiles = kwargs.get("relationFiles", {})
         self.fileMap       = kwargs.get("fileMap", {})
-        self.indexManager  = kwargs.get("indexManager", IndexManager(indexDir=self.indexDir))
+        self.indexClass    = kwargs.get("indexManagerClass", FileManager.defaultIndexClass)
 
         if restoring:
           self.relationFiles = dict([(i[0], FileId(i[1])) for i in kwargs["restore"][0]])
@@ -82,6 +104,12 @@ class FileManager:
             self.fileMap[fId] = \
               self.fileClass(bufferPool=self.bufferPool, fileId=fId, filePath=fPath, mode="update")
 
+        # The index manager is initialized after restoring the file map, since B+-tree
+        # indexes are backed by files in the file map.
+        self.indexManager = kwargs.get("indexManager", None)
+        if self.indexManager is None:
+          self.indexManager = self.indexClass(indexDir=self.indexDir, fileManager=self)
+
       else:
         self.restore()
 
@@ -94,7 +122,10 @@ class FileManager:
     self.relationFiles   = other.relationFiles
     self.fileMap         = other.fileMap
     self.indexDir        = other.indexDir
+    self.indexClass      = other.indexClass
     self.indexManager    = other.indexManager
+    if getattr(self.indexManager, "fileMgr", None) is other:
+      self.indexManager.fileMgr = self
 
   # Closes and flushes all storage files in the file manager.
   # This includes flushing all pages held in the buffer pool.
@@ -172,6 +203,30 @@ class FileManager:
     fId = self.relationFiles.get(relId, None) if relId else None
     return (fId, self.fileMap.get(fId, None)) if fId else (None, None)
 
+  # Creates a storage file for an index in the index directory, returning its file id and object.
+  def createIndexFile(self, fileName, schema, pageClass):
+    fId  = FileId(self.fileCounter)
+    path = os.path.join(self.indexDir, fileName)
+    self.fileCounter += 1
+    self.fileMap[fId] = \
+      self.fileClass(bufferPool=self.bufferPool, \
+                     fileId=fId, filePath=path, mode="create", \
+                     pageSize=self.defaultPageSize, schema=schema, pageClass=pageClass)
+
+    self.checkpoint()
+    return (fId, self.fileMap[fId])
+
+  # Removes or detaches an index's storage file, discarding its pages from the buffer pool.
+  def removeIndexFile(self, fileId, detach=False):
+    iFile = self.fileMap.pop(fileId, None)
+    if iFile:
+      self.bufferPool.discardFile(fileId)
+      if not detach:
+        iFile.close()
+        os.remove(iFile.path)
+
+      self.checkpoint()
+
 
   # Page operations
   def readPage(self, pageId, pageBuffer):
@@ -190,9 +245,20 @@ class FileManager:
     if relId in self.relationFiles and self.indexManager:
       return self.indexManager.hasIndex(relId, keySchema)
 
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  # Returns the indexes on a relation as triples of (key schema, primary, index id).
+  def indexes(self, relId):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.indexes(relId)
+    return []
+
+  # Returns the id of an index on a relation whose key matches the given key schema, or None.
+  def matchIndex(self, relId, keySchema):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.matchIndex(relId, keySchema)
+
+  def createIndex(self, relId, relSchema, keySchema, primary, includeSchema=None, kind="btree"):
     if relId in self.relationFiles and self.indexManager:
-      return self.indexManager.createIndex(relId, relSchema, keySchema, primary)
+      return self.indexManager.createIndex(relId, relSchema, keySchema, primary, includeSchema, kind)
 
   def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
     if relId in self.relationFiles and self.indexManager:
@@ -206,6 +272,25 @@ class FileManager:
     if self.indexManager:
       return self.indexManager.getIndex(indexId)
 
+  # Returns the include schema of a covering index, or None for other indexes.
+  def indexIncludes(self, indexId):
+    if self.indexManager:
+      return self.indexManager.indexIncludes(indexId)
+
+  # Returns the kind of an index, i.e., "btree", "hash" or "bitmap".
+  def indexKind(self, indexId):
+    if self.indexManager:
+      return self.indexManager.indexKind(indexId)
+
+  # Deferred index maintenance, buffering index changes until the batch ends.
+  def beginBatch(self, batchSize=None):
+    if self.indexManager:
+      self.indexManager.beginBatch(batchSize)
+
+  def endBatch(self):
+    if self.indexManager:
+      self.indexManager.endBatch()
+
   # Tuple operations
 
   # Returns a tuple id for the newly inserted data.
@@ -213,17 +298,30 @@ class FileManager:
     (_, rFile) = self.relationFile(relId)
     if rFile and self.indexManager:
       tupleId = rFile.insertTuple(tupleData)
-      self.indexManager.insertTuple(relId, tupleData, tupleId)
+      try:
+        self.indexManager.insertTuple(relId, tupleData, tupleId)
+      except ValueError:
+        rFile.deleteTuple(tupleId)
+        raise
       return tupleId
 
+  # Inserts several tuples as a single statement, deferring index maintenance
+  # into batches applied in key order. Returns the tuple ids for the new data.
+  def insertTuples(self, relId, tuplesData):
+    self.beginBatch()
+    try:
+      return [self.insertTuple(relId, tupleData) for tupleData in tuplesData]
+    finally:
+      self.endBatch()
+
   def deleteTuple(self, relId, tupleId):
-    rFile = self.fileMap.get(tupleId.pageId.fileIndex, None)
+    rFile = self.fileMap.get(tupleId.pageId.fileId, None)
     if rFile and self.indexManager:
       tupleData = rFile.deleteTuple(tupleId)
       self.indexManager.deleteTuple(relId, tupleData, tupleId)
 
   def updateTuple(self, relId, tupleId, tupleData):
-    rFile = self.fileMap.get(tupleId.pageId.fileIndex, None)
+    rFile = self.fileMap.get(tupleId.pageId.fileId, None)
     if rFile and self.indexManager:
       oldData = rFile.updateTuple(tupleId, tupleData)
       self.indexManager.updateTuple(relId, oldData, tupleData, tupleId)
@@ -237,12 +335,36 @@ class FileManager:
     if relId in self.relationFiles and self.indexManager:
       return self.indexManager.lookupByIndex(indexId, keyData)
 
+  # Perform an index range lookup between the given (optional) low and high keys.
+  # This returns an ordered iterator over (key, tuple id) pairs.
+  def lookupRange(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.lookupRange(indexId, lowKey, highKey, lowInclusive, highInclusive)
+
+  # Perform a covering index range lookup, returning an ordered iterator over
+  # (key, tuple id, included values) triples.
+  def lookupCovering(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.lookupCovering(indexId, lowKey, highKey, lowInclusive, highInclusive)
+
+  # Perform a bitmap index range lookup, returning a bitmap of the matching tuples
+  # (or of all other tuples when negated), or None if the index is not a bitmap index.
+  def lookupBitmap(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True, negate=False):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.lookupBitmap(indexId, lowKey, highKey, lowInclusive, highInclusive, negate)
+
+  # Perform a full index scan, returning an ordered iterator over (key, tuple id) pairs.
+  def scanByIndex(self, relId, indexId):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.scanByIndex(indexId)
+
   # Removes tuple(s) by key using the given index.
   # This should maintain all other indexes by retrieving the full tuple and tuple id,
   # and then using the deleteTuple method.
   def deleteByIndex(self, relId, indexId, keyData):
     if relId in self.relationFiles and self.indexManager:
-      tupleIds = self.indexManager.lookupByIndex(indexId, keyData)
+      # Materialize the matches, since index lookups stream from the index we are modifying.
+      tupleIds = list(self.indexManager.lookupByIndex(indexId, keyData))
       for tupleId in tupleIds:
         tupleData = self.deleteTuple(relId, tupleId)
         if tupleData:
@@ -253,7 +375,8 @@ class FileManager:
   # by retrieving the full tuple and tuple id, and then using the updateTuple method.
   def updateByIndex(self, relId, indexId, keyData, tupleData):
     if relId in self.relationFiles and self.indexManager:
-      tupleIds = self.indexManager.lookupByIndex(indexId, keyData)
+      # Materialize the matches, since index lookups stream from the index we are modifying.
+      tupleIds = list(self.indexManager.lookupByIndex(indexId, keyData))
       for tupleId in tupleIds:
         oldData = self.updateTuple(relId, tupleId)
         if oldData:
@@ -265,7 +388,7 @@ class FileManager:
   # Otherwise it returns a single tuple identifier.
   def lookupByKey(self, relId, keyData):
     if relId in self.relationFiles and self.indexManager:
-      self.lookupByKey(relId, keyData)
+      return self.indexManager.lookupByKey(relId, keyData)
 
   # Removes a tuple based on its primary key value.
   def deleteByKey(self, relId, keyData):
@@ -304,15 +427,25 @@ class FileManager:
       pfileClass     = pickle.dumps(self.fileClass).decode(encoding=FileManager.checkpointEncoding)
       prelationFiles = list(map(lambda entry: (entry[0], entry[1].fileIndex), self.relationFiles.items()))
       pfileMap       = list(map(lambda entry: (entry[0].fileIndex, entry[1].path), self.fileMap.items()))
-      return json.dumps((self.dataDir, self.indexDir, pfileClass, self.fileCounter, prelationFiles, pfileMap))
+      pindexClass    = pickle.dumps(self.indexClass).decode(encoding=FileManager.checkpointEncoding)
+      return json.dumps((self.dataDir, self.indexDir, pfileClass, self.fileCounter, prelationFiles, pfileMap, pindexClass))
 
   @classmethod
   def unpack(cls, bufferPool, strBuffer):
     args = json.loads(strBuffer)
-    if len(args) == 6:
+    if len(args) in [6, 7]:
       unfileClass = pickle.loads(args[2].encode(encoding=FileManager.checkpointEncoding))
+
+      # Checkpoints without an index manager class predate B+-tree indexes, and use BerkeleyDB.
+      if len(args) == 7:
+        unindexClass = pickle.loads(args[6].encode(encoding=FileManager.checkpointEncoding))
+      else:
+        from Storage.Index.IndexManager import IndexManager
+        unindexClass = IndexManager
+
       return cls(bufferPool=bufferPool, dataDir=args[0], indexDir=args[1], \
-                 fileClass=unfileClass, fileCounter=args[3], restore=(args[4], args[5]))
+                 fileClass=unfileClass, fileCounter=args[3], restore=(args[4], args[5]), \
+                 indexManagerClass=unindexClass)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,586 @@
+import struct
+from struct import Struct
+
+from Catalog.Identifiers import PageId, FileId, TupleId
+from Catalog.Schema      import DBSchema
+from Storage.Page        import PageHeader, Page
+
+class BTreePageHeader(PageHeader):
+  """
+  A B+-tree node page header.
+
+  B+-tree nodes store fixed-size entries contiguously in sorted order, and
+  thus extend the contiguous page header with a leaf flag (in the page's flags),
+  and a link field holding a page index. For leaves, the link is the page index
+  of the next leaf, while for internal nodes it is the page index of the leftmost
+  child. A zero link denotes no page, since page 0 is always the tree's root.
+
+  The binary representation of this header object is: (PageHeader, link)
+
+  >>> import io
+  >>> buffer = io.BytesIO(bytes(4096))
+  >>> ph     = BTreePageHeader(buffer=buffer.getbuffer(), tupleSize=10)
+  >>> ph.setLeaf(True)
+  >>> ph.link = 70000
+  >>> buffer.getbuffer()[0:ph.headerSize()] = ph.pack()
+  >>> ph2    = BTreePageHeader.unpack(buffer.getbuffer())
+  >>> ph == ph2 and ph2.isLeaf() and ph2.link == 70000
+  True
+  """
+
+  linkRepr = struct.Struct("I")
+  size     = PageHeader.size + linkRepr.size
+
+  # Flag bitmask for leaf nodes, alongside PageHeader.dirtyMask.
+  leafMask = 0b100
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.link = kwargs.get("link", 0)
+      super().__init__(**kwargs)
+
+  def __eq__(self, other):
+    return super().__eq__(other) and self.link == other.link
+
+  def postHeaderInitialize(self, **kwargs):
+    fresh  = kwargs.get("flags", None) is None
+    buffer = kwargs.get("buffer", None)
+
+    super().postHeaderInitialize(**kwargs)
+    if fresh and buffer:
+      buffer[PageHeader.size:self.headerSize()] = BTreePageHeader.linkRepr.pack(self.link)
+
+  def fromOther(self, other):
+    super().fromOther(other)
+    if isinstance(other, BTreePageHeader):
+      self.link = other.link
+
+  def headerSize(self):
+    return BTreePageHeader.size
+
+  # Leaf flag accessors
+  def isLeaf(self):
+    return self.flag(BTreePageHeader.leafMask)
+
+  def setLeaf(self, leaf):
+    self.setFlag(BTreePageHeader.leafMask, leaf)
+
+  def pack(self):
+    return super().pack() + BTreePageHeader.linkRepr.pack(self.link)
+
+  @classmethod
+  def unpack(cls, buffer):
+    values = PageHeader.binrepr.unpack_from(buffer)
+    link   = BTreePageHeader.linkRepr.unpack_from(buffer, offset=PageHeader.size)[0]
+    if len(values) == 4:
+      return cls(buffer=buffer, flags=values[0], tupleSize=values[1],
+                 freeSpaceOffset=values[2], pageCapacity=values[3], link=link)
+
+
+class BTreePage(Page):
+  """
+  A B+-tree node page, storing a sorted array of fixed-size entries.
+
+  Entries are byte strings, compared bytewise. Leaf entries are a key followed by
+  a tuple id, while internal entries are a separator (i.e., a leaf entry) followed
+  by a child page index. The page provides binary search and positional insertion
+  and deletion over its entries, while the B+-tree interprets their contents.
+
+  >>> schema = DBSchema('entry', [('key', 'char(4)'), ('value', 'char(6)')])
+  >>> p      = BTreePage(pageId=PageId(FileId(1), 0), buffer=bytes(4096), schema=schema)
+  >>> for e in [b'b', b'd', b'a', b'c']:
+  ...   p.insertEntry(p.bisect(e.ljust(10, b'.')), e.ljust(10, b'.'))
+  ...
+  >>> [e[:1] for e in p.entries()]
+  [b'a', b'b', b'c', b'd']
+
+  >>> (p.bisect(b'c'), p.bisect(b'c'.ljust(10, b'.'), right=True))
+  (2, 3)
+
+  >>> p.deleteEntry(0)
+  >>> [e[:1] for e in p.entries()]
+  [b'b', b'c', b'd']
+  """
+
+  headerClass = BTreePageHeader
+
+  # Header constructor override for B+-tree nodes.
+  def initializeHeader(self, **kwargs):
+    schema = kwargs.get("schema", None)
+    if schema:
+      return BTreePageHeader(buffer=self.getbuffer(), tupleSize=schema.size)
+    else:
+      raise ValueError("No schema provided when constructing a B+-tree page.")
+
+  # Reinitializes the node as an empty leaf or internal node, with the given entry size and link.
+  def format(self, leaf, entrySize, link):
+    self.header.setLeaf(leaf)
+    self.header.tupleSize       = entrySize
+    self.header.freeSpaceOffset = self.header.dataOffset()
+    self.header.link            = link
+    self.setDirty(True)
+
+  def numEntries(self):
+    return self.header.numTuples()
+
+  def isFull(self):
+    return not self.header.hasFreeTuple()
+
+  def entryOffset(self, index):
+    return self.header.dataOffset() + index * self.header.tupleSize
+
+  def entry(self, index):
+    start = self.entryOffset(index)
+    return bytes(self.getbuffer()[start:start+self.header.tupleSize])
+
+  # Returns a copy of all entries in the node.
+  def entries(self):
+    size = self.header.tupleSize
+    data = bytes(self.getbuffer()[self.header.dataOffset():self.header.freeSpaceOffset])
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+  # Returns the position of the first entry greater than or equal to the probe
+  # (or strictly greater, when 'right' is set), comparing only the first 'width'
+  # bytes of each entry (defaulting to the probe's length).
+  def bisect(self, probe, right=False, width=None):
+    width    = width if width is not None else len(probe)
+    buffer   = self.getbuffer()
+    (lo, hi) = (0, self.numEntries())
+    while lo < hi:
+      mid   = (lo + hi) // 2
+      start = self.entryOffset(mid)
+      entry = bytes(buffer[start:start+width])
+      if entry < probe or (right and entry == probe):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  # Inserts an entry at the given position, shifting all subsequent entries.
+  def insertEntry(self, index, entry):
+    if self.isFull() or len(entry) != self.header.tupleSize:
+      raise ValueError("Invalid B+-tree entry insertion into a full page or with an invalid entry")
+
+    start  = self.entryOffset(index)
+    end    = self.header.freeSpaceOffset
+    size   = self.header.tupleSize
+    buffer = self.getbuffer()
+    buffer[start+size:end+size] = bytes(buffer[start:end])
+    buffer[start:start+size]    = entry
+    self.header.freeSpaceOffset += size
+    self.setDirty(True)
+
+  # Removes the entry at the given position, shifting all subsequent entries.
+  def deleteEntry(self, index):
+    start  = self.entryOffset(index)
+    end    = self.header.freeSpaceOffset
+    size   = self.header.tupleSize
+    buffer = self.getbuffer()
+    buffer[start:end-size] = bytes(buffer[start+size:end])
+    self.header.freeSpaceOffset -= size
+    self.setDirty(True)
+
+  # Replaces all entries in the node.
+  def setEntries(self, entries):
+    start = self.header.dataOffset()
+    data  = b''.join(entries)
+    if start + len(data) > self.header.pageCapacity:
+      raise ValueError("Invalid B+-tree entries, exceeding the page capacity")
+
+    self.getbuffer()[start:start+len(data)] = data
+    self.header.freeSpaceOffset = start + len(data)
+    self.setDirty(True)
+
+
+class BTree:
+  """
+  A B+-tree index over the pages of a storage file, accessed through the buffer pool.
+
+  The tree maps order-preserving index keys (see DBSchema.packKey) to tuple ids.
+  Leaf entries are the concatenation of a key and a packed tuple id, and the tree
+  is ordered on these entries. Thus, duplicate keys in secondary indexes are ordered
+  by tuple id, and all entries are distinct. Internal nodes hold separators and
+  child page indexes, where each separator is the smallest (key, tuple id) in its child.
+
+  Covering trees store the packed values of additional included columns in each leaf
+  entry, after the tuple id, as given by an include schema.
+
+  The root is always page 0 of the file. A root split moves the root's contents
+  to a new page, such that the root never moves. Leaves are linked to their right
+  sibling, supporting range cursors that stream over consecutive leaves.
+
+  Deletions do not rebalance the tree, and may leave empty leaves that cursors skip.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> bp = Storage.BufferPool.BufferPool(pageSize=256, poolSize=256*16)
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp, pageSize=256, dataDir='btree-test')
+  >>> bp.setFileManager(fm)
+
+  >>> keySchema = DBSchema('idKey', [('id', 'int')])
+  >>> pageId    = PageId(FileId(0), 1)
+  >>> key       = lambda i: keySchema.packKey(keySchema.instantiate(i))
+
+  >>> (fileId, _) = fm.createIndexFile('test.bt', BTree.entrySchema(keySchema), BTreePage)
+  >>> tree = BTree(fm, fileId, keySchema, duplicates=True)
+
+  # Insert keys in a shuffled order, with duplicates, causing several levels of splits.
+  >>> for i in [(7 * j) % 500 for j in range(500)]:
+  ...   tree.insert(key(i // 2), TupleId(pageId, i))
+  ...
+  >>> tree.height() > 2
+  True
+
+  # Ordered scans and lookups, in key and then tuple id order.
+  >>> [keySchema.unpackKey(k).id for (k, _) in tree.scan()] == sorted(i // 2 for i in range(500))
+  True
+
+  >>> [tId.tupleIndex for tId in tree.lookup(key(100))]
+  [200, 201]
+
+  >>> [keySchema.unpackKey(k).id for (k, _) in tree.range(key(10), key(12), lowInclusive=False)]
+  [11, 11, 12, 12]
+
+  # Deletion of specific duplicates, and of all entries.
+  >>> tree.delete(key(100), TupleId(pageId, 200))
+  True
+  >>> [tId.tupleIndex for tId in tree.lookup(key(100))]
+  [201]
+
+  >>> all(tree.delete(key(i // 2), TupleId(pageId, i)) for i in range(500) if i != 200)
+  True
+  >>> list(tree.scan())
+  []
+
+  # Bulk load a unique tree, and check leaf links in a full scan.
+  >>> (fileId, _) = fm.createIndexFile('test2.bt', BTree.entrySchema(keySchema), BTreePage)
+  >>> tree2 = BTree(fm, fileId, keySchema, duplicates=False)
+  >>> tree2.bulkLoad((key(i), TupleId(pageId, i % 100)) for i in range(-500, 500))
+  >>> [keySchema.unpackKey(k).id for (k, _) in tree2.scan()] == list(range(-500, 500))
+  True
+  >>> [keySchema.unpackKey(k).id for (k, _) in tree2.range(highKey=key(-498))]
+  [-500, -499, -498]
+
+  # Unique trees reject duplicate keys.
+  >>> tree2.insert(key(0), TupleId(pageId, 0))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique B+-tree
+
+  >>> tree2.insert(key(1000), TupleId(pageId, 0))
+  >>> [tId.tupleIndex for tId in tree2.lookup(key(1000))]
+  [0]
+
+  # Covering trees return included column values alongside tuple ids.
+  >>> ageSchema   = DBSchema('age', [('age', 'int')])
+  >>> (fileId, _) = fm.createIndexFile('test3.bt', BTree.entrySchema(keySchema, ageSchema), BTreePage)
+  >>> tree3 = BTree(fm, fileId, keySchema, duplicates=True, includeSchema=ageSchema)
+  >>> for i in range(200):
+  ...   tree3.insert(key(i % 50), TupleId(pageId, i), ageSchema.pack(ageSchema.instantiate(i)))
+  ...
+  >>> [ageSchema.unpack(v).age for (_, _, v) in tree3.coveringRange(key(7), key(7))]
+  [7, 57, 107, 157]
+
+  >>> shutil.rmtree('btree-test')
+  """
+
+  # The fraction of each node filled during bulk loading.
+  fillFactor = 0.9
+
+  # The size of a packed child page index in internal node entries.
+  childRepr = struct.Struct(">I")
+
+  def __init__(self, fileMgr, fileId, keySchema, duplicates=False, includeSchema=None):
+    self.fileMgr       = fileMgr
+    self.fileId        = fileId
+    self.keySchema     = keySchema
+    self.duplicates    = duplicates
+    self.includeSchema = includeSchema
+    self.keySize       = keySchema.keyrepr.size
+    self.entrySize     = self.keySize + TupleId.size
+    self.leafSize      = self.entrySize + (includeSchema.size if includeSchema else 0)
+    self.childSize     = self.entrySize + BTree.childRepr.size
+
+    # Initialize an empty tree as a root leaf.
+    if self.storageFile().numPages() == 0:
+      self.storageFile().allocatePage()
+      self.node(0).format(True, self.leafSize, 0)
+
+  # Returns the schema of the leaf entries in a B+-tree with the given key and include schemas.
+  @classmethod
+  def entrySchema(cls, keySchema, includeSchema=None):
+    valueSize = TupleId.size + (includeSchema.size if includeSchema else 0)
+    return DBSchema(keySchema.name + "_entry", \
+                    [('key', 'char(' + str(keySchema.keyrepr.size) + ')'), ('value', 'char(' + str(valueSize) + ')')])
+
+  # Storage helpers. Storage files are resolved through the file manager, since
+  # B+-trees may be restored before their files.
+  def storageFile(self):
+    return self.fileMgr.fileMap[self.fileId]
+
+  def node(self, pageIndex):
+    return self.fileMgr.bufferPool.getPage(PageId(self.fileId, pageIndex))
+
+  # Allocates a new node at the end of the file.
+  def allocateNode(self, leaf, link):
+    page = self.storageFile().allocatePage()
+    node = self.node(page.pageId.pageIndex)
+    node.format(leaf, self.leafSize if leaf else self.childSize, link)
+    return node
+
+  def childEntry(self, separator, childIndex):
+    return separator + BTree.childRepr.pack(childIndex)
+
+  def child(self, node, position):
+    if position == 0:
+      return node.header.link
+    entry = node.entry(position - 1)
+    return BTree.childRepr.unpack_from(entry, self.entrySize)[0]
+
+  # Returns the number of levels in the tree.
+  def height(self):
+    (path, _) = self.findLeaf(b'')
+    return len(path) + 1
+
+  # Returns the number of entries in the tree.
+  def numEntries(self):
+    return self.storageFile().numTuples()
+
+
+  # Tree traversal.
+
+  # Descends from the root to the leaf where the given probe belongs, returning
+  # the path of (page index, child position) pairs taken, and the leaf's page index.
+  def findLeaf(self, probe):
+    path      = []
+    pageIndex = 0
+    node      = self.node(pageIndex)
+    while not node.header.isLeaf():
+      position  = node.bisect(probe, right=True, width=self.entrySize)
+      path.append((pageIndex, position))
+      pageIndex = self.child(node, position)
+      node      = self.node(pageIndex)
+    return (path, pageIndex)
+
+  # A range cursor, starting from the first entry at or after the probe, and ending
+  # before the first entry whose key does not satisfy the 'inRange' predicate.
+  # This is a generator over (key, tuple id, included values) triples, copying each
+  # leaf's entries before following the leaf's sibling link.
+  def cursor(self, probe, inRange):
+    (_, pageIndex) = self.findLeaf(probe)
+    node     = self.node(pageIndex)
+    position = node.bisect(probe)
+    while True:
+      entries = node.entries()[position:]
+      link    = node.header.link
+      for entry in entries:
+        key = entry[:self.keySize]
+        if not inRange(key):
+          return
+        yield (key, TupleId.unpack(entry[self.keySize:self.entrySize]), entry[self.entrySize:])
+
+      if link == 0:
+        return
+      (node, position) = (self.node(link), 0)
+
+
+  # Lookups.
+
+  # Returns an iterator over the tuple ids for the given key.
+  def lookup(self, key):
+    return (tupleId for (_, tupleId, _) in self.cursor(key, lambda k: k == key))
+
+  # Returns an ordered iterator over (key, tuple id) pairs between the given low and
+  # high keys, which are optional (i.e., None) for open-ended ranges.
+  def range(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    entries = self.coveringRange(lowKey, highKey, lowInclusive, highInclusive)
+    return ((key, tupleId) for (key, tupleId, _) in entries)
+
+  # Returns an ordered iterator over (key, tuple id, included values) triples between
+  # the given low and high keys, where included values are packed with the include schema.
+  def coveringRange(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if highKey is None:
+      inRange = lambda k: True
+    elif highInclusive:
+      inRange = lambda k: k <= highKey
+    else:
+      inRange = lambda k: k < highKey
+
+    entries = self.cursor(lowKey if lowKey is not None else b'', inRange)
+    if lowKey is not None and not lowInclusive:
+      entries = (entry for entry in entries if entry[0] != lowKey)
+    return entries
+
+  # Returns an ordered iterator over all (key, tuple id) pairs.
+  def scan(self):
+    return self.range()
+
+
+  # Modifications.
+
+  # Inserts a (key, tuple id) pair with any included values, raising a ValueError
+  # for duplicate keys in a unique tree.
+  def insert(self, key, tupleId, included=b''):
+    if not self.duplicates and next(self.lookup(key), None) is not None:
+      raise ValueError("Invalid insertion of a duplicate key into a unique B+-tree")
+
+    entry = self.leafEntry(key, tupleId, included)
+    (path, pageIndex) = self.findLeaf(entry)
+    node = self.node(pageIndex)
+    self.insertIntoNode(path, pageIndex, node.bisect(entry), entry)
+    self.storageFile().header.insertTuple()
+
+  # Inserts an entry into the given node, splitting the node if it is full and
+  # inserting the resulting separator into the parent node on the given path.
+  def insertIntoNode(self, path, pageIndex, position, entry):
+    node = self.node(pageIndex)
+    if not node.isFull():
+      node.insertEntry(position, entry)
+      return
+
+    entries = node.entries()
+    entries.insert(position, entry)
+    middle  = len(entries) // 2
+    leaf    = node.header.isLeaf()
+
+    # Leaf splits copy the middle entry up as a separator, while internal
+    # node splits move the middle separator up.
+    if leaf:
+      (left, right, separator) = (entries[:middle], entries[middle:], entries[middle][:self.entrySize])
+      rightLink = node.header.link
+    else:
+      (left, right, separator) = (entries[:middle], entries[middle+1:], entries[middle][:self.entrySize])
+      rightLink = BTree.childRepr.unpack_from(entries[middle], self.entrySize)[0]
+
+    rightNode = self.allocateNode(leaf, rightLink)
+    rightNode.setEntries(right)
+    rightIndex = rightNode.pageId.pageIndex
+
+    if path:
+      node = self.node(pageIndex)
+      node.setEntries(left)
+      if leaf:
+        node.header.link = rightIndex
+
+      (parentIndex, parentPosition) = path.pop()
+      self.insertIntoNode(path, parentIndex, parentPosition, self.childEntry(separator, rightIndex))
+
+    else:
+      # Split the root, moving its left half to a new node.
+      leftNode = self.allocateNode(leaf, rightIndex if leaf else node.header.link)
+      leftNode.setEntries(left)
+
+      root = self.node(0)
+      root.format(False, self.childSize, leftNode.pageId.pageIndex)
+      root.setEntries([self.childEntry(separator, rightIndex)])
+
+  # Deletes a (key, tuple id) pair, or the entry for the key in a unique tree when
+  # no tuple id is given. Returns whether an entry was deleted.
+  def delete(self, key, tupleId=None):
+    probe = key + tupleId.pack() if tupleId is not None else key
+    (_, pageIndex) = self.findLeaf(probe)
+
+    while True:
+      node     = self.node(pageIndex)
+      position = node.bisect(probe)
+      if position < node.numEntries():
+        if node.entry(position)[:len(probe)] == probe:
+          node.deleteEntry(position)
+          self.storageFile().header.deleteTuple()
+          return True
+        return False
+
+      # Follow sibling links past any leaves without a matching position.
+      pageIndex = node.header.link
+      if pageIndex == 0:
+        return False
+
+
+  # Bulk loading.
+
+  # Loads an empty tree from an iterable of (key, tuple id) pairs, or (key, tuple id,
+  # included values) triples for covering trees, sorted by key and then tuple id.
+  # Leaves are filled in order up to the fill factor, followed by each level of
+  # internal nodes.
+  def bulkLoad(self, pairs):
+    if self.storageFile().numPages() > 1 or self.node(0).numEntries() > 0:
+      raise ValueError("Invalid bulk load into a non-empty B+-tree")
+
+    leafFill     = max(1, int(BTree.fillFactor * self.nodeCapacity(self.leafSize)))
+    fanout       = max(2, int(BTree.fillFactor * self.nodeCapacity(self.childSize)) + 1)
+    level        = []
+    chunk        = []
+    previous     = None
+    numEntries   = 0
+
+    for (key, tupleId, *included) in pairs:
+      entry = self.leafEntry(key, tupleId, included[0] if included else b'')
+      if previous is not None and \
+          (entry[:self.entrySize] <= previous[:self.entrySize] \
+            or (not self.duplicates and key == previous[:self.keySize])):
+        raise ValueError("Invalid bulk load input, with unsorted or duplicate entries")
+
+      # Defer writing a full leaf until we know it is not the only leaf, i.e., the root.
+      if len(chunk) == leafFill:
+        self.appendNode(level, chunk, True)
+        chunk = []
+
+      chunk.append(entry)
+      previous    = entry
+      numEntries += 1
+
+    if not level:
+      self.node(0).setEntries(chunk)
+    else:
+      if chunk:
+        self.appendNode(level, chunk, True)
+
+      # Build internal levels until a single root node remains.
+      while len(level) > 1:
+        groups = [level[i:i+fanout] for i in range(0, len(level), fanout)]
+        nextLevel = []
+        for group in groups:
+          entries = [self.childEntry(first[:self.entrySize], pageIndex) for (first, pageIndex) in group[1:]]
+          if len(groups) == 1:
+            root = self.node(0)
+            root.format(False, self.childSize, group[0][1])
+            root.setEntries(entries)
+          else:
+            self.appendNode(nextLevel, entries, False, group[0])
+        level = nextLevel
+
+    self.storageFile().header.numTuples += numEntries
+
+  # Writes a new node for the given entries, appending its first entry and page index
+  # to the level. Leaves are linked to their predecessor on the level, while internal
+  # nodes take their first child from the given (first entry, page index) pair.
+  def appendNode(self, level, entries, leaf, firstChild=None):
+    node = self.allocateNode(leaf, 0 if leaf else firstChild[1])
+    node.setEntries(entries)
+    pageIndex = node.pageId.pageIndex
+
+    if leaf and level:
+      previous = self.node(level[-1][1])
+      previous.header.link = pageIndex
+      previous.setDirty(True)
+
+    level.append((entries[0] if leaf else firstChild[0], pageIndex))
+
+  # Returns a leaf entry, validating the size of any included values.
+  def leafEntry(self, key, tupleId, included):
+    entry = key + tupleId.pack() + included
+    if len(entry) != self.leafSize:
+      raise ValueError("Invalid B+-tree entry, with a mismatched key or included values")
+    return entry
+
+  # Returns the number of entries of the given size that fit in a node.
+  def nodeCapacity(self, entrySize):
+    return (self.storageFile().pageSize() - BTreePageHeader.size) // entrySize
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
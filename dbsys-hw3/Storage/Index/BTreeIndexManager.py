@@ -0,0 +1,721 @@
+import json, os, os.path
+
+from Catalog.Schema      import DBSchema, DBSchemaEncoder, DBSchemaDecoder
+from Catalog.Identifiers import FileId, PageId, TupleId
+from Storage.Index.BTree       import BTree, BTreePage
+from Storage.Index.BitmapIndex import BitmapIndex
+from Storage.Index.HashIndex   import HashIndex
+from Storage.Index.IndexBatch import IndexBatch
+
+class BTreeIndexManager:
+  """
+  An index manager class, using the storage engine's native B+-trees.
+
+  This provides the same interface as the BerkeleyDB-based IndexManager, with each
+  index implemented as a B+-tree over a storage file managed by the file manager.
+  Index pages are thus read and written through the buffer pool, alongside the
+  pages of the heap files for our relations. Indexes are unclustered, with values
+  that are tuple identifiers into the heap files.
+
+  Keys for a primary indexes must be unique, while secondary indexes support
+  duplicate keys. A relation can have at most one primary index. Indexes created
+  on a non-empty relation are bulk loaded from the relation's existing tuples.
+
+  Indexes may be created with an include schema of additional non-key columns,
+  whose values are stored in each leaf entry. Such covering indexes answer
+  queries over their key and included columns without accessing the heap file
+  (see lookupCovering).
+
+  Indexes are created as one of several kinds, with B+-trees as the default:
+  - hash indexes (see HashIndex), which answer equality lookups only, without
+    descending a tree. Range lookups on hash indexes raise a ValueError.
+  - bitmap indexes (see BitmapIndex), for low-cardinality secondary keys. Bitmap
+    lookups return a bitmap of matching tuple positions, which may be negated and
+    combined with other bitmaps before fetching any heap page.
+
+  Index maintenance may be deferred with the beginBatch and endBatch methods, for
+  example during bulk DML statements. Within a batch, index changes are buffered
+  and applied in key order (see IndexBatch) once the batch fills, when it ends,
+  or before any lookup. Primary key violations are reported when applying changes.
+
+  The index manager maintains the same relationIndexes data structure as the
+  IndexManager, while its indexMap maps an index id to a BTree, HashIndex or
+  BitmapIndex object.
+  The index manager checkpoints its internal data structures to disk, while
+  the index files are checkpointed by the file manager.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> bp = Storage.BufferPool.BufferPool()
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp, dataDir='btree-im-test')
+  >>> bp.setFileManager(fm)
+  >>> im = fm.indexManager
+
+  ## Test index operations
+  >>> schema    = DBSchema('employee', [('id', 'int'), ('age', 'int'), ('salary', 'double')])
+  >>> keySchema = DBSchema('employeeKey', [('id', 'int')])
+  >>> ageSchema = DBSchema('employeeAge', [('age', 'int')])
+
+  # Test index addition
+  >>> indexId1 = im.createIndex(schema.name, schema, keySchema, True)
+  >>> indexId2 = im.createIndex(schema.name, schema, ageSchema, False)
+
+  >>> im.indexes(schema.name) # doctest:+ELLIPSIS
+  [(..., True, 1), (..., False, 2)]
+
+  >>> im.hasIndex(schema.name, ageSchema)
+  True
+
+  >>> im.matchIndex(schema.name, DBSchema('foo', [('age', 'int')]))
+  2
+
+  ## Data operations: test data insertion/deletion/lookup on all indexes
+  >>> pageId = PageId(FileId(0), 1)
+  >>> e1Id   = TupleId(pageId, 1000)
+  >>> e1Data = schema.pack(schema.instantiate(1, 25, 100000))
+  >>> im.insertTuple(schema.name, e1Data, e1Id)
+
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, schema.projectKey(e1Data, ageSchema))]
+  [1000]
+
+  >>> im.lookupByKey(schema.name, schema.projectKey(e1Data, keySchema)).tupleIndex
+  1000
+
+  # Update the tuple's age, invalidating only the secondary index entry.
+  >>> e1NewData = schema.pack(schema.instantiate(1, 30, 90000))
+  >>> im.updateTuple(schema.name, e1Data, e1NewData, e1Id)
+  >>> list(im.lookupByIndex(indexId2, schema.projectKey(e1Data, ageSchema)))
+  []
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, schema.projectKey(e1NewData, ageSchema))]
+  [1000]
+
+  # Delete an indexed tuple
+  >>> im.deleteTuple(schema.name, e1NewData, e1Id)
+  >>> list(im.lookupByIndex(indexId1, schema.projectKey(e1NewData, keySchema)))
+  []
+  >>> im.lookupByKey(schema.name, schema.projectKey(e1NewData, keySchema)) is None
+  True
+
+  ## Index scan tests
+  >>> for i in range(10):
+  ...    im.insertTuple(schema.name, schema.pack(schema.instantiate(i, 2*i+20, 5000*(10+i))), TupleId(pageId, i))
+  ...
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByKey(schema.name)] # doctest:+ELLIPSIS
+  [0, 1, 2, ..., 9]
+
+  >>> [ageSchema.unpackKey(k).age for (k,_) in im.scanByIndex(indexId2)] # doctest:+ELLIPSIS
+  [20, 22, 24, ..., 38]
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.lookupRange(indexId1, \
+        keySchema.packKey(keySchema.instantiate(3)), keySchema.packKey(keySchema.instantiate(6)), \
+        lowInclusive=False, highInclusive=False)]
+  [4, 5]
+
+  # Primary indexes reject duplicate keys, while secondary indexes support them.
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(3, 20, 1000.0)), TupleId(pageId, 11))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique B+-tree
+
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(11, 20, 1000.0)), TupleId(pageId, 11))
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, ageSchema.packKey(ageSchema.instantiate(20)))]
+  [0, 11]
+
+  # Deferred index maintenance, applying changes in key order before lookups.
+  >>> im.beginBatch()
+  >>> for i in reversed(range(12, 20)):
+  ...    im.insertTuple(schema.name, schema.pack(schema.instantiate(i, 2*i+20, 5000*(10+i))), TupleId(pageId, i))
+  ...
+  >>> im.deleteTuple(schema.name, schema.pack(schema.instantiate(19, 58, 5000*29)), TupleId(pageId, 19))
+  >>> len(im.batch)
+  14
+
+  # Duplicate keys are rejected on insertion within a batch, against both the index and the batch.
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(3, 20, 1000.0)), TupleId(pageId, 20))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique index
+
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(12, 20, 1000.0)), TupleId(pageId, 20))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique index
+
+  >>> len(im.batch)
+  14
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByIndex(indexId1)] # doctest:+ELLIPSIS
+  [0, 1, ..., 9, 11, 12, 13, 14, 15, 16, 17, 18]
+  >>> len(im.batch)
+  0
+
+  >>> im.deleteTuple(schema.name, schema.pack(schema.instantiate(18, 56, 5000*28)), TupleId(pageId, 18))
+  >>> im.endBatch()
+  >>> im.batch is None
+  True
+
+  # Covering indexes return included column values from the index, and are
+  # maintained when only their included columns change.
+  >>> deptSchema  = DBSchema('department', [('did', 'int'), ('floor', 'int'), ('budget', 'double')])
+  >>> floorSchema = DBSchema('departmentFloor', [('floor', 'int')])
+  >>> didSchema   = DBSchema('departmentId', [('did', 'int')])
+  >>> indexId3 = im.createIndex(deptSchema.name, deptSchema, floorSchema, False, didSchema)
+  >>> im.indexIncludes(indexId3).fields
+  ['did']
+
+  >>> for i in range(6):
+  ...    im.insertTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(i, i % 3, 1000.0*i)), TupleId(pageId, 100+i))
+  ...
+  >>> floorKey = floorSchema.packKey(floorSchema.instantiate(1))
+  >>> [didSchema.unpack(v).did for (_, _, v) in im.lookupCovering(indexId3, floorKey, floorKey)]
+  [1, 4]
+
+  >>> im.updateTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(4, 1, 4000.0)), \
+        deptSchema.pack(deptSchema.instantiate(7, 1, 4000.0)), TupleId(pageId, 104))
+  >>> [didSchema.unpack(v).did for (_, _, v) in im.lookupCovering(indexId3, floorKey, floorKey)]
+  [1, 7]
+
+  >>> im.createIndex(deptSchema.name, deptSchema, didSchema, True, DBSchema('departmentInfo', [('did', 'int'), ('budget', 'double')]))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid index include schema, overlapping with the index key
+
+  # Bitmap indexes require a heap file for their tuple positions.
+  >>> fm.createRelation(deptSchema.name, deptSchema)
+  >>> tupleIds = [fm.insertTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(i, i % 3, 1000.0))) for i in range(6, 12)]
+  >>> indexId4 = im.createIndex(deptSchema.name, deptSchema, DBSchema('departmentFloor2', [('floor', 'int')]), False, kind="bitmap")
+  >>> im.indexKind(indexId4)
+  'bitmap'
+
+  >>> floorBitmap = im.lookupBitmap(indexId4, floorKey, floorKey)
+  >>> notFloorBitmap = im.lookupBitmap(indexId4, floorKey, floorKey, negate=True)
+  >>> [tupleIds.index(t) + 6 for t in floorBitmap.tupleIds()], len(notFloorBitmap)
+  ([7, 10], 4)
+
+  >>> fm.deleteTuple(deptSchema.name, tupleIds[1])
+  >>> [tupleIds.index(t) + 6 for t in im.lookupByIndex(indexId4, floorKey)]
+  [10]
+
+  # Hash indexes answer equality lookups, including primary key lookups.
+  >>> indexId5 = im.createIndex(deptSchema.name, deptSchema, didSchema, True, kind="hash")
+  >>> im.indexKind(indexId5)
+  'hash'
+  >>> didKey = didSchema.packKey(didSchema.instantiate(9))
+  >>> tupleIds.index(im.lookupByKey(deptSchema.name, didKey)) + 6
+  9
+  >>> list(im.lookupRange(indexId5, didKey))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid range lookup on a hash index, which supports equality lookups only
+
+  >>> im.createIndex(deptSchema.name, deptSchema, DBSchema('departmentBudget', [('budget', 'double')]), False, kind="trie")
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid index kind: trie
+
+  # Test restoring the index manager from its checkpoint.
+  >>> im.checkpoint()
+  >>> im2 = BTreeIndexManager(fileManager=fm, indexDir=im.indexDir)
+  >>> [keySchema.unpackKey(k).id for (k,_) in im2.scanByIndex(indexId1)] # doctest:+ELLIPSIS
+  [0, 1, 2, ..., 9, 11, 12, ..., 17]
+  >>> im2.indexIncludes(indexId3).fields
+  ['did']
+  >>> [tupleIds.index(t) + 6 for t in im2.lookupByIndex(indexId4, floorKey)]
+  [10]
+  >>> tupleIds.index(im2.lookupByKey(deptSchema.name, didKey)) + 6
+  9
+
+  # Test index removal
+  >>> im.removeIndex(schema.name, indexId1)
+  >>> im.removeIndex(deptSchema.name, indexId3)
+  >>> im.removeIndex(deptSchema.name, indexId4)
+  >>> im.removeIndex(deptSchema.name, indexId5)
+  >>> im.indexes(schema.name) # doctest:+ELLIPSIS
+  [(..., False, 2)]
+
+  >>> im.removeIndex(schema.name, indexId2)
+  >>> im.indexes(schema.name)
+  []
+
+  >>> shutil.rmtree('btree-im-test')
+  """
+
+  defaultIndexDir = "data/index"
+
+  indexKinds = { "btree": ".bt", "hash": ".hx", "bitmap": ".bm" }
+
+  checkpointEncoding = "latin1"
+  checkpointFile     = "db.bt"
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.fileMgr    = kwargs.get("fileManager", None)
+      self.indexDir   = kwargs.get("indexDir", BTreeIndexManager.defaultIndexDir)
+      self.batch      = None
+      self.batchDepth = 0
+      checkpointFound = os.path.exists(os.path.join(self.indexDir, BTreeIndexManager.checkpointFile))
+      restoring       = "restore" in kwargs
+
+      if self.fileMgr is None:
+        raise ValueError("No file manager found when initializing a B+-tree index manager")
+
+      if not os.path.exists(self.indexDir):
+          os.makedirs(self.indexDir)
+
+      if restoring or not checkpointFound:
+        self.indexCounter    = kwargs.get("indexCounter", 0)
+        self.relationIndexes = kwargs.get("relationIndexes", {}) # rel id -> (relation schema, primary, dict(secondaries))
+        self.indexMap        = kwargs.get("indexMap", {})        # index id -> BTree object
+
+        if restoring:
+          for i in kwargs["restore"][0]:
+            self.relationIndexes[i[0]] = (i[1][0], i[1][1], dict(i[1][2]))
+
+          for (indexId, fileIndex, keySchema, duplicates, *options) in kwargs["restore"][1]:
+            includeSchema = options[0] if options else None
+            bitmapArgs    = options[1] if len(options) > 1 else None
+            hashArgs      = options[2] if len(options) > 2 else None
+            if bitmapArgs:
+              self.indexMap[indexId] = BitmapIndex(bitmapArgs[0], FileId(fileIndex), keySchema, bitmapArgs[1])
+            elif hashArgs:
+              self.indexMap[indexId] = \
+                HashIndex(self.fileMgr, FileId(fileIndex), keySchema, duplicates, includeSchema, hashArgs)
+            else:
+              self.indexMap[indexId] = BTree(self.fileMgr, FileId(fileIndex), keySchema, duplicates, includeSchema)
+
+      else:
+        self.restore()
+
+  def fromOther(self, other):
+    self.fileMgr         = other.fileMgr
+    self.indexDir        = other.indexDir
+    self.indexCounter    = other.indexCounter
+    self.relationIndexes = other.relationIndexes
+    self.indexMap        = other.indexMap
+    self.batch           = other.batch
+    self.batchDepth      = other.batchDepth
+
+  # Index files are flushed and closed by the file manager.
+  def close(self):
+    self.flushBatch()
+    self.checkpoint()
+
+  # Save the index manager internals to the data directory, as well as any bitmap
+  # indexes, which are kept in memory.
+  def checkpoint(self):
+    for index in self.indexMap.values():
+      if isinstance(index, BitmapIndex):
+        index.save()
+
+    imPath = os.path.join(self.indexDir, BTreeIndexManager.checkpointFile)
+    with open(imPath, 'w', encoding=BTreeIndexManager.checkpointEncoding) as f:
+      f.write(self.pack())
+
+  # Load indexes from an existing data directory.
+  def restore(self):
+    imPath = os.path.join(self.indexDir, BTreeIndexManager.checkpointFile)
+    with open(imPath, 'r', encoding=BTreeIndexManager.checkpointEncoding) as f:
+      other = BTreeIndexManager.unpack(self.fileMgr, f.read())
+      self.fromOther(other)
+
+
+  # Index identifier methods.
+
+  def indexFileName(self, relId, indexId, extension=".bt"):
+    return relId+"_idx"+str(indexId)+extension
+
+  # Generates a filename for the index.
+  def generateIndexFileName(self, relId, extension=".bt"):
+    self.indexCounter += 1
+    return (self.indexCounter, self.indexFileName(relId, self.indexCounter, extension))
+
+
+  # Index management methods
+
+  # Returns whether the relation has any indexes initialized.
+  def hasIndexes(self, relId):
+    return relId in self.relationIndexes and self.relationIndexes[relId]
+
+  # Returns the indexes available on a relation as a triple of (schema, primary, index id)
+  def indexes(self, relId):
+    if self.hasIndexes(relId):
+      _, primary, secondaries = self.relationIndexes[relId]
+      firstElem = [(primary[0], True, primary[1])] if primary else []
+      return firstElem + list(map(lambda x: (x[0], False, x[1]), secondaries.items()))
+    return []
+
+  # Returns whether an index on the given key exists for a relation.
+  def hasIndex(self, relId, keySchema):
+    if self.hasIndexes(relId):
+      _, primary, secondaries = self.relationIndexes[relId]
+      return (primary is not None and primary[0] == keySchema) or keySchema in secondaries
+    return False
+
+  def checkDuplicateIndex(self, relId, keySchema, primary):
+    errorMsg = None
+    if self.hasIndexes(relId):
+      _, prim, _ = self.relationIndexes[relId]
+
+      if primary and prim is not None:
+        errorMsg = "Invalid construction of a duplicate primary index"
+
+      elif self.hasIndex(relId, keySchema):
+        errorMsg = "Invalid construction of a duplicate index"
+
+    return errorMsg
+
+  # Creates a new index for the given key in a new index file, as a B+-tree or
+  # as the given kind of index (i.e., "btree", "hash" or "bitmap").
+  # Returns the index id of the newly created index.
+  # If the relation already contains tuples, the index is bulk loaded from them.
+  # An optional include schema adds non-key columns to the index's entries.
+  def createIndex(self, relId, relSchema, keySchema, primary, includeSchema=None, kind="btree"):
+    errorMsg = self.checkDuplicateIndex(relId, keySchema, primary)
+    if errorMsg:
+      raise ValueError(errorMsg)
+
+    if kind not in BTreeIndexManager.indexKinds:
+      raise ValueError("Invalid index kind: " + str(kind))
+
+    if includeSchema is not None and set(includeSchema.fields) & set(keySchema.fields):
+      raise ValueError("Invalid index include schema, overlapping with the index key")
+
+    if kind == "bitmap":
+      return self.createBitmapIndex(relId, relSchema, keySchema, primary, includeSchema)
+
+    indexId, indexFile = self.generateIndexFileName(relId, BTreeIndexManager.indexKinds[kind])
+    (fileId, _) = self.fileMgr.createIndexFile(indexFile, BTree.entrySchema(keySchema, includeSchema), BTreePage)
+    if kind == "hash":
+      tree = HashIndex(self.fileMgr, fileId, keySchema, not primary, includeSchema)
+    else:
+      tree = BTree(self.fileMgr, fileId, keySchema, not primary, includeSchema)
+
+    tree.bulkLoad(sorted(self.relationEntries(relId, relSchema, keySchema, includeSchema), \
+                         key=lambda x: (x[0], x[1].pack())))
+
+    self.addIndex(relId, relSchema, keySchema, primary, indexId, tree)
+    return indexId
+
+  # Creates a new bitmap index for the given key, over the positions of the relation's heap file.
+  def createBitmapIndex(self, relId, relSchema, keySchema, primary, includeSchema):
+    if primary or includeSchema is not None:
+      raise ValueError("Invalid bitmap index, which must be a secondary index without included columns")
+
+    (fileId, relFile) = self.fileMgr.relationFile(relId)
+    if relFile is None:
+      raise ValueError("Invalid bitmap index on a relation without a heap file")
+
+    indexId, indexFile = self.generateIndexFileName(relId, BTreeIndexManager.indexKinds["bitmap"])
+    slotsPerPage = BitmapIndex.pageSlots(relFile.pageClass(), relFile.pageSize(), relFile.schema().size)
+    index        = BitmapIndex(os.path.join(self.indexDir, indexFile), fileId, keySchema, slotsPerPage)
+    index.bulkLoad(self.relationEntries(relId, relSchema, keySchema))
+
+    self.addIndex(relId, relSchema, keySchema, primary, indexId, index)
+    return indexId
+
+  # Returns the (key, tuple id, included values) triples for the existing tuples of a relation.
+  def relationEntries(self, relId, relSchema, keySchema, includeSchema=None):
+    if self.fileMgr.hasRelation(relId):
+      for (pageId, page) in self.fileMgr.pages(relId):
+        slots = page.header.usedSlots() if hasattr(page.header, "usedSlots") else range(page.header.numTuples())
+        for tupleIndex in slots:
+          tupleId   = TupleId(pageId, tupleIndex)
+          tupleData = page.getTuple(tupleId)
+          included  = relSchema.projectBinary(tupleData, includeSchema) if includeSchema else b''
+          yield (relSchema.projectKey(tupleData, keySchema), tupleId, included)
+
+  # Adds a pre-existing B+-tree index to the database.
+  def addIndex(self, relId, relSchema, keySchema, primary, indexId, tree):
+    if indexId not in self.indexMap:
+      errorMsg = self.checkDuplicateIndex(relId, keySchema, primary)
+      if errorMsg:
+        raise ValueError(errorMsg)
+
+    self.indexCounter = max(self.indexCounter, indexId)
+    self.indexMap[indexId] = tree
+
+    # Add the new index to the relationIndexes data structure.
+    if primary:
+      schema, _, secondaries = \
+        self.relationIndexes[relId] if self.hasIndexes(relId) else (relSchema, None, {})
+
+      self.relationIndexes[relId] = (schema, (keySchema, indexId), secondaries)
+
+    else:
+      if not self.hasIndexes(relId):
+        self.relationIndexes[relId] = (relSchema, None, {})
+      self.relationIndexes[relId][2][keySchema] = indexId
+
+    self.checkpoint()
+
+  # Returns the index (i.e., BTree, HashIndex or BitmapIndex object) corresponding to the index id.
+  def getIndex(self, indexId):
+    if indexId in self.indexMap:
+      return self.indexMap[indexId]
+
+  # Removes or detaches the index for the given relation.
+  # When detaching, we do not delete the index file from the file system.
+  def removeIndex(self, relId, indexId, detach=False):
+    if self.hasIndexes(relId):
+      schema, primary, secondaries = self.relationIndexes[relId]
+      if primary and primary[1] == indexId:
+        self.relationIndexes[relId] = (schema, None, secondaries)
+      else:
+        self.relationIndexes[relId] = \
+          (schema, primary, dict(filter(lambda x: x[1] != indexId, secondaries.items())))
+
+      # Clean up relationIndexes entries when no primary or secondary is present.
+      if self.relationIndexes[relId][1] is None and not self.relationIndexes[relId][2]:
+        del self.relationIndexes[relId]
+
+    if self.batch is not None:
+      self.batch.discard(indexId)
+
+    index = self.indexMap.pop(indexId, None)
+    if isinstance(index, BitmapIndex):
+      if not detach:
+        index.remove()
+    elif index:
+      self.fileMgr.removeIndexFile(index.fileId, detach)
+
+    self.checkpoint()
+
+  # Returns the index id of the best matching index
+  # For now, this requires an exact match on the schema fields and types, but not the name.
+  def matchIndex(self, relId, keySchema):
+    indexes = self.indexes(relId)
+    if indexes:
+      return next((x[2] for x in indexes if keySchema.match(x[0])), None)
+
+  # Returns the include schema of a covering index, or None for other indexes.
+  def indexIncludes(self, indexId):
+    tree = self.getIndex(indexId)
+    if tree is not None:
+      return tree.includeSchema
+
+  # Returns the kind of an index, i.e., "btree", "hash" or "bitmap".
+  def indexKind(self, indexId):
+    index = self.getIndex(indexId)
+    if isinstance(index, BitmapIndex):
+      return "bitmap"
+    elif isinstance(index, HashIndex):
+      return "hash"
+    elif index is not None:
+      return "btree"
+
+  # Returns the packed included column values of a tuple for the given index.
+  def includedValues(self, schema, indexId, tupleData):
+    includeSchema = self.indexIncludes(indexId)
+    return schema.projectBinary(tupleData, includeSchema) if includeSchema else b''
+
+  # Auxiliary index helpers.
+
+  def hasPrimaryIndex(self, relId):
+    return self.hasIndexes(relId) and self.relationIndexes[relId][1] is not None
+
+  def getPrimaryIndex(self, relId):
+    if self.hasPrimaryIndex(relId):
+      _, primary, _ = self.relationIndexes[relId]
+      return self.getIndex(primary[1])
+
+
+  # Deferred index maintenance.
+
+  # Starts deferring index changes into a batch. Batches may be nested, with
+  # changes applied when the outermost batch ends.
+  def beginBatch(self, batchSize=None):
+    if self.batch is None:
+      self.batch = IndexBatch(batchSize)
+    self.batchDepth += 1
+
+  def endBatch(self):
+    self.batchDepth = max(0, self.batchDepth - 1)
+    if self.batchDepth == 0:
+      self.flushBatch()
+      self.batch = None
+
+  # Applies all buffered index changes, in key order for each index.
+  def flushBatch(self):
+    if self.batch:
+      for (indexId, deletes, inserts) in self.batch.changes():
+        tree = self.getIndex(indexId)
+        if tree is not None:
+          for (key, tupleId, _) in deletes:
+            tree.delete(key, tupleId)
+          for (key, tupleId, included) in inserts:
+            tree.insert(key, tupleId, included)
+
+  # Checks that a key is not already present in a unique index, accounting for
+  # the current batch. Indexes check this themselves for unbatched insertions,
+  # whereas batched insertions must be rejected before the batch is applied.
+  def checkUniqueKey(self, indexId, key):
+    tree = self.getIndex(indexId)
+    if tree is not None and not tree.duplicates:
+      present = 1 if next(tree.lookup(key), None) is not None else 0
+      if present + self.batch.keyChange(indexId, key) > 0:
+        raise ValueError("Invalid insertion of a duplicate key into a unique index")
+
+  # Adds an entry to an index, or to the current batch.
+  def insertEntry(self, indexId, key, tupleId, included=b''):
+    if self.batch is not None:
+      self.batch.insert(indexId, key, tupleId, included)
+    else:
+      tree = self.getIndex(indexId)
+      if tree is not None:
+        tree.insert(key, tupleId, included)
+
+  # Removes an entry from an index, or adds its removal to the current batch.
+  def deleteEntry(self, indexId, key, tupleId, included=b''):
+    if self.batch is not None:
+      self.batch.delete(indexId, key, tupleId, included)
+    else:
+      tree = self.getIndex(indexId)
+      if tree is not None:
+        tree.delete(key, tupleId)
+
+  # Applies the current batch if it is full.
+  def checkBatch(self):
+    if self.batch is not None and self.batch.isFull():
+      self.flushBatch()
+
+
+  # Index access methods.
+
+  # Updates all indexes on the relation to add the new tuple.
+  # Primary indexes raise a ValueError on duplicate keys, before any index is changed.
+  def insertTuple(self, relId, tupleData, tupleId):
+    if self.hasIndexes(relId):
+      schema, _, _ = self.relationIndexes[relId]
+      if self.batch is not None:
+        for (keySchema, primary, indexId) in self.indexes(relId):
+          self.checkUniqueKey(indexId, schema.projectKey(tupleData, keySchema))
+
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.insertEntry(indexId, schema.projectKey(tupleData, keySchema), tupleId, \
+                         self.includedValues(schema, indexId, tupleData))
+      self.checkBatch()
+
+  # Updates all indexes on the relation to remove the given tuple.
+  def deleteTuple(self, relId, tupleData, tupleId):
+    if self.hasIndexes(relId):
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.deleteEntry(indexId, schema.projectKey(tupleData, keySchema), tupleId, \
+                         self.includedValues(schema, indexId, tupleData))
+      self.checkBatch()
+
+  # Updates all indexes on the relation to refresh the given tuple, for
+  # indexes whose key or included values have changed.
+  # Note: since our storage engine uses heap files only, the tuple id itself should not change.
+  def updateTuple(self, relId, oldData, newData, tupleId):
+    if self.hasIndexes(relId):
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        oldKey      = schema.projectKey(oldData, keySchema)
+        newKey      = schema.projectKey(newData, keySchema)
+        oldIncluded = self.includedValues(schema, indexId, oldData)
+        newIncluded = self.includedValues(schema, indexId, newData)
+        if oldKey != newKey or oldIncluded != newIncluded:
+          self.deleteEntry(indexId, oldKey, tupleId, oldIncluded)
+          self.insertEntry(indexId, newKey, tupleId, newIncluded)
+      self.checkBatch()
+
+
+  # Lookup methods.
+  # These apply any buffered index changes before accessing the index.
+
+  # Perform an index lookup for the given key.
+  # This returns an iterator over tuple ids, streaming entries from the index.
+  def lookupByIndex(self, indexId, keyData):
+    self.flushBatch()
+    tree = self.getIndex(indexId)
+    if tree is not None:
+      return tree.lookup(keyData)
+
+  # Perform an index range lookup between the given low and high keys, which are
+  # optional (i.e., None) for open-ended ranges.
+  # This returns an ordered iterator of (key, tuple id) pairs, streaming entries from the index.
+  # Hash indexes only support single-key ranges, and unordered full scans without any keys.
+  def lookupRange(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    self.flushBatch()
+    tree = self.getIndex(indexId)
+    if tree is not None:
+      return tree.range(lowKey, highKey, lowInclusive, highInclusive)
+
+  # Perform a covering index range lookup, as with lookupRange.
+  # This returns an ordered iterator of (key, tuple id, included values) triples, where
+  # included values are packed with the index's include schema.
+  def lookupCovering(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    self.flushBatch()
+    tree = self.getIndex(indexId)
+    if tree is not None:
+      return tree.coveringRange(lowKey, highKey, lowInclusive, highInclusive)
+
+  # Perform a bitmap index range lookup, returning the bitmap of matching tuple positions,
+  # or of all other indexed tuples when negated. Returns None for other index types.
+  def lookupBitmap(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True, negate=False):
+    self.flushBatch()
+    index = self.getIndex(indexId)
+    if isinstance(index, BitmapIndex):
+      bitmap = index.bitmap(lowKey, highKey, lowInclusive, highInclusive)
+      return index.complement(bitmap) if negate else bitmap
+
+  # Retrieve a tuple based on its key.
+  # This method returns None if the relation does not have a primary index,
+  # or if the key does not exist in the index.
+  # Otherwise it returns a single tuple identifier.
+  def lookupByKey(self, relId, keyData):
+    self.flushBatch()
+    tree = self.getPrimaryIndex(relId)
+    if tree is not None:
+      return next(tree.lookup(keyData), None)
+
+
+  # Index scan operations.
+  # These return an ordered iterator of (key, tuple id) pairs
+
+  # Scan over a specific index.
+  def scanByIndex(self, indexId):
+    return self.lookupRange(indexId)
+
+  # Scan over the primary index for a relation.
+  def scanByKey(self, relId):
+    self.flushBatch()
+    tree = self.getPrimaryIndex(relId)
+    if tree is not None:
+      return tree.scan()
+
+
+  # Index manager serialization
+  def pack(self):
+    if self.relationIndexes is not None and self.indexMap is not None:
+      # Convert secondaries dictionary to a list since it has an object as a key type (incompatible w/ JSON)
+      pRelIndexes = list(map(lambda x: (x[0], (x[1][0], x[1][1], list(x[1][2].items()))), self.relationIndexes.items()))
+      pIndexMap   = list(map(lambda entry: (entry[0], entry[1].fileId.fileIndex, entry[1].keySchema, \
+                                            entry[1].duplicates, entry[1].includeSchema, \
+                                            self.packBitmapArgs(entry[1]), self.packHashArgs(entry[1])), \
+                             self.indexMap.items()))
+      return json.dumps((self.indexDir, self.indexCounter, pRelIndexes, pIndexMap), cls=DBSchemaEncoder)
+
+  # Bitmap indexes are restored from their index file path and page slots.
+  def packBitmapArgs(self, index):
+    return (index.filePath, index.slotsPerPage) if isinstance(index, BitmapIndex) else None
+
+  # Hash indexes are restored from their bucket directory.
+  def packHashArgs(self, index):
+    return index.directory() if isinstance(index, HashIndex) else None
+
+  @classmethod
+  def unpack(cls, fileMgr, buffer):
+    args = json.loads(buffer, cls=DBSchemaDecoder)
+    if len(args) == 4:
+      return cls(fileManager=fileMgr, indexDir=args[0], indexCounter=args[1], restore=(args[2], args[3]))
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,286 @@
+import os, os.path, pickle, zlib
+
+from Catalog.Identifiers import FileId, PageId, TupleId
+
+class Bitmap:
+  """
+  A compressed bitmap over the tuple positions of a heap file.
+
+  Each tuple id maps to a position (pageIndex * slotsPerPage + tupleIndex), such that
+  position order is heap page order. Positions are grouped into fixed-size chunks,
+  each represented as a Python integer, and empty chunks are not stored. Bitmaps
+  over the same heap file are combined with the &, | and - (and-not) operators.
+
+  >>> pageId = lambda i: PageId(FileId(0), i)
+  >>> b1 = Bitmap(FileId(0), 100, [TupleId(pageId(i), i) for i in range(5)])
+  >>> b2 = Bitmap(FileId(0), 100, [TupleId(pageId(i), i) for i in range(3, 8)])
+
+  >>> [(t.pageId.pageIndex, t.tupleIndex) for t in (b1 & b2).tupleIds()]
+  [(3, 3), (4, 4)]
+  >>> (len(b1 | b2), len(b1 - b2))
+  (8, 3)
+
+  # Positions far apart only store their non-empty chunks.
+  >>> b3 = Bitmap(FileId(0), 100, [TupleId(pageId(0), 1), TupleId(pageId(100000), 1)])
+  >>> len(b3.chunks)
+  2
+  >>> Bitmap.unpack(b3.pack()) == b3
+  True
+  """
+
+  chunkBits = 1 << 16
+
+  def __init__(self, fileId, slotsPerPage, tupleIds=None, chunks=None):
+    self.fileId       = fileId
+    self.slotsPerPage = slotsPerPage
+    self.chunks       = dict(chunks) if chunks else {}   # chunk index -> integer bitset
+    for tupleId in (tupleIds if tupleIds else []):
+      self.add(tupleId)
+
+  def __len__(self):
+    return sum(chunk.bit_count() for chunk in self.chunks.values())
+
+  def __eq__(self, other):
+    return isinstance(other, Bitmap) and self.fileId == other.fileId \
+            and self.slotsPerPage == other.slotsPerPage and self.chunks == other.chunks
+
+  def __contains__(self, tupleId):
+    (chunk, bit) = divmod(self.position(tupleId), Bitmap.chunkBits)
+    return (self.chunks.get(chunk, 0) >> bit) & 1 == 1
+
+  def position(self, tupleId):
+    return tupleId.pageId.pageIndex * self.slotsPerPage + tupleId.tupleIndex
+
+  def add(self, tupleId):
+    (chunk, bit) = divmod(self.position(tupleId), Bitmap.chunkBits)
+    self.chunks[chunk] = self.chunks.get(chunk, 0) | (1 << bit)
+
+  # Removes a tuple id, returning whether it was present.
+  def remove(self, tupleId):
+    if tupleId not in self:
+      return False
+
+    (chunk, bit) = divmod(self.position(tupleId), Bitmap.chunkBits)
+    self.chunks[chunk] &= ~(1 << bit)
+    if not self.chunks[chunk]:
+      del self.chunks[chunk]
+    return True
+
+  # Bitmap combination, returning a new bitmap over the same heap file. The flags indicate
+  # whether chunks present in only the left or right bitmap may yield a non-empty chunk.
+  def combine(self, other, op, leftOnly, rightOnly):
+    if self.fileId != other.fileId or self.slotsPerPage != other.slotsPerPage:
+      raise ValueError("Invalid combination of bitmaps over different heap files")
+
+    chunks = {}
+    for i in set(self.chunks) | set(other.chunks):
+      if (i in self.chunks or rightOnly) and (i in other.chunks or leftOnly):
+        chunk = op(self.chunks.get(i, 0), other.chunks.get(i, 0))
+        if chunk:
+          chunks[i] = chunk
+    return Bitmap(self.fileId, self.slotsPerPage, chunks=chunks)
+
+  def __and__(self, other):
+    return self.combine(other, lambda x, y: x & y, False, False)
+
+  def __or__(self, other):
+    return self.combine(other, lambda x, y: x | y, True, True)
+
+  def __sub__(self, other):
+    return self.combine(other, lambda x, y: x & ~y, True, False)
+
+  # Returns the set positions in increasing order.
+  def positions(self):
+    for i in sorted(self.chunks):
+      chunk = self.chunks[i]
+      while chunk:
+        lowest = chunk & -chunk
+        yield i * Bitmap.chunkBits + lowest.bit_length() - 1
+        chunk ^= lowest
+
+  # Returns the tuple ids in the bitmap, in heap page order.
+  def tupleIds(self):
+    for position in self.positions():
+      (pageIndex, tupleIndex) = divmod(position, self.slotsPerPage)
+      yield TupleId(PageId(self.fileId, pageIndex), tupleIndex)
+
+  # Bitmap serialization, as (file index, slots per page, [(chunk index, chunk bytes)]).
+  def pack(self):
+    chunks = [(i, c.to_bytes((c.bit_length() + 7) // 8, 'little')) for (i, c) in sorted(self.chunks.items())]
+    return (self.fileId.fileIndex, self.slotsPerPage, chunks)
+
+  @classmethod
+  def unpack(cls, packed):
+    (fileIndex, slotsPerPage, chunks) = packed
+    return cls(FileId(fileIndex), slotsPerPage, chunks=[(i, int.from_bytes(c, 'little')) for (i, c) in chunks])
+
+
+class BitmapIndex:
+  """
+  A bitmap index, maintaining a bitmap of tuple positions for each distinct key.
+
+  Bitmap indexes suit low-cardinality attributes, where a B+-tree would store
+  long runs of duplicate keys. Tuple positions follow the slot layout of the
+  relation's pages (see BitmapIndex.pageSlots), such that matches of several
+  predicates are combined as bitmaps before fetching any heap page.
+
+  This provides the same interface as the BTree class, for maintenance and lookups
+  by the index manager. Bitmap indexes are always secondary indexes. Their bitmaps
+  are kept in memory, and written to a zlib-compressed index file on checkpoints.
+
+  >>> import shutil
+  >>> from Catalog.Schema import DBSchema
+  >>> keySchema = DBSchema('flag', [('flag', 'char(1)')])
+  >>> key       = lambda v: keySchema.packKey(keySchema.instantiate(v))
+  >>> pageId    = lambda i: PageId(FileId(0), i)
+  >>> os.makedirs('bitmap-test', exist_ok=True)
+
+  >>> index = BitmapIndex('bitmap-test/flag.bm', FileId(0), keySchema, 10)
+  >>> for i in range(30):
+  ...   index.insert(key('ANR'[i % 3]), TupleId(pageId(i // 10), i % 10))
+  ...
+  >>> [(t.pageId.pageIndex, t.tupleIndex) for t in index.lookup(key('R'))]
+  [(0, 2), (0, 5), (0, 8), (1, 1), (1, 4), (1, 7), (2, 0), (2, 3), (2, 6), (2, 9)]
+
+  # Combine matches with AND, OR and NOT before accessing the heap.
+  >>> notR = index.complement(index.bitmap(key('R'), key('R')))
+  >>> len(notR & index.bitmap(key('A'), key('N'))), len(notR | index.bitmap(key('R'), key('R')))
+  (20, 30)
+
+  >>> index.delete(key('R'), TupleId(pageId(2), 9))
+  True
+  >>> len(index.bitmap(key('R'), key('R'))), len(index.complement(index.bitmap(key('R'), key('R'))))
+  (9, 20)
+
+  >>> [keySchema.unpackKey(k).flag for (k, _) in index.range(key('N'))][:2]
+  ['N', 'N']
+
+  # Restore the index from its index file.
+  >>> index.save()
+  >>> index2 = BitmapIndex('bitmap-test/flag.bm', FileId(0), keySchema, 10)
+  >>> len(index2.bitmap()), index2.numEntries()
+  (29, 29)
+
+  >>> shutil.rmtree('bitmap-test')
+  """
+
+  def __init__(self, filePath, fileId, keySchema, slotsPerPage):
+    self.filePath      = filePath
+    self.fileId        = fileId
+    self.keySchema     = keySchema
+    self.slotsPerPage  = slotsPerPage
+    self.duplicates    = True
+    self.includeSchema = None
+    self.bitmaps       = {}   # key -> Bitmap
+    self.existing      = Bitmap(fileId, slotsPerPage)
+
+    if os.path.exists(filePath):
+      self.restore()
+
+  # Returns the number of tuple slots per page, following the page class's header layout.
+  @classmethod
+  def pageSlots(cls, pageClass, pageSize, tupleSize):
+    header = pageClass.headerClass(buffer=memoryview(bytearray(pageSize)), tupleSize=tupleSize)
+    return getattr(header, "numSlots", (pageSize - header.headerSize()) // tupleSize)
+
+  def numEntries(self):
+    return len(self.existing)
+
+  def emptyBitmap(self):
+    return Bitmap(self.fileId, self.slotsPerPage)
+
+
+  # Lookups.
+
+  # Returns the union of the bitmaps of all keys between the given low and high keys,
+  # which are optional (i.e., None) for open-ended ranges.
+  def bitmap(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    result = self.emptyBitmap()
+    for key in self.keys(lowKey, highKey, lowInclusive, highInclusive):
+      result = result | self.bitmaps[key]
+    return result
+
+  # Returns the bitmap of all indexed tuples that are not in the given bitmap.
+  def complement(self, bitmap):
+    return self.existing - bitmap
+
+  # Returns the indexed keys in the given range, in key order.
+  def keys(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    return [key for key in sorted(self.bitmaps) \
+              if (lowKey is None or key > lowKey or (lowInclusive and key == lowKey)) \
+                and (highKey is None or key < highKey or (highInclusive and key == highKey))]
+
+  # Returns an iterator over the tuple ids for the given key, in heap page order.
+  def lookup(self, key):
+    return self.bitmaps[key].tupleIds() if key in self.bitmaps else iter([])
+
+  # Returns an ordered iterator over (key, tuple id) pairs in the given key range.
+  def range(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    for key in self.keys(lowKey, highKey, lowInclusive, highInclusive):
+      for tupleId in self.bitmaps[key].tupleIds():
+        yield (key, tupleId)
+
+  # Bitmap indexes do not include any columns beyond their key.
+  def coveringRange(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    return ((key, tupleId, b'') for (key, tupleId) in self.range(lowKey, highKey, lowInclusive, highInclusive))
+
+  def scan(self):
+    return self.range()
+
+
+  # Modifications.
+
+  def insert(self, key, tupleId, included=b''):
+    if included:
+      raise ValueError("Invalid bitmap index entry, with included values")
+
+    self.bitmaps.setdefault(bytes(key), self.emptyBitmap()).add(tupleId)
+    self.existing.add(tupleId)
+
+  # Removes the given tuple id (or any tuple id) for a key, returning whether an entry was removed.
+  def delete(self, key, tupleId=None):
+    bitmap = self.bitmaps.get(bytes(key), None)
+    if bitmap is None:
+      return False
+
+    if tupleId is None:
+      tupleId = next(bitmap.tupleIds())
+
+    removed = bitmap.remove(tupleId)
+    if removed:
+      self.existing.remove(tupleId)
+      if not bitmap.chunks:
+        del self.bitmaps[bytes(key)]
+    return removed
+
+  # Loads the index from an iterable of (key, tuple id) pairs, or (key, tuple id, included
+  # values) triples as produced for other index types.
+  def bulkLoad(self, entries):
+    for (key, tupleId, *included) in entries:
+      self.insert(key, tupleId, included[0] if included else b'')
+
+
+  # Index file persistence.
+
+  def save(self):
+    packed = [(key, bitmap.pack()) for (key, bitmap) in self.bitmaps.items()]
+    with open(self.filePath, 'wb') as f:
+      f.write(zlib.compress(pickle.dumps(packed)))
+
+  def restore(self):
+    with open(self.filePath, 'rb') as f:
+      packed = pickle.loads(zlib.decompress(f.read()))
+
+    self.bitmaps  = {key: Bitmap.unpack(bitmap) for (key, bitmap) in packed}
+    self.existing = self.emptyBitmap()
+    for bitmap in self.bitmaps.values():
+      self.existing = self.existing | bitmap
+
+  def remove(self):
+    if os.path.exists(self.filePath):
+      os.remove(self.filePath)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,326 @@
+import zlib
+
+from Catalog.Identifiers import PageId, FileId, TupleId
+from Catalog.Schema      import DBSchema
+from Storage.Index.BTree import BTree, BTreePage, BTreePageHeader
+
+class HashIndex:
+  """
+  A linear hash index over the pages of a storage file, accessed through the buffer pool.
+
+  The index maps index keys to tuple ids, as with the BTree class, but only supports
+  equality lookups. Each bucket is a chain of pages, starting at a primary page and
+  linked through overflow pages. Bucket pages reuse the B+-tree's leaf node layout
+  (see BTreePage), holding (key, tuple id, included values) entries in sorted order,
+  with the page header's link holding the page index of the next overflow page.
+
+  Keys are hashed with CRC32. With linear hashing, the index starts with a fixed
+  number of buckets, and splits one bucket at a time, in bucket order, whenever the
+  average bucket fill exceeds the maximum load. Thus the number of buckets grows
+  gradually, without rehashing the whole index. The bucket directory (i.e., the
+  level, split pointer, primary page of each bucket, and any free pages) is kept
+  in memory, and checkpointed by the index manager.
+
+  Deletions do not merge buckets, and may leave empty overflow pages in a bucket chain.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> bp = Storage.BufferPool.BufferPool(pageSize=256, poolSize=256*16)
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp, pageSize=256, dataDir='hash-test')
+  >>> bp.setFileManager(fm)
+
+  >>> keySchema = DBSchema('idKey', [('id', 'int')])
+  >>> pageId    = PageId(FileId(0), 1)
+  >>> key       = lambda i: keySchema.packKey(keySchema.instantiate(i))
+
+  >>> (fileId, _) = fm.createIndexFile('test.hx', BTree.entrySchema(keySchema), BTreePage)
+  >>> index = HashIndex(fm, fileId, keySchema, duplicates=True)
+
+  # Insert keys with duplicates, causing several bucket splits.
+  >>> for i in range(500):
+  ...   index.insert(key(i // 2), TupleId(pageId, i))
+  ...
+  >>> index.numBuckets() > HashIndex.initialBuckets
+  True
+  >>> [tId.tupleIndex for tId in index.lookup(key(100))]
+  [200, 201]
+
+  >>> sorted(keySchema.unpackKey(k).id for (k, _) in index.scan()) == sorted(i // 2 for i in range(500))
+  True
+
+  # Hash indexes answer equality lookups only.
+  >>> [keySchema.unpackKey(k).id for (k, _) in index.range(key(7), key(7))]
+  [7, 7]
+  >>> list(index.range(key(7), key(9)))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid range lookup on a hash index, which supports equality lookups only
+
+  >>> index.delete(key(100), TupleId(pageId, 200))
+  True
+  >>> [tId.tupleIndex for tId in index.lookup(key(100))]
+  [201]
+  >>> all(index.delete(key(i // 2), TupleId(pageId, i)) for i in range(500) if i != 200)
+  True
+  >>> (list(index.scan()), index.numEntries())
+  ([], 0)
+
+  # Bulk load a unique index, and restore it from its bucket directory.
+  >>> (fileId, _) = fm.createIndexFile('test2.hx', BTree.entrySchema(keySchema), BTreePage)
+  >>> index2 = HashIndex(fm, fileId, keySchema)
+  >>> index2.bulkLoad((key(i), TupleId(pageId, i % 100)) for i in range(1000))
+  >>> index3 = HashIndex(fm, fileId, keySchema, directory=index2.directory())
+  >>> [tId.tupleIndex for tId in index3.lookup(key(942))]
+  [42]
+  >>> index3.insert(key(942), TupleId(pageId, 0))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique hash index
+
+  >>> shutil.rmtree('hash-test')
+  """
+
+  # The number of buckets of an empty index.
+  initialBuckets = 4
+
+  # The average fraction of bucket page capacity triggering a bucket split.
+  maxLoad = 0.75
+
+  def __init__(self, fileMgr, fileId, keySchema, duplicates=False, includeSchema=None, directory=None):
+    self.fileMgr       = fileMgr
+    self.fileId        = fileId
+    self.keySchema     = keySchema
+    self.duplicates    = duplicates
+    self.includeSchema = includeSchema
+    self.keySize       = keySchema.keyrepr.size
+    self.entrySize     = self.keySize + TupleId.size
+    self.leafSize      = self.entrySize + (includeSchema.size if includeSchema else 0)
+
+    if directory:
+      (self.level, self.nextSplit, buckets, freePages) = directory
+      self.buckets   = list(buckets)
+      self.freePages = list(freePages)
+
+    else:
+      (self.level, self.nextSplit, self.buckets, self.freePages) = (0, 0, [], [])
+      for _ in range(HashIndex.initialBuckets):
+        self.buckets.append(self.allocateNode())
+
+  # Returns the bucket directory, as a (level, split pointer, bucket pages, free pages) tuple.
+  def directory(self):
+    return (self.level, self.nextSplit, list(self.buckets), list(self.freePages))
+
+  # Storage helpers, as with B+-trees.
+  def storageFile(self):
+    return self.fileMgr.fileMap[self.fileId]
+
+  def node(self, pageIndex):
+    return self.fileMgr.bufferPool.getPage(PageId(self.fileId, pageIndex))
+
+  # Allocates an empty bucket page, reusing any free overflow page. Returns its page index.
+  def allocateNode(self):
+    if self.freePages:
+      pageIndex = self.freePages.pop()
+    else:
+      pageIndex = self.storageFile().allocatePage().pageId.pageIndex
+
+    self.node(pageIndex).format(True, self.leafSize, 0)
+    return pageIndex
+
+  def numBuckets(self):
+    return len(self.buckets)
+
+  def numEntries(self):
+    return self.storageFile().numTuples()
+
+  def nodeCapacity(self):
+    return (self.storageFile().pageSize() - BTreePageHeader.size) // self.leafSize
+
+
+  # Hashing.
+
+  # Returns the bucket of a key. Buckets before the split pointer have already been
+  # split in the current level, and are addressed with the next level's hash function.
+  def bucket(self, key):
+    h = zlib.crc32(key)
+    n = HashIndex.initialBuckets << self.level
+    b = h % n
+    return h % (2 * n) if b < self.nextSplit else b
+
+  # Returns the page indexes of a bucket's chain of pages.
+  def chain(self, bucket):
+    pageIndex = self.buckets[bucket]
+    while True:
+      yield pageIndex
+      pageIndex = self.node(pageIndex).header.link
+      if pageIndex == 0:
+        return
+
+  # Returns a copy of the entries in a bucket's chain matching the given probe.
+  def bucketEntries(self, key, probe=None):
+    probe   = probe if probe is not None else key
+    entries = []
+    for pageIndex in self.chain(self.bucket(key)):
+      node = self.node(pageIndex)
+      for entry in node.entries()[node.bisect(probe):]:
+        if entry[:len(probe)] != probe:
+          break
+        entries.append(entry)
+    return entries
+
+  # Returns a (key, tuple id, included values) triple for a bucket entry.
+  def unpackEntry(self, entry):
+    return (entry[:self.keySize], TupleId.unpack(entry[self.keySize:self.entrySize]), entry[self.entrySize:])
+
+
+  # Lookups.
+
+  # Returns an iterator over the tuple ids for the given key.
+  def lookup(self, key):
+    return (tupleId for (_, tupleId, _) in self.coveringRange(key, key))
+
+  # Returns an iterator over (key, tuple id) pairs for a single key, or all entries.
+  def range(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    entries = self.coveringRange(lowKey, highKey, lowInclusive, highInclusive)
+    return ((key, tupleId) for (key, tupleId, _) in entries)
+
+  # Returns an iterator over (key, tuple id, included values) triples for a single key
+  # (i.e., an inclusive range with equal bounds), or all entries in bucket order
+  # when no bounds are given. Other ranges raise a ValueError.
+  def coveringRange(self, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if lowKey is None and highKey is None:
+      return self.scanEntries()
+
+    if lowKey != highKey or not(lowInclusive and highInclusive):
+      raise ValueError("Invalid range lookup on a hash index, which supports equality lookups only")
+
+    return map(self.unpackEntry, self.bucketEntries(lowKey))
+
+  # A generator over all entries, copying each page's entries before following its link.
+  def scanEntries(self):
+    for bucket in range(self.numBuckets()):
+      for pageIndex in self.chain(bucket):
+        for entry in self.node(pageIndex).entries():
+          yield self.unpackEntry(entry)
+
+  # Returns an unordered iterator over all (key, tuple id) pairs.
+  def scan(self):
+    return self.range()
+
+
+  # Modifications.
+
+  # Inserts a (key, tuple id) pair with any included values, raising a ValueError
+  # for duplicate keys in a unique index. Splits a bucket when exceeding the maximum load.
+  def insert(self, key, tupleId, included=b''):
+    if not self.duplicates and self.bucketEntries(key):
+      raise ValueError("Invalid insertion of a duplicate key into a unique hash index")
+
+    self.insertIntoBucket(self.bucket(key), self.leafEntry(key, tupleId, included))
+    self.storageFile().header.insertTuple()
+
+    if self.numEntries() > HashIndex.maxLoad * self.numBuckets() * self.nodeCapacity():
+      self.split()
+
+  # Inserts an entry into the first page of a bucket's chain with free space,
+  # appending an overflow page if all pages are full.
+  def insertIntoBucket(self, bucket, entry):
+    for pageIndex in self.chain(bucket):
+      node = self.node(pageIndex)
+      if not node.isFull():
+        node.insertEntry(node.bisect(entry), entry)
+        return
+
+    overflow = self.allocateNode()
+    self.node(overflow).insertEntry(0, entry)
+    node = self.node(pageIndex)
+    node.header.link = overflow
+    node.setDirty(True)
+
+  # Splits the bucket at the split pointer, redistributing its entries between
+  # itself and a new bucket, and advances the split pointer.
+  def split(self):
+    bucket  = self.nextSplit
+    entries = []
+    for pageIndex in list(self.chain(bucket)):
+      entries.extend(self.node(pageIndex).entries())
+      if pageIndex != self.buckets[bucket]:
+        self.freePages.append(pageIndex)
+
+    self.node(self.buckets[bucket]).format(True, self.leafSize, 0)
+    self.buckets.append(self.allocateNode())
+
+    self.nextSplit += 1
+    if self.nextSplit == HashIndex.initialBuckets << self.level:
+      (self.level, self.nextSplit) = (self.level + 1, 0)
+
+    for entry in entries:
+      self.insertIntoBucket(self.bucket(entry[:self.keySize]), entry)
+
+  # Deletes a (key, tuple id) pair, or the entry for the key in a unique index when
+  # no tuple id is given. Returns whether an entry was deleted.
+  def delete(self, key, tupleId=None):
+    probe = key + tupleId.pack() if tupleId is not None else key
+    for pageIndex in self.chain(self.bucket(key)):
+      node     = self.node(pageIndex)
+      position = node.bisect(probe)
+      if position < node.numEntries() and node.entry(position)[:len(probe)] == probe:
+        node.deleteEntry(position)
+        self.storageFile().header.deleteTuple()
+        return True
+    return False
+
+
+  # Bulk loading.
+
+  # Loads an empty index from an iterable of (key, tuple id) pairs, or (key, tuple id,
+  # included values) triples for covering indexes. The number of buckets is chosen
+  # up front for the number of entries, and each bucket's pages are written once.
+  def bulkLoad(self, pairs):
+    if self.numEntries() > 0 or self.numBuckets() != HashIndex.initialBuckets:
+      raise ValueError("Invalid bulk load into a non-empty hash index")
+
+    entries = [self.leafEntry(key, tupleId, included[0] if included else b'') \
+                for (key, tupleId, *included) in pairs]
+
+    # Grow the directory to the target number of buckets, from the linear hashing split order.
+    target = max(HashIndex.initialBuckets, int(len(entries) / (HashIndex.maxLoad * self.nodeCapacity())) + 1)
+    while self.numBuckets() < target:
+      self.buckets.append(self.allocateNode())
+      self.nextSplit += 1
+      if self.nextSplit == HashIndex.initialBuckets << self.level:
+        (self.level, self.nextSplit) = (self.level + 1, 0)
+
+    buckets = [[] for _ in self.buckets]
+    for entry in entries:
+      buckets[self.bucket(entry[:self.keySize])].append(entry)
+
+    capacity = self.nodeCapacity()
+    for (bucket, bucketEntries) in enumerate(buckets):
+      bucketEntries.sort()
+      if not self.duplicates and \
+          any(a[:self.keySize] == b[:self.keySize] for (a, b) in zip(bucketEntries, bucketEntries[1:])):
+        raise ValueError("Invalid bulk load input, with duplicate entries")
+
+      pageIndex = self.buckets[bucket]
+      for start in range(0, len(bucketEntries), capacity):
+        if start > 0:
+          overflow = self.allocateNode()
+          node = self.node(pageIndex)
+          node.header.link = overflow
+          node.setDirty(True)
+          pageIndex = overflow
+        self.node(pageIndex).setEntries(bucketEntries[start:start+capacity])
+
+    self.storageFile().header.numTuples += len(entries)
+
+  # Returns a bucket entry, validating the size of any included values.
+  def leafEntry(self, key, tupleId, included):
+    entry = key + tupleId.pack() + included
+    if len(entry) != self.leafSize:
+      raise ValueError("Invalid hash index entry, with a mismatched key or included values")
+    return entry
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,110 @@
+from Catalog.Identifiers import TupleId
+
+class IndexBatch:
+  """
+  A buffer of deferred index changes, used by index managers for batched index maintenance.
+
+  Changes are buffered per index as insertions and deletions of index entries, that is,
+  (key, tuple id) pairs along with any included column values for covering indexes.
+  Changes to the same entry are netted, such that an insertion and a deletion of an
+  entry within the same batch cancel out. When applying a batch, each index's deletions
+  and then its insertions are returned in key order (and tuple id order for duplicate
+  keys), turning random index accesses into a sequential pass over the index.
+
+  >>> from Catalog.Identifiers import FileId, PageId
+  >>> pageId = PageId(FileId(0), 1)
+  >>> batch  = IndexBatch(batchSize=4)
+
+  >>> batch.insert(1, b'c', TupleId(pageId, 0))
+  >>> batch.insert(1, b'a', TupleId(pageId, 1))
+  >>> batch.delete(1, b'b', TupleId(pageId, 2))
+  >>> batch.insert(2, b'x', TupleId(pageId, 3))
+  >>> (len(batch), batch.isFull())
+  (4, True)
+
+  # Deleting a buffered insertion cancels it out.
+  >>> batch.delete(2, b'x', TupleId(pageId, 3))
+  >>> len(batch)
+  3
+
+  # Net insertions per key, e.g., to check unique keys before applying the batch.
+  >>> (batch.keyChange(1, b'a'), batch.keyChange(1, b'b'), batch.keyChange(2, b'x'))
+  (1, -1, 0)
+
+  >>> [(indexId, [k for (k, _, _) in deletes], [k for (k, _, _) in inserts]) for (indexId, deletes, inserts) in batch.changes()]
+  [(1, [b'b'], [b'a', b'c'])]
+
+  >>> len(batch)
+  0
+  """
+
+  # The default number of buffered index entries before a batch is applied.
+  defaultBatchSize = 16384
+
+  def __init__(self, batchSize=None):
+    self.batchSize  = batchSize if batchSize else IndexBatch.defaultBatchSize
+    self.entries    = {}   # index id -> dict of (key, packed tuple id and included values) -> net change
+    self.keyChanges = {}   # index id -> dict of key -> net change over all entries with that key
+    self.numEntries = 0
+
+  def __len__(self):
+    return self.numEntries
+
+  def isFull(self):
+    return self.numEntries >= self.batchSize
+
+  def insert(self, indexId, key, tupleId, included=b''):
+    self.change(indexId, key, tupleId, included, 1)
+
+  def delete(self, indexId, key, tupleId, included=b''):
+    self.change(indexId, key, tupleId, included, -1)
+
+  # Accumulates the net change for an index entry.
+  def change(self, indexId, key, tupleId, included, delta):
+    indexEntries = self.entries.setdefault(indexId, {})
+    entry        = (bytes(key), tupleId.pack() + bytes(included))
+    previous     = indexEntries.pop(entry, 0)
+    net          = previous + delta
+    if net:
+      indexEntries[entry] = net
+    self.numEntries += (1 if net else 0) - (1 if previous else 0)
+
+    keyChanges = self.keyChanges.setdefault(indexId, {})
+    keyNet     = keyChanges.pop(entry[0], 0) + delta
+    if keyNet:
+      keyChanges[entry[0]] = keyNet
+
+  # Returns the net number of buffered insertions of the given key into an index.
+  def keyChange(self, indexId, key):
+    return self.keyChanges.get(indexId, {}).get(bytes(key), 0)
+
+  # Drops any buffered changes for an index, e.g., when removing the index.
+  def discard(self, indexId):
+    self.numEntries -= len(self.entries.pop(indexId, {}))
+    self.keyChanges.pop(indexId, None)
+
+  # Returns and clears the buffered changes, as a list of triples of index id, and
+  # sorted lists of (key, tuple id, included values) triples to delete and insert.
+  def changes(self):
+    result = []
+    for (indexId, indexEntries) in sorted(self.entries.items()):
+      ordered = sorted(indexEntries.items())
+      deletes = [self.unpackEntry(entry) for (entry, net) in ordered if net < 0]
+      inserts = [self.unpackEntry(entry) for (entry, net) in ordered if net > 0]
+      if deletes or inserts:
+        result.append((indexId, deletes, inserts))
+
+    self.entries    = {}
+    self.keyChanges = {}
+    self.numEntries = 0
+    return result
+
+  @staticmethod
+  def unpackEntry(entry):
+    (key, value) = entry
+    return (key, TupleId.unpack(value), value[TupleId.size:])
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,8 +1,9 @@
-import json, os, os.path
+import itertools, json, os, os.path
 
 from bsddb3              import db
 from Catalog.Schema      import DBSchema, DBSchemaEncoder, DBSchemaDecoder
 from Catalog.Identifiers import FileId, PageId, TupleId
+from Storage.Index.IndexBatch import IndexBatch
 
 class IndexManager:
   """
@@ -32,6 +33,25 @@ class IndexManager:
   underyling storage file, to ensure the indexes are kept consistent.
   These methods ensure that all indexes (both primary and secondaries) are maintained.
 
+  Index keys use the order-preserving binary key representation of DBSchema.packKey,
+  such that the BerkeleyDB B-tree order matches the order of key values, and range
+  lookups and ordered scans are meaningful. The index manager tracks per-index options,
+  including the version of the key encoding used by each index. Indexes created with
+  an older key encoding (i.e., native struct packing) are migrated upon restore.
+
+  Indexes may also be created as BerkeleyDB hash databases, with the "hash" index kind.
+  Hash indexes only support equality lookups, and unordered full scans.
+
+  Indexes may be created with an include schema of additional non-key columns, whose
+  packed values are stored after the tuple identifier in each index value. Such
+  covering indexes answer queries over their key and included columns without
+  accessing the heap file (see lookupCovering).
+
+  Index maintenance may be deferred with the beginBatch and endBatch methods, for
+  example during bulk DML statements. Within a batch, index changes are buffered
+  and applied in key order (see IndexBatch) once the batch fills, when it ends,
+  or before any lookup, rather than as random BerkeleyDB accesses per tuple.
+
   In a similar fashion to the file manager, the index manager checkpoints its
   internal data structures to disk.
 
@@ -91,12 +111,12 @@ class IndexManager:
   >>> im.insertTuple(schema.name, e1Data, e1Id)
 
   # Look up that tuple in both indexes
-  >>> idx1Key = schema.projectBinary(e1Data, keySchema)
+  >>> idx1Key = schema.projectKey(e1Data, keySchema)
   >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
         for tId in im.lookupByIndex(indexId1, idx1Key)]
   [(1, 1000)]
 
-  >>> idx2Key = schema.projectBinary(e1Data, ageSchema)
+  >>> idx2Key = schema.projectKey(e1Data, ageSchema)
   >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
         for tId in im.lookupByIndex(indexId2, idx2Key)]
   [(1, 1000)]
@@ -108,22 +128,22 @@ class IndexManager:
   >>> im.updateTuple(schema.name, e1Data, e1NewDataNewKey, e1Id)
 
   # Look up the old tuple in both indexes
-  >>> idx1Key = schema.projectBinary(e1Data, keySchema)
+  >>> idx1Key = schema.projectKey(e1Data, keySchema)
   >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
         for tId in im.lookupByIndex(indexId1, idx1Key)]
   [(1, 1000)]
 
-  >>> idx2Key = schema.projectBinary(e1Data, ageSchema)
+  >>> idx2Key = schema.projectKey(e1Data, ageSchema)
   >>> list(im.lookupByIndex(indexId2, idx2Key))
   []
 
   # Look up the new tuple in both indexes
-  >>> idx1Key = schema.projectBinary(e1NewDataNewKey, keySchema)
+  >>> idx1Key = schema.projectKey(e1NewDataNewKey, keySchema)
   >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
         for tId in im.lookupByIndex(indexId1, idx1Key)]
   [(1, 1000)]
 
-  >>> idx2Key = schema.projectBinary(e1NewDataNewKey, ageSchema)
+  >>> idx2Key = schema.projectKey(e1NewDataNewKey, ageSchema)
   >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
         for tId in im.lookupByIndex(indexId2, idx2Key)]
   [(1, 1000)]
@@ -132,11 +152,11 @@ class IndexManager:
   >>> im.deleteTuple(schema.name, e1NewDataNewKey, e1Id)
 
   # Ensure that the lookup returns no tuples.
-  >>> idx1Key = schema.projectBinary(e1NewDataNewKey, keySchema)
+  >>> idx1Key = schema.projectKey(e1NewDataNewKey, keySchema)
   >>> list(im.lookupByIndex(indexId1, idx1Key))
   []
 
-  >>> idx2Key = schema.projectBinary(e1NewDataNewKey, ageSchema)
+  >>> idx2Key = schema.projectKey(e1NewDataNewKey, ageSchema)
   >>> list(im.lookupByIndex(indexId2, idx2Key))
   []
 
@@ -154,12 +174,110 @@ class IndexManager:
   ...
 
   # Scan by both indexes, ensuring they are sorted on their search key.
-  >>> [keySchema.unpack(k).id for (k,_) in im.scanByIndex(indexId1)] # doctest:+ELLIPSIS
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByIndex(indexId1)] # doctest:+ELLIPSIS
   [0, 1, 2, ..., 9]
 
-  >>> [ageSchema.unpack(k).age for (k,_) in im.scanByIndex(indexId2)] # doctest:+ELLIPSIS
+  >>> [ageSchema.unpackKey(k).age for (k,_) in im.scanByIndex(indexId2)] # doctest:+ELLIPSIS
   [20, 22, 24, ..., 38]
 
+  # Range scans, in key order.
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.lookupRange(indexId1, \
+        keySchema.packKey(keySchema.instantiate(3)), keySchema.packKey(keySchema.instantiate(6)))]
+  [3, 4, 5, 6]
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.lookupRange(indexId1, \
+        keySchema.packKey(keySchema.instantiate(3)), keySchema.packKey(keySchema.instantiate(6)), \
+        lowInclusive=False, highInclusive=False)]
+  [4, 5]
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.lookupRange(indexId1, \
+        highKey=keySchema.packKey(keySchema.instantiate(2)))]
+  [0, 1, 2]
+
+  # Scans read the index cursor in chunks.
+  >>> IndexManager.cursorChunkSize = 3
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByIndex(indexId1)] # doctest:+ELLIPSIS
+  [0, 1, 2, ..., 9]
+  >>> IndexManager.cursorChunkSize = 1024
+
+  # Secondary indexes support duplicate keys.
+  >>> e2Id = TupleId(pageId, 11)
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(11, 20, 1000.0)), e2Id)
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, ageSchema.packKey(ageSchema.instantiate(20)))]
+  [0, 11]
+
+  # Negative keys precede positive ones.
+  >>> e3Id = TupleId(pageId, 12)
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(-5, 18, 1000.0)), e3Id)
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByIndex(indexId1)] # doctest:+ELLIPSIS
+  [-5, 0, 1, 2, ..., 9, 11]
+
+  # Migrate an index using the legacy native key encoding.
+  >>> legacyId = im.createIndex('legacy', schema, keySchema, True)
+  >>> for (tup, tupId) in testTuples:
+  ...    im.getIndex(legacyId).put(schema.projectBinary(tup, keySchema), tupId.pack())
+  ...
+  >>> im.indexOptions[legacyId] = {'keyEncoding': 0, 'duplicates': False}
+  >>> im.migrateIndexes()
+  >>> im.indexOptions[legacyId]['keyEncoding'] == IndexManager.keyEncoding
+  True
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.scanByIndex(legacyId)] # doctest:+ELLIPSIS
+  [0, 1, 2, ..., 9]
+  >>> im.removeIndex('legacy', legacyId)
+
+
+  # Deferred index maintenance, applying changes in key order before lookups.
+  >>> im.beginBatch()
+  >>> for i in reversed(range(20, 25)):
+  ...    im.insertTuple(schema.name, schema.pack(schema.instantiate(i, 2*i+20, 1000.0)), TupleId(pageId, i))
+  ...
+  >>> im.deleteTuple(schema.name, schema.pack(schema.instantiate(24, 68, 1000.0)), TupleId(pageId, 24))
+  >>> len(im.batch)
+  8
+
+  # Duplicate primary keys are rejected on insertion, before the batch is applied.
+  >>> im.insertTuple(schema.name, schema.pack(schema.instantiate(22, 30, 1000.0)), TupleId(pageId, 25))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid insertion of a duplicate key into a unique index
+
+  >>> len(im.batch)
+  8
+
+  >>> [keySchema.unpackKey(k).id for (k,_) in im.lookupRange(indexId1, \
+        keySchema.packKey(keySchema.instantiate(20)))]
+  [20, 21, 22, 23]
+  >>> im.endBatch()
+
+  # Covering indexes return included column values from the index values.
+  >>> deptSchema  = DBSchema('department', [('did', 'int'), ('floor', 'int'), ('budget', 'double')])
+  >>> floorSchema = DBSchema('departmentFloor', [('floor', 'int')])
+  >>> didSchema   = DBSchema('departmentId', [('did', 'int')])
+  >>> indexId3 = im.createIndex(deptSchema.name, deptSchema, floorSchema, False, didSchema)
+  >>> for i in range(6):
+  ...    im.insertTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(i, i % 3, 1000.0*i)), TupleId(pageId, 100+i))
+  ...
+  >>> im.updateTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(4, 1, 4000.0)), \
+        deptSchema.pack(deptSchema.instantiate(7, 1, 4000.0)), TupleId(pageId, 104))
+  >>> floorKey = floorSchema.packKey(floorSchema.instantiate(1))
+  >>> [didSchema.unpack(v).did for (_, _, v) in im.lookupCovering(indexId3, floorKey, floorKey)]
+  [1, 7]
+  >>> im.removeIndex(deptSchema.name, indexId3)
+
+  # Hash indexes answer equality lookups only.
+  >>> indexId4 = im.createIndex(deptSchema.name, deptSchema, didSchema, True, kind="hash")
+  >>> im.indexKind(indexId4)
+  'hash'
+  >>> for i in range(6):
+  ...    im.insertTuple(deptSchema.name, deptSchema.pack(deptSchema.instantiate(i, i % 3, 1000.0*i)), TupleId(pageId, 100+i))
+  ...
+  >>> im.lookupByKey(deptSchema.name, didSchema.packKey(didSchema.instantiate(4))).tupleIndex
+  104
+  >>> list(im.lookupRange(indexId4, didSchema.packKey(didSchema.instantiate(4))))
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid range lookup on a hash index, which supports equality lookups only
+  >>> im.removeIndex(deptSchema.name, indexId4)
 
   # Test index removal
   >>> im.removeIndex(schema.name, indexId1)
@@ -177,6 +295,14 @@ class IndexManager:
   checkpointEncoding = "latin1"
   checkpointFile     = "db.im"
 
+  # The number of index entries read from a BDB cursor at a time by lookups and scans.
+  cursorChunkSize    = 1024
+
+  # The current key encoding version for indexes.
+  # Version 0 indexes use native struct packing (DBSchema.pack) for keys, while
+  # version 1 indexes use an order-preserving encoding (DBSchema.packKey).
+  keyEncoding        = 1
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -184,6 +310,8 @@ class IndexManager:
 
     else:
       self.indexDir   = kwargs.get("indexDir", IndexManager.defaultIndexDir)
+      self.batch      = None
+      self.batchDepth = 0
       checkpointFound = os.path.exists(os.path.join(self.indexDir, IndexManager.checkpointFile))
       restoring       = "restore" in kwargs
 
@@ -194,16 +322,28 @@ class IndexManager:
         self.indexCounter    = kwargs.get("indexCounter", 0)
         self.relationIndexes = kwargs.get("relationIndexes", {}) # rel id -> (relation schema, primary, dict(secondaries))
         self.indexMap        = kwargs.get("indexMap", {})        # index id -> DB object
+        self.indexOptions    = kwargs.get("indexOptions", {})    # index id -> dict of options
 
         self.initializeDB(self.indexDir)
 
         if restoring:
-          # Initialize relationIndexes and indexMap from restore data.
+          # Initialize relationIndexes, indexOptions and indexMap from restore data.
+          # Checkpoints without index options predate order-preserving keys.
           for i in kwargs["restore"][0]:
             self.relationIndexes[i[0]] = (i[1][0], i[1][1], dict(i[1][2]))
 
+          restoredOptions = kwargs["restore"][2] if len(kwargs["restore"]) > 2 else []
+          for i in restoredOptions:
+            self.indexOptions[i[0]] = i[1]
+
           for i in kwargs["restore"][1]:
-            self.indexMap[i[0]] = self.openIndexDB(i[1])
+            if i[0] not in self.indexOptions:
+              self.indexOptions[i[0]] = {"keyEncoding": 0, "duplicates": False}
+            filename = i[1][0] if isinstance(i[1], list) else i[1]
+            self.indexMap[i[0]] = self.openIndexDB(filename, self.indexOptions[i[0]]["duplicates"], \
+                                                   self.indexOptions[i[0]].get("kind", "btree") == "hash")
+
+          self.migrateIndexes()
 
       else:
         self.restore()
@@ -213,10 +353,14 @@ class IndexManager:
     self.indexCounter    = other.indexCounter
     self.relationIndexes = other.relationIndexes
     self.indexMap        = other.indexMap
+    self.indexOptions    = other.indexOptions
     self.env             = other.env
+    self.batch           = other.batch
+    self.batchDepth      = other.batchDepth
 
   # Close all open indexes.
   def close(self):
+    self.flushBatch()
     for idxId in self.indexMap:
       self.closeIndexDB(self.indexMap[idxId])
 
@@ -242,16 +386,20 @@ class IndexManager:
     envFlags = db.DB_CREATE | db.DB_INIT_MPOOL
     self.env.open(dbDir, envFlags)
 
-  # TODO: set duplicate flags for secondary indexes as needed.
-  def createIndexDB(self, filename):
+  # Secondary indexes allow duplicate keys. Hash indexes use a BDB hash database.
+  def createIndexDB(self, filename, duplicates=False, hashed=False):
     indexDb = db.DB(dbEnv=self.env)
+    if duplicates:
+      indexDb.set_flags(db.DB_DUP)
     dbFlags = db.DB_CREATE | db.DB_TRUNCATE
-    indexDb.open(filename, db.DB_BTREE, dbFlags)
+    indexDb.open(filename, db.DB_HASH if hashed else db.DB_BTREE, dbFlags)
     return indexDb
 
-  def openIndexDB(self, filename):
+  def openIndexDB(self, filename, duplicates=False, hashed=False):
     indexDb = db.DB(dbEnv=self.env)
-    indexDb.open(filename, db.DB_BTREE)
+    if duplicates:
+      indexDb.set_flags(db.DB_DUP)
+    indexDb.open(filename, db.DB_HASH if hashed else db.DB_BTREE)
     return indexDb
 
   def closeIndexDB(self, indexDb):
@@ -315,15 +463,30 @@ class IndexManager:
   # If the index is indicated to be a primary index, the values are tuple identifiers,
   # while for secondary indexes, the values are sets of tuple identifiers.
   # This method should ensure that no relation has two primary indexes.
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  # An optional include schema adds non-key columns to the index values.
+  # The index kind is either "btree" or "hash", while bitmap indexes are only
+  # supported by the native index manager (see BTreeIndexManager).
+  def createIndex(self, relId, relSchema, keySchema, primary, includeSchema=None, kind="btree"):
     # Check if this is a duplicate index and abort.
     errorMsg = self.checkDuplicateIndex(relId, keySchema, primary)
     if errorMsg:
       raise ValueError(errorMsg)
 
+    if kind == "bitmap":
+      raise ValueError("Invalid bitmap index, not supported by BerkeleyDB indexes")
+
+    if kind not in ["btree", "hash"]:
+      raise ValueError("Invalid index kind: " + str(kind))
+
+    if includeSchema is not None and set(includeSchema.fields) & set(keySchema.fields):
+      raise ValueError("Invalid index include schema, overlapping with the index key")
+
     indexId, indexFile = self.generateIndexFileName(relId)
-    indexDb = self.createIndexDB(indexFile)
+    indexDb = self.createIndexDB(indexFile, not primary, kind == "hash")
     self.indexMap[indexId] = indexDb
+    self.indexOptions[indexId] = {"keyEncoding": IndexManager.keyEncoding, "duplicates": not primary, "kind": kind}
+    if includeSchema is not None:
+      self.indexOptions[indexId]["include"] = includeSchema
 
     # Add the new index to the relationFiles data structure.
     if primary:
@@ -342,6 +505,7 @@ class IndexManager:
 
 
   # Adds a pre-existing BDB index to the database.
+  # The index must use the current key encoding.
   def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
     if indexId not in self.indexMap:
       # Check if this is a duplicate index and abort.
@@ -351,6 +515,7 @@ class IndexManager:
 
     self.indexCounter = max(self.indexCounter, indexId+1)
     self.indexMap[indexId] = indexDb
+    self.indexOptions[indexId] = {"keyEncoding": IndexManager.keyEncoding, "duplicates": not primary}
 
     # Add the new index to the relationFiles data structure.
     if primary:
@@ -386,6 +551,10 @@ class IndexManager:
       if self.relationIndexes[relId][1] is None and not self.relationIndexes[relId][2]:
         del self.relationIndexes[relId]
 
+    self.indexOptions.pop(indexId, None)
+    if self.batch is not None:
+      self.batch.discard(indexId)
+
     if indexId in self.indexMap:
       indexDb = self.indexMap.pop(indexId, None)
       if indexDb and detach:
@@ -402,53 +571,166 @@ class IndexManager:
     if indexes:
       return next((x[2] for x in indexes if keySchema.match(x[0])), None)
 
+  # Rebuilds any indexes using an outdated key encoding, re-encoding their keys
+  # into new index files while streaming over the existing index entries.
+  def migrateIndexes(self):
+    migrated = False
+    for relId in list(self.relationIndexes.keys()):
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        options = self.indexOptions.get(indexId, {})
+        if indexId in self.indexMap and options.get("keyEncoding", 0) < IndexManager.keyEncoding:
+          self.migrateIndex(relId, keySchema, primary, indexId)
+          migrated = True
+
+    if migrated:
+      self.checkpoint()
+
+  def migrateIndex(self, relId, keySchema, primary, indexId):
+    oldDb = self.indexMap[indexId]
+    _, indexFile = self.generateIndexFileName(relId)
+    newDb = self.createIndexDB(indexFile, not primary, self.indexKind(indexId) == "hash")
+
+    crsr  = oldDb.cursor()
+    entry = crsr.first()
+    while entry:
+      newDb.put(keySchema.packKey(keySchema.unpack(entry[0])), entry[1])
+      entry = crsr.next()
+    crsr.close()
+
+    self.removeIndexDB(oldDb)
+    self.indexMap[indexId] = newDb
+    self.indexOptions[indexId].update({"keyEncoding": IndexManager.keyEncoding, "duplicates": not primary})
+
+  # Returns the include schema of a covering index, or None for other indexes.
+  def indexIncludes(self, indexId):
+    return self.indexOptions.get(indexId, {}).get("include", None)
+
+  # Returns the kind of an index, i.e., "btree" or "hash".
+  def indexKind(self, indexId):
+    if indexId in self.indexMap:
+      return self.indexOptions.get(indexId, {}).get("kind", "btree")
+
+  # Returns the packed included column values of a tuple for the given index.
+  def includedValues(self, schema, indexId, tupleData):
+    includeSchema = self.indexIncludes(indexId)
+    return schema.projectBinary(tupleData, includeSchema) if includeSchema else b''
+
   # Auxiliary index helpers.
 
   def hasPrimaryIndex(self, relId):
     return self.hasIndexes(relId) and self.relationIndexes[relId][1] is not None
 
   def getPrimaryIndex(self, relId):
-    if self.hasIndexes(relId):
+    if self.hasPrimaryIndex(relId):
       _, primary, _ = self.relationIndexes[relId]
-      return self.getIndex(primary[0])
+      return self.getIndex(primary[1])
+
+
+  # Deferred index maintenance.
+
+  # Starts deferring index changes into a batch. Batches may be nested, with
+  # changes applied when the outermost batch ends.
+  def beginBatch(self, batchSize=None):
+    if self.batch is None:
+      self.batch = IndexBatch(batchSize)
+    self.batchDepth += 1
+
+  def endBatch(self):
+    self.batchDepth = max(0, self.batchDepth - 1)
+    if self.batchDepth == 0:
+      self.flushBatch()
+      self.batch = None
+
+  # Applies all buffered index changes, in key order for each index.
+  def flushBatch(self):
+    if self.batch:
+      for (indexId, deletes, inserts) in self.batch.changes():
+        indexDb = self.getIndex(indexId)
+        if indexDb is not None:
+          duplicates = self.indexOptions[indexId]["duplicates"]
+          for (key, tupleId, included) in deletes:
+            self.deleteIndexEntry(indexDb, key, tupleId, not duplicates, included)
+          for (key, tupleId, included) in inserts:
+            self.putIndexEntry(indexDb, key, tupleId, not duplicates, included)
+
+  # BDB entry operations. Primary indexes do not allow overwriting keys, while
+  # secondary index deletions remove only the entry matching the given tuple id.
+  # Index values are packed tuple ids, followed by any included column values.
+  def putIndexEntry(self, indexDb, key, tupleId, primary, included=b''):
+    putFlags = db.DB_NOOVERWRITE if primary else 0
+    indexDb.put(key, tupleId.pack() + included, flags=putFlags)
+
+  def deleteIndexEntry(self, indexDb, key, tupleId, primary, included=b''):
+    if primary:
+      indexDb.delete(key)
+    else:
+      crsr = indexDb.cursor()
+      found = crsr.get_both(key, tupleId.pack() + included)
+      if found:
+        crsr.delete()
+      crsr.close()
+
+  # Checks that a key is not already present in a primary index, accounting for the
+  # current batch, such that duplicates raise a ValueError before any index is changed
+  # rather than a BDB error from the DB_NOOVERWRITE put when the batch is applied.
+  def checkUniqueKey(self, indexId, key):
+    indexDb = self.getIndex(indexId)
+    if indexDb is not None and not self.indexOptions[indexId]["duplicates"]:
+      present = 1 if indexDb.get(key) is not None else 0
+      pending = self.batch.keyChange(indexId, key) if self.batch is not None else 0
+      if present + pending > 0:
+        raise ValueError("Invalid insertion of a duplicate key into a unique index")
+
+  # Adds an index entry, or buffers it in the current batch.
+  def insertEntry(self, indexId, primary, key, tupleId, included=b''):
+    if self.batch is not None:
+      self.batch.insert(indexId, key, tupleId, included)
+    else:
+      indexDb = self.getIndex(indexId)
+      if indexDb is not None:
+        self.putIndexEntry(indexDb, key, tupleId, primary, included)
+
+  # Removes an index entry, or buffers its removal in the current batch.
+  def deleteEntry(self, indexId, primary, key, tupleId, included=b''):
+    if self.batch is not None:
+      self.batch.delete(indexId, key, tupleId, included)
+    else:
+      indexDb = self.getIndex(indexId)
+      if indexDb is not None:
+        self.deleteIndexEntry(indexDb, key, tupleId, primary, included)
+
+  # Applies the current batch if it is full.
+  def checkBatch(self):
+    if self.batch is not None and self.batch.isFull():
+      self.flushBatch()
 
 
   # Index access methods.
 
   # Updates all indexes on the relation to add the new tuple.
   # The key for each index should be extracted from the full tuple given in tupleData.
+  # Primary indexes raise a ValueError on duplicate keys, before any index is changed.
   def insertTuple(self, relId, tupleData, tupleId):
     if self.hasIndexes(relId):
       schema, _, _ = self.relationIndexes[relId]
-      indexes      = self.indexes(relId)
-      if indexes:
-        for (keySchema, primary, indexId) in indexes:
-          indexDb  = self.getIndex(indexId)
-          if indexDb is not None:
-            indexKey = schema.projectBinary(tupleData, keySchema)
-            putFlags = db.DB_NOOVERWRITE if primary else 0
-            indexDb.put(indexKey, tupleId.pack(), flags=putFlags)
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        if primary:
+          self.checkUniqueKey(indexId, schema.projectKey(tupleData, keySchema))
+
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.insertEntry(indexId, primary, schema.projectKey(tupleData, keySchema), tupleId, \
+                         self.includedValues(schema, indexId, tupleData))
+      self.checkBatch()
 
   # Updates all indexes on the relation to remove the given tuple.
   # The key for each index should be extracted from the full tuple given in tupleData.
   def deleteTuple(self, relId, tupleData, tupleId):
     if self.hasIndexes(relId):
       schema, _, _ = self.relationIndexes[relId]
-      indexes      = self.indexes(relId)
-      if indexes:
-        for (keySchema, primary, indexId) in indexes:
-          indexDb  = self.getIndex(indexId)
-          if indexDb is not None:
-            indexKey = schema.projectBinary(tupleData, keySchema)
-            if primary:
-              indexDb.delete(indexKey)
-            else:
-              # Delete only the tuple matching the given tuple id.
-              crsr = indexDb.cursor()
-              found = crsr.get_both(indexKey, tupleId.pack())
-              if found:
-                crsr.delete()
-              crsr.close()
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.deleteEntry(indexId, primary, schema.projectKey(tupleData, keySchema), tupleId, \
+                         self.includedValues(schema, indexId, tupleData))
+      self.checkBatch()
 
   # Updates all indexes on the relation to refresh the given tuple.
   # The old and new keys for each index should be extracted from the full tuples.
@@ -463,56 +745,121 @@ class IndexManager:
         for (keySchema, primary, indexId) in indexes:
           indexDb = self.getIndex(indexId)
           if indexDb is not None:
-            oldKey  = schema.projectBinary(oldData, keySchema)
-            newKey  = schema.projectBinary(newData, keySchema)
-
-            # If the keys are the same, we do not need to perform any operations.
-            # That is, we assume the tuple id argument is the same as the existing
-            # entry (since this is a tuple id), and we do not check this.
-            if oldKey == newKey:
+            oldKey      = schema.projectKey(oldData, keySchema)
+            newKey      = schema.projectKey(newData, keySchema)
+            oldIncluded = self.includedValues(schema, indexId, oldData)
+            newIncluded = self.includedValues(schema, indexId, newData)
+
+            # If the keys and included values are the same, we do not need to perform
+            # any operations. That is, we assume the tuple id argument is the same as the
+            # existing entry (since this is a tuple id), and we do not check this.
+            if oldKey == newKey and oldIncluded == newIncluded:
               pass
 
-            # Insert a new index entry if the key has changed.
+            # Buffer the change when deferring index maintenance.
+            elif self.batch is not None:
+              self.batch.delete(indexId, oldKey, tupleId, oldIncluded)
+              self.batch.insert(indexId, newKey, tupleId, newIncluded)
+
+            # Insert a new index entry if the key or included values have changed.
             else:
               if primary:
                 indexDb.delete(oldKey)
-                indexDb.put(newKey, tupleId.pack(), flags=db.DB_NOOVERWRITE)
+                indexDb.put(newKey, tupleId.pack() + newIncluded, flags=db.DB_NOOVERWRITE)
               else:
                 # Update only the tuple matching the given tuple id.
                 crsr = indexDb.cursor()
-                found = crsr.get_both(oldKey, tupleId.pack())
+                found = crsr.get_both(oldKey, tupleId.pack() + oldIncluded)
                 if found:
                   crsr.delete()
-                  crsr.put(newKey, tupleId.pack(), flags=db.DB_KEYLAST)
+                  crsr.put(newKey, tupleId.pack() + newIncluded, flags=db.DB_KEYLAST)
                     # TODO: flags based on whether the secondary index is unique?
                 crsr.close()
+      self.checkBatch()
 
 
   # Lookup methods.
+  # These apply any buffered index changes before accessing the index.
+
+  # Reads the entries of an index in key order with a BDB cursor, starting from the first
+  # entry at or after the given key (or the first index entry), and ending before the first
+  # entry whose key does not satisfy the 'inRange' predicate. With the 'exact' flag, the
+  # cursor starts at the given key itself, as required for equality lookups on hash indexes.
+  # This is a generator over (key, tuple id, included values) triples, which reads entries
+  # from the cursor in chunks of at most cursorChunkSize entries, ensuring constant memory usage.
+  def cursorEntries(self, indexDb, startKey, inRange, exact=False):
+    crsr = indexDb.cursor()
+    try:
+      if startKey is None:
+        entry = crsr.first()
+      else:
+        entry = crsr.set(startKey) if exact else crsr.set_range(startKey)
+      while entry:
+        chunk = []
+        while entry and len(chunk) < IndexManager.cursorChunkSize:
+          if not inRange(entry[0]):
+            entry = None
+          else:
+            chunk.append(entry)
+            entry = crsr.next()
+
+        for (key, value) in chunk:
+          yield (key, TupleId.unpack(value), value[TupleId.size:])
+    finally:
+      crsr.close()
 
   # Perform an index lookup for the given key.
-  # This returns an iterator over tuple ids.
-  # TODO: this materializes all tuple ids.
-  # TODO: Use an iterator abstraction to avoid this.
+  # This returns an iterator over tuple ids, streaming entries from the index.
   def lookupByIndex(self, indexId, keyData):
-    result = []
+    self.flushBatch()
     indexDb = self.getIndex(indexId)
     if indexDb is not None:
-      crsr = indexDb.cursor()
+      return (tupleId for (_, tupleId, _) in self.cursorEntries(indexDb, keyData, lambda k: k == keyData, True))
+
+  # Perform an index range lookup between the given low and high keys, which are
+  # optional (i.e., None) for open-ended ranges.
+  # This returns an ordered iterator of (key, tuple id) pairs, streaming entries from the index.
+  # Keys must use the order-preserving representation of DBSchema.packKey.
+  # Hash indexes only support single-key ranges, and unordered full scans without any keys.
+  def lookupRange(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    entries = self.lookupCovering(indexId, lowKey, highKey, lowInclusive, highInclusive)
+    if entries is not None:
+      return ((key, tupleId) for (key, tupleId, _) in entries)
+
+  # Perform a covering index range lookup, as with lookupRange.
+  # This returns an ordered iterator of (key, tuple id, included values) triples, where
+  # included values are packed with the index's include schema.
+  def lookupCovering(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    self.flushBatch()
+    indexDb = self.getIndex(indexId)
+    if indexDb is not None and self.indexKind(indexId) == "hash" and not(lowKey is None and highKey is None):
+      if lowKey != highKey or not(lowInclusive and highInclusive):
+        raise ValueError("Invalid range lookup on a hash index, which supports equality lookups only")
+      return self.cursorEntries(indexDb, lowKey, lambda k: k == lowKey, True)
+
+    elif indexDb is not None:
+      if highKey is None:
+        inRange = lambda k: True
+      elif highInclusive:
+        inRange = lambda k: k <= highKey
+      else:
+        inRange = lambda k: k < highKey
 
-      data = crsr.set(keyData)
-      while data and data[0] == keyData:
-        result.append(TupleId.unpack(data[1]))
-        data = crsr.next()
+      entries = self.cursorEntries(indexDb, lowKey, inRange)
+      if lowKey is not None and not lowInclusive:
+        entries = itertools.dropwhile(lambda entry: entry[0] == lowKey, entries)
+      return entries
 
-      crsr.close()
-      return iter(result)
+  # BerkeleyDB indexes do not provide bitmap lookups.
+  def lookupBitmap(self, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True, negate=False):
+    return None
 
   # Retrieve a tuple based on its key.
   # This method returns None if the relation does not have a primary index,
   # or if the key does not exist in the index.
   # Otherwise it returns a single tuple identifier.
   def lookupByKey(self, relId, keyData):
+    self.flushBatch()
     indexDb = self.getPrimaryIndex(relId)
     if indexDb:
       return TupleId.unpack(indexDb.get(keyData))
@@ -523,15 +870,14 @@ class IndexManager:
 
   # Scan over a specific index.
   def scanByIndex(self, indexId):
-    indexDb = self.getIndex(indexId)
-    if indexDb is not None:
-      return iter(indexDb.items())
+    return self.lookupRange(indexId)
 
   # Scan over the primary index for a relation.
   def scanByKey(self, relId):
+    self.flushBatch()
     indexDb = self.getPrimaryIndex(relId)
     if indexDb is not None:
-      return iter(indexDb.items())
+      return ((key, tupleId) for (key, tupleId, _) in self.cursorEntries(indexDb, None, lambda k: True))
 
 
   # Index manager serialization
@@ -543,13 +889,17 @@ class IndexManager:
       # Convert secondaries dictionary to a list since it has an object as a key type (incompatible w/ JSON)
       pRelIndexes = list(map(lambda x: (x[0], (x[1][0], x[1][1], list(x[1][2].items()))), self.relationIndexes.items()))
       pIndexMap   = list(map(lambda entry: (entry[0], entry[1].get_dbname()), self.indexMap.items()))
-      return json.dumps((self.indexDir, self.indexCounter, pRelIndexes, pIndexMap), cls=DBSchemaEncoder)
+      pIndexOpts  = list(self.indexOptions.items())
+      return json.dumps((self.indexDir, self.indexCounter, pRelIndexes, pIndexMap, pIndexOpts), cls=DBSchemaEncoder)
 
   @classmethod
   def unpack(cls, buffer):
     args = json.loads(buffer, cls=DBSchemaDecoder)
     if len(args) == 4:
+      # Legacy checkpoint, without index options.
       return cls(indexDir=args[0], indexCounter=args[1], restore=(args[2], args[3]))
+    elif len(args) == 5:
+      return cls(indexDir=args[0], indexCounter=args[1], restore=(args[2], args[3], args[4]))
 
 
 if __name__ == "__main__":
@@ -520,11 +520,18 @@ class SlottedPageTupleIterator(PageTupleIterator):
     return self
 
   # Tuple iterator
+  # We skip over whole bytes of the slot bitvector without any used slots.
   def __next__(self):
     (start, end) = (None, None)
-    while (start is None or end is None) and self.iterTupleIdx < self.page.header.maxTuples():
+    header    = self.page.header
+    maxTuples = header.maxTuples()
+    while (start is None or end is None) and self.iterTupleIdx < maxTuples:
+      if self.iterTupleIdx % 8 == 0 and not header.slots[header.slotBufferByteOffset(self.iterTupleIdx)]:
+        self.iterTupleIdx += 8
+        continue
+
       tId = TupleId(self.page.pageId, self.iterTupleIdx)
-      (start, end) = self.page.header.tupleRange(tId)
+      (start, end) = header.tupleRange(tId)
       self.iterTupleIdx += 1
 
     if start and end:
@@ -1,3 +1,4 @@
+from Catalog.Identifiers import TupleId
 from Catalog.Schema      import DBSchema
 from Storage.FileManager import FileManager
 from Storage.BufferPool  import BufferPool
@@ -28,6 +29,19 @@ class StorageEngine:
   >>> [schema.unpack(tup).id for tup in storage.tuples(schema.name)] == list(range(20))
   True
 
+  # Test bitmap heap fetch, which returns tuples in page order.
+  >>> tupleIds = [storage.insertTuple(schema.name, schema.pack(schema.instantiate(i, 20))) for i in range(20, 25)]
+  >>> [schema.unpack(tup).id for (_, tup) in storage.fetchTuples(reversed(tupleIds + tupleIds))]
+  [20, 21, 22, 23, 24]
+
+  # Bulk insertion, with deferred index maintenance.
+  >>> ageSchema = DBSchema('employeeAge', [('age', 'int')])
+  >>> indexId   = storage.createIndex(schema.name, schema, ageSchema, False)
+  >>> tupleIds  = storage.insertTuples(schema.name, [schema.pack(schema.instantiate(i, 30)) for i in range(25, 30)])
+  >>> ageKey    = ageSchema.packKey(ageSchema.instantiate(30))
+  >>> [tupleId in tupleIds for tupleId in storage.lookupByIndex(schema.name, indexId, ageKey)]
+  [False, True, True, True, True, True]
+
   """
 
   def __init__(self, **kwargs):
@@ -37,7 +51,7 @@ class StorageEngine:
 
     else:
       bpArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "poolSize"]}
-      fmArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "dataDir", "indexDir"]}
+      fmArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "dataDir", "indexDir", "indexManagerClass"]}
       self.bufferPool = BufferPool(**bpArgs)
       self.fileMgr    = FileManager(bufferPool=self.bufferPool, **fmArgs)
 
@@ -88,9 +102,17 @@ class StorageEngine:
     if self.fileMgr:
       return self.fileMgr.hasIndex(relId, keySchema)
 
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  def indexes(self, relId):
+    if self.fileMgr:
+      return self.fileMgr.indexes(relId)
+
+  def matchIndex(self, relId, keySchema):
     if self.fileMgr:
-      return self.fileMgr.createIndex(relId, relSchema, keySchema, primary)
+      return self.fileMgr.matchIndex(relId, keySchema)
+
+  def createIndex(self, relId, relSchema, keySchema, primary, includeSchema=None, kind="btree"):
+    if self.fileMgr:
+      return self.fileMgr.createIndex(relId, relSchema, keySchema, primary, includeSchema, kind)
 
   def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
     if self.fileMgr:
@@ -104,6 +126,44 @@ class StorageEngine:
     if self.fileMgr:
       return self.fileMgr.getIndex(indexId)
 
+  def indexIncludes(self, indexId):
+    if self.fileMgr:
+      return self.fileMgr.indexIncludes(indexId)
+
+  def indexKind(self, indexId):
+    if self.fileMgr:
+      return self.fileMgr.indexKind(indexId)
+
+  # Deferred index maintenance, for bulk modifications.
+  def beginBatch(self, batchSize=None):
+    if self.fileMgr:
+      self.fileMgr.beginBatch(batchSize)
+
+  def endBatch(self):
+    if self.fileMgr:
+      self.fileMgr.endBatch()
+
+  # Index lookups and scans, returning streaming iterators over index entries.
+  def lookupByIndex(self, relId, indexId, keyData):
+    if self.fileMgr:
+      return self.fileMgr.lookupByIndex(relId, indexId, keyData)
+
+  def lookupRange(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if self.fileMgr:
+      return self.fileMgr.lookupRange(relId, indexId, lowKey, highKey, lowInclusive, highInclusive)
+
+  def lookupCovering(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True):
+    if self.fileMgr:
+      return self.fileMgr.lookupCovering(relId, indexId, lowKey, highKey, lowInclusive, highInclusive)
+
+  def lookupBitmap(self, relId, indexId, lowKey=None, highKey=None, lowInclusive=True, highInclusive=True, negate=False):
+    if self.fileMgr:
+      return self.fileMgr.lookupBitmap(relId, indexId, lowKey, highKey, lowInclusive, highInclusive, negate)
+
+  def scanByIndex(self, relId, indexId):
+    if self.fileMgr:
+      return self.fileMgr.scanByIndex(relId, indexId)
+
 
   # Data manipulation operations
 
@@ -114,6 +174,13 @@ class StorageEngine:
     else:
       raise ValueError("Could not insert tuple, no file manager found")
 
+  # Returns a list of tuple ids for the newly inserted data, with batched index maintenance.
+  def insertTuples(self, relId, tuplesData):
+    if self.fileMgr:
+      return self.fileMgr.insertTuples(relId, tuplesData)
+    else:
+      raise ValueError("Could not insert tuples, no file manager found")
+
   def deleteTuple(self, relId, tupleId):
     if self.fileMgr:
       self.fileMgr.deleteTuple(relId, tupleId)
@@ -126,6 +193,32 @@ class StorageEngine:
     else:
       raise ValueError("Could not update tuple, no file manager found")
 
+  # Bitmap heap fetch of the given tuple ids, e.g., as collected from index lookups.
+  # This sorts the tuple ids by page, and visits each page once to extract all of its
+  # matching tuples, yielding (tuple id, tuple data) pairs in page order.
+  # Duplicate tuple ids are fetched once.
+  def fetchTuples(self, tupleIds):
+    pageTuples = {}
+    for tupleId in tupleIds:
+      pageTuples.setdefault(tupleId.pageId, set()).add(tupleId.tupleIndex)
+
+    for pageId in sorted(pageTuples, key=lambda p: (p.fileId.fileIndex, p.pageIndex)):
+      # Copy out the page's tuples while it is pinned, since the caller may
+      # evict the page before consuming them.
+      page   = self.bufferPool.getPage(pageId, pinned=True)
+      tuples = []
+      try:
+        for tupleIndex in sorted(pageTuples[pageId]):
+          tupleId   = TupleId(pageId, tupleIndex)
+          tupleData = page.getTuple(tupleId)
+          if tupleData:
+            tuples.append((tupleId, bytes(tupleData)))
+      finally:
+        self.bufferPool.unpinPage(pageId)
+
+      for entry in tuples:
+        yield entry
+
   # Tuple-based table scan
   def tuples(self, relId):
     if self.fileMgr:
@@ -32,12 +32,167 @@ class ExpressionInfo(ast.NodeVisitor):
     result = []
     if self.components:
       for c in self.components:
-        s = io.StringIO()
-        unparse.Unparser(c,s)
-        result.append(s.getvalue().strip())
+        result.append(ExpressionInfo.unparseNode(c))
     else:
       result = [self.expr]
     return result
 
+  # Splits the expression's conjuncts into equality comparisons between expressions
+  # over the given LHS and RHS attributes, and the remaining residual conjuncts.
+  # Returns a list of (lhs expression, rhs expression) pairs, and a list of residual expressions.
+  def equiJoinComponents(self, lhsAttrs, rhsAttrs):
+    equalities = []
+    residuals  = []
+
+    root = ast.parse(self.expr, mode='eval').body
+    conjuncts = root.values if isinstance(root, ast.BoolOp) and isinstance(root.op, ast.And) else [root]
+
+    for c in conjuncts:
+      pair = None
+      if isinstance(c, ast.Compare) and len(c.ops) == 1 and isinstance(c.ops[0], ast.Eq):
+        (left, right) = (c.left, c.comparators[0])
+        leftAttrs  = ExpressionInfo.nodeAttributes(left)
+        rightAttrs = ExpressionInfo.nodeAttributes(right)
+
+        if leftAttrs and rightAttrs:
+          if leftAttrs <= lhsAttrs and rightAttrs <= rhsAttrs:
+            pair = (left, right)
+          elif leftAttrs <= rhsAttrs and rightAttrs <= lhsAttrs:
+            pair = (right, left)
+
+      if pair:
+        equalities.append(tuple(map(ExpressionInfo.unparseNode, pair)))
+      else:
+        residuals.append(ExpressionInfo.unparseNode(c))
+
+    return (equalities, residuals)
+
+  # Returns the expression with its attribute names replaced as given by a dictionary.
+  def renameAttributes(self, names):
+    if all(names.get(n, n) == n for n in self.names):
+      return self.expr
+
+    root = ast.parse(self.expr.strip(), mode='eval').body
+    for node in ast.walk(root):
+      if isinstance(node, ast.Name) and node.id in names:
+        node.id = names[node.id]
+    return ExpressionInfo.unparseNode(root)
+
+  # Returns the expression with its literal numbers and strings replaced by named query
+  # parameters, adding the literals' values to the given dictionary of parameter values.
+  # Parameters are named by their position in the dictionary, i.e., '_p0', '_p1', etc.
+  def parameterize(self, parameters):
+    class Parameterizer(ast.NodeTransformer):
+      def visit_Constant(self, node):
+        if isinstance(node.value, (int, float, str, bytes)) and not isinstance(node.value, bool):
+          name = "_p" + str(len(parameters))
+          parameters[name] = node.value
+          return ast.copy_location(ast.Name(id=name, ctx=ast.Load()), node)
+        return node
+
+      # Format strings only have constant parts.
+      def visit_JoinedStr(self, node):
+        return node
+
+    root = Parameterizer().visit(ast.parse(self.expr.strip(), mode='eval').body)
+    return ExpressionInfo.unparseNode(root)
+
+  # Returns the expression with the given query parameters replaced by their values.
+  def bindParameters(self, parameters):
+    if not any(n in parameters for n in self.names):
+      return self.expr
+
+    class Binder(ast.NodeTransformer):
+      def visit_Name(self, node):
+        if node.id in parameters:
+          return ast.copy_location(ast.Constant(value=parameters[node.id]), node)
+        return node
+
+    root = Binder().visit(ast.parse(self.expr.strip(), mode='eval').body)
+    return ExpressionInfo.unparseNode(root)
+
+  # Returns the conjunction of a list of expressions, parenthesizing any
+  # expressions with a lower precedence than 'and' (e.g., disjunctions).
+  @staticmethod
+  def conjunction(exprs):
+    def conjunct(expr):
+      root = ast.parse(expr.strip(), mode='eval').body
+      lowerPrecedence = (isinstance(root, ast.BoolOp) and isinstance(root.op, ast.Or)) \
+                          or isinstance(root, (ast.IfExp, ast.Lambda))
+      return "(" + expr.strip() + ")" if lowerPrecedence else expr
+
+    return " and ".join(map(conjunct, exprs))
+
+  # Returns an (attribute, operator, constant) triple if the expression is a single comparison
+  # between one of the given attributes and a literal constant, and None otherwise.
+  # Comparisons are normalized to have the attribute on the LHS, e.g., '5 < a' yields ('a', '>', 5).
+  # Any of the given query parameter names also stand for constants, as QueryParameter instances.
+  def sargableComparison(self, attrs, parameters=()):
+    isAttribute = lambda node: isinstance(node, ast.Name) and node.id in attrs
+
+    root = ast.parse(self.expr.strip(), mode='eval').body
+    if isinstance(root, ast.Compare) and len(root.ops) == 1 \
+        and type(root.ops[0]) in ExpressionInfo.comparisonOps:
+      op = ExpressionInfo.comparisonOps[type(root.ops[0])]
+      (left, right) = (root.left, root.comparators[0])
+
+      if isAttribute(right) and not isAttribute(left):
+        (left, right, op) = (right, left, ExpressionInfo.flippedOps[op])
+
+      if isAttribute(left):
+        if isinstance(right, ast.Name) and right.id in parameters:
+          return (left.id, op, QueryParameter(right.id))
+        try:
+          return (left.id, op, ast.literal_eval(right))
+        except ValueError:
+          pass
+
+    return None
+
+  comparisonOps = { ast.Eq: '==', ast.NotEq: '!=', ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=' }
+  flippedOps    = { '==': '==', '!=': '!=', '<': '>', '<=': '>=', '>': '<', '>=': '<=' }
+
+  # Returns the names referenced in an AST node.
+  @staticmethod
+  def nodeAttributes(node):
+    return set(n.id for n in ast.walk(node) if isinstance(n, ast.Name))
+
+  # Returns source code for an AST node.
+  # We prefer the standard library's unparser where available (Python 3.9+), since
+  # our bundled unparser predates newer AST node types such as ast.Constant.
+  @staticmethod
+  def unparseNode(node):
+    if hasattr(ast, "unparse"):
+      return ast.unparse(node)
+
+    s = io.StringIO()
+    unparse.Unparser(node,s)
+    return s.getvalue().strip()
+
   def isAttribute(self):
     return self.onlyNames
+
+
+# A named query parameter standing in for a constant (see ExpressionInfo.parameterize),
+# e.g., as an index scan key value that is only bound when executing the scan.
+class QueryParameter:
+  def __init__(self, name):
+    self.name = name
+
+  def __eq__(self, other):
+    return isinstance(other, QueryParameter) and self.name == other.name
+
+  def __hash__(self):
+    return hash(self.name)
+
+  def __repr__(self):
+    return self.name
+
+  # Returns a tuple of values, with any query parameters replaced by their values.
+  @staticmethod
+  def bindValues(values, parameters):
+    if values is None:
+      return None
+    if any(isinstance(v, QueryParameter) and v.name not in parameters for v in values):
+      raise ValueError("Unbound query parameter in values " + str(values))
+    return tuple(parameters[v.name] if isinstance(v, QueryParameter) else v for v in values)
@@ -0,0 +1,212 @@
+import ast
+
+from Utils.ExpressionInfo import ExpressionInfo
+
+# Estimates the selectivity of an eval'able predicate from column statistics
+class SelectivityEstimator(ast.NodeVisitor):
+  """
+  A predicate selectivity estimator, walking a predicate's AST.
+
+  The estimator is given a dictionary of column statistics (see Catalog.Statistics),
+  keyed by the attribute names used in predicates. It supports:
+  - comparisons between an attribute and a constant, using the column's most
+    common values and histogram, including chained range comparisons (e.g., '1 < a < 5').
+  - IN and NOT IN lists of constants, as the sum of their equality selectivities.
+  - comparisons between attributes, using distinct value counts for equalities,
+    and the columns' value ranges otherwise.
+  - AND, OR and NOT combinations, assuming independent predicates. Conjunctions
+    of range comparisons on the same attribute are estimated as a single range.
+
+  Any other predicate, or any predicate on attributes without statistics, uses
+  a default selectivity.
+
+  >>> from Catalog.Statistics import ColumnStatistics
+  >>> columns = { 'a': ColumnStatistics.build(list(range(100))), \
+                  'b': ColumnStatistics.build([i % 10 for i in range(100)]) }
+  >>> estimator = SelectivityEstimator(columns)
+
+  >>> [round(estimator.estimate(e), 2) for e in ['a < 25', '25 > a', 'a >= 10 and a < 20', '10 <= a < 20']]
+  [0.25, 0.25, 0.1, 0.1]
+
+  >>> [round(estimator.estimate(e), 2) for e in ['b == 3', 'b != 3', 'b in [1, 2, 3]', 'not (b in (1, 2, 3))']]
+  [0.1, 0.9, 0.3, 0.7]
+
+  >>> [round(estimator.estimate(e), 3) for e in ['a < 50 or b == 3', 'a < 50 and b == 3', 'a == b', 'a > 200']]
+  [0.55, 0.05, 0.01, 0.0]
+
+  >>> [round(estimator.estimate(e), 2) for e in ['c == 3', 'a + 1 < 5', 'True', None]]
+  [0.1, 0.33, 1.0, 1.0]
+  """
+
+  # Selectivities for predicates not covered by column statistics.
+  defaultSelectivity = { "==": 0.1, "!=": 0.9, "in": 0.1, "other": 1.0 / 3 }
+
+  rangeOps = ["<", "<=", ">", ">="]
+
+  def __init__(self, columns):
+    self.columns = columns
+
+  # Returns the estimated fraction of tuples satisfying the given predicate.
+  def estimate(self, expr):
+    if expr is None or not expr.strip():
+      return 1.0
+    return self.bound(self.visit(ast.parse(expr.strip(), mode='eval').body))
+
+  @staticmethod
+  def bound(selectivity):
+    return min(1.0, max(0.0, selectivity))
+
+  # Returns the literal value of an AST node, or None if it is not a constant.
+  @staticmethod
+  def constant(node):
+    try:
+      return (ast.literal_eval(node),)
+    except ValueError:
+      return None
+
+  # Returns an (attribute, operator, constant) triple for a comparison of an attribute
+  # with statistics and a constant, normalizing the attribute to the LHS.
+  def attributeComparison(self, left, op, right):
+    if isinstance(right, ast.Name) and not isinstance(left, ast.Name):
+      (left, right, op) = (right, left, ExpressionInfo.flippedOps.get(op, None))
+
+    if op and isinstance(left, ast.Name) and left.id in self.columns:
+      value = SelectivityEstimator.constant(right)
+      if value is not None:
+        return (left.id, op, value[0])
+    return None
+
+  # Boolean combinations.
+  def visit_BoolOp(self, node):
+    if isinstance(node.op, ast.And):
+      ranges      = {}
+      selectivity = 1.0
+      for value in node.values:
+        comparison = self.rangeComparison(value)
+        if comparison:
+          (attr, op, constant) = comparison
+          ranges.setdefault(attr, []).append((op, constant))
+        else:
+          selectivity *= self.bound(self.visit(value))
+
+      for (attr, bounds) in ranges.items():
+        selectivity *= self.rangeSelectivity(attr, bounds)
+      return selectivity
+
+    else:
+      nonMatching = 1.0
+      for value in node.values:
+        nonMatching *= 1.0 - self.bound(self.visit(value))
+      return 1.0 - nonMatching
+
+  def visit_UnaryOp(self, node):
+    if isinstance(node.op, ast.Not):
+      return 1.0 - self.bound(self.visit(node.operand))
+    return self.generic_visit(node)
+
+  def visit_Constant(self, node):
+    return 1.0 if node.value else 0.0
+
+  def visit_NameConstant(self, node):
+    return 1.0 if node.value else 0.0
+
+  # Comparisons. Chained comparisons (e.g., 'a < b < c') are a conjunction of pairwise comparisons.
+  def visit_Compare(self, node):
+    operands = [node.left] + node.comparators
+    if len(node.ops) > 1:
+      pairs = [ast.Compare(left=l, ops=[op], comparators=[r]) for (l, op, r) in zip(operands, node.ops, operands[1:])]
+      return self.visit(ast.BoolOp(op=ast.And(), values=pairs))
+
+    (left, right) = (node.left, node.comparators[0])
+    op = node.ops[0]
+
+    if isinstance(op, (ast.In, ast.NotIn)):
+      selectivity = self.inSelectivity(left, right)
+      return 1.0 - selectivity if isinstance(op, ast.NotIn) else selectivity
+
+    op = ExpressionInfo.comparisonOps.get(type(op), None)
+    comparison = self.attributeComparison(left, op, right)
+    if comparison:
+      (attr, op, value) = comparison
+      column = self.columns[attr]
+      if op == "==":
+        return column.equalitySelectivity(value)
+      elif op == "!=":
+        return 1.0 - column.equalitySelectivity(value)
+      else:
+        return self.rangeSelectivity(attr, [(op, value)])
+
+    if isinstance(left, ast.Name) and isinstance(right, ast.Name) \
+        and left.id in self.columns and right.id in self.columns:
+      return self.attributesSelectivity(self.columns[left.id], op, self.columns[right.id])
+
+    return self.defaultFor(op)
+
+  # Returns the (attribute, operator, constant) triple for range comparisons, and None otherwise.
+  def rangeComparison(self, node):
+    if isinstance(node, ast.Compare) and len(node.ops) == 1:
+      op = ExpressionInfo.comparisonOps.get(type(node.ops[0]), None)
+      comparison = self.attributeComparison(node.left, op, node.comparators[0])
+      if comparison and comparison[1] in SelectivityEstimator.rangeOps:
+        return comparison
+    return None
+
+  # Returns the selectivity of a conjunction of range comparisons on an attribute, as
+  # given by a list of (operator, constant) pairs, retaining the tightest bounds.
+  def rangeSelectivity(self, attr, bounds):
+    (low, lowInclusive, high, highInclusive) = (None, True, None, True)
+    try:
+      for (op, value) in bounds:
+        if op in [">", ">="] and (low is None or value > low or (value == low and op == ">")):
+          (low, lowInclusive) = (value, op == ">=")
+        elif op in ["<", "<="] and (high is None or value < high or (value == high and op == "<")):
+          (high, highInclusive) = (value, op == "<=")
+    except TypeError:
+      return SelectivityEstimator.defaultSelectivity["other"]
+
+    return self.columns[attr].rangeSelectivity(low, high, lowInclusive, highInclusive)
+
+  # Returns the selectivity of an IN list of constants over an attribute.
+  def inSelectivity(self, left, right):
+    values = SelectivityEstimator.constant(right)
+    if isinstance(left, ast.Name) and left.id in self.columns and values is not None:
+      try:
+        column = self.columns[left.id]
+        return sum(column.equalitySelectivity(v) for v in set(values[0]))
+      except TypeError:
+        pass
+    return SelectivityEstimator.defaultSelectivity["in"]
+
+  # Returns the selectivity of a comparison between two attributes. Equalities assume
+  # the values of the attribute with fewer distinct values all have matches, while
+  # other comparisons are decided by disjoint value ranges where possible.
+  def attributesSelectivity(self, lhs, op, rhs):
+    if op == "==":
+      return lhs.joinSelectivity(rhs)
+    elif op == "!=":
+      return 1.0 - lhs.joinSelectivity(rhs)
+
+    try:
+      if op in ["<", "<="]:
+        (lhs, rhs, op) = (rhs, lhs, ExpressionInfo.flippedOps[op])
+      if op in [">", ">="]:
+        if lhs.minValue > rhs.maxValue or (op == ">=" and lhs.minValue == rhs.maxValue):
+          return 1.0
+        if lhs.maxValue < rhs.minValue or (op == ">" and lhs.maxValue == rhs.minValue):
+          return 0.0
+    except TypeError:
+      pass
+    return self.defaultFor(op)
+
+  @staticmethod
+  def defaultFor(op):
+    return SelectivityEstimator.defaultSelectivity.get(op, SelectivityEstimator.defaultSelectivity["other"])
+
+  # Any other expression, e.g., function calls or arithmetic, uses the default selectivity.
+  def generic_visit(self, node):
+    return SelectivityEstimator.defaultSelectivity["other"]
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -194,15 +194,11 @@ class WorkloadGenerator:
         filePath = os.path.join(datadir, i+".csv")
         if os.path.exists(filePath):
           with open(filePath) as f:
-            self.tupleIds[i] = []
-            for line in f:
-              if random.random() <= scaleFactor:
-                tup = self.schemas[i].instantiate(*(self.parsers[i].parse(line)))
-                tupleId = db.insertTuple(i, self.schemas[i].pack(tup))
-                if tupleId is not None:
-                  self.tupleIds[i].append(tupleId)
-                else:
-                  raise ValueError("Failed to insert tuple")
+            tuples = (self.schemas[i].pack(self.schemas[i].instantiate(*(self.parsers[i].parse(line)))) \
+                        for line in f if random.random() <= scaleFactor)
+            self.tupleIds[i] = db.insertTuples(i, tuples)
+            if any(tupleId is None for tupleId in self.tupleIds[i]):
+              raise ValueError("Failed to insert tuple")
         else:
           raise ValueError("Could not find file: " + filePath)
       else: